@@ -13,9 +13,57 @@ import geopandas as gpd
 import pandas as pd
 
 
+# -------------------------------------------------------
+# Partition the eHydro bathymetry data by HUC once per run
+def build_ehydro_bathy_index(fim_dir, hucs, bathy_gdf, bathy_index_path):
+    """Function for building a HUC8 partitioned copy of the eHydro bathymetry data. Each
+    bathymetry feature is assigned to every HUC whose wbd8_clp boundary it intersects (the same
+    test the per HUC mask read used), sorted by HUC8 and written to GeoParquet so that each HUC
+    task can pull only its own rows with a predicate pushdown read.
+
+        Parameters
+        ----------
+        fim_dir : str
+            Directory path for fim_pipeline output.
+        hucs : list
+            List of HUC-8 strings found in fim_dir.
+        bathy_gdf : geopandas.GeoDataFrame
+            The full eHydro bathymetric adjustment data.
+        bathy_index_path : str
+            Path to the output GeoParquet index.
+
+        Returns
+        ----------
+        hucs_in_index : list
+            HUC-8 strings that have at least one bathymetry feature.
+
+    """
+    wbd8_clp_list = []
+    for huc in hucs:
+        wbd8_clp_file = join(fim_dir, huc, 'wbd8_clp.gpkg')
+        if not os.path.isfile(wbd8_clp_file):
+            continue
+        wbd8_clp = gpd.read_file(wbd8_clp_file, engine="pyogrio", use_arrow=True)
+        wbd8_clp = wbd8_clp[['geometry']].to_crs(bathy_gdf.crs).dissolve()
+        wbd8_clp['HUC8'] = huc
+        wbd8_clp_list.append(wbd8_clp)
+
+    if len(wbd8_clp_list) == 0:
+        bathy_index = bathy_gdf.iloc[0:0].assign(HUC8=pd.Series(dtype=str))
+    else:
+        wbd8_clp_all = pd.concat(wbd8_clp_list, ignore_index=True)
+        bathy_index = gpd.sjoin(bathy_gdf, wbd8_clp_all, how='inner', predicate='intersects')
+        bathy_index = bathy_index.drop(columns='index_right')
+
+    bathy_index = bathy_index.sort_values('HUC8').reset_index(drop=True)
+    bathy_index.to_parquet(bathy_index_path, index=False, write_covering_bbox=True)
+
+    return sorted(bathy_index['HUC8'].unique())
+
+
 # -------------------------------------------------------
 # Adjusting synthetic rating curves using 'USACE eHydro' bathymetry data
-def correct_rating_for_ehydro_bathymetry(fim_dir, huc, bathy_file_ehydro, verbose):
+def correct_rating_for_ehydro_bathymetry(fim_dir, huc, bathy_file_ehydro, verbose, bathy_index_path=None):
     """Function for correcting synthetic rating curves. It will correct each branch's
     SRCs in serial based on the feature_ids in the input eHydro bathy_file.
 
@@ -30,6 +78,9 @@ def correct_rating_for_ehydro_bathymetry(fim_dir, huc, bathy_file_ehydro, verbos
             "/data/inputs/bathymetry/bathymetry_adjustment_data.gpkg".
         verbose : bool
             Verbose printing.
+        bathy_index_path : str
+            Optional. Path to the HUC8 partitioned GeoParquet made by build_ehydro_bathy_index.
+            When given, only this HUC's rows are read from it instead of masking bathy_file_ehydro.
 
         Returns
         ----------
@@ -39,10 +90,15 @@ def correct_rating_for_ehydro_bathymetry(fim_dir, huc, bathy_file_ehydro, verbos
 
     log_text = f'Calculating eHydro bathymetry adjustment: {huc}\n'
 
-    # Load wbd and use it as a mask to pull the bathymetry data
     fim_huc_dir = join(fim_dir, huc)
-    wbd8_clp = gpd.read_file(join(fim_huc_dir, 'wbd8_clp.gpkg'), engine="pyogrio", use_arrow=True)
-    bathy_data = gpd.read_file(bathy_file_ehydro, mask=wbd8_clp, engine="fiona")
+    if bathy_index_path is not None:
+        # Pull just this HUC's rows from the partitioned index
+        bathy_data = gpd.read_parquet(bathy_index_path, filters=[('HUC8', '==', huc)])
+        bathy_data = bathy_data.drop(columns='HUC8')
+    else:
+        # Load wbd and use it as a mask to pull the bathymetry data
+        wbd8_clp = gpd.read_file(join(fim_huc_dir, 'wbd8_clp.gpkg'), engine="pyogrio", use_arrow=True)
+        bathy_data = gpd.read_file(bathy_file_ehydro, mask=wbd8_clp, engine="fiona")
     bathy_data = bathy_data.rename(columns={'ID': 'feature_id'})
 
     # Get src_full from each branch
@@ -156,20 +212,23 @@ def correct_rating_for_ai_bathymetry(fim_dir, huc, strm_order, bathy_file_aibase
     log_text = f'Calculating AI-based bathymetry adjustment: {huc}\n'
     print(f'Calculating AI-based bathymetry adjustment: {huc}\n')
 
-    # Load AI-based bathymetry data
-    ml_bathy_data = pd.read_parquet(bathy_file_aibased, engine='pyarrow')
-    ml_bathy_data_df = ml_bathy_data[
-        ['COMID', 'owp_tw_inchan', 'owp_inchan_channel_area', 'owp_inchan_channel_perimeter']
-    ]
-
     fim_huc_dir = join(fim_dir, huc)
 
     path_nwm_streams = join(fim_huc_dir, "nwm_subset_streams.gpkg")
-    nwm_stream = gpd.read_file(path_nwm_streams)
+    nwm_stream = gpd.read_file(path_nwm_streams, columns=['ID', 'order_'], engine="pyogrio", use_arrow=True)
 
     wbd8 = gpd.read_file(join(fim_huc_dir, 'wbd.gpkg'), engine="pyogrio", use_arrow=True)
     nwm_stream_clp = nwm_stream.clip(wbd8)
 
+    # Load AI-based bathymetry data for just this HUC's streams (filter is pushed down to the parquet reader)
+    huc_comids = [int(comid) for comid in nwm_stream_clp['ID'].unique()]
+    ml_bathy_data_df = pd.read_parquet(
+        bathy_file_aibased,
+        engine='pyarrow',
+        columns=['COMID', 'owp_tw_inchan', 'owp_inchan_channel_area', 'owp_inchan_channel_perimeter'],
+        filters=[('COMID', 'in', huc_comids)],
+    )
+
     ml_bathy_data_df = ml_bathy_data_df.merge(
         nwm_stream_clp[['ID', 'order_']], left_on='COMID', right_on='ID'
     )
@@ -325,7 +384,15 @@ def correct_rating_for_ai_bathymetry(fim_dir, huc, strm_order, bathy_file_aibase
 # --------------------------------------------------------
 # Apply src_adjustment_for_bathymetry
 def apply_src_adjustment_for_bathymetry(
-    fim_dir, huc, strm_order, bathy_file_ehydro, bathy_file_aibased, ai_toggle, verbose, log_file_path
+    fim_dir,
+    huc,
+    strm_order,
+    bathy_file_ehydro,
+    bathy_file_aibased,
+    ai_toggle,
+    verbose,
+    log_file_path,
+    bathy_index_path=None,
 ):
     """
     Function for applying both eHydro & AI-based bathymetry adjustment to synthetic rating curves.
@@ -347,7 +414,9 @@ def apply_src_adjustment_for_bathymetry(
             msg = f"Correcting rating curve for ehydro bathy for huc : {huc}"
             log_text += msg + '\n'
             print(msg)
-            log_text += correct_rating_for_ehydro_bathymetry(fim_dir, huc, bathy_file_ehydro, verbose)
+            log_text += correct_rating_for_ehydro_bathymetry(
+                fim_dir, huc, bathy_file_ehydro, verbose, bathy_index_path
+            )
         else:
             print(f'USACE eHydro bathymetry file does not exist for huc: {huc}')
 
@@ -468,6 +537,14 @@ def process_bathy_adjustment(
     log_text += msg
     print(msg)
 
+    # Partition the bathymetry data by HUC once so each HUC task doesn't mask scan the national file
+    bathy_index_path = os.path.join(fim_dir, 'ehydro_bathy_index' + output_suffix + '.parquet')
+    hucs_in_index = build_ehydro_bathy_index(fim_dir, fim_hucs, bathy_gdf, bathy_index_path)
+    del bathy_gdf, buffered_bathy
+    msg = f"Partitioned eHydro bathymetric data for {len(hucs_in_index)} HUCs into {bathy_index_path}\n"
+    log_text += msg
+    print(msg)
+
     if ai_toggle == 1:
         msg = f"AI-Based bathymetry data is applied on streams with order {strm_order} or higher\n"
         log_text += msg
@@ -486,6 +563,7 @@ def process_bathy_adjustment(
                 'ai_toggle': ai_toggle,
                 'verbose': verbose,
                 'log_file_path': log_file_path,
+                'bathy_index_path': bathy_index_path,
             }
             future = executor.submit(apply_src_adjustment_for_bathymetry, **args)
             futures[future] = future
@@ -495,6 +573,9 @@ def process_bathy_adjustment(
                 if future.exception():
                     raise future.exception()
 
+    if os.path.exists(bathy_index_path):
+        os.remove(bathy_index_path)
+
     ## Record run time and close log file
     end_time = dt.datetime.now(dt.timezone.utc)
     log_text += 'END TIME: ' + str(end_time) + '\n'
@@ -16,6 +16,8 @@ from rasterio.mask import mask
 from shapely import ops
 from shapely.geometry import Point
 
+from utils.shared_functions import points_to_pixel_indices
+
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -87,16 +89,15 @@ def mitigate_branch_outlet_backpool(
 
         return flagged_catchment, outlier_catchment_ids
 
-    # Extract raster catchment ID for the last point
-    def get_raster_value(point):
-        row, col = src.index(point.geometry.x, point.geometry.y)
-        value = catchment_pixels_geom[row, col]
-        return value
+    # Extract raster catchment IDs for all points at once
+    def get_raster_values(points_geom):
+        rows, cols = points_to_pixel_indices(src.transform, points_geom.geometry.x, points_geom.geometry.y)
+        return catchment_pixels_geom[rows, cols]
 
     # Function to test whether the catchment occurs at the outlet (Error Criteria 2)
     def check_if_outlet(last_point_geom, outlier_catchment_ids):
         # Get the catchment ID of the last_point_geom
-        last_point_geom['catchment_id'] = last_point_geom.apply(get_raster_value, axis=1)
+        last_point_geom['catchment_id'] = get_raster_values(last_point_geom)
 
         # Check if values in 'catchment_id' column of the snapped point are in outlier_catchments_df
         outlet_flag = last_point_geom['catchment_id'].isin(outlier_catchment_ids)
@@ -384,7 +385,7 @@ def mitigate_branch_outlet_backpool(
                     pt_3tl_geom = gpd.GeoDataFrame(pt_3tl, columns=['geometry'], crs=split_flows_geom.crs)
 
                     # Get the catchment ID of the new snapped point
-                    pt_3tl_geom['catchment_id'] = pt_3tl_geom.apply(get_raster_value, axis=1)
+                    pt_3tl_geom['catchment_id'] = get_raster_values(pt_3tl_geom)
 
                     del catchment_pixels_geom
 
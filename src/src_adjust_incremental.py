@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime as dt
+import glob
+import multiprocessing
+import os
+import sys
+from multiprocessing import Pool
+
+import pandas as pd
+
+import src_adjust_ras2fim_rating as ras2fim_calb
+import src_adjust_usgs_rating_trace as usgs_calb
+from aggregate_by_huc import aggregate_by_huc
+from src_adjust_spatial_obs import build_points_procs, process_points
+from src_roughness_optimization import (
+    CALB_SOURCE_TAGS,
+    fingerprint_calibration_input,
+    get_calibration_fingerprint_path,
+    read_calibration_fingerprints,
+    record_calibration_fingerprint,
+    reset_branch_calibration,
+    update_rating_curve,
+)
+from utils.shared_functions import concat_huc_csv, find_matching_subdirectories
+
+
+'''
+The script re-applies the SRC calibration chain (USGS rating curves --> ras2fim rating curves --> spatial
+observation points) only to the branches whose calibration inputs changed since they were last calibrated.
+It is meant for refreshing calibration data (e.g. a weekly observation refresh) on a FIM run that already went
+through fim_post_processing.sh, without re-running the whole chain for every HUC and branch.
+
+Each calibration stage records a fingerprint of the observation data it applied to a branch
+(calb_fingerprints_<branch_id>.json in the branch directory). This script rebuilds the per branch inputs for
+every enabled stage, fingerprints them and compares with the record. A branch is recalibrated when any of its
+stage fingerprints differ (including a stage that gained or lost all of its data).
+
+A HydroID's roughness adjustment spreads downstream to its neighbors (DOWNSTREAM_THRESHOLD) and the stages
+blend with each other, so the unit of work is the branch: a changed branch has its hydroTable reset to the
+pre-calibration discharge and every stage re-applied in order. Unchanged branches are not touched.
+
+Processing
+- Build the per branch calibration inputs for each enabled stage (same logic as the individual stage scripts)
+- Fingerprint them and compare with the recorded fingerprints to find the changed branches
+- Reset and recalibrate the changed branches in parallel and record their new fingerprints
+- Re-aggregate the HUC hydrotables for the HUCs that had a changed branch
+
+Assumptions
+- The HAND/SRC hydrofabric has not changed since the last full fim_post_processing.sh run (otherwise run the
+  full post processing instead)
+- The same stages must be enabled as in the full run; a branch with a recorded stage that is not enabled here
+  is recalibrated without that stage
+
+Outputs
+- Updated branch hydroTable_<branch_id>.csv and calb_fingerprints_<branch_id>.json for changed branches
+- Updated hydrotable.csv for the affected HUCs. If manual calibration is used, re-run
+  src_manual_calibration.py afterwards.
+- logs/src_optimization/log_incremental_src_adjust.log
+'''
+
+
+def collect_stage_procs(
+    run_dir,
+    usgs_rc_filepath,
+    nwm_recurr_filepath,
+    ras_input_dir,
+    ras_rc_filepath,
+    spatial_obs,
+    debug_outputs_option,
+    log_dir,
+    log_file,
+):
+    '''
+    Builds the calibration inputs of every enabled stage and groups them by branch.
+
+    Returns
+    -------
+    dict : {(huc, branch_id): {'branch_dir': str, 'procs': {source_tag: proc args}}}
+    '''
+    branch_procs = {}
+
+    def add_proc(huc, branch_id, branch_dir, source_tag, proc):
+        branch = branch_procs.setdefault((huc, str(branch_id)), {'branch_dir': branch_dir, 'procs': {}})
+        branch['procs'][source_tag] = proc
+
+    if usgs_rc_filepath:
+        log_file.write('Building USGS rating curve calibration inputs...\n')
+        usgs_elev_df = concat_huc_csv(run_dir, 'usgs_elev_table.csv')
+        if usgs_elev_df is None or usgs_elev_df.empty:
+            log_file.write('WARNING: no usgs_elev_table.csv entries found in run_dir\n')
+        else:
+            usgs_df = usgs_calb.create_usgs_rating_database(
+                usgs_rc_filepath, usgs_elev_df, nwm_recurr_filepath, log_dir
+            )
+            for proc in usgs_calb.build_branch_procs(usgs_df, run_dir, debug_outputs_option, log_file):
+                add_proc(proc[3], proc[4], proc[0], 'usgs_rating', proc)
+
+    if ras_input_dir:
+        log_file.write('Building ras2fim rating curve calibration inputs...\n')
+        hucs_with_data = find_matching_subdirectories(run_dir, ras_input_dir)
+        for huc_run_dir, ras_df in ras2fim_calb.iter_huc_ras2fim_ratings(
+            run_dir, hucs_with_data, ras_rc_filepath, nwm_recurr_filepath, log_dir, log_file
+        ):
+            for proc in ras2fim_calb.build_branch_procs(ras_df, huc_run_dir, debug_outputs_option, log_file):
+                add_proc(proc[3], proc[4], proc[0], 'ras2fim_rating', proc)
+
+    if spatial_obs:
+        log_file.write('Building spatial observation point calibration inputs...\n')
+        for proc in build_points_procs(run_dir, debug_outputs_option, log_file):
+            add_proc(proc[1], proc[2], proc[0], 'point_obs', proc)
+
+    return branch_procs
+
+
+def fingerprint_branch_procs(stage_procs):
+    # Index of the observation dataframe in each stage's proc args
+    df_index = {'usgs_rating': 1, 'ras2fim_rating': 1, 'point_obs': 6}
+    return {
+        source_tag: fingerprint_calibration_input(proc[df_index[source_tag]])
+        for source_tag, proc in stage_procs.items()
+    }
+
+
+def find_calibrated_branches(run_dir):
+    '''
+    Returns {(huc, branch_id): branch_dir} for every branch that has a calibration fingerprint record.
+    '''
+    calibrated_branches = {}
+    for fingerprint_path in glob.glob(
+        os.path.join(run_dir, '*', 'branches', '*', 'calb_fingerprints_*.json')
+    ):
+        branch_dir = os.path.dirname(fingerprint_path)
+        branch_id = os.path.basename(branch_dir)
+        huc = os.path.basename(os.path.dirname(os.path.dirname(branch_dir)))
+        calibrated_branches[(huc, branch_id)] = branch_dir
+    return calibrated_branches
+
+
+def recalibrate_branch(huc, branch_id, branch_dir, stage_procs, fingerprints):
+    '''
+    Resets a branch's calibration and re-applies every stage that has data for it, in the same order as
+    fim_post_processing.sh, then records the new fingerprints.
+    '''
+    log_text = f'\nIncremental recalibration for huc --> {huc}  branch id: {branch_id}\n'
+    htable_path = os.path.join(branch_dir, 'hydroTable_' + branch_id + '.csv')
+    if not os.path.isfile(htable_path):
+        return log_text + 'WARNING: hydroTable does not exist (skipping)\n'
+
+    reset_branch_calibration(htable_path)
+    fingerprint_path = get_calibration_fingerprint_path(branch_dir, branch_id)
+    if os.path.isfile(fingerprint_path):
+        os.remove(fingerprint_path)
+
+    for source_tag in CALB_SOURCE_TAGS:
+        if source_tag not in stage_procs:
+            continue
+        if source_tag == 'point_obs':
+            log_text += process_points(stage_procs[source_tag])
+        else:
+            log_text += update_rating_curve(*stage_procs[source_tag])
+        record_calibration_fingerprint(branch_dir, branch_id, source_tag, fingerprints[source_tag])
+
+    return log_text
+
+
+def reaggregate_hucs(run_dir, hucs, job_number, log_dir):
+    '''
+    Re-aggregates the HUC level hydrotable.csv (and bridge points) for the given HUCs using all of each HUC's
+    branches listed in fim_inputs.csv.
+    '''
+    fim_inputs = pd.read_csv(
+        os.path.join(run_dir, 'fim_inputs.csv'), header=None, names=['huc', 'levpa_id'], dtype=str
+    )
+    fim_inputs = fim_inputs[fim_inputs['huc'].isin(hucs)]
+    incremental_inputs_csv = os.path.join(log_dir, 'incremental_fim_inputs.csv')
+    fim_inputs.to_csv(incremental_inputs_csv, header=False, index=False)
+
+    num_job_workers = max(1, min(job_number, os.cpu_count() - 2))
+    aggregate_by_huc(run_dir, incremental_inputs_csv, False, True, False, False, True, num_job_workers)
+
+    # A stale pre-manual copy would make src_manual_calibration.py ignore the new hydrotable
+    for huc in hucs:
+        pre_manual_htable = os.path.join(run_dir, huc, 'hydrotable_pre-manual.csv')
+        if os.path.isfile(pre_manual_htable):
+            os.remove(pre_manual_htable)
+
+
+def run_incremental_calibration(
+    run_dir,
+    usgs_rc_filepath,
+    nwm_recurr_filepath,
+    ras_input_dir,
+    ras_rc_filepath,
+    spatial_obs,
+    debug_outputs_option,
+    dry_run,
+    job_number,
+):
+    assert os.path.isdir(run_dir), 'ERROR: could not find the input fim_dir location: ' + str(run_dir)
+    if ras_input_dir and not ras_rc_filepath:
+        raise ValueError('The ras2fim rating curve csv name (-ras_rc) is required with -ras_input')
+    if (usgs_rc_filepath or ras_input_dir) and not nwm_recurr_filepath:
+        raise ValueError('The NWM recurrence flow file (-nwm_recur) is required for rating curve calibration')
+
+    available_cores = multiprocessing.cpu_count()
+    if job_number > available_cores:
+        job_number = available_cores - 1
+        print(
+            "Provided job number exceeds the number of available cores. "
+            + str(job_number)
+            + " max jobs will be used instead."
+        )
+
+    log_dir = os.path.join(run_dir, "logs", "src_optimization")
+    print("Log file output here: " + str(log_dir))
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    begin_time = dt.datetime.now()
+    log_file = open(os.path.join(log_dir, 'log_incremental_src_adjust.log'), "w")
+    log_file.write('START TIME: ' + str(begin_time) + '\n')
+    log_file.write('#########################################################\n\n')
+
+    branch_procs = collect_stage_procs(
+        run_dir,
+        usgs_rc_filepath,
+        nwm_recurr_filepath,
+        ras_input_dir,
+        ras_rc_filepath,
+        spatial_obs,
+        debug_outputs_option,
+        log_dir,
+        log_file,
+    )
+
+    # Branches that were calibrated before but have no calibration data now also need to be reset
+    calibrated_branches = find_calibrated_branches(run_dir)
+    for (huc, branch_id), branch_dir in calibrated_branches.items():
+        branch_procs.setdefault((huc, branch_id), {'branch_dir': branch_dir, 'procs': {}})
+
+    changed_branches = []
+    for (huc, branch_id), branch in sorted(branch_procs.items()):
+        fingerprints = fingerprint_branch_procs(branch['procs'])
+        if fingerprints != read_calibration_fingerprints(branch['branch_dir'], branch_id):
+            changed_branches.append((huc, branch_id, branch['branch_dir'], branch['procs'], fingerprints))
+
+    changed_hucs = sorted({huc for huc, *_ in changed_branches})
+    msg = (
+        f'{len(changed_branches)} of {len(branch_procs)} calibrated branches have changed calibration inputs '
+        f'({len(changed_hucs)} HUCs)'
+    )
+    print(msg)
+    log_file.write(msg + '\n')
+    for huc, branch_id, *_ in changed_branches:
+        log_file.write(f'  {huc} - branch-id: {branch_id}\n')
+    log_file.write('#########################################################\n\n')
+
+    if changed_branches and not dry_run:
+        print(f"Recalibrating {len(changed_branches)} branches using {job_number} jobs...")
+        with Pool(processes=job_number) as pool:
+            log_output = pool.starmap(recalibrate_branch, changed_branches)
+            log_file.writelines(["%s\n" % item for item in log_output])
+
+        print(f"Re-aggregating hydrotables for {len(changed_hucs)} HUCs...")
+        reaggregate_hucs(run_dir, changed_hucs, job_number, log_dir)
+
+    ## Record run time and close log file
+    log_file.write('#########################################################\n\n')
+    end_time = dt.datetime.now()
+    log_file.write('END TIME: ' + str(end_time) + '\n')
+    tot_run_time = end_time - begin_time
+    log_file.write('TOTAL RUN TIME: ' + str(tot_run_time))
+    sys.stdout = sys.__stdout__
+    log_file.close()
+
+
+if __name__ == '__main__':
+    '''
+    Sample usage (re-apply all three calibration sources where their inputs changed):
+        python3 /foss_fim/src/src_adjust_incremental.py
+            -run_dir /outputs/fim_run_dir
+            -usgs_rc /data/inputs/usgs_gages/usgs_rating_curves.csv
+            -nwm_recur /data/inputs/rating_curve/nwm_recur_flows/nwm21_17C_recurr_intervals_cfs.csv
+            -ras_input /data/inputs/rating_curve/ras2fim_exports
+            -ras_rc reformat_ras_rating_curve_points_rel_101.csv
+            -spatial
+            -j 8
+    '''
+    parser = argparse.ArgumentParser(
+        description='Re-applies SRC calibration only to branches whose calibration inputs changed.'
+    )
+    parser.add_argument('-run_dir', '--run-dir', help='Parent directory of FIM run.', required=True)
+    parser.add_argument(
+        '-usgs_rc',
+        '--usgs-ratings',
+        help='OPTIONAL: Path to USGS rating curve csv file (enables USGS rating calibration)',
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        '-nwm_recur',
+        '--nwm_recur',
+        help='Path to NWM recur file (multiple NWM flow intervals). NOTE: assumes flow units are cfs!!',
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        '-ras_input',
+        '--ras2fim-dir',
+        help='OPTIONAL: Path to RAS2FIM rating curve input directory (enables ras2fim calibration)',
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        '-ras_rc',
+        '--ras2fim-ratings',
+        help='CSV file name for RAS2FIM rating curve (reach avg)',
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        '-spatial',
+        '--spatial-obs',
+        help='OPTIONAL flag: enables calibration with the spatial observation point .parquet files',
+        default=False,
+        required=False,
+        action='store_true',
+    )
+    parser.add_argument(
+        '-debug',
+        '--extra-outputs',
+        help='OPTIONAL flag: Use this to keep intermediate output files for debugging/testing',
+        default=False,
+        required=False,
+        action='store_true',
+    )
+    parser.add_argument(
+        '-dry',
+        '--dry-run',
+        help='OPTIONAL flag: only log the branches that would be recalibrated',
+        default=False,
+        required=False,
+        action='store_true',
+    )
+    parser.add_argument(
+        '-j', '--job-number', help='Number of jobs to use', type=int, required=False, default=1
+    )
+
+    args = vars(parser.parse_args())
+
+    run_incremental_calibration(
+        args['run_dir'],
+        args['usgs_ratings'],
+        args['nwm_recur'],
+        args['ras2fim_dir'],
+        args['ras2fim_ratings'],
+        args['spatial_obs'],
+        args['extra_outputs'],
+        args['dry_run'],
+        args['job_number'],
+    )
@@ -12,7 +12,12 @@ from pathlib import Path
 
 import pandas as pd
 
-from src_roughness_optimization import update_rating_curve
+from src_roughness_optimization import (
+    fingerprint_calibration_input,
+    record_calibration_fingerprint,
+    update_rating_curve,
+)
+from utils.rating_lookup_store import get_lookup_store_dir, read_nwm_recurr_flows_cms
 from utils.shared_functions import check_file_age, concat_huc_csv, find_matching_subdirectories
 
 
@@ -25,7 +30,7 @@ Processing
 - Read in the aggregate RAS elev table csv from the HUC fim directory (output from ras_gage_crosswalk.py)
 - Filter null entries and convert RAS2FIM flow from cfs to cms
 - Calculate HAND elevation value for each gage location (NAVD88 elevation - NHD DEM thalweg elevation)
-- Read in the NWM recurr csv file and convert flow to cfs
+- Read in the NWM recurr flows for the crosswalked feature_ids (from the rating lookup store)
 - Calculate the closest SRC discharge value to the NWM flow value
 - Create dataframe with crosswalked RAS2FIM flow and NWM recurr flow and assign metadata attributes
 - Calculate flow difference (variance) to check for large discrepancies btw NWM flow and RAS2FIM closest flow
@@ -91,24 +96,13 @@ def create_ras2fim_rating_database(huc_ras_input_file, ras_elev_df, nwm_recurr_f
     ]
     ras_rc_df['feature_id'] = ras_rc_df['feature_id'].astype(int)
 
-    # read in the NWM recurr csv file
-    nwm_recur_df = pd.read_csv(nwm_recurr_filepath, dtype={'feature_id': int})
-    if "Unnamed: 0" in nwm_recur_df.columns:
-        nwm_recur_df = nwm_recur_df.drop(columns=["Unnamed: 0"])
-    nwm_recur_df.rename(
-        columns={
-            '2_0_year_recurrence_flow_17C': '2_0_year',
-            '5_0_year_recurrence_flow_17C': '5_0_year',
-            '10_0_year_recurrence_flow_17C': '10_0_year',
-            '25_0_year_recurrence_flow_17C': '25_0_year',
-            '50_0_year_recurrence_flow_17C': '50_0_year',
-        },
-        inplace=True,
+    # read the NWM recurr flows (cms) for the crosswalked feature_ids from the lookup store
+    nwm_recur_df = read_nwm_recurr_flows_cms(
+        get_lookup_store_dir(os.path.join(log_dir, 'lookup_store')),
+        nwm_recurr_filepath,
+        feature_ids=ras_rc_df['feature_id'].unique(),
     )
 
-    # convert cfs to cms (x 0.028317)
-    nwm_recur_df.loc[:, ['2_0_year', '5_0_year', '10_0_year', '25_0_year', '50_0_year']] *= 0.028317
-
     # merge nwm recurr with ras_rc_df
     merge_df = ras_rc_df.merge(nwm_recur_df, how='left', on='feature_id')
 
@@ -199,7 +193,8 @@ def create_ras2fim_rating_database(huc_ras_input_file, ras_elev_df, nwm_recurr_f
     return final_df
 
 
-def branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file):
+def build_branch_procs(ras_df, huc_run_dir, debug_outputs_option, log_file):
+    # Builds the update_rating_curve argument list for every branch in the HUC with ras2fim data
     procs_list = []  # Initialize list for mulitprocessing.
 
     # loop through all unique level paths that have a ras2fim data points
@@ -288,11 +283,22 @@ def branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file):
                     ]
                 )
 
+    return procs_list
+
+
+def branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file):
+    procs_list = build_branch_procs(ras_df, huc_run_dir, debug_outputs_option, log_file)
+
     # multiprocess all available branches
     print(f"Calculating new SRCs for {len(procs_list)} branches using {job_number} jobs...")
     with Pool(processes=job_number) as pool:
         log_output = pool.starmap(update_rating_curve, procs_list)
         log_file.writelines(["%s\n" % item for item in log_output])
+
+    # Record what was applied to each branch (used by src_adjust_incremental.py)
+    for branch_dir, water_edge_median_ds, _, _, branch_id, *_ in procs_list:
+        fingerprint = fingerprint_calibration_input(water_edge_median_ds)
+        record_calibration_fingerprint(branch_dir, branch_id, 'ras2fim_rating', fingerprint)
     # try statement for debugging
     # try:
     #     with Pool(processes=job_number) as pool:
@@ -305,41 +311,10 @@ def branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file):
     #     )
 
 
-def run_prep(run_dir, ras_input_dir, ras_rc_filepath, nwm_recurr_filepath, debug_outputs_option, job_number):
-    ## Check input args are valid
-    assert os.path.isdir(run_dir), 'ERROR: could not find the input fim_dir location: ' + str(run_dir)
-
-    available_cores = multiprocessing.cpu_count()
-    if job_number > available_cores:
-        job_number = available_cores - 1
-        print(
-            "Provided job number exceeds the number of available cores. "
-            + str(job_number)
-            + " max jobs will be used instead."
-        )
-
-    ## Create output dir for log and ras2fim rc database
-    log_dir = os.path.join(run_dir, "logs", "src_optimization")
-    print("Log file output here: " + str(log_dir))
-    if not os.path.isdir(log_dir):
-        os.makedirs(log_dir)
-
-    ## Create a time var to log run time
-    begin_time = dt.datetime.now()
-    # Create log file for processing records
-    log_file = open(os.path.join(log_dir, 'log_ras2fim_rc_src_adjust.log'), "w")
-    log_file.write('START TIME: ' + str(begin_time) + '\n')
-    log_file.write('#########################################################\n\n')
-
-    hucs_with_data = find_matching_subdirectories(run_dir, ras_input_dir)
-    if len(hucs_with_data) == 0:
-        print('ALERT: Did not find any HUCs with ras2fim data to perform adjustments')
-        log_file.write('ALERT: Did not find any HUCs with ras2fim data to perform adjustments\n')
-        return
-
-    log_file.write('RAS2FIM data available and will perform SRC adjustments for hucs:\n')
-    log_file.write(str(hucs_with_data))
-    log_file.write('\n#########################################################\n\n')
+def iter_huc_ras2fim_ratings(
+    run_dir, hucs_with_data, ras_rc_filepath, nwm_recurr_filepath, log_dir, log_file
+):
+    # Yields the HUC run directory and ras2fim rating database for each HUC with valid ras2fim elev data
     for huc in hucs_with_data:
         huc_run_dir = os.path.join(run_dir, huc)
         huc_ras_input_file = os.path.join(huc_run_dir, ras_rc_filepath)
@@ -375,8 +350,49 @@ def run_prep(run_dir, ras_input_dir, ras_rc_filepath, nwm_recurr_filepath, debug
                 huc_ras_input_file, ras_elev_df, nwm_recurr_filepath, log_dir
             )
 
-            ## Create huc proc_list for multiprocessing and execute the update_rating_curve function
-            branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file)
+            yield huc_run_dir, ras_df
+
+
+def run_prep(run_dir, ras_input_dir, ras_rc_filepath, nwm_recurr_filepath, debug_outputs_option, job_number):
+    ## Check input args are valid
+    assert os.path.isdir(run_dir), 'ERROR: could not find the input fim_dir location: ' + str(run_dir)
+
+    available_cores = multiprocessing.cpu_count()
+    if job_number > available_cores:
+        job_number = available_cores - 1
+        print(
+            "Provided job number exceeds the number of available cores. "
+            + str(job_number)
+            + " max jobs will be used instead."
+        )
+
+    ## Create output dir for log and ras2fim rc database
+    log_dir = os.path.join(run_dir, "logs", "src_optimization")
+    print("Log file output here: " + str(log_dir))
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    ## Create a time var to log run time
+    begin_time = dt.datetime.now()
+    # Create log file for processing records
+    log_file = open(os.path.join(log_dir, 'log_ras2fim_rc_src_adjust.log'), "w")
+    log_file.write('START TIME: ' + str(begin_time) + '\n')
+    log_file.write('#########################################################\n\n')
+
+    hucs_with_data = find_matching_subdirectories(run_dir, ras_input_dir)
+    if len(hucs_with_data) == 0:
+        print('ALERT: Did not find any HUCs with ras2fim data to perform adjustments')
+        log_file.write('ALERT: Did not find any HUCs with ras2fim data to perform adjustments\n')
+        return
+
+    log_file.write('RAS2FIM data available and will perform SRC adjustments for hucs:\n')
+    log_file.write(str(hucs_with_data))
+    log_file.write('\n#########################################################\n\n')
+    for huc_run_dir, ras_df in iter_huc_ras2fim_ratings(
+        run_dir, hucs_with_data, ras_rc_filepath, nwm_recurr_filepath, log_dir, log_file
+    ):
+        ## Create huc proc_list for multiprocessing and execute the update_rating_curve function
+        branch_proc_list(ras_df, huc_run_dir, debug_outputs_option, log_file)
 
     ## Record run time and close log file
     log_file.write('#########################################################\n\n')
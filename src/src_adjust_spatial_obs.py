@@ -11,7 +11,12 @@ import geopandas as gpd
 import rasterio
 from dotenv import load_dotenv
 
-from src_roughness_optimization import update_rating_curve
+from src_roughness_optimization import (
+    fingerprint_calibration_input,
+    record_calibration_fingerprint,
+    update_rating_curve,
+)
+from utils.shared_functions import sample_rasters_at_points
 from utils.shared_variables import (
     DEFAULT_FIM_PROJECTION_CRS,
     DOWNSTREAM_THRESHOLD,
@@ -64,8 +69,8 @@ def process_points(args):
 
     Processing
     - Extract x,y coordinates from geometry
-    - Projects the point data to matching CRS for HAND and hydroid rasters
     - Samples the hydroid and HAND raster values for each point and stores the values in dataframe
+      (the points are projected and subset to the branch raster extent by ingest_points_layer)
     - Calculates the median HAND value for all points by hydroid
     '''
 
@@ -79,15 +84,11 @@ def process_points(args):
     htable_path = args[7]
     optional_outputs = args[8]
 
-    ## Define coords variable to be used in point raster value attribution.
-    coords = [(x, y) for x, y in zip(water_edge_df.X, water_edge_df.Y)]
-
-    water_edge_df = water_edge_df.to_crs(DEFAULT_FIM_PROJECTION_CRS)
-
-    ## Use point geometry to determine HAND raster pixel values.
-    with rasterio.open(hand_path) as hand_src, rasterio.open(catchments_path) as catchments_src:
-        water_edge_df['hand'] = [h[0] for h in hand_src.sample(coords)]
-        water_edge_df['hydroid'] = [c[0] for c in catchments_src.sample(coords)]
+    ## Use point geometry to determine HAND and catchment raster pixel values (batched block reads).
+    ## Points arrive already projected to DEFAULT_FIM_PROJECTION_CRS and clipped to this branch's extent.
+    water_edge_df['hand'], water_edge_df['hydroid'] = sample_rasters_at_points(
+        [hand_path, catchments_path], water_edge_df.X.values, water_edge_df.Y.values
+    )
 
     water_edge_df = water_edge_df[
         (water_edge_df['hydroid'].notnull()) & (water_edge_df['hand'] > 0) & (water_edge_df['hydroid'] > 0)
@@ -176,6 +177,32 @@ def find_points_in_huc(huc_id):
     return water_edge_df
 
 
+def subset_points_to_raster_extent(water_edge_df, raster_path):
+    '''
+    This function returns the points that fall within the bounds of a raster, so that a branch task
+    only receives (and pickles) the points it can actually sample.
+
+    Inputs
+    - water_edge_df:  geodataframe with point data and X, Y columns in the raster's CRS
+    - raster_path:    path to the raster whose extent is used (e.g. the branch catchments raster)
+
+    Outputs
+    - geodataframe with the subset of points inside the raster bounds
+    '''
+
+    with rasterio.open(raster_path) as src:
+        left, bottom, right, top = src.bounds
+
+    in_extent = (
+        (water_edge_df['X'] >= left)
+        & (water_edge_df['X'] < right)
+        & (water_edge_df['Y'] > bottom)
+        & (water_edge_df['Y'] <= top)
+    )
+
+    return water_edge_df[in_extent]
+
+
 def find_hucs_with_points(points_file_dir, fim_out_huc_list):
     '''
     This function queries a directory with .parquet files of HUCs containing calibration points
@@ -195,14 +222,34 @@ def find_hucs_with_points(points_file_dir, fim_out_huc_list):
 
 
 def ingest_points_layer(fim_directory, job_number, debug_outputs_option, log_file):
+    '''
+    The function builds the proc list (see build_points_procs) and passes the branch organized data
+    to the process_points function, then records what was applied to each branch.
+    '''
+
+    procs_list = build_points_procs(fim_directory, debug_outputs_option, log_file)
+
+    with Pool(processes=job_number) as pool:
+        log_output = pool.map(process_points, procs_list)
+        log_file.writelines(["%s\n" % item for item in log_output])
+
+    # Record what was applied to each branch (used by src_adjust_incremental.py)
+    for proc in procs_list:
+        branch_dir, branch_id, water_edge_df = proc[0], proc[2], proc[6]
+        fingerprint = fingerprint_calibration_input(water_edge_df)
+        record_calibration_fingerprint(branch_dir, branch_id, 'point_obs', fingerprint)
+
+    log_file.write('#########################################################\n')
+
+
+def build_points_procs(fim_directory, debug_outputs_option, log_file):
     '''
     The function obtains all points within a given huc, locates the corresponding FIM output files
-    for each huc (confirms all necessary files exist), and then passes a proc list of
-    huc organized data to process_points function.
+    for each huc (confirms all necessary files exist), and then builds a proc list of
+    branch organized data for the process_points function.
 
     Inputs
     - fim_directory:        parent directory of fim ouputs (contains HUC directories)
-    - job_number:           number of multiprocessing jobs to use for processing hucs
     - debug_outputs_option: optional flag to output intermediate files
     - log_file:             where stdout/stderr will be logged
 
@@ -210,10 +257,8 @@ def ingest_points_layer(fim_directory, job_number, debug_outputs_option, log_fil
     - Query the <input_calib_points_dir> for all unique huc ids that have calb points
     - Loop through all HUCs with calib data and locate necessary fim output files to pass to calib workflow
 
-    - procs_list:           passes multiprocessing list of input args for process_points function input
-
     Outputs
-    - log_file:             where stdout/stderr will be logged
+    - procs_list:           multiprocessing list of input args for process_points function input
     '''
 
     print("Finding all fim_output hucs that contain calibration points...")
@@ -264,6 +309,9 @@ def ingest_points_layer(fim_directory, job_number, debug_outputs_option, log_fil
         print(f"{len(water_edge_df)} points found in " + str(huc))
         log_file.write(f"{len(water_edge_df)} points found in " + str(huc) + '\n')
 
+        ## Project once per HUC (instead of once per branch) to match the HAND and hydroid rasters.
+        water_edge_df = water_edge_df.to_crs(DEFAULT_FIM_PROJECTION_CRS)
+
         ## Create X and Y location columns by extracting from geometry.
         water_edge_df['X'] = water_edge_df['geometry'].x
         water_edge_df['Y'] = water_edge_df['geometry'].y
@@ -343,6 +391,18 @@ def ingest_points_layer(fim_directory, job_number, debug_outputs_option, log_fil
                     + '\n'
                 )
             else:
+                ## Only send each branch the points that fall within its catchment raster extent
+                branch_water_edge_df = subset_points_to_raster_extent(water_edge_df, catchments_path)
+                if branch_water_edge_df.empty:
+                    log_file.write(
+                        'NOTE --> skipping HUC: '
+                        + str(huc)
+                        + '  Branch: '
+                        + str(branch_id)
+                        + ': no observation points found within the branch raster extent\n'
+                    )
+                    continue
+
                 procs_list.append(
                     [
                         branch_dir,
@@ -351,17 +411,13 @@ def ingest_points_layer(fim_directory, job_number, debug_outputs_option, log_fil
                         hand_path,
                         catchments_path,
                         catchments_poly_path,
-                        water_edge_df,
+                        branch_water_edge_df,
                         htable_path,
                         debug_outputs_option,
                     ]
                 )
 
-    with Pool(processes=job_number) as pool:
-        log_output = pool.map(process_points, procs_list)
-        log_file.writelines(["%s\n" % item for item in log_output])
-
-    log_file.write('#########################################################\n')
+    return procs_list
 
 
 def run_prep(fim_directory, debug_outputs_option, ds_thresh_override, DOWNSTREAM_THRESHOLD, job_number):
@@ -8,7 +8,12 @@ from multiprocessing import Pool
 import geopandas as gpd
 import pandas as pd
 
-from src_roughness_optimization import update_rating_curve
+from src_roughness_optimization import (
+    fingerprint_calibration_input,
+    record_calibration_fingerprint,
+    update_rating_curve,
+)
+from utils.rating_lookup_store import get_lookup_store_dir, read_nwm_recurr_flows_cms, read_usgs_rating_curves
 from utils.shared_functions import check_file_age, concat_huc_csv
 from utils.shared_variables import USGS_CALB_TRACE_DIST
 
@@ -18,11 +23,12 @@ The script ingests a USGS rating curve csv and a NWM flow recurrence interval da
 The gage location will be associated to the corresponding hydroID and attributed with the HAND elevation value
 
 Processing
-- Read in USGS rating curve from csv and convert WSE navd88 values to meters
+- Read in USGS rating curve for the crosswalked gages (from the rating lookup store) and convert WSE navd88
+  values to meters
 - Read in the aggregate USGS elev table csv from the HUC fim directory (output from usgs_gage_crosswalk.py)
 - Filter null entries and convert usgs flow from cfs to cms
 - Calculate HAND elevation value for each gage location (NAVD88 elevation - NHD DEM thalweg elevation)
-- Read in the NWM recurr csv file and convert flow to cfs
+- Read in the NWM recurr flows for the crosswalked feature_ids (from the rating lookup store)
 - Calculate the closest SRC discharge value to the NWM flow value
 - Create dataframe with crosswalked USGS flow and NWM recurr flow and assign metadata attributes
 - Calculate flow difference (variance) to check for large discrepancies btw NWM flow and USGS closest flow
@@ -46,19 +52,10 @@ Outputs
 
 def create_usgs_rating_database(usgs_rc_filepath, usgs_elev_df, nwm_recurr_filepath, log_dir):
     start_time = dt.datetime.now()
-    print('Reading USGS rating curve from csv...')
     log_text = 'Processing database for USGS flow/WSE at NWM flow recur intervals...\n'
-    col_usgs = ["location_id", "flow", "stage", "elevation_navd88"]
-    usgs_rc_df = pd.read_csv(
-        usgs_rc_filepath, dtype={'location_id': object}, usecols=col_usgs
-    )  # , nrows=30000)
-    print('Duration (read usgs_rc_csv): {}'.format(dt.datetime.now() - start_time))
-
-    # convert WSE navd88 values to meters
-    usgs_rc_df['elevation_navd88_m'] = usgs_rc_df['elevation_navd88'] / 3.28084
+    lookup_store_dir = get_lookup_store_dir(os.path.join(log_dir, 'lookup_store'))
 
     # read in the aggregate USGS elev table csv
-    start_time = dt.datetime.now()
     cross_df = usgs_elev_df[
         ["location_id", "HydroID", "feature_id", "levpa_id", "HUC8", "dem_adj_elevation"]
     ].copy()
@@ -70,6 +67,17 @@ def create_usgs_rating_database(usgs_rc_filepath, usgs_elev_df, nwm_recurr_filep
     # (removes ahps lide entries that aren't associated with USGS gage)
     cross_df = cross_df[cross_df.location_id.notnull()]
 
+    # read the USGS ratings for the crosswalked gages from the lookup store
+    print('Reading USGS rating curves from the lookup store...')
+    col_usgs = ["location_id", "flow", "stage", "elevation_navd88"]
+    usgs_rc_df = read_usgs_rating_curves(
+        lookup_store_dir, usgs_rc_filepath, col_usgs, location_ids=cross_df['location_id'].unique()
+    )
+    print('Duration (read usgs_rc): {}'.format(dt.datetime.now() - start_time))
+
+    # convert WSE navd88 values to meters
+    usgs_rc_df['elevation_navd88_m'] = usgs_rc_df['elevation_navd88'] / 3.28084
+
     # convert usgs flow from cfs to cms
     usgs_rc_df['discharge_cms'] = usgs_rc_df.flow / 35.3147
     usgs_rc_df = usgs_rc_df.drop(columns=["flow"])
@@ -85,23 +93,11 @@ def create_usgs_rating_database(usgs_rc_filepath, usgs_elev_df, nwm_recurr_filep
     ]
     usgs_rc_df['feature_id'] = usgs_rc_df['feature_id'].astype(int)
 
-    # read in the NWM recurr csv file
-    nwm_recur_df = pd.read_csv(nwm_recurr_filepath, dtype={'feature_id': int})
-    if "Unnamed: 0" in nwm_recur_df.columns:
-        nwm_recur_df = nwm_recur_df.drop(columns=["Unnamed: 0"])
-    nwm_recur_df = nwm_recur_df.rename(
-        columns={
-            '2_0_year_recurrence_flow_17C': '2_0_year',
-            '5_0_year_recurrence_flow_17C': '5_0_year',
-            '10_0_year_recurrence_flow_17C': '10_0_year',
-            '25_0_year_recurrence_flow_17C': '25_0_year',
-            '50_0_year_recurrence_flow_17C': '50_0_year',
-        }
+    # read the NWM recurr flows (cms) for the crosswalked feature_ids from the lookup store
+    nwm_recur_df = read_nwm_recurr_flows_cms(
+        lookup_store_dir, nwm_recurr_filepath, feature_ids=usgs_rc_df['feature_id'].unique()
     )
 
-    # convert cfs to cms (x 0.028317)
-    nwm_recur_df.loc[:, ['2_0_year', '5_0_year', '10_0_year', '25_0_year', '50_0_year']] *= 0.028317
-
     # merge nwm recurr with usgs_rc
     merge_df = usgs_rc_df.merge(nwm_recur_df, how='left', on='feature_id')
 
@@ -263,7 +259,8 @@ def trace_network(df, start_id):
     return trace_up, trace_down
 
 
-def branch_proc_list(usgs_df, run_dir, debug_outputs_option, log_file):
+def build_branch_procs(usgs_df, run_dir, debug_outputs_option, log_file):
+    # Builds the update_rating_curve argument list for every branch with valid USGS gage trace data
     procs_list = []  # Initialize list for mulitprocessing.
 
     # loop through all unique level paths that have a USGS gage
@@ -438,11 +435,22 @@ def branch_proc_list(usgs_df, run_dir, debug_outputs_option, log_file):
                     ]
                 )
 
+    return procs_list
+
+
+def branch_proc_list(usgs_df, run_dir, debug_outputs_option, log_file):
+    procs_list = build_branch_procs(usgs_df, run_dir, debug_outputs_option, log_file)
+
     # multiprocess all available branches
     print(f"Calculating new SRCs for {len(procs_list)} branches using {job_number} jobs...")
     with Pool(processes=job_number) as pool:
         log_output = pool.starmap(update_rating_curve, procs_list)
         log_file.writelines(["%s\n" % item for item in log_output])
+
+    # Record what was applied to each branch (used by src_adjust_incremental.py)
+    for branch_dir, usgs_elev_trace, _, _, branch_id, *_ in procs_list:
+        fingerprint = fingerprint_calibration_input(usgs_elev_trace)
+        record_calibration_fingerprint(branch_dir, branch_id, 'usgs_rating', fingerprint)
     # TO-DO update the error handling to properly capture issues in the multiprocessing
     # try statement for debugging
     # try:
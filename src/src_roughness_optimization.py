@@ -1,5 +1,6 @@
 import argparse
 import datetime as dt
+import hashlib
 import json
 import multiprocessing
 import os
@@ -18,6 +19,22 @@ from utils.shared_variables import DOWNSTREAM_THRESHOLD, ROUGHNESS_MAX_THRESH, R
 
 gpd.options.io_engine = "pyogrio"
 
+# Calibration sources in the order they are applied by fim_post_processing.sh
+CALB_SOURCE_TAGS = ['usgs_rating', 'ras2fim_rating', 'point_obs']
+
+# Hydrotable columns written by update_rating_curve (removed when a branch's calibration is reset)
+CALB_HTABLE_COLUMNS = [
+    'calb_applied',
+    'last_updated',
+    'submitter',
+    'obs_source',
+    'precalb_discharge_cms',
+    'calb_coef_usgs',
+    'calb_coef_ras2fim',
+    'calb_coef_spatial',
+    'calb_coef_final',
+]
+
 
 def update_rating_curve(
     fim_directory,
@@ -770,3 +787,61 @@ def group_manningn_calc(df_nmerge, down_dist_thresh):
     ## drop accum vars from group calc
     # df_nmerge = df_nmerge.drop(['accum_dist','hyid_accum_count'], axis=1)
     return df_nmerge
+
+
+def fingerprint_calibration_input(calb_input_df):
+    '''
+    Returns a content hash of the observation dataframe handed to a calibration stage for one branch, plus
+    the calibration parameters that change the result (downstream propagation distance and roughness
+    limits). Row order does not change the hash. Geometry columns are ignored (the X/Y or hydroid columns
+    carry the location).
+    '''
+    params = (DOWNSTREAM_THRESHOLD, ROUGHNESS_MIN_THRESH, ROUGHNESS_MAX_THRESH)
+    calb_input_df = pd.DataFrame(calb_input_df).drop(columns='geometry', errors='ignore')
+    columns = sorted(calb_input_df.columns)
+    row_hashes = np.sort(pd.util.hash_pandas_object(calb_input_df[columns], index=False).to_numpy())
+
+    hasher = hashlib.sha256(row_hashes.tobytes())
+    hasher.update(','.join(columns).encode())
+    hasher.update(repr(params).encode())
+    return hasher.hexdigest()
+
+
+def get_calibration_fingerprint_path(branch_dir, branch_id):
+    return os.path.join(branch_dir, 'calb_fingerprints_' + str(branch_id) + '.json')
+
+
+def read_calibration_fingerprints(branch_dir, branch_id):
+    '''
+    Returns a dictionary of {source_tag: fingerprint} for the calibration stages last applied to a branch
+    (empty if the branch has no calibration record).
+    '''
+    fingerprint_path = get_calibration_fingerprint_path(branch_dir, branch_id)
+    if not os.path.isfile(fingerprint_path):
+        return {}
+    with open(fingerprint_path, 'r') as fingerprint_file:
+        return json.load(fingerprint_file)
+
+
+def record_calibration_fingerprint(branch_dir, branch_id, source_tag, fingerprint):
+    '''
+    Records the fingerprint of the inputs a calibration stage just applied to a branch.
+    '''
+    fingerprints = read_calibration_fingerprints(branch_dir, branch_id)
+    fingerprints[source_tag] = fingerprint
+    with open(get_calibration_fingerprint_path(branch_dir, branch_id), 'w') as fingerprint_file:
+        json.dump(fingerprints, fingerprint_file, indent=2, sort_keys=True)
+
+
+def reset_branch_calibration(htable_path):
+    '''
+    Restores a branch hydroTable to its pre-calibration discharge and removes all calibration attributes,
+    so the calibration stages can be re-applied to it from scratch.
+    '''
+    df_htable = pd.read_csv(
+        htable_path, dtype={'HUC': object, 'last_updated': object, 'submitter': object, 'obs_source': object}
+    )
+    if 'precalb_discharge_cms' in df_htable.columns and df_htable['precalb_discharge_cms'].notnull().all():
+        df_htable['discharge_cms'] = df_htable['precalb_discharge_cms']
+    df_htable = df_htable.drop(columns=CALB_HTABLE_COLUMNS, errors='ignore')
+    df_htable.to_csv(htable_path, index=False)
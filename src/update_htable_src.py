@@ -52,6 +52,11 @@ def process_branch(sub_branch_path, branch):
     input_src_full.to_csv(src_full_file, index=False)
     input_hydro_table.to_csv(hydro_table_file, index=False)
 
+    # The calibration record no longer applies to the reset hydroTable
+    calb_fingerprint_file = os.path.join(sub_branch_path, f'calb_fingerprints_{branch}.json')
+    if os.path.isfile(calb_fingerprint_file):
+        os.remove(calb_fingerprint_file)
+
 
 def reset_hydro_and_src(fim_dir):
     hucs = [h for h in os.listdir(fim_dir) if re.match(r'^\d{8}$', h)]
@@ -6,7 +6,8 @@ import warnings
 from os.path import join
 
 import geopandas as gpd
-import rasterio
+
+from utils.shared_functions import sample_rasters_at_points
 
 
 gpd.options.io_engine = "pyogrio"
@@ -115,12 +116,9 @@ class GageCrosswalk(object):
         before running this method, otherwise the DEM will be sampled at the actual gage locations.
         '''
 
-        coord_list = [
-            (x, y) for x, y in zip(self.gages['geometry_snapped'].x, self.gages['geometry_snapped'].y)
-        ]
-
-        with rasterio.open(dem_filename) as dem:
-            self.gages[column_name] = [x[0] for x in dem.sample(coord_list)]
+        (self.gages[column_name],) = sample_rasters_at_points(
+            [dem_filename], self.gages['geometry_snapped'].x.values, self.gages['geometry_snapped'].y.values
+        )
 
     def write(self, output_directory):
         '''Write to csv file'''
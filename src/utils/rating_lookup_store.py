@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import glob
+import hashlib
+import json
+import os
+import time
+from functools import reduce
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+'''
+Local lookup store for the rating curve / NWM recurrence flow sources used by the SRC calibration scripts
+(src_adjust_usgs_rating_trace.py, src_adjust_ras2fim_rating.py) and tools/rating_curve_comparison.py.
+
+Each table is parsed/joined once from its source file(s) and saved as a parquet file named after the content
+hash of the sources. Later reads reuse the parquet file (with row filters pushed down to parquet so that only
+the gages/feature_ids of interest are loaded) until a source actually changes, at which point the table is
+rebuilt. Stale versions of a table are removed once they were not used for STALE_TABLE_DAYS, so runs with
+other sources that share the store can keep reading theirs (a table removed while being read is rebuilt).
+
+The store directory defaults to a location chosen by the calling script and can be shared between runs by
+setting the `rating_lookup_store_dir` environment variable.
+'''
+
+# Increment when the logic of any table builder changes so that existing tables are rebuilt
+LOOKUP_STORE_VERSION = 1
+
+SOURCE_HASH_INDEX = 'source_hashes.json'
+
+# Days after which a stale (unused) version of a table is removed from the store
+STALE_TABLE_DAYS = 7
+
+
+def get_lookup_store_dir(default_dir):
+    '''
+    Returns the lookup store directory ($rating_lookup_store_dir if set, otherwise default_dir) and makes
+    sure it exists.
+    '''
+    store_dir = os.getenv('rating_lookup_store_dir', default_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    return store_dir
+
+
+def _write_json_atomic(data, json_path):
+    tmp_path = f'{json_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, json_path)
+
+
+def hash_source_file(store_dir, file_path):
+    '''
+    Returns the sha256 content hash of a source file.
+
+    The hash is remembered in the store (keyed by path, size and modification time) so that an unchanged
+    file is only read once.
+    '''
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    file_sig = [file_stat.st_size, file_stat.st_mtime_ns]
+
+    index_path = os.path.join(store_dir, SOURCE_HASH_INDEX)
+    hash_index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path) as f:
+                hash_index = json.load(f)
+        except ValueError:
+            # A partially written index is rebuilt
+            hash_index = {}
+
+    entry = hash_index.get(file_path)
+    if entry is not None and entry['sig'] == file_sig:
+        return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            sha.update(chunk)
+    file_hash = sha.hexdigest()
+
+    hash_index[file_path] = {'sig': file_sig, 'sha256': file_hash}
+    _write_json_atomic(hash_index, index_path)
+    return file_hash
+
+
+def get_lookup_table(store_dir, table_name, source_paths, build_function, columns=None, filters=None):
+    '''
+    Returns a lookup table from the store, building it first if it does not exist for the current sources.
+
+    Parameters
+    ----------
+    store_dir : str
+        Lookup store directory (see get_lookup_store_dir).
+    table_name : str
+        Name of the table (used in the parquet file name).
+    source_paths : list
+        Files the table is built from. The table is rebuilt when the content of any of them changes.
+    build_function : callable
+        Called with no arguments to build the table (returns a pandas DataFrame).
+    columns : list (optional)
+        Columns to read (all columns by default).
+    filters : list (optional)
+        pyarrow row filters applied when reading the table (e.g. [('feature_id', 'in', feature_ids)]).
+
+    Returns
+    -------
+    pandas DataFrame
+    '''
+    key_sha = hashlib.sha256(f'{LOOKUP_STORE_VERSION}|{table_name}'.encode())
+    for source_path in source_paths:
+        key_sha.update(hash_source_file(store_dir, source_path).encode())
+    table_key = key_sha.hexdigest()[:16]
+
+    table_path = os.path.join(store_dir, f'{table_name}_{table_key}.parquet')
+    for attempt in range(2):
+        if not os.path.isfile(table_path):
+            print(f'Building lookup table: {table_name}')
+            table_df = build_function()
+            tmp_path = f'{table_path}.{os.getpid()}.tmp'
+            table_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, table_path)
+            _remove_stale_tables(store_dir, table_name, table_path)
+
+        try:
+            # Mark the table as used, so other runs sharing the store do not remove it
+            os.utime(table_path)
+            return _read_table(table_path, columns, filters)
+        except FileNotFoundError:
+            # Removed by another run in the meantime, built again
+            if attempt > 0:
+                raise
+
+
+def _remove_stale_tables(store_dir, table_name, table_path):
+    # Remove the other versions of a table that were not used for STALE_TABLE_DAYS
+    for old_path in glob.glob(os.path.join(store_dir, f'{table_name}_*.parquet')):
+        if old_path == table_path:
+            continue
+        try:
+            if time.time() - os.path.getmtime(old_path) > STALE_TABLE_DAYS * 86400:
+                os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+def _read_table(table_path, columns, filters):
+    if filters and any(op == 'in' and len(values) == 0 for _, op, values in filters):
+        # Nothing matches an empty "in" filter (and pyarrow cannot type an empty value list)
+        empty_df = pq.read_schema(table_path).empty_table().to_pandas()
+        return empty_df[columns] if columns is not None else empty_df
+
+    return pd.read_parquet(table_path, columns=columns, filters=filters)
+
+
+def read_nwm_recurr_flows_cms(store_dir, nwm_recurr_filepath, feature_ids=None):
+    '''
+    Returns the NWM 17C recurrence flows (2, 5, 10, 25 and 50 year columns, converted to cms) from the
+    lookup store. If feature_ids is given, only those rows are read.
+    '''
+
+    def build():
+        nwm_recur_df = pd.read_csv(nwm_recurr_filepath, dtype={'feature_id': int})
+        if "Unnamed: 0" in nwm_recur_df.columns:
+            nwm_recur_df = nwm_recur_df.drop(columns=["Unnamed: 0"])
+        nwm_recur_df = nwm_recur_df.rename(
+            columns={
+                '2_0_year_recurrence_flow_17C': '2_0_year',
+                '5_0_year_recurrence_flow_17C': '5_0_year',
+                '10_0_year_recurrence_flow_17C': '10_0_year',
+                '25_0_year_recurrence_flow_17C': '25_0_year',
+                '50_0_year_recurrence_flow_17C': '50_0_year',
+            }
+        )
+
+        # convert cfs to cms (x 0.028317)
+        nwm_recur_df.loc[:, ['2_0_year', '5_0_year', '10_0_year', '25_0_year', '50_0_year']] *= 0.028317
+        return nwm_recur_df.sort_values('feature_id')
+
+    filters = None
+    if feature_ids is not None:
+        filters = [('feature_id', 'in', sorted({int(fid) for fid in feature_ids}))]
+    return get_lookup_table(store_dir, 'nwm_recurr_flows_cms', [nwm_recurr_filepath], build, filters=filters)
+
+
+def read_usgs_rating_curves(store_dir, usgs_rc_filepath, columns=None, location_ids=None):
+    '''
+    Returns the USGS rating curve database (location_id as str) from the lookup store. If location_ids is
+    given, only those gages are read.
+    '''
+
+    def build():
+        usgs_rc_df = pd.read_csv(usgs_rc_filepath, dtype={'location_id': object, 'feature_id': object})
+        return usgs_rc_df.sort_values('location_id', kind='stable')
+
+    filters = None
+    if location_ids is not None:
+        filters = [('location_id', 'in', sorted({str(loc) for loc in location_ids}))]
+    return get_lookup_table(
+        store_dir, 'usgs_rating_curves', [usgs_rc_filepath], build, columns=columns, filters=filters
+    )
+
+
+def read_nwm_recurr_intervals_cfs(store_dir, nwm_flow_dir, catfim_flows_filename, feature_ids=None):
+    '''
+    Returns the NWM 2, 5, 10, 25 and 50 year recurrence flows (nwm3_17C_recurr_<interval>_0_cms.csv files)
+    and the categorical flows melted into one long table (feature_id as str, recurr_interval, discharge_cfs)
+    from the lookup store. If feature_ids is given, only those rows are read.
+    '''
+    recurr_intervals = ("2", "5", "10", "25", "50")
+    recurr_files = [
+        os.path.join(nwm_flow_dir, 'nwm3_17C_recurr_{}_0_cms.csv'.format(interval))
+        for interval in recurr_intervals
+    ]
+
+    def build():
+        recurr_dfs = []
+        for interval, recurr_file in zip(recurr_intervals, recurr_files):
+            df = pd.read_csv(recurr_file, dtype={'feature_id': str})
+            # Update column names
+            df = df.rename(columns={"discharge": interval})
+            recurr_dfs.append(df)
+
+        # Merge NWM recurr intervals into a single layer
+        nwm_recurr_intervals_all = reduce(
+            lambda x, y: pd.merge(x, y, on='feature_id', how='outer'), recurr_dfs
+        )
+        nwm_recurr_intervals_all = pd.melt(
+            nwm_recurr_intervals_all,
+            id_vars=['feature_id'],
+            value_vars=recurr_intervals,
+            var_name='recurr_interval',
+            value_name='discharge_cms',
+        )
+
+        # Append catfim data (already set up in format similar to nwm_recurr_intervals_all)
+        cat_fim = pd.read_csv(catfim_flows_filename, dtype={'feature_id': str})
+        nwm_recurr_intervals_all = pd.concat([nwm_recurr_intervals_all, cat_fim])
+
+        # Convert discharge to cfs and filter
+        nwm_recurr_intervals_all['discharge_cfs'] = nwm_recurr_intervals_all.discharge_cms * 35.3147
+        nwm_recurr_intervals_all = nwm_recurr_intervals_all.filter(
+            items=['discharge_cfs', 'recurr_interval', 'feature_id']
+        ).drop_duplicates()
+        nwm_recurr_intervals_all['recurr_interval'] = nwm_recurr_intervals_all['recurr_interval'].astype(str)
+        return nwm_recurr_intervals_all.sort_values('feature_id', kind='stable')
+
+    filters = None
+    if feature_ids is not None:
+        filters = [('feature_id', 'in', sorted({str(fid) for fid in feature_ids}))]
+    return get_lookup_table(
+        store_dir,
+        'nwm_recurr_intervals_cfs',
+        recurr_files + [catfim_flows_filename],
+        build,
+        columns=['discharge_cfs', 'recurr_interval', 'feature_id'],
+        filters=filters,
+    )
@@ -13,6 +13,8 @@ import fiona
 import geopandas as gp
 import numpy as np
 import pandas as pd
+import rasterio
+from rasterio.windows import Window
 from tqdm import tqdm
 
 import utils.shared_variables as sv
@@ -168,6 +170,103 @@ def progress_bar_handler(executor_dict, desc):
             print('{}, {}, {}'.format(executor_dict[future], exc.__class__.__name__, exc))
 
 
+########################################################################
+# Functions to sample raster values at many points at once
+########################################################################
+def points_to_pixel_indices(transform, xs, ys):
+    '''
+    Converts arrays of x and y map coordinates to row and column pixel indices in one vectorized step.
+    Uses the same floor rounding as rasterio's DatasetReader.index.
+
+    Parameters
+    ----------
+    transform : affine.Affine
+        Geotransform of the raster.
+    xs, ys : array-like
+        Point coordinates in the raster's CRS.
+
+    Returns
+    -------
+    rows, cols : numpy.ndarray (int64)
+    '''
+    cols, rows = ~transform * (np.asarray(xs, dtype='float64'), np.asarray(ys, dtype='float64'))
+
+    return np.floor(rows).astype('int64'), np.floor(cols).astype('int64')
+
+
+def sample_rasters_at_points(raster_paths, xs, ys, band=1):
+    '''
+    Samples one or more rasters at a set of points. Instead of a small windowed read per point (as
+    DatasetReader.sample does), the points are converted to pixel indices in bulk, grouped by the
+    raster's internal blocks and each block that holds a point is read only once. Rasters that share
+    a grid reuse the same pixel indices.
+
+    Points that fall outside a raster get that raster's nodata value (or 0 if it has none), which
+    matches DatasetReader.sample.
+
+    Parameters
+    ----------
+    raster_paths : list
+        Paths to the rasters to sample. All rasters must be in the same CRS as the points.
+    xs, ys : array-like
+        Point coordinates.
+    band : int
+        Band to sample from each raster. Defaults to 1.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        One array of sampled values per raster, in the same order as raster_paths.
+    '''
+    xs = np.asarray(xs, dtype='float64')
+    ys = np.asarray(ys, dtype='float64')
+    results = []
+    grid_cache = {}
+
+    for raster_path in raster_paths:
+        with rasterio.open(raster_path) as src:
+            grid_key = (tuple(src.transform), src.height, src.width)
+            if grid_key not in grid_cache:
+                rows, cols = points_to_pixel_indices(src.transform, xs, ys)
+                inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+                grid_cache[grid_key] = (rows, cols, inside)
+            rows, cols, inside = grid_cache[grid_key]
+
+            dtype = src.dtypes[band - 1]
+            fill_value = src.nodata if src.nodata is not None else 0
+            values = np.full(len(xs), fill_value, dtype=dtype)
+
+            if inside.any():
+                block_height, block_width = src.block_shapes[band - 1]
+                pt_idx = np.flatnonzero(inside)
+                block_rows = rows[pt_idx] // block_height
+                block_cols = cols[pt_idx] // block_width
+
+                # Sort the points by block so each block's points are a contiguous run
+                order = np.lexsort((block_cols, block_rows))
+                pt_idx, block_rows, block_cols = pt_idx[order], block_rows[order], block_cols[order]
+                block_change = np.flatnonzero((np.diff(block_rows) != 0) | (np.diff(block_cols) != 0)) + 1
+                starts = np.concatenate(([0], block_change))
+                ends = np.concatenate((block_change, [len(pt_idx)]))
+
+                for start, end in zip(starts, ends):
+                    row_off = int(block_rows[start]) * block_height
+                    col_off = int(block_cols[start]) * block_width
+                    window = Window(
+                        col_off,
+                        row_off,
+                        min(block_width, src.width - col_off),
+                        min(block_height, src.height - row_off),
+                    )
+                    block = src.read(band, window=window)
+                    block_pts = pt_idx[start:end]
+                    values[block_pts] = block[rows[block_pts] - row_off, cols[block_pts] - col_off]
+
+            results.append(values)
+
+    return results
+
+
 # #####################################
 class FIM_Helpers:
     # -----------------------------------------------------------
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+
+'''
+Completion manifest of a CatFIM run, saved in the output folder as catfim_manifest.db (SQLite, so the HUC,
+interval and branch processes can all record into it at the same time).
+
+Every inundation unit (one extent tif of a HUC / lid / category / stage) is recorded when it completes,
+with the sha256 of its output tif:
+    done    the extent tif was saved
+    empty   nothing was inundated, so there is no extent tif
+    failed  the inundation raised an error
+HUCs are recorded as well once all of their lids were processed.
+
+When a run is resumed (-rs), units recorded as done (whose tif still has the recorded hash) or empty are
+skipped, as are HUCs whose units are all completed. Failed or missing units are processed again.
+'''
+
+MANIFEST_FILE_NAME = 'catfim_manifest.db'
+
+UNIT_STATUSES = ['done', 'empty', 'failed']
+
+
+@functools.lru_cache(maxsize=1024)
+def __hash_file(file_path, file_size, file_mtime_ns):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_output_file(file_path):
+    '''
+    Returns the sha256 of an output file, or None if it does not exist. Hashes are remembered by path, size
+    and modification time so a file is only read once per process.
+    '''
+    if not os.path.isfile(file_path):
+        return None
+    file_stat = os.stat(file_path)
+    return __hash_file(os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+
+
+class CatFIM_Manifest:
+    def __init__(self, output_catfim_dir, resume=False):
+        self.output_catfim_dir = output_catfim_dir
+        self.manifest_path = os.path.join(output_catfim_dir, MANIFEST_FILE_NAME)
+        self.resume = resume
+
+        with self.__connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS run_config (name TEXT PRIMARY KEY, value TEXT)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'huc TEXT, lid TEXT, category TEXT, category_key TEXT, stage REAL, status TEXT,'
+                ' output_file TEXT, output_sha256 TEXT, updated TEXT, PRIMARY KEY (huc, lid, category_key))'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS hucs (huc TEXT PRIMARY KEY, status TEXT, updated TEXT)')
+
+    def __connect(self):
+        # Each call uses its own connection, so the manifest can be passed to (and used in) MP pools
+        return closing(sqlite3.connect(self.manifest_path, timeout=300, isolation_level=None))
+
+    def __execute(self, sql, params=()):
+        with self.__connect() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def __output_file(self, output_path):
+        # Relative to the output folder, so a run can still be resumed if the folder was moved
+        return os.path.relpath(output_path, self.output_catfim_dir)
+
+    def check_run_config(self, run_config):
+        '''
+        Saves the settings the outputs depend on (e.g. the HAND folder). When resuming, raises a ValueError
+        if they are not the ones of the run being resumed.
+        '''
+        run_config = {name: json.dumps(value) for name, value in run_config.items()}
+        if self.resume:
+            saved_config = dict(self.__execute('SELECT name, value FROM run_config'))
+            changed = [name for name, value in run_config.items() if saved_config.get(name, value) != value]
+            if len(changed) > 0:
+                raise ValueError(
+                    f"Unable to resume the CatFIM run in {self.output_catfim_dir} as {changed} changed."
+                    " Use the -o flag to overwrite it instead."
+                )
+
+        with self.__connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO run_config VALUES (?, ?)', run_config.items())
+
+    def record_unit(self, huc, lid, category, category_key, stage, output_path, status):
+        '''Records a completed (done or empty) or failed unit and the hash of its output tif.'''
+        if status not in UNIT_STATUSES:
+            raise ValueError(f'status must be one of {UNIT_STATUSES}, not {status}')
+
+        self.__execute(
+            'INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                huc,
+                lid,
+                category,
+                category_key,
+                stage,
+                status,
+                self.__output_file(output_path),
+                hash_output_file(output_path) if status == 'done' else None,
+                datetime.now(timezone.utc).isoformat(),
+            ),
+        )
+
+    def __is_unit_completed(self, status, output_file, output_sha256):
+        output_path = os.path.join(self.output_catfim_dir, output_file)
+        if status == 'done':
+            return hash_output_file(output_path) == output_sha256
+        return status == 'empty' and not os.path.exists(output_path)
+
+    def is_unit_done(self, huc, lid, category_key, output_path):
+        '''True if resuming and the unit was completed by an earlier run (and its tif is unchanged).'''
+        if not self.resume:
+            return False
+
+        rows = self.__execute(
+            'SELECT status, output_file, output_sha256 FROM units'
+            ' WHERE huc = ? AND lid = ? AND category_key = ?',
+            (huc, lid, category_key),
+        )
+        if len(rows) == 0 or rows[0][1] != self.__output_file(output_path):
+            return False
+        return self.__is_unit_completed(*rows[0])
+
+    def record_huc(self, huc):
+        '''Records that all of the lids of a HUC were processed.'''
+        self.__execute(
+            'INSERT OR REPLACE INTO hucs VALUES (?, ?, ?)',
+            (huc, 'done', datetime.now(timezone.utc).isoformat()),
+        )
+
+    def is_huc_done(self, huc):
+        '''True if resuming and the HUC was processed by an earlier run with all of its units completed.'''
+        if not self.resume:
+            return False
+
+        if len(self.__execute("SELECT huc FROM hucs WHERE huc = ? AND status = 'done'", (huc,))) == 0:
+            return False
+
+        units = self.__execute('SELECT status, output_file, output_sha256 FROM units WHERE huc = ?', (huc,))
+        return all(self.__is_unit_completed(*unit) for unit in units)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import heapq
+import os
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+'''
+Flat task scheduler used by CatFIM to run all of its work over one fixed pool of worker processes.
+
+CatFIM work is a DAG of tasks: the branches of a HUC are indexed, the sites (lids) of the HUC are prepared,
+each lid is inundated once both are done and the HUC is post processed once all of its lids are done.
+Rather than nesting process pools (HUC > lid > branch / interval), every task goes into one queue:
+    - A task is queued once all of the tasks it depends on are completed, so each HUC moves on as soon as
+      it can, independently of the other HUCs.
+    - Queued tasks are started whenever a worker is free, deepest tasks first (e.g. post processing before
+      indexing a new HUC), so HUCs are completed (and their memory freed) as early as possible.
+    - Each task can give an estimate of the memory it needs. A task is only started if it fits in the memory
+      left by the running tasks (the first task always starts). Smaller queued tasks fill the free workers
+      in the meantime.
+Callbacks (when_done) run in the parent process once their tasks are completed, to add more tasks
+(e.g. one per lid once the HUC sites are known) or to record results.
+
+Configuration comes from the environment (e.g. the CatFIM .env file):
+    CATFIM_MEMORY_LIMIT_GB   Memory available to the running tasks. Defaults to 80% of the machine memory.
+'''
+
+
+def get_memory_limit_mb():
+    '''Returns the memory (MB) the running tasks can use (CATFIM_MEMORY_LIMIT_GB, see module notes).'''
+    if os.getenv('CATFIM_MEMORY_LIMIT_GB'):
+        return float(os.getenv('CATFIM_MEMORY_LIMIT_GB')) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.8 / 2**20
+
+
+class CatFIM_Task:
+    def __init__(self, key, function, args, memory_mb, depends_on, in_parent):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.memory_mb = memory_mb
+        self.in_parent = in_parent
+        self.waiting_on = set(depends_on)
+        self.dependents = []
+        self.depth = 0
+
+
+class CatFIM_Scheduler:
+    def __init__(self, max_workers, memory_limit_mb=None):
+        self.max_workers = max(1, max_workers)
+        self.memory_limit_mb = memory_limit_mb if memory_limit_mb is not None else get_memory_limit_mb()
+
+        self.tasks = {}
+        self.completed = set()
+        self.results = {}
+        self.errors = {}
+
+        self.__ready = []  # heap of (-depth, sequence, key)
+        self.__ready_callbacks = deque()
+        self.__sequence = 0
+        self.__running = {}  # future: task
+        self.__running_memory_mb = 0
+
+    def __add(self, key, function, args, memory_mb, depends_on, in_parent=False):
+        if key in self.tasks:
+            raise ValueError(f'Task {key} was already added')
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                raise ValueError(f'Task {key} depends on {dependency} which was not added')
+
+        task = CatFIM_Task(key, function, args, memory_mb, depends_on, in_parent)
+        task.waiting_on -= self.completed
+        for dependency in task.waiting_on:
+            self.tasks[dependency].dependents.append(key)
+        task.depth = max([self.tasks[dependency].depth + 1 for dependency in depends_on], default=0)
+        self.tasks[key] = task
+
+        if len(task.waiting_on) == 0:
+            self.__queue(task)
+
+    def __queue(self, task):
+        if task.in_parent:
+            self.__ready_callbacks.append(task)
+            return
+        heapq.heappush(self.__ready, (-task.depth, self.__sequence, task.key))
+        self.__sequence += 1
+
+    def submit(self, key, function, *args, memory_mb=0, depends_on=()):
+        '''
+        Adds a task running function(*args) in the pool once the tasks of depends_on (keys) are completed.
+        Its result is then available from result(key). memory_mb is the estimated memory the task needs.
+        '''
+        self.__add(key, function, args, memory_mb, depends_on)
+
+    def when_done(self, key, depends_on, callback):
+        '''
+        Adds a task calling callback() in this process once the tasks of depends_on are completed. Other
+        tasks can depend on it (e.g. on tasks added by the callback).
+        '''
+        self.__add(key, callback, (), 0, depends_on, in_parent=True)
+
+    def result(self, key):
+        '''Returns (and forgets) the result of a completed task. None if the task failed.'''
+        return self.results.pop(key, None)
+
+    def __complete(self, task, result):
+        if result is not None:
+            self.results[task.key] = result
+        self.completed.add(task.key)
+        for dependent_key in task.dependents:
+            dependent = self.tasks[dependent_key]
+            dependent.waiting_on.discard(task.key)
+            if len(dependent.waiting_on) == 0:
+                self.__queue(dependent)
+
+    def __fail(self, task):
+        self.errors[task.key] = traceback.format_exc()
+        self.__complete(task, None)
+
+    def __start_ready_tasks(self, executor):
+        skipped = []
+        while len(self.__ready) > 0 and len(self.__running) < self.max_workers:
+            ready = heapq.heappop(self.__ready)
+            task = self.tasks[ready[2]]
+
+            if len(self.__running) > 0 and self.__running_memory_mb + task.memory_mb > self.memory_limit_mb:
+                # Does not fit for now, smaller tasks queued after it can still start
+                skipped.append(ready)
+                continue
+
+            future = executor.submit(task.function, *task.args)
+            self.__running[future] = task
+            self.__running_memory_mb += task.memory_mb
+
+        for ready in skipped:
+            heapq.heappush(self.__ready, ready)
+
+    def run(self):
+        '''
+        Runs all of the tasks (including the ones added while running) until none are left.
+        Errors of failed tasks are kept in errors (key: traceback), their dependents still run.
+        '''
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while len(self.__ready_callbacks) > 0:
+                    task = self.__ready_callbacks.popleft()
+                    try:
+                        self.__complete(task, task.function())
+                    except Exception:
+                        self.__fail(task)
+
+                self.__start_ready_tasks(executor)
+                if len(self.__running) == 0:
+                    break
+
+                done, _ = wait(self.__running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = self.__running.pop(future)
+                    self.__running_memory_mb -= task.memory_mb
+                    try:
+                        self.__complete(task, future.result())
+                    except BrokenProcessPool:
+                        raise
+                    except Exception:
+                        self.__fail(task)
+
+        if len(self.completed) != len(self.tasks):
+            raise RuntimeError(f'{len(self.tasks) - len(self.completed)} tasks were never started')
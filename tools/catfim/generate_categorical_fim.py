@@ -8,18 +8,28 @@ import shutil
 import sys
 import time
 import traceback
-from concurrent.futures import ProcessPoolExecutor, as_completed, wait
 from datetime import datetime, timezone
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+from catfim_manifest import MANIFEST_FILE_NAME, CatFIM_Manifest
+from catfim_scheduler import CatFIM_Scheduler
 from dotenv import load_dotenv
 from generate_categorical_fim_flows import generate_flows
 from generate_categorical_fim_mapping import (
+    calc_hand_stage,
+    estimate_branch_index_memory_mb,
+    estimate_lid_memory_mb,
+    get_lid_branch_index,
+    index_huc_branch,
+    list_huc_branches,
     manage_catfim_mapping,
+    merge_huc_branch_index,
     post_process_cat_fim_for_viz,
     produce_stage_based_lid_tifs,
+    read_lid_branch_rems,
+    schedule_post_process_huc,
 )
 from tools_shared_functions import (
     filter_nwm_segments_by_stream_order,
@@ -27,6 +37,8 @@ from tools_shared_functions import (
     get_nwm_segs,
     get_thresholds,
     ngvd_to_navd_ft,
+    prefetch_ngvd_to_navd,
+    prefetch_thresholds,
 )
 from tools_shared_variables import (
     acceptable_alt_acc_thresh,
@@ -50,6 +62,9 @@ MP_LOG = fl.FIM_logger()  # the Multi Proc version
 
 gpd.options.io_engine = "pyogrio"
 
+# Vertical datum names (vcs) of sites whose datum is converted from NGVD29 to NAVD88
+NGVD_VCS_NAMES = ['NGVD29', 'NGVD 1929', 'NGVD,1929', 'NGVD OF 1929', 'NGVD']
+
 
 # TODO: Aug 2024: This script was upgraded significantly with lots of misc TODO's embedded.
 # Lots of inline documenation needs updating as well
@@ -88,6 +103,7 @@ def process_generate_categorical_fim(
     past_major_interval_cap,
     step_num,
     nwm_metafile,
+    resume=False,
 ):
 
     # ================================
@@ -130,7 +146,17 @@ def process_generate_categorical_fim(
 
     # ================================
     set_start_files_folders(
-        step_num, output_catfim_dir, output_mapping_dir, output_flows_dir, attributes_dir, overwrite
+        step_num, output_catfim_dir, output_mapping_dir, output_flows_dir, attributes_dir, overwrite, resume
+    )
+
+    # Records each completed HUC / lid / category / stage so an interrupted run can be resumed (-rs)
+    manifest = CatFIM_Manifest(output_catfim_dir, resume)
+    manifest.check_run_config(
+        {
+            'fim_run_dir': os.path.abspath(fim_run_dir),
+            'search': search,
+            'past_major_interval_cap': past_major_interval_cap,
+        }
     )
 
     FLOG.trace("locals...")
@@ -259,11 +285,13 @@ def process_generate_categorical_fim(
 
         catfim_sites_file_path = os.path.join(output_mapping_dir, 'stage_based_catfim_sites.gpkg')
 
+        # HUCs already post processed while inundating (see schedule_post_process_huc)
+        post_processed_hucs = []
         if step_num <= 1:
 
             df_restricted_sites = load_restricted_sites(is_stage_based)
 
-            generate_stage_based_categorical_fim(
+            post_processed_hucs = generate_stage_based_categorical_fim(
                 output_catfim_dir,
                 fim_run_dir,
                 nwm_us_search,
@@ -276,6 +304,7 @@ def process_generate_categorical_fim(
                 past_major_interval_cap,
                 nwm_metafile,
                 df_restricted_sites,
+                manifest,
             )
         else:
             FLOG.lprint("generate_stage_based_categorical_fim step skipped")
@@ -290,7 +319,13 @@ def process_generate_categorical_fim(
 
             ahps_jobs = job_number_huc * 5
             post_process_cat_fim_for_viz(
-                catfim_method, output_catfim_dir, ahps_jobs, catfim_version, model_version, FLOG.LOG_FILE_PATH
+                catfim_method,
+                output_catfim_dir,
+                ahps_jobs,
+                catfim_version,
+                model_version,
+                FLOG.LOG_FILE_PATH,
+                post_processed_hucs,
             )
         else:
             FLOG.lprint("post_process_cat_fim_for_viz step skipped")
@@ -342,6 +377,7 @@ def process_generate_categorical_fim(
                 job_number_huc,
                 job_number_inundate,
                 FLOG.LOG_FILE_PATH,
+                manifest=manifest,
             )
         else:
             FLOG.lprint("manage_catfim_mapping step skipped")
@@ -481,9 +517,6 @@ def iterate_through_huc_stage_based(
     huc_dictionary,
     threshold_url,
     all_lists,
-    past_major_interval_cap,
-    job_number_inundate,
-    job_number_intervals,
     nwm_flows_region_df,
     df_restricted_sites,
     parent_log_output_file,
@@ -491,7 +524,11 @@ def iterate_through_huc_stage_based(
     progress_stmt,
 ):
     """_summary_
-    This and its children will create stage based tifs and catfim data based on a huc
+    This checks the thresholds, gage elevations, datums and segments of the lids of a huc. The lids that pass
+    are then inundated (stage based tifs and catfim data) by inundate_lid_stage_based, one task per lid.
+
+    Returns (all_messages, lid_sites): the messages of the lids and the lids to inundate (dicts of the
+    values computed here), or None if there was an error.
     """
 
     try:
@@ -504,11 +541,9 @@ def iterate_through_huc_stage_based(
         MP_LOG.lprint("")
 
         all_messages = []
-        stage_based_att_dict = {}
+        lid_sites = []
 
         mapping_dir = os.path.join(output_catfim_dir, "mapping")
-        attributes_dir = os.path.join(output_catfim_dir, 'attributes')
-        huc_messages_dir = os.path.join(mapping_dir, 'huc_messages')
 
         # Make output directory for the particular huc in the mapping folder
         mapping_huc_directory = os.path.join(mapping_dir, huc)
@@ -549,32 +584,9 @@ def iterate_through_huc_stage_based(
         if skip_lid_process == False:  # else skip to message processing
             usgs_elev_df = pd.read_csv(usgs_elev_table)
 
-            df_cols = {
-                "nws_lid": pd.Series(dtype='str'),
-                "name": pd.Series(dtype='str'),
-                "WFO": pd.Series(dtype='str'),
-                "rfc": pd.Series(dtype='str'),
-                "huc": pd.Series(dtype='str'),
-                "state": pd.Series(dtype='str'),
-                "county": pd.Series(dtype='str'),
-                "magnitude": pd.Series(dtype='str'),
-                "q": pd.Series(dtype='str'),
-                "q_uni": pd.Series(dtype='str'),
-                "q_src": pd.Series(dtype='str'),
-                "stage": pd.Series(dtype='float'),
-                "stage_uni": pd.Series(dtype='str'),
-                "s_src": pd.Series(dtype='str'),
-                "wrds_time": pd.Series(dtype='str'),
-                "nrldb_time": pd.Series(dtype='str'),
-                "nwis_time": pd.Series(dtype='str'),
-                "lat": pd.Series(dtype='float'),
-                "lon": pd.Series(dtype='float'),
-                "dtm_adj_ft": pd.Series(dtype='str'),
-                "dadj_w_ft": pd.Series(dtype='float'),
-                "dadj_w_m": pd.Series(dtype='float'),
-                "lid_alt_ft": pd.Series(dtype='float'),
-                "lid_alt_m": pd.Series(dtype='float'),
-            }
+            # Fetch the thresholds of all of the HUC's lids at once (bounded by WRDS_MAX_WORKERS), the
+            # get_thresholds calls below are then answered from the WRDS client cache
+            prefetch_thresholds(threshold_url, 'nws_lid', [lid.lower() for lid in nws_lids], threshold='all')
 
             for lid in nws_lids:
 
@@ -672,9 +684,6 @@ def iterate_through_huc_stage_based(
                 if len(dem_eval_messages) > 0:
                     continue
 
-                # Initialize nested dict for lid attributes
-                stage_based_att_dict.update({lid: {}})
-
                 # Find lid metadata from master list of metadata dictionaries.
                 metadata = next(
                     (item for item in all_lists if item['identifiers']['nws_lid'] == lid.upper()), False
@@ -742,319 +751,386 @@ def iterate_through_huc_stage_based(
                     MP_LOG.warning(huc_lid_id + msg)
                     continue
 
-                # This function sometimes is called within a MP but sometimes not.
-                # So, we might have an MP inside an MP
-                # and we will need a new prefix for it.
+                # The lid is inundated by its own task once the HUC branches are indexed
+                lid_sites.append(
+                    {
+                        'lid': lid,
+                        'segments': segments,
+                        'stage_values_df': stage_values_df,
+                        'valid_stage_names': valid_stage_names,
+                        'stage_warning_msg': stage_warning_msg,
+                        'datum_adj_ft': datum_adj_ft,
+                        'lid_usgs_elev': lid_usgs_elev,
+                        'lid_altitude': lid_altitude,
+                        'metadata': metadata,
+                        'thresholds': thresholds,
+                        'flows': flows,
+                    }
+                )
+            # end of for loop
+        # end of if
 
-                # For each flood category / magnitude
-                MP_LOG.lprint(f"{huc_lid_id}: About to process flood categories")
-                # child_log_file_prefix_tifs = MP_LOG.MP_calc_prefix_name(
-                #     MP_LOG.LOG_FILE_PATH, child_log_file_prefix + "_MP_tifs"
-                # )
+        return all_messages, lid_sites
 
-                # Make mapping lid_directory.
-                mapping_lid_directory = os.path.join(mapping_huc_directory, lid)
-                if not os.path.exists(mapping_lid_directory):
-                    os.mkdir(mapping_lid_directory)
+    except Exception:
+        MP_LOG.error(f"{huc} : {lid} Error iterating through huc stage based")
+        MP_LOG.error(traceback.format_exc())
 
-                # Check whether stage value is actually a WSE value, and fix if needed:
-                # Get lowest stage value
-                lowest_stage_val = stage_values_df['stage_value'].min()
+    return None
 
-                maximum_stage_threshold = 250  # TODO: Move to a variables file?
 
-                # Make an "rfc_stage" column for better documentation which shows the original
-                # uncorrect WRDS value before we adjsuted it for inundation
-                stage_values_df['rfc_stage'] = stage_values_df['stage_value']
+# This is part of an MP call and needs MP_LOG
+def inundate_lid_stage_based(
+    output_catfim_dir,
+    huc,
+    lid_site,
+    lid_index_df,
+    past_major_interval_cap,
+    manifest,
+    parent_log_output_file,
+    child_log_file_prefix,
+):
+    """
+    Creates the stage based tifs (categories and intervals) and the attributes csv of a lid checked by
+    iterate_through_huc_stage_based. The branch rems of the lid (from lid_index_df, its rows of the HUC
+    index) are read once for all of its stages and intervals.
+    Stages already inundated by an earlier run are skipped when resuming (see catfim_manifest)
 
-                # Stage value is larger than the elevation value AND greater than the
-                # maximum stage threshold, subtract the elev from the "stage" value
-                # to get the actual stage
+    Returns the messages of the lid, or None if there was an error.
+    """
 
-                if (lowest_stage_val > lid_altitude) and (lowest_stage_val > maximum_stage_threshold):
-                    stage_values_df['stage_value'] = stage_values_df['stage_value'] - lid_altitude
-                    MP_LOG.lprint(
-                        f"{huc_lid_id}: Lowest stage val > elev and higher than max stage thresh. Subtracted elev from stage vals to fix."
-                    )
+    lid = lid_site['lid']
+    try:
+        # This is setting up logging for this function to go up to the parent
+        # child_log_file_prefix is likely MP_iter_hucs
+        MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
 
-                # +++++++++++++++++++++++++++++
-                # This section is for inundating stages and intervals come later
+        huc_lid_id = f"{huc} : {lid}"
+        all_messages = []
+        stage_based_att_dict = {lid: {}}
 
-                # At this point we have at least one valid stage/category
-                # cyle through on the stages that are valid
-                # This are not interval values
-                for idx, stage_row in stage_values_df.iterrows():
-                    # MP_LOG.lprint(f"{huc_lid_id}: Magnitude is {category}")
-                    # Pull stage value and confirm it's valid, then process
+        mapping_huc_directory = os.path.join(output_catfim_dir, "mapping", huc)
+        attributes_dir = os.path.join(output_catfim_dir, 'attributes')
 
-                    category = stage_row['stage_name']
-                    stage_value = stage_row['stage_value']
+        segments = lid_site['segments']
+        stage_values_df = lid_site['stage_values_df']
+        valid_stage_names = lid_site['valid_stage_names']
+        stage_warning_msg = lid_site['stage_warning_msg']
+        datum_adj_ft = lid_site['datum_adj_ft']
+        lid_usgs_elev = lid_site['lid_usgs_elev']
+        lid_altitude = lid_site['lid_altitude']
+        metadata = lid_site['metadata']
+        thresholds = lid_site['thresholds']
+        flows = lid_site['flows']
+
+        df_cols = {
+            "nws_lid": pd.Series(dtype='str'),
+            "name": pd.Series(dtype='str'),
+            "WFO": pd.Series(dtype='str'),
+            "rfc": pd.Series(dtype='str'),
+            "huc": pd.Series(dtype='str'),
+            "state": pd.Series(dtype='str'),
+            "county": pd.Series(dtype='str'),
+            "magnitude": pd.Series(dtype='str'),
+            "q": pd.Series(dtype='str'),
+            "q_uni": pd.Series(dtype='str'),
+            "q_src": pd.Series(dtype='str'),
+            "stage": pd.Series(dtype='float'),
+            "stage_uni": pd.Series(dtype='str'),
+            "s_src": pd.Series(dtype='str'),
+            "wrds_time": pd.Series(dtype='str'),
+            "nrldb_time": pd.Series(dtype='str'),
+            "nwis_time": pd.Series(dtype='str'),
+            "lat": pd.Series(dtype='float'),
+            "lon": pd.Series(dtype='float'),
+            "dtm_adj_ft": pd.Series(dtype='str'),
+            "dadj_w_ft": pd.Series(dtype='float'),
+            "dadj_w_m": pd.Series(dtype='float'),
+            "lid_alt_ft": pd.Series(dtype='float'),
+            "lid_alt_m": pd.Series(dtype='float'),
+        }
+
+        # For each flood category / magnitude
+        MP_LOG.lprint(f"{huc_lid_id}: About to process flood categories")
+
+        # Make mapping lid_directory.
+        mapping_lid_directory = os.path.join(mapping_huc_directory, lid)
+        if not os.path.exists(mapping_lid_directory):
+            os.mkdir(mapping_lid_directory)
+
+        # Check whether stage value is actually a WSE value, and fix if needed:
+        # Get lowest stage value
+        lowest_stage_val = stage_values_df['stage_value'].min()
+
+        maximum_stage_threshold = 250  # TODO: Move to a variables file?
+
+        # Make an "rfc_stage" column for better documentation which shows the original
+        # uncorrect WRDS value before we adjsuted it for inundation
+        stage_values_df['rfc_stage'] = stage_values_df['stage_value']
+
+        # Stage value is larger than the elevation value AND greater than the
+        # maximum stage threshold, subtract the elev from the "stage" value
+        # to get the actual stage
+
+        if (lowest_stage_val > lid_altitude) and (lowest_stage_val > maximum_stage_threshold):
+            stage_values_df['stage_value'] = stage_values_df['stage_value'] - lid_altitude
+            MP_LOG.lprint(
+                f"{huc_lid_id}: Lowest stage val > elev and higher than max stage thresh. Subtracted elev from stage vals to fix."
+            )
 
-                    # messages already included in the stage_warning_msg above
-                    if stage_value == -1:
-                        continue
+        # The rem / catchments of each branch are read once for all of the stages and intervals
+        # of the lid (cells of the lid's catchments only), but only when one of them has not
+        # been completed yet by an earlier run. If none of the branches hold the lid's segments,
+        # no stage can inundate and the lid is reported below as "All stages failed to inundate"
+        branch_rems = None
 
-                    MP_LOG.trace(f"About to create tifs for {huc_lid_id} : {category} : {stage_value}")
+        # +++++++++++++++++++++++++++++
+        # This section is for inundating stages and intervals come later
 
-                    # datum_adj_ft should not be None at this point
-                    # Call function to execute mapping of the TIFs.
+        # At this point we have at least one valid stage/category
+        # cyle through on the stages that are valid
+        # This are not interval values
+        for idx, stage_row in stage_values_df.iterrows():
+            # MP_LOG.lprint(f"{huc_lid_id}: Magnitude is {category}")
+            # Pull stage value and confirm it's valid, then process
 
-                    # Calcluate a portion of the file name which includes the category,
-                    # a formatted stage value and a possible "i" to show it is an interval file
-                    category_key = __calculate_category_key(category, stage_value, False)
+            category = stage_row['stage_name']
+            stage_value = stage_row['stage_value']
 
-                    # These are the up to 5 magnitudes being inundated at their stage value
-                    (messages, hand_stage, datum_adj_wse, datum_adj_wse_m) = produce_stage_based_lid_tifs(
-                        stage_value,
-                        datum_adj_ft,
-                        branch_dir,
-                        lid_usgs_elev,
-                        lid_altitude,
-                        fim_dir,
-                        segments,
-                        lid,
-                        huc,
-                        mapping_lid_directory,
-                        category,
-                        category_key,
-                        job_number_inundate,
-                        MP_LOG.LOG_FILE_PATH,
-                        child_log_file_prefix,
-                    )
+            # messages already included in the stage_warning_msg above
+            if stage_value == -1:
+                continue
 
-                    # If we get a message back, then something went wrong with the site adn we need to
-                    # remove it as a valid site
-
-                    all_messages += messages
-
-                    # Extra metadata for alternative CatFIM technique.
-                    # TODO Revisit because branches complicate things
-                    stage_based_att_dict[lid].update(
-                        {
-                            category: {
-                                'datum_adj_wse_ft': datum_adj_wse,
-                                'datum_adj_wse_m': datum_adj_wse_m,
-                                'hand_stage': hand_stage,
-                                'datum_adj_ft': datum_adj_ft,
-                                'lid_alt_ft': lid_altitude,
-                                'lid_alt_m': lid_altitude * 0.3048,
-                            }
-                        }
-                    )
+            MP_LOG.trace(f"About to create tifs for {huc_lid_id} : {category} : {stage_value}")
 
-                    # Let's see any tifs made it, if not.. change this to an invalid stage value
-                    stage_file_name = os.path.join(
-                        mapping_lid_directory, lid + '_' + category_key + '_extent.tif'
-                    )
-                    if os.path.exists(stage_file_name) == False:
-                        # somethign failed and we didn't get a rolled up extent file, so we need to reject the stage
-                        stage_values_df.at[idx, 'stage_value'] = -1
+            # datum_adj_ft should not be None at this point
+            # Call function to execute mapping of the TIFs.
+
+            # Calcluate a portion of the file name which includes the category,
+            # a formatted stage value and a possible "i" to show it is an interval file
+            category_key = __calculate_category_key(category, stage_value, False)
+            stage_file_name = os.path.join(mapping_lid_directory, lid + '_' + category_key + '_extent.tif')
 
-                # So, we might have an MP inside an MP
-                # let's merge what we have at this point, before we go into another MP
-                # MP_LOG.merge_log_files(MP_LOG.LOG_FILE_PATH, child_log_file_prefix_tifs, True)
+            if manifest.is_unit_done(huc, lid, category_key, stage_file_name):
+                MP_LOG.trace(f"{huc_lid_id} : {category_key} : already completed, skipped")
+                messages = []
+                hand_stage, datum_adj_wse, datum_adj_wse_m = calc_hand_stage(
+                    stage_value, datum_adj_ft, lid_usgs_elev, lid_altitude
+                )
+            else:
+                if branch_rems is None:
+                    branch_rems = read_lid_branch_rems(lid_index_df, lid, huc)
+
+                # These are the up to 5 magnitudes being inundated at their stage value
+                (messages, hand_stage, datum_adj_wse, datum_adj_wse_m) = produce_stage_based_lid_tifs(
+                    stage_value,
+                    datum_adj_ft,
+                    branch_rems,
+                    lid_usgs_elev,
+                    lid_altitude,
+                    segments,
+                    lid,
+                    huc,
+                    mapping_lid_directory,
+                    category,
+                    category_key,
+                    manifest,
+                )
 
-                # we do intervals only on non-record and valid stages
-                non_rec_stage_values_df_unsorted = stage_values_df[
-                    (stage_values_df["stage_value"] != -1) & (stage_values_df["stage_name"] != 'record')
-                ]
+            # If we get a message back, then something went wrong with the site adn we need to
+            # remove it as a valid site
+
+            all_messages += messages
+
+            # Extra metadata for alternative CatFIM technique.
+            # TODO Revisit because branches complicate things
+            stage_based_att_dict[lid].update(
+                {
+                    category: {
+                        'datum_adj_wse_ft': datum_adj_wse,
+                        'datum_adj_wse_m': datum_adj_wse_m,
+                        'hand_stage': hand_stage,
+                        'datum_adj_ft': datum_adj_ft,
+                        'lid_alt_ft': lid_altitude,
+                        'lid_alt_m': lid_altitude * 0.3048,
+                    }
+                }
+            )
 
-                non_rec_stage_values_df = non_rec_stage_values_df_unsorted.sort_values(
-                    by='stage_value'
-                ).reset_index()
+            # Let's see any tifs made it, if not.. change this to an invalid stage value
+            if os.path.exists(stage_file_name) == False:
+                # somethign failed and we didn't get a rolled up extent file, so we need to reject the stage
+                stage_values_df.at[idx, 'stage_value'] = -1
 
-                # MP_LOG.trace(f"non_rec_stage_values_df is {non_rec_stage_values_df}")
+        # we do intervals only on non-record and valid stages
+        non_rec_stage_values_df_unsorted = stage_values_df[
+            (stage_values_df["stage_value"] != -1) & (stage_values_df["stage_name"] != 'record')
+        ]
 
-                # +++++++++++++++++++++++++++++
-                # Creating interval tifs (if applicable)
+        non_rec_stage_values_df = non_rec_stage_values_df_unsorted.sort_values(by='stage_value').reset_index()
 
-                # We already inundated and created files for the specific stages just not the intervals
-                # Make list of interval recs to be created
-                interval_list = []  # might stay empty
+        # MP_LOG.trace(f"non_rec_stage_values_df is {non_rec_stage_values_df}")
 
-                num_non_rec_stages = len(non_rec_stage_values_df)
-                if num_non_rec_stages > 0:
+        # +++++++++++++++++++++++++++++
+        # Creating interval tifs (if applicable)
 
-                    interval_list = __calc_stage_intervals(
-                        non_rec_stage_values_df, past_major_interval_cap, huc_lid_id
-                    )
+        # We already inundated and created files for the specific stages just not the intervals
+        # Make list of interval recs to be created
+        interval_list = []  # might stay empty
 
-                    tif_child_log_file_prefix = MP_LOG.MP_calc_prefix_name(
-                        parent_log_output_file, "MP_sb_interval_tifs"
-                    )
+        num_non_rec_stages = len(non_rec_stage_values_df)
+        if num_non_rec_stages > 0:
 
-                    # Now we add the interval tifs but no interval tifs for the "record" stage if there is one.
-                    with ProcessPoolExecutor(max_workers=job_number_intervals) as executor:
-                        try:
-
-                            for interval_rec in interval_list:  # list of lists
-
-                                category = interval_rec[0]  # stage name
-                                interval_stage_value = interval_rec[1]
-
-                                # Calcluate a portion of the file name which includes the category,
-                                # a formatted stage value and a possible "i" to show it is an interval file
-                                category_key = __calculate_category_key(category, interval_stage_value, True)
-
-                                executor.submit(
-                                    produce_stage_based_lid_tifs,
-                                    interval_stage_value,
-                                    datum_adj_ft,
-                                    branch_dir,
-                                    lid_usgs_elev,
-                                    lid_altitude,
-                                    fim_dir,
-                                    segments,
-                                    lid,
-                                    huc,
-                                    mapping_lid_directory,
-                                    category,
-                                    category_key,
-                                    job_number_inundate,
-                                    parent_log_output_file,
-                                    tif_child_log_file_prefix,
-                                )
-                        except TypeError:  # sometimes the thresholds are Nonetypes
-                            MP_LOG.error(
-                                f"{huc_lid_id}: ERROR: type error in ProcessPool,"
-                                " likely in the interval code"
-                            )
-                            MP_LOG.error(traceback.format_exc())
-                            continue
-
-                        except Exception:
-                            MP_LOG.critical(f"{huc_lid_id}: ERROR: ProcessPool has an error")
-                            MP_LOG.critical(traceback.format_exc())
-                            # merge MP Logs (Yes)
-                            MP_LOG.merge_log_files(parent_log_output_file, tif_child_log_file_prefix, True)
-                            sys.exit(1)
-
-                    # merge MP Logs (merging MP into an MP (proc_pool in a proc_pool))
-                    MP_LOG.merge_log_files(parent_log_output_file, tif_child_log_file_prefix, True)
+            interval_list = __calc_stage_intervals(
+                non_rec_stage_values_df, past_major_interval_cap, huc_lid_id
+            )
 
+            # Only the intervals not completed by an earlier run are inundated
+            pending_interval_list = []
+            for category, interval_stage_value in interval_list:
+                category_key = __calculate_category_key(category, interval_stage_value, True)
+                interval_file_name = os.path.join(
+                    mapping_lid_directory, lid + '_' + category_key + '_extent.tif'
+                )
+                if manifest.is_unit_done(huc, lid, category_key, interval_file_name):
+                    MP_LOG.trace(f"{huc_lid_id} : {category_key} : already completed, skipped")
                 else:
-                    MP_LOG.lprint(
-                        f"{huc_lid_id}: Skipping intervals as there are not any 'non-record' stages"
+                    pending_interval_list.append((category, interval_stage_value, category_key))
+
+            if len(pending_interval_list) > 0 and branch_rems is None:
+                branch_rems = read_lid_branch_rems(lid_index_df, lid, huc)
+
+            # Now we add the interval tifs but no interval tifs for the "record" stage if there is one.
+            # They only compare the branch rems already read with their stage, so they are created in
+            # this task rather than in tasks of their own
+            try:
+                # category_key is a portion of the file name which includes the category,
+                # a formatted stage value and an "i" to show it is an interval file
+                for category, interval_stage_value, category_key in pending_interval_list:
+                    produce_stage_based_lid_tifs(
+                        interval_stage_value,
+                        datum_adj_ft,
+                        branch_rems,
+                        lid_usgs_elev,
+                        lid_altitude,
+                        segments,
+                        lid,
+                        huc,
+                        mapping_lid_directory,
+                        category,
+                        category_key,
+                        manifest,
                     )
+            except TypeError:  # sometimes the thresholds are Nonetypes
+                MP_LOG.error(f"{huc_lid_id}: ERROR: type error, likely in the interval code")
+                MP_LOG.error(traceback.format_exc())
+                return all_messages
 
-                # end of skip_add_intervals == False
+        else:
+            MP_LOG.lprint(f"{huc_lid_id}: Skipping intervals as there are not any 'non-record' stages")
 
-                # For each valid stage, and if all goes well, they should have files
-                # that end with "_extent.tif". If there is anything between _extent and .tif
-                # it is a branch file adn our test is it at least one rollup exists
-                inundate_lid_files = glob.glob(f"{mapping_lid_directory}/*_extent.tif")
-                if len(inundate_lid_files) == 0:
-                    msg = ':All stages failed to inundate'
-                    all_messages.append(lid + msg)
-                    MP_LOG.warning(huc_lid_id + msg)
-                    continue
+        # end of skip_add_intervals == False
 
-                # Create a csv with same information as geopackage but with each threshold as new record.
-                # Probably a less verbose way.
-                csv_df = pd.DataFrame(df_cols)  # for first appending
-
-                # for threshold in categories:  (threshold and category are somewhat interchangeable)
-                # some may have failed inundation, which we will rectify later
-                MP_LOG.trace(f"{huc_lid_id}: updating threshhold values")
-
-                for threshold in valid_stage_names:
-
-                    try:
-
-                        # we don't know if the magnitude/stage can be mapped yes it hasn't been inundated
-                        line_df = pd.DataFrame(
-                            {
-                                'nws_lid': [lid],
-                                'name': metadata['nws_data']['name'],
-                                'WFO': metadata['nws_data']['wfo'],
-                                'rfc': metadata['nws_data']['rfc'],
-                                'huc': [huc],
-                                'state': metadata['nws_data']['state'],
-                                'county': metadata['nws_data']['county'],
-                                'magnitude': threshold,
-                                'q': flows[threshold],
-                                'q_uni': flows['units'],
-                                'q_src': flows['source'],
-                                'rfs_stage': stage_values_df.loc[stage_values_df['stage_name'] == threshold][
-                                    'rfc_stage'
-                                ],
-                                'stage': stage_values_df.loc[stage_values_df['stage_name'] == threshold][
-                                    'stage_value'
-                                ],
-                                'stage_uni': thresholds['units'],
-                                's_src': thresholds['source'],
-                                'wrds_time': thresholds['wrds_timestamp'],
-                                'nrldb_time': metadata['nrldb_timestamp'],
-                                'nwis_time': metadata['nwis_timestamp'],
-                                'lat': [float(metadata['nws_preferred']['latitude'])],
-                                'lon': [float(metadata['nws_preferred']['longitude'])],
-                                'dtm_adj_ft': stage_based_att_dict[lid][threshold]['datum_adj_ft'],
-                                'dadj_w_ft': stage_based_att_dict[lid][threshold]['datum_adj_wse_ft'],
-                                'dadj_w_m': stage_based_att_dict[lid][threshold]['datum_adj_wse_m'],
-                                'lid_alt_ft': stage_based_att_dict[lid][threshold]['lid_alt_ft'],
-                                'lid_alt_m': stage_based_att_dict[lid][threshold]['lid_alt_m'],
-                                'mapped': '',
-                                'status': '',
-                            }
-                        )
-                        csv_df = pd.concat([csv_df, line_df], ignore_index=True)
-
-                    except Exception:
-                        # is this the text we want users to see
-                        msg = f':Error with threshold {threshold}'
-                        all_messages.append(lid + msg)
-                        MP_LOG.error(huc_lid_id + msg)
-                        MP_LOG.error(traceback.format_exc())
-                        continue
-                        # sys.exit(1)
-
-                # might be that none of the lids for this HUC passed
-                # If a site folder exists (ie a flow file was written) save files containing site attributes.
-                # if os.path.exists(mapping_lid_directory):
-                if len(csv_df) > 0:
-                    # Round flow and stage columns to 2 decimal places.
-                    csv_df = csv_df.round({'q': 2, 'stage': 2})
-
-                    # Export DataFrame to csv containing attributes
-                    attributes_filepath = os.path.join(attributes_dir, f'{lid}_attributes.csv')
-                    csv_df.to_csv(attributes_filepath, index=False)
-
-                    # If it made it to this point (i.e. no continues), there were no major preventers of mapping
-                    # well.. mostly. If it fails, we can change back to
-
-                    if stage_warning_msg == "":  # does not mean the lid is good.
-                        all_messages.append(lid + ':Good')
-                    else:  # we will leave the ":---" on it for now if it is does have a warnning message
-                        all_messages.append(lid + stage_warning_msg)
-                        MP_LOG.warning(huc_lid_id + stage_warning_msg)
-                else:
-                    msg = ':Missing all calculated flows'
-                    all_messages.append(lid + msg)
-                    MP_LOG.error(huc_lid_id + msg)
-
-                # MP_LOG.success(f'{huc_lid_id}: Complete')
-                # mark_complete(mapping_lid_directory)
-            # end of for loop
-        # end of if
+        # For each valid stage, and if all goes well, they should have files
+        # that end with "_extent.tif". If there is anything between _extent and .tif
+        # it is a branch file adn our test is it at least one rollup exists
+        inundate_lid_files = glob.glob(f"{mapping_lid_directory}/*_extent.tif")
+        if len(inundate_lid_files) == 0:
+            msg = ':All stages failed to inundate'
+            all_messages.append(lid + msg)
+            MP_LOG.warning(huc_lid_id + msg)
+            return all_messages
+
+        # Create a csv with same information as geopackage but with each threshold as new record.
+        # Probably a less verbose way.
+        csv_df = pd.DataFrame(df_cols)  # for first appending
+
+        # for threshold in categories:  (threshold and category are somewhat interchangeable)
+        # some may have failed inundation, which we will rectify later
+        MP_LOG.trace(f"{huc_lid_id}: updating threshhold values")
+
+        for threshold in valid_stage_names:
+
+            try:
+
+                # we don't know if the magnitude/stage can be mapped yes it hasn't been inundated
+                line_df = pd.DataFrame(
+                    {
+                        'nws_lid': [lid],
+                        'name': metadata['nws_data']['name'],
+                        'WFO': metadata['nws_data']['wfo'],
+                        'rfc': metadata['nws_data']['rfc'],
+                        'huc': [huc],
+                        'state': metadata['nws_data']['state'],
+                        'county': metadata['nws_data']['county'],
+                        'magnitude': threshold,
+                        'q': flows[threshold],
+                        'q_uni': flows['units'],
+                        'q_src': flows['source'],
+                        'rfs_stage': stage_values_df.loc[stage_values_df['stage_name'] == threshold][
+                            'rfc_stage'
+                        ],
+                        'stage': stage_values_df.loc[stage_values_df['stage_name'] == threshold][
+                            'stage_value'
+                        ],
+                        'stage_uni': thresholds['units'],
+                        's_src': thresholds['source'],
+                        'wrds_time': thresholds['wrds_timestamp'],
+                        'nrldb_time': metadata['nrldb_timestamp'],
+                        'nwis_time': metadata['nwis_timestamp'],
+                        'lat': [float(metadata['nws_preferred']['latitude'])],
+                        'lon': [float(metadata['nws_preferred']['longitude'])],
+                        'dtm_adj_ft': stage_based_att_dict[lid][threshold]['datum_adj_ft'],
+                        'dadj_w_ft': stage_based_att_dict[lid][threshold]['datum_adj_wse_ft'],
+                        'dadj_w_m': stage_based_att_dict[lid][threshold]['datum_adj_wse_m'],
+                        'lid_alt_ft': stage_based_att_dict[lid][threshold]['lid_alt_ft'],
+                        'lid_alt_m': stage_based_att_dict[lid][threshold]['lid_alt_m'],
+                        'mapped': '',
+                        'status': '',
+                    }
+                )
+                csv_df = pd.concat([csv_df, line_df], ignore_index=True)
 
-        # Write all_messages by HUC to be scraped later.
-        if len(all_messages) > 0:
+            except Exception:
+                # is this the text we want users to see
+                msg = f':Error with threshold {threshold}'
+                all_messages.append(lid + msg)
+                MP_LOG.error(huc_lid_id + msg)
+                MP_LOG.error(traceback.format_exc())
+                continue
+                # sys.exit(1)
+
+        # might be that none of the lids for this HUC passed
+        # If a site folder exists (ie a flow file was written) save files containing site attributes.
+        # if os.path.exists(mapping_lid_directory):
+        if len(csv_df) > 0:
+            # Round flow and stage columns to 2 decimal places.
+            csv_df = csv_df.round({'q': 2, 'stage': 2})
+
+            # Export DataFrame to csv containing attributes
+            attributes_filepath = os.path.join(attributes_dir, f'{lid}_attributes.csv')
+            csv_df.to_csv(attributes_filepath, index=False)
+
+            # If it made it to this point (i.e. no continues), there were no major preventers of mapping
+            # well.. mostly. If it fails, we can change back to
+
+            if stage_warning_msg == "":  # does not mean the lid is good.
+                all_messages.append(lid + ':Good')
+            else:  # we will leave the ":---" on it for now if it is does have a warnning message
+                all_messages.append(lid + stage_warning_msg)
+                MP_LOG.warning(huc_lid_id + stage_warning_msg)
+        else:
+            msg = ':Missing all calculated flows'
+            all_messages.append(lid + msg)
+            MP_LOG.error(huc_lid_id + msg)
 
-            # TODO: Aug 2024: This is now identical to the way flow handles messages
-            # but the system should probably be changed to somethign more elegant but good enough
-            # for now. At least is is MP safe.
-            huc_messages_txt_file = os.path.join(huc_messages_dir, str(huc) + '_messages.txt')
-            with open(huc_messages_txt_file, 'w') as f:
-                for item in all_messages:
-                    item = item.strip()
-                    # f.write("%s\n" % item)
-                    f.write(f"{item}\n")
+        return all_messages
 
     except Exception:
-        MP_LOG.error(f"{huc} : {lid} Error iterating through huc stage based")
+        MP_LOG.error(f"{huc} : {lid} Error inundating the lid stage based")
         MP_LOG.error(traceback.format_exc())
 
-    return
+    return None
 
 
 def __calc_stage_values(categories, thresholds):
@@ -1263,47 +1339,18 @@ def load_restricted_sites(is_stage_based):
     return df_restricted_sites
 
 
-def __adjust_datum_ft(flows, metadata, lid, huc_lid_id):
-
-    # TODO: Aug 2024: This whole parts needs revisiting. Lots of lid data has changed and this
-    # is all likely very old.
-
-    # Jul 2024: For now, we will duplicate messages via all_messsages and via the logging system.
-    all_messages = []
-
-    datum_adj_ft = None
-    ### --- Do Datum Offset --- ###
-    # determine source of interpolated threshold flows, this will be the rating curve that will be used.
-    rating_curve_source = flows.get('source')
-
-    # MP_LOG.trace(f"{huc_lid_id} : rating_curve_source is {rating_curve_source}")
-
-    if rating_curve_source is None:
-        msg = ':No source for rating curve'
-        all_messages.append(lid + msg)
-        MP_LOG.warning(huc_lid_id + msg)
-        return None, all_messages
-
-    # Get the datum and adjust to NAVD if necessary.
+def __get_lid_datum_data(rating_curve_source, metadata, lid):
+    '''
+    Returns the datum information (see get_datum) of the rating curve source of a lid, with the lid
+    workarounds below applied. None if the rating curve source is unknown.
+    '''
     nws_datum_info, usgs_datum_info = get_datum(metadata)
     if rating_curve_source == 'USGS Rating Depot':
         datum_data = usgs_datum_info
     elif rating_curve_source == 'NRLDB':
         datum_data = nws_datum_info
-
-    # If datum not supplied, skip to new site
-    datum = datum_data.get('datum', None)
-    if datum is None:
-        msg = ':Datum info unavailable'
-        all_messages.append(lid + msg)
-        MP_LOG.warning(huc_lid_id + msg)
-        return None, all_messages
-
-    # ___________________________________________________________________________________________________#
-    # NOTE: !!!!
-    # When appending to a all_message and we may not automatcially want the record dropped
-    # then add "---" in front of the message. Whenever the code finds a message that does not
-    # start with a ---, it assumes if it is a fail and drops it. We will make a better system later.
+    else:
+        return None
 
     # ___________________________________________________________________________________________________#
     # SPECIAL CASE: Workaround for "bmbp1" where the only valid datum is from NRLDB (USGS datum is null).
@@ -1360,13 +1407,91 @@ def __adjust_datum_ft(flows, metadata, lid, huc_lid_id):
         datum_data.update(vcs='NGVD29')
     # ___________________________________________________________________________________________________#
 
+    return datum_data
+
+
+def __prefetch_datum_adjustments(lids, all_lists):
+    '''
+    Gets the NGVD29 to NAVD88 adjustments of all of the NGVD29 lids of the run at once (see
+    prefetch_ngvd_to_navd). The rating curve source of a lid is only known once its thresholds are read
+    in its HUC, so the datums of both sources are fetched.
+    '''
+    datum_infos = []
+    for metadata in all_lists:
+        lid = metadata['identifiers']['nws_lid'].lower()
+        if lid not in lids:
+            continue
+        for rating_curve_source in ['USGS Rating Depot', 'NRLDB']:
+            try:
+                datum_data = __get_lid_datum_data(rating_curve_source, metadata, lid)
+            except Exception:
+                # Incomplete metadata, the lid reports it when processed
+                continue
+            if (
+                datum_data is not None
+                and datum_data.get('datum') is not None
+                and datum_data.get('vcs') in NGVD_VCS_NAMES
+                and datum_data.get('crs') is not None
+                and datum_data.get('lat') is not None
+                and datum_data.get('lon') is not None
+            ):
+                datum_infos.append(datum_data)
+
+    FLOG.lprint(f"Getting the NGVD29 to NAVD88 adjustments of {len(datum_infos)} site datums")
+    try:
+        prefetch_ngvd_to_navd(datum_infos, region='contiguous')
+    except Exception:
+        # Not fatal, each lid gets (and reports on) its own adjustment later
+        FLOG.warning("Unable to prefetch the NGVD29 to NAVD88 adjustments")
+        FLOG.warning(traceback.format_exc())
+
+
+def __adjust_datum_ft(flows, metadata, lid, huc_lid_id):
+
+    # TODO: Aug 2024: This whole parts needs revisiting. Lots of lid data has changed and this
+    # is all likely very old.
+
+    # Jul 2024: For now, we will duplicate messages via all_messsages and via the logging system.
+    all_messages = []
+
+    datum_adj_ft = None
+    ### --- Do Datum Offset --- ###
+    # determine source of interpolated threshold flows, this will be the rating curve that will be used.
+    rating_curve_source = flows.get('source')
+
+    # MP_LOG.trace(f"{huc_lid_id} : rating_curve_source is {rating_curve_source}")
+
+    if rating_curve_source is None:
+        msg = ':No source for rating curve'
+        all_messages.append(lid + msg)
+        MP_LOG.warning(huc_lid_id + msg)
+        return None, all_messages
+
+    # Get the datum (with the lid workarounds) and adjust to NAVD if necessary.
+    datum_data = __get_lid_datum_data(rating_curve_source, metadata, lid)
+
+    # If datum not supplied, skip to new site
+    if datum_data is None or datum_data.get('datum', None) is None:
+        msg = ':Datum info unavailable'
+        all_messages.append(lid + msg)
+        MP_LOG.warning(huc_lid_id + msg)
+        return None, all_messages
+
+    # ___________________________________________________________________________________________________#
+    # NOTE: !!!!
+    # When appending to a all_message and we may not automatcially want the record dropped
+    # then add "---" in front of the message. Whenever the code finds a message that does not
+    # start with a ---, it assumes if it is a fail and drops it. We will make a better system later.
+
     # Adjust datum to NAVD88 if needed
     # Default datum_adj_ft to 0.0
     datum_adj_ft = 0.0
     crs = datum_data.get('crs')
-    if datum_data.get('vcs') in ['NGVD29', 'NGVD 1929', 'NGVD,1929', 'NGVD OF 1929', 'NGVD']:
+    if datum_data.get('vcs') in NGVD_VCS_NAMES:
         # Get the datum adjustment to convert NGVD to NAVD. Sites not in contiguous US are previously
         #   removed otherwise the region needs changed.
+        # Usually answered from the datum cache filled by __prefetch_datum_adjustments. The datum client
+        #   retries (with backoff) when VDatum is busy or unreachable.
         try:
             datum_adj_ft = ngvd_to_navd_ft(datum_info=datum_data, region='contiguous')
         except Exception as ex:
@@ -1375,20 +1500,19 @@ def __adjust_datum_ft(flows, metadata, lid, huc_lid_id):
             ex = str(ex)
             if crs is None:
                 msg = ':NOAA VDatum adjustment error, CRS is missing'
-                all_messages.append(lid + msg)
-                MP_LOG.error(huc_lid_id + msg)
-            if 'HTTPSConnectionPool' in ex:
-                time.sleep(10)  # Maybe the API needs a break, so wait 10 seconds
-                try:
-                    datum_adj_ft = ngvd_to_navd_ft(datum_info=datum_data, region='contiguous')
-                except Exception:
-                    msg = ':NOAA VDatum adjustment error, possible API issue'
-                    all_messages.append(lid + msg)
-                    MP_LOG.error(huc_lid_id + msg)
-            if 'Invalid projection' in ex:
+            elif 'Invalid projection' in ex:
                 msg = f':NOAA VDatum adjustment error, invalid projection: crs={crs}'
-                all_messages.append(lid + msg)
-                MP_LOG.error(huc_lid_id + msg)
+            else:
+                msg = ':NOAA VDatum adjustment error, possible API issue'
+            all_messages.append(lid + msg)
+            MP_LOG.error(huc_lid_id + msg)
+            return None, all_messages
+
+        if datum_adj_ft is None:
+            # VDatum had no adjustment, or it is not in the cache (DATUM_MODE offline)
+            msg = ':NOAA VDatum adjustment unavailable'
+            all_messages.append(lid + msg)
+            MP_LOG.warning(huc_lid_id + msg)
             return None, all_messages
 
     return datum_adj_ft, all_messages
@@ -1521,6 +1645,7 @@ def generate_stage_based_categorical_fim(
     past_major_interval_cap,
     nwm_metafile,
     df_restricted_sites,
+    manifest,
 ):
     '''
     Sep 2024,
@@ -1571,7 +1696,23 @@ def generate_stage_based_categorical_fim(
     # FLOG.trace("Huc distionary is ...")
     # FLOG.trace(huc_dictionary)
 
+    # Datum adjustments are cached in the run folder unless the env file points to a shared cache
+    # (see tools/datum_client.py). Set before the MP pools start so all workers share it.
+    if not os.getenv('DATUM_CACHE_DIR'):
+        os.environ['DATUM_CACHE_DIR'] = os.path.join(output_catfim_dir, 'datum_cache')
+    FLOG.lprint(
+        f"Datum adjustments are cached at {os.getenv('DATUM_CACHE_DIR')} ({os.getenv('DATUM_MODE', 'live')})"
+    )
+    run_lids = set(
+        lid.lower()
+        for huc in huc_dictionary
+        if huc in lst_hucs and not manifest.is_huc_done(huc)
+        for lid in huc_dictionary[huc]
+    )
+    __prefetch_datum_adjustments(run_lids, all_lists)
+
     child_log_file_prefix = FLOG.MP_calc_prefix_name(FLOG.LOG_FILE_PATH, "MP_iter_hucs")
+    post_process_log_file_prefix = FLOG.MP_calc_prefix_name(FLOG.LOG_FILE_PATH, "MP_post_process")
 
     FLOG.lprint(">>>>>>>>>>>>>>>>>>>>>>>>>>>>")
     FLOG.lprint("Start processing HUCs for Stage-Based CatFIM")
@@ -1579,41 +1720,60 @@ def generate_stage_based_categorical_fim(
     huc_index = 0
     FLOG.lprint(f"Number of hucs to process is {num_hucs}")
 
-    with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
-        try:
-            for huc in huc_dictionary:
-                if huc in lst_hucs:
-                    # FLOG.lprint(f'Generating stage based catfim for : {huc}')
+    # All of the HUCs, lids and branches are processed by one flat scheduler (see catfim_scheduler).
+    # The intervals of a lid are created by its lid task, so the number of processes is the largest
+    # number the HUC pool used to run at once (-jh times -jn or -ji)
+    job_number_tasks = job_number_huc * max(job_number_inundate, job_number_intervals)
+    FLOG.lprint(f"Number of processes used is {job_number_tasks}")
+    scheduler = CatFIM_Scheduler(job_number_tasks)
+    post_processed_hucs = []
+
+    for huc in huc_dictionary:
+        if huc in lst_hucs:
+            # FLOG.lprint(f'Generating stage based catfim for : {huc}')
+
+            if manifest.is_huc_done(huc):
+                FLOG.lprint(f"{huc} : already completed, skipped")
+                huc_index += 1
+                continue
 
-                    nwm_flows_region_df = nwm_flows_alaska_df if str(huc[:2]) == '19' else nwm_flows_df
+            nwm_flows_region_df = nwm_flows_alaska_df if str(huc[:2]) == '19' else nwm_flows_df
 
-                    progress_stmt = f"index {huc_index + 1} of {num_hucs}"
-                    executor.submit(
-                        iterate_through_huc_stage_based,
-                        output_catfim_dir,
-                        huc,
-                        fim_run_dir,
-                        huc_dictionary,
-                        threshold_url,
-                        all_lists,
-                        past_major_interval_cap,
-                        job_number_inundate,
-                        job_number_intervals,
-                        nwm_flows_region_df,
-                        df_restricted_sites,
-                        str(FLOG.LOG_FILE_PATH),
-                        child_log_file_prefix,
-                        progress_stmt,
-                    )
-                    huc_index += 1
+            progress_stmt = f"index {huc_index + 1} of {num_hucs}"
+            __schedule_huc_stage_based(
+                scheduler,
+                output_catfim_dir,
+                huc,
+                fim_run_dir,
+                huc_dictionary,
+                threshold_url,
+                all_lists,
+                past_major_interval_cap,
+                nwm_flows_region_df,
+                df_restricted_sites,
+                manifest,
+                child_log_file_prefix,
+                post_process_log_file_prefix,
+                progress_stmt,
+                post_processed_hucs,
+            )
+            huc_index += 1
 
-        except Exception:
-            FLOG.critical("ERROR: ProcessPool has an error")
-            FLOG.critical(traceback.format_exc())
-            sys.exit(1)
+    try:
+        scheduler.run()
+    except Exception:
+        FLOG.critical("ERROR: ProcessPool has an error")
+        FLOG.critical(traceback.format_exc())
+        FLOG.merge_log_files(FLOG.LOG_FILE_PATH, child_log_file_prefix, True)
+        sys.exit(1)
+
+    for task_key, task_error in scheduler.errors.items():
+        FLOG.error(f"{task_key} failed")
+        FLOG.error(task_error)
 
     # Need to merge MP logs here, merged into the "master log file"
     FLOG.merge_log_files(FLOG.LOG_FILE_PATH, child_log_file_prefix, True)
+    FLOG.merge_log_files(FLOG.LOG_FILE_PATH, post_process_log_file_prefix, True)
 
     FLOG.lprint(">>>>>>>>>>>>>>>>>>>>>>>>>>>>")
     FLOG.lprint('Wrapping up processing HUCs for Stage-Based CatFIM...')
@@ -1747,11 +1907,143 @@ def generate_stage_based_categorical_fim(
     else:
         FLOG.warning(f"nws_sites_layer ({nws_lid_gpkg_file_path}) : has no messages and should have some")
 
+    return post_processed_hucs
+
+
+def __schedule_huc_stage_based(
+    scheduler,
+    output_catfim_dir,
+    huc,
+    fim_run_dir,
+    huc_dictionary,
+    threshold_url,
+    all_lists,
+    past_major_interval_cap,
+    nwm_flows_region_df,
+    df_restricted_sites,
+    manifest,
+    child_log_file_prefix,
+    post_process_log_file_prefix,
+    progress_stmt,
+    post_processed_hucs,
+):
+    # Adds the tasks of a HUC to the scheduler. Task keys start with the HUC:
+    #   (huc, 'index', branch): each branch is indexed (index_huc_branch)
+    #   (huc, 'sites'): at the same time, the lids of the HUC are checked (iterate_through_huc_stage_based)
+    #   (huc, 'lid', lid): once both are done, each lid is inundated (inundate_lid_stage_based)
+    #   (huc, 'post_process'): once all of the lids are done, the HUC is post processed (post_process_huc)
+    parent_log_output_file = str(FLOG.LOG_FILE_PATH)
+    branch_dir = os.path.join(fim_run_dir, huc, 'branches')
+
+    # Index the HydroIDs of every branch once for all of the lids of the HUC, so each lid only
+    # reads the branches holding its segments
+    index_keys = []
+    if os.path.exists(branch_dir):
+        for branch in list_huc_branches(branch_dir):
+            index_keys.append((huc, 'index', branch))
+            scheduler.submit(
+                index_keys[-1],
+                index_huc_branch,
+                branch_dir,
+                huc,
+                branch,
+                parent_log_output_file,
+                child_log_file_prefix,
+                memory_mb=estimate_branch_index_memory_mb(branch_dir, branch),
+            )
+
+    scheduler.submit(
+        (huc, 'sites'),
+        iterate_through_huc_stage_based,
+        output_catfim_dir,
+        huc,
+        fim_run_dir,
+        huc_dictionary,
+        threshold_url,
+        all_lists,
+        nwm_flows_region_df,
+        df_restricted_sites,
+        parent_log_output_file,
+        child_log_file_prefix,
+        progress_stmt,
+    )
+
+    def sites_done():
+        huc_branch_index_df = merge_huc_branch_index([scheduler.result(key) for key in index_keys])
+        huc_sites = scheduler.result((huc, 'sites'))
+        if huc_sites is None:
+            return
+
+        all_messages, lid_sites = huc_sites
+        lid_keys = []
+        for lid_site in lid_sites:
+            if (huc, 'lid', lid_site['lid']) in lid_keys:
+                continue
+            lid_index_df = get_lid_branch_index(huc_branch_index_df, lid_site['segments'])
+            lid_keys.append((huc, 'lid', lid_site['lid']))
+            scheduler.submit(
+                lid_keys[-1],
+                inundate_lid_stage_based,
+                output_catfim_dir,
+                huc,
+                lid_site,
+                lid_index_df,
+                past_major_interval_cap,
+                manifest,
+                parent_log_output_file,
+                child_log_file_prefix,
+                memory_mb=estimate_lid_memory_mb(lid_index_df),
+                depends_on=[(huc, 'lids')],
+            )
+
+        def huc_done():
+            lid_messages = [scheduler.result(key) for key in lid_keys]
+            for messages in lid_messages:
+                all_messages.extend(messages or [])
+
+            # Write all_messages by HUC to be scraped later.
+            if len(all_messages) > 0:
+
+                # TODO: Aug 2024: This is now identical to the way flow handles messages
+                # but the system should probably be changed to somethign more elegant but good enough
+                # for now. At least is is MP safe.
+                huc_messages_dir = os.path.join(output_catfim_dir, 'mapping', 'huc_messages')
+                huc_messages_txt_file = os.path.join(huc_messages_dir, str(huc) + '_messages.txt')
+                with open(huc_messages_txt_file, 'w') as f:
+                    for item in all_messages:
+                        item = item.strip()
+                        # f.write("%s\n" % item)
+                        f.write(f"{item}\n")
+
+            # Lids that could not get their thresholds from WRDS (or failed) are tried again when resuming
+            if None not in lid_messages and not any(
+                message.endswith(':Error getting thresholds from WRDS API') for message in all_messages
+            ):
+                manifest.record_huc(huc)
+
+            if schedule_post_process_huc(
+                scheduler,
+                output_catfim_dir,
+                huc,
+                (huc, 'done'),
+                parent_log_output_file,
+                post_process_log_file_prefix,
+                progress_stmt,
+            ):
+                post_processed_hucs.append(huc)
+
+        scheduler.when_done((huc, 'done'), lid_keys + [(huc, 'lids')], huc_done)
+
+    scheduler.when_done((huc, 'lids'), index_keys + [(huc, 'sites')], sites_done)
+
 
 def set_start_files_folders(
-    step_num, output_catfim_dir, output_mapping_dir, output_flows_dir, attributes_dir, overwrite
+    step_num, output_catfim_dir, output_mapping_dir, output_flows_dir, attributes_dir, overwrite, resume=False
 ):
 
+    if overwrite and resume:
+        raise Exception("The -o (overwrite) and -rs (resume) flags can not be used together.")
+
     # ================================
     # Folder cleaning based on step system
     if step_num == 0:
@@ -1760,16 +2052,19 @@ def set_start_files_folders(
             os.mkdir(output_catfim_dir)
 
         # Create output directories (check against maping only as a proxy for all three)
-        if os.path.exists(output_mapping_dir) == True:
+        if os.path.exists(output_mapping_dir) == True and resume == False:
             if overwrite == False:
                 raise Exception(
                     f"The output mapping folder of {output_catfim_dir} already exists."
                     " If you want to overwrite it, please add the -o flag. Note: When overwritten, "
-                    " the three folders of mapping, flows and attributes wil be deleted and rebuilt"
+                    " the three folders of mapping, flows and attributes wil be deleted and rebuilt."
+                    " If you want to finish an interrupted run instead, please add the -rs flag."
                 )
             shutil.rmtree(output_flows_dir, ignore_errors=True)
             shutil.rmtree(attributes_dir, ignore_errors=True)
             shutil.rmtree(output_mapping_dir, ignore_errors=True)
+            if os.path.exists(os.path.join(output_catfim_dir, MANIFEST_FILE_NAME)):
+                os.remove(os.path.join(output_catfim_dir, MANIFEST_FILE_NAME))
 
     os.makedirs(output_flows_dir, exist_ok=True)
     os.makedirs(output_mapping_dir, exist_ok=True)
@@ -1931,6 +2226,16 @@ if __name__ == '__main__':
         '-o', '--overwrite', help='OPTIONAL: Overwrite files', required=False, action="store_true"
     )
 
+    parser.add_argument(
+        '-rs',
+        '--resume',
+        help='OPTIONAL: Resume an interrupted run in the same output folder. HUCs, sites and stages'
+        ' already completed (as recorded in the catfim_manifest.db of the output folder) are skipped and'
+        ' only failed or missing ones are processed. Can not be used with -o.',
+        required=False,
+        action="store_true",
+    )
+
     args = vars(parser.parse_args())
 
     try:
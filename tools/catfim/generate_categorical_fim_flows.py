@@ -5,10 +5,8 @@ import copy
 import glob
 import os
 import pickle
-import random
 import shutil
 import sys
-import time
 import traceback
 from concurrent.futures import ProcessPoolExecutor, as_completed, wait
 from datetime import datetime, timezone
@@ -25,6 +23,7 @@ from tools_shared_functions import (
     get_metadata,
     get_nwm_segs,
     get_thresholds,
+    prefetch_thresholds,
 )
 
 import utils.fim_logger as fl
@@ -78,14 +77,9 @@ def generate_flows_for_huc(
         start_time = datetime.now(timezone.utc)
         dt_string = start_time.strftime("%m/%d/%Y %H:%M:%S")
 
-        # A bit of start staggering to help not overload the MP (20 sec)
-        time_delay = random.randrange(0, 20)
-        # MP_LOG.lprint(f" ... {huc} start time is {dt_string} and delay is {time_delay}")
         MP_LOG.lprint("")
         MP_LOG.lprint(f" ... {huc} flow generation start time is {dt_string}")
 
-        time.sleep(time_delay)
-
         # Process each huc unit, first define message variable and categories.
         all_messages = []
         categories = ['action', 'minor', 'moderate', 'major', 'record']
@@ -96,6 +90,10 @@ def generate_flows_for_huc(
             MP_LOG.lprint(f"huc {huc} has no applicable nws_lids")
             return
 
+        # Fetch the thresholds of all of the HUC's lids at once (bounded by WRDS_MAX_WORKERS), the
+        # get_thresholds calls below are then answered from the WRDS client cache
+        prefetch_thresholds(threshold_url, 'nws_lid', [lid.lower() for lid in nws_lids], threshold='all')
+
         # less columns then stage cols
         df_cols = {
             "nws_lid": pd.Series(dtype='str'),
@@ -416,6 +414,14 @@ def generate_flows(
 
     all_start = datetime.now(timezone.utc)
     API_BASE_URL, WBD_LAYER = get_env_paths(env_file)
+
+    # WRDS responses are cached in the run folder unless the env file points to a shared cache
+    # (see tools/wrds_client.py). Set before the MP pools start so all workers share it.
+    if not os.getenv('WRDS_CACHE_DIR'):
+        os.environ['WRDS_CACHE_DIR'] = os.path.join(output_catfim_dir, 'wrds_cache')
+    FLOG.lprint(
+        f"WRDS responses are cached at {os.getenv('WRDS_CACHE_DIR')} ({os.getenv('WRDS_MODE', 'live')})"
+    )
     nwm_us_search = int(nwm_us_search)
     nwm_ds_search = int(nwm_ds_search)
     metadata_url = f'{API_BASE_URL}/metadata'
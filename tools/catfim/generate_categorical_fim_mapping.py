@@ -2,7 +2,6 @@
 
 
 import argparse
-import glob
 import os
 
 # import shutil
@@ -15,13 +14,16 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import rasterio
-from inundate_gms import Inundate_gms
-from mosaic_inundation import Mosaic_inundation
-from rasterio.features import shapes
+from catfim_scheduler import CatFIM_Scheduler
+from rasterio.features import geometry_mask, shapes
+from rasterio.transform import array_bounds
 from rasterio.warp import Resampling, calculate_default_transform, reproject
+from rasterio.windows import Window, from_bounds
+from shapely import union_all
+from shapely.geometry import shape
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.polygon import Polygon
-from tools_shared_functions import mask_out_lakes
+from tools_shared_functions import _write_cog, mask_out_lakes
 from tqdm import tqdm
 
 import utils.fim_logger as fl
@@ -40,356 +42,638 @@ MP_LOG = fl.FIM_logger()
 gpd.options.io_engine = "pyogrio"
 
 
-# Technically, this is once called as a non MP, but also called in an MP pool
-# we will use an MP object either way
-def produce_stage_based_lid_tifs(
-    stage_val,
-    datum_adj_ft,
-    branch_dir,
-    lid_usgs_elev,
-    lid_altitude,
-    fim_dir,
-    segments,
-    lid,
-    huc,
-    lid_directory,
-    category,
-    category_key,
-    number_of_jobs,
-    mp_parent_log_file,
-    child_log_file_prefix,
-):
+# Approximate peak memory (bytes) per raster cell read by the scheduled tasks, used to estimate the memory
+# each task needs (see catfim_scheduler)
+INDEX_BYTES_PER_CELL = 40
+LID_BYTES_PER_CELL = 24
+POST_PROCESS_BYTES_PER_CELL = 8
+
+# Rows of the catchments raster read at once when indexing a branch
+INDEX_STRIP_ROWS = 1024
+
+HUC_BRANCH_INDEX_COLUMNS = [
+    'HydroID',
+    'feature_id',
+    'LakeID',
+    'row_start',
+    'row_stop',
+    'col_start',
+    'col_stop',
+    'branch',
+    'rem_path',
+    'catchments_path',
+]
+
+
+def __get_branch_file_paths(branch_dir, branch):
+    full_branch_path = os.path.join(branch_dir, branch)
+    rem_path = os.path.join(full_branch_path, 'rem_zeroed_masked_' + branch + '.tif')
+    catchments_path = os.path.join(
+        full_branch_path, 'gw_catchments_reaches_filtered_addedAttributes_' + branch + '.tif'
+    )
+    hydrotable_path = os.path.join(full_branch_path, 'hydroTable_' + branch + '.csv')
+    return rem_path, catchments_path, hydrotable_path
 
-    MP_LOG.MP_Log_setup(mp_parent_log_file, child_log_file_prefix)
 
-    messages = []
+def list_huc_branches(branch_dir):
+    """Returns the (sorted) branches of a HUC branch directory."""
+    branches = [x for x in os.listdir(branch_dir) if os.path.isdir(os.path.join(branch_dir, x))]
+    branches.sort()
+    return branches
 
-    huc_lid_cat_id = f"{huc} : {lid} : {category_key}"
-    MP_LOG.trace(f"{huc_lid_cat_id}: Starting to create tifs")
 
-    # Determine datum-offset water surface elevation (from above).
-    datum_adj_wse = stage_val + datum_adj_ft + lid_altitude
-    datum_adj_wse_m = datum_adj_wse * 0.3048  # Convert ft to m
+def estimate_branch_index_memory_mb(branch_dir, branch):
+    """Returns the estimated memory (MB) used by index_huc_branch for a branch."""
+    catchments_path = __get_branch_file_paths(branch_dir, branch)[1]
+    if not os.path.exists(catchments_path):
+        return 0
+    with rasterio.open(catchments_path) as catchments_src:
+        strip_cells = catchments_src.width * min(INDEX_STRIP_ROWS, catchments_src.height)
+    return strip_cells * INDEX_BYTES_PER_CELL / 2**20
 
-    # Subtract HAND gage elevation from HAND WSE to get HAND stage.
-    hand_stage = datum_adj_wse_m - lid_usgs_elev
 
-    # TODO: see what happens if this is returned with tj
+# This is part of an MP call and needs MP_LOG
+def index_huc_branch(branch_dir, huc, branch, parent_log_output_file, child_log_file_prefix):
+    """
+    Indexes the HydroIDs of a branch for stage-based inundation.
 
-    # If no segments, write message and exit out
-    if not segments or len(segments) == 0:
-        msg = ':missing nwm segments'
-        messages.append(lid + msg)
-        MP_LOG.warning(huc_lid_cat_id + msg)
-        return messages, hand_stage, datum_adj_wse, datum_adj_wse_m
+    Returns a dataframe with one row per HydroID of the branch catchments raster: its feature_id, LakeID
+    and the window (row_start, row_stop, col_start, col_stop) of its cells in the branch rasters.
+    The catchments raster is read in strips of rows so the full raster is never held in memory.
 
-    # Produce extent tif hand_stage. Multiprocess across branches.
-    # branches = os.listdir(branch_dir)
-    # MP_LOG.trace(f"{huc_lid_cat_id} branch_dir is {branch_dir}")
+    Returns None if the branch files are missing (could be a bad branch) or hold no HydroIDs.
+    """
 
-    branches = [x for x in os.listdir(branch_dir) if os.path.isdir(os.path.join(branch_dir, x))]
-    branches.sort()
-    # MP_LOG.trace(f"{huc_lid_cat_id} branches are {branches}")
-
-    # This is an MP in an MP. We want this set of mp's to roll up to the
-    # parent MP file, and not the full catfim parent log. We roll this child MP into
-    # it's parent mp and later that parent MP will rollup to the catfim file.
-    child_log_file_prefix = MP_LOG.MP_calc_prefix_name(MP_LOG.LOG_FILE_PATH, "MP_branch")
-    with ProcessPoolExecutor(max_workers=number_of_jobs) as executor:
-        for branch in branches:
-            msg_id_w_branch = f"{huc_lid_cat_id}: {branch}"
-            # MP_LOG.trace(f"{msg_id_w_branch} : inundating branch")
-            # Define paths to necessary files to produce inundation grids.
-            full_branch_path = os.path.join(branch_dir, branch)
-            rem_path = os.path.join(fim_dir, huc, full_branch_path, 'rem_zeroed_masked_' + branch + '.tif')
-            catchments_path = os.path.join(
-                fim_dir,
-                huc,
-                full_branch_path,
-                'gw_catchments_reaches_filtered_addedAttributes_' + branch + '.tif',
-            )
-            hydrotable_path = os.path.join(fim_dir, huc, full_branch_path, 'hydroTable_' + branch + '.csv')
+    try:
+        # This is setting up logging for this function to go up to the parent
+        MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
 
-            # sometimes, these can fail to exist if a branchf initial failed during HAND generation
-            if not os.path.exists(rem_path):
-                msg = ":rem doesn't exist (could be bad branch)"
-                # messages.append(lid + msg)
-                MP_LOG.warning(msg_id_w_branch + msg)
-                continue
-            if not os.path.exists(catchments_path):
-                msg = ":catchments files don't exist (could be bad branch)"
-                # messages.append(lid + msg)
-                MP_LOG.warning(msg_id_w_branch + msg)
-                continue
-            if not os.path.exists(hydrotable_path):
-                msg = ":hydrotable doesn't exist (could be bad branch)"
-                # messages.append(lid + msg)
-                MP_LOG.warning(msg_id_w_branch + msg)
-                continue
+        msg_id_w_branch = f"{huc} : {branch}"
+        rem_path, catchments_path, hydrotable_path = __get_branch_file_paths(branch_dir, branch)
+
+        # sometimes, these can fail to exist if a branchf initial failed during HAND generation
+        if not os.path.exists(rem_path):
+            msg = ":rem doesn't exist (could be bad branch)"
+            MP_LOG.warning(msg_id_w_branch + msg)
+            return None
+        if not os.path.exists(catchments_path):
+            msg = ":catchments files don't exist (could be bad branch)"
+            MP_LOG.warning(msg_id_w_branch + msg)
+            return None
+        if not os.path.exists(hydrotable_path):
+            msg = ":hydrotable doesn't exist (could be bad branch)"
+            MP_LOG.warning(msg_id_w_branch + msg)
+            return None
+
+        hydrotable_df = pd.read_csv(
+            hydrotable_path, usecols=['HydroID', 'feature_id', 'LakeID'], dtype={'LakeID': float}
+        ).drop_duplicates('HydroID')
+
+        strip_windows = []
+        with rasterio.open(catchments_path) as catchments_src:
+            for row_start in range(0, catchments_src.height, INDEX_STRIP_ROWS):
+                strip = catchments_src.read(
+                    1,
+                    window=Window(
+                        0,
+                        row_start,
+                        catchments_src.width,
+                        min(INDEX_STRIP_ROWS, catchments_src.height - row_start),
+                    ),
+                )
+                rows, cols = np.nonzero(strip != catchments_src.nodata)
+                if len(rows) == 0:
+                    continue
+                strip_windows.append(
+                    pd.DataFrame({'HydroID': strip[rows, cols], 'row': rows + row_start, 'col': cols})
+                    .groupby('HydroID')
+                    .agg(
+                        row_min=('row', 'min'),
+                        row_max=('row', 'max'),
+                        col_min=('col', 'min'),
+                        col_max=('col', 'max'),
+                    )
+                )
+                del strip, rows, cols
 
-            # Use hydroTable to determine hydroid_list from site_ms_segments.
-            hydrotable_df = pd.read_csv(
-                hydrotable_path, low_memory=False, dtype={'HUC': str, 'LakeID': float, 'subdiv_applied': int}
-            )
+        if len(strip_windows) == 0:
+            return None
 
-            hydroid_list, lake_hydroid_list, nolake_hydroid_list = [], [], []
+        hydroid_windows = (
+            pd.concat(strip_windows)
+            .groupby(level=0)
+            .agg({'row_min': 'min', 'row_max': 'max', 'col_min': 'min', 'col_max': 'max'})
+        )
+        hydroid_windows = pd.DataFrame(
+            {
+                'row_start': hydroid_windows['row_min'],
+                'row_stop': hydroid_windows['row_max'] + 1,
+                'col_start': hydroid_windows['col_min'],
+                'col_stop': hydroid_windows['col_max'] + 1,
+            }
+        )
 
-            # Determine hydroids at which to perform inundation
-            for feature_id in segments:
+        branch_index_df = hydrotable_df.merge(hydroid_windows, left_on='HydroID', right_index=True)
+        branch_index_df['branch'] = branch
+        branch_index_df['rem_path'] = rem_path
+        branch_index_df['catchments_path'] = catchments_path
+        return branch_index_df
 
-                try:
-                    subset_hydrotable_df = hydrotable_df[hydrotable_df['feature_id'] == int(feature_id)]
+    except Exception:
+        MP_LOG.error(f"{huc} : {branch} Error indexing the branch for inundation with stage")
+        MP_LOG.error(traceback.format_exc())
 
-                    # List of HydroID's where the LakeID is greater than 0 (which shows that there's a lake)
-                    lake_hydroid_list = list(
-                        subset_hydrotable_df.loc[subset_hydrotable_df['LakeID'] > 0]['HydroID'].unique()
-                    )
+    return None
 
-                    # If lakes are detected, add info to the log
-                    if len(lake_hydroid_list) > 0:
-                        MP_LOG.trace(
-                            f"HydroIDs {lake_hydroid_list} removed from processing because they contain lakes. FeatureId is {feature_id}."
-                        )
 
-                    # List of HydroID's where there the LakeID is less than 0 (no lake, so we can inundate)
-                    nolake_hydroid_list = list(
-                        subset_hydrotable_df.loc[subset_hydrotable_df['LakeID'] < 0]['HydroID'].unique()
-                    )
+def merge_huc_branch_index(branch_index_dfs):
+    """
+    Merges the branch indexes of a HUC (see index_huc_branch, None for branches that could not be indexed)
+    into the stage-based inundation index of the HUC. It is built once per HUC, then get_lid_branch_index
+    takes the rows of a lid's segments from it, so only the branches (and the windows of them) holding the
+    lid's HydroIDs are read.
+    """
 
-                    # Add HydroIDs without lakes to the list to process
-                    hydroid_list += nolake_hydroid_list
+    branch_index_dfs = [df for df in branch_index_dfs if df is not None]
+    if len(branch_index_dfs) == 0:
+        return pd.DataFrame(columns=HUC_BRANCH_INDEX_COLUMNS)
 
-                except IndexError:
-                    MP_LOG.trace(
-                        f"Index Error for {msg_id_w_branch}. FeatureId is {feature_id} : Continuing on."
-                    )
-                    pass
+    return pd.concat(branch_index_dfs, ignore_index=True)
 
-            # Create inundation maps with branch and stage data
-            # only sites /categories that got this far are valid and can be inundated
-            try:
-                # MP_LOG.trace(f"{huc_lid_cat_id} : branch = {branch} :  Generating stage-based FIM")
-
-                executor.submit(
-                    produce_inundated_branch_tif,
-                    rem_path,
-                    catchments_path,
-                    hydroid_list,
-                    hand_stage,
-                    lid_directory,
-                    category_key,
-                    huc,
-                    lid,
-                    branch,
-                    MP_LOG.LOG_FILE_PATH,
-                    child_log_file_prefix,
-                )
 
-            except Exception:
-                msg = f':inundation failed at {category}'
-                messages.append(lid + msg)
-                MP_LOG.warning(msg_id_w_branch + msg)
-                MP_LOG.error(traceback.format_exc())
+def get_lid_branch_index(huc_branch_index_df, segments):
+    """Returns the rows of the HUC index (see merge_huc_branch_index) holding the lid's segments."""
+    return huc_branch_index_df[huc_branch_index_df['feature_id'].isin([int(seg) for seg in segments])]
+
+
+def __get_lid_branch_windows(lid_index_df):
+    # Window holding the (non-lake) HydroIDs of the lid for each branch
+    for branch, branch_df in lid_index_df.loc[lid_index_df['LakeID'] < 0].groupby('branch'):
+        row_start, col_start = branch_df['row_start'].min(), branch_df['col_start'].min()
+        window = Window(
+            col_start,
+            row_start,
+            branch_df['col_stop'].max() - col_start,
+            branch_df['row_stop'].max() - row_start,
+        )
+        yield branch, branch_df, window
+
+
+def estimate_lid_memory_mb(lid_index_df):
+    """Returns the estimated memory (MB) used to inundate a lid (see read_lid_branch_rems)."""
+    window_cells = sum(
+        window.width * window.height for _, _, window in __get_lid_branch_windows(lid_index_df)
+    )
+    return window_cells * LID_BYTES_PER_CELL / 2**20
 
-    # Nov 2024: Fix this. The logs get out of order as it is can be a MP in MP
-    # hold on this
-    # MP_LOG.merge_log_files(mp_parent_log_file, child_log_file_prefix, True)
-
-    # -- MOSAIC -- #
-    # Merge all rasters in lid_directory that have the same magnitude/category.
-    path_list = []
-
-    # we are looking for the branch files for the category/stage
-    # or any given stage interval
-
-    lid_dir_list = [x for x in os.listdir(lid_directory) if category_key in x]
-    lid_dir_list.sort()  # To force branch 0 first in list, sort
-
-    # MP_LOG.lprint(f"{huc}: {lid} : Merging branch files {huc_lid_cat_id}")
-    # MP_LOG.trace(f"{huc_lid_cat_id} : lid_dir_list is... {lid_dir_list}")
-    # MP_LOG.trace("")
-
-    for f in lid_dir_list:
-        path_list.append(os.path.join(lid_directory, f))
-
-    # Merging all of the branch tifs into one lid_category tif
-    if len(lid_dir_list) > 0:
-        zero_branch_grid = path_list[0]
-        zero_branch_src = rasterio.open(zero_branch_grid)
-        zero_branch_array = zero_branch_src.read(1)
-        summed_array = zero_branch_array  # Initialize it as the branch zero array
-
-        output_tif = os.path.join(lid_directory, lid + '_' + category_key + '_extent.tif')
-        MP_LOG.trace(f"{huc_lid_cat_id}: Merging all branches into output file to be saved as {output_tif}")
-
-        # Loop through remaining items in list and sum them with summed_array
-        for remaining_raster in path_list[1:]:
-
-            remaining_raster_src = rasterio.open(remaining_raster)
-            remaining_raster_array_original = remaining_raster_src.read(1)
-
-            # TODO: Nov 2024: We should need to reproject at all (Research if this works wihtout it)
-            # Reproject non-branch-zero grids so I can sum them with the branch zero grid
-            remaining_raster_array = np.empty(zero_branch_array.shape, dtype=np.int8)
-            reproject(
-                remaining_raster_array_original,
-                destination=remaining_raster_array,
-                src_transform=remaining_raster_src.transform,
-                src_crs=remaining_raster_src.crs,
-                src_nodata=remaining_raster_src.nodata,
-                dst_transform=zero_branch_src.transform,
-                dst_crs=zero_branch_src.crs,
-                dst_nodata=0,
-                dst_resolution=zero_branch_src.res,
-                resampling=Resampling.nearest,
+
+def read_lid_branch_rem(
+    rem_path, catchments_path, hydroid_list, window, huc, lid, branch, keep_catchments=False
+):
+    """
+    Reads the REM and catchments rasters of a branch once for all of the stages of a lid.
+
+    Only the window holding the lid's HydroIDs (non-lake HydroIDs of the lid's segments) is read. Returns the
+    REM values of the cells of those HydroIDs, cropped to the smallest window holding them, with every other
+    cell set to infinity. Any stage (HAND stage) then inundates the cells where the cropped REM is <= the
+    stage. With keep_catchments, the cropped catchments (HydroID of each cell) are returned as well, for
+    flow-based stages which differ by HydroID.
+
+    Returns None if no cell of the branch can be inundated for the lid.
+    """
+
+    try:
+        # both of these have a nodata value of 0 (well.. not by the image but by cell values)
+        with rasterio.open(rem_path) as rem_src, rasterio.open(catchments_path) as catchments_src:
+            rem_profile = rem_src.profile
+            rem_array = rem_src.read(1, window=window)
+            catchments_array = catchments_src.read(1, window=window)
+            target_cells = (
+                np.isin(catchments_array, hydroid_list)
+                & (catchments_array != catchments_src.nodata)
+                & (rem_array != rem_src.nodata)
             )
-            # Sum rasters
-            summed_array = summed_array + remaining_raster_array
 
-        # Mask out the lakes from the inundation array
-        summed_masked_array = mask_out_lakes(summed_array, huc, zero_branch_src)
+        rows = np.flatnonzero(target_cells.any(axis=1))
+        cols = np.flatnonzero(target_cells.any(axis=0))
+        if len(rows) == 0:
+            return None
 
-        del zero_branch_array, summed_array  # Clean up
+        crop_window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        rem_crop = rem_array[crop_window.toslices()].copy()
+        rem_crop[~target_cells[crop_window.toslices()]] = np.inf
+        catchments_crop = catchments_array[crop_window.toslices()].copy() if keep_catchments else None
+        del rem_array, catchments_array, target_cells
 
-        # Define path to merged file, in same format as expected by post_process_cat_fim_for_viz function
-        profile = zero_branch_src.profile
-        summed_masked_array = summed_masked_array.astype('uint8')
-        with rasterio.open(output_tif, 'w', **profile) as dst:
-            dst.write(summed_masked_array, 1)
-            MP_LOG.lprint(f"{huc_lid_cat_id}: branch rollup extent file saved at {output_tif}")
+        crop_window = Window(
+            window.col_off + crop_window.col_off, window.row_off + crop_window.row_off, *rem_crop.shape[::-1]
+        )
+        branch_rem = {
+            'branch': branch,
+            'rem_path': rem_path,
+            'profile': rem_profile,
+            'transform': rasterio.windows.transform(crop_window, rem_profile['transform']),
+            'rem': rem_crop,
+        }
+        if keep_catchments:
+            branch_rem['catchments'] = catchments_crop
+        return branch_rem
 
-        # For space reasons, we need to delete all of the intermediary files such as:
-        #    Stage: grmn3_action_extent_0.tif, grmn3_action_extent_1933000003.tif. The give aways are a number before
-        #        the .tif
-        #    Flows: allm1_action_12p0ft_extent_01010002_0.tif, allm1_action_12p0ft_extent_01010002_7170000001.tif
-        #       your give away is to just delete any file that has the HUC number in teh file name
-        # The intermediatary are all inundated branch tifs.
+    except Exception:
+        MP_LOG.error(f"{huc} : {lid} : {branch} Error reading the branch rem for inundation with stage")
+        MP_LOG.error(traceback.format_exc())
 
-        # The ones we want to keep end at _extent.tif and remove ones that have _extent_*.tif
-        MP_LOG.lprint(f"{huc_lid_cat_id}: Removing interium inundated branch files")
-        branch_tifs = glob.glob(f"{lid_directory}/{lid}_{category_key}_extent_*.tif")
-        for tif_file in branch_tifs:
-            os.remove(tif_file)
+    return None
 
-    # else:
-    #     MP_LOG.warning(f"{huc}: {lid}: Merging {category_key} : no valid inundated branches")
 
-    return messages, hand_stage, datum_adj_wse, datum_adj_wse_m
+def read_lid_branch_rems(lid_index_df, lid, huc, keep_catchments=False):
+    """
+    Reads the REM / catchments of the branches holding the lid's segments once (see read_lid_branch_rem).
+    The branches (and the windows to read from them) come from the lid's rows of the HUC index
+    (get_lid_branch_index), so branches without any of the lid's HydroIDs are never opened.
+
+    The returned list (sorted by branch) is then used by produce_stage_based_lid_tifs for every
+    category and interval stage of the lid (or by produce_flow_based_lid_tifs for every magnitude).
+    """
 
+    huc_lid_id = f"{huc} : {lid}"
 
-# This is part of an MP call and needs MP_LOG
-# This is a form of inundation which we are doing ourselves
-# as we only have one flow value and our normal inundation tools
-# are looking for files not single values
-def produce_inundated_branch_tif(
-    rem_path,
-    catchments_path,
-    hydroid_list,
-    hand_stage,
+    # List of HydroID's where the LakeID is greater than 0 (which shows that there's a lake)
+    lake_hydroid_list = list(lid_index_df.loc[lid_index_df['LakeID'] > 0]['HydroID'].unique())
+    if len(lake_hydroid_list) > 0:
+        MP_LOG.trace(
+            f"{huc_lid_id}: HydroIDs {lake_hydroid_list} removed from processing because they contain lakes."
+        )
+
+    # HydroID's where there the LakeID is less than 0 (no lake, so we can inundate)
+    branch_rems = []
+    for branch, branch_df, window in __get_lid_branch_windows(lid_index_df):
+        branch_rem = read_lid_branch_rem(
+            branch_df['rem_path'].iloc[0],
+            branch_df['catchments_path'].iloc[0],
+            branch_df['HydroID'].unique(),
+            window,
+            huc,
+            lid,
+            branch,
+            keep_catchments,
+        )
+        if branch_rem is not None:
+            branch_rems.append(branch_rem)
+
+    if len(branch_rems) == 0:
+        MP_LOG.trace(f"{huc_lid_id}: no branches hold the lid's segments")
+
+    return branch_rems
+
+
+def __add_branch_extent(summed_array, window_transform, grid_crs, extent_array, extent_transform, extent_crs):
+    """
+    Adds a branch extent (1 = inundated) to the summed extent array of the output grid window.
+    Branch grids aligned to the output grid are added directly, others are reprojected first.
+    """
+
+    col_off = (extent_transform.c - window_transform.c) / window_transform.a
+    row_off = (extent_transform.f - window_transform.f) / window_transform.e
+    is_aligned = (
+        extent_crs == grid_crs
+        and extent_transform[:2] == window_transform[:2]
+        and extent_transform[3:5] == window_transform[3:5]
+        and abs(col_off - round(col_off)) < 1e-6
+        and abs(row_off - round(row_off)) < 1e-6
+    )
+
+    if is_aligned:
+        col_off, row_off = int(round(col_off)), int(round(row_off))
+        rows = slice(max(row_off, 0), min(row_off + extent_array.shape[0], summed_array.shape[0]))
+        cols = slice(max(col_off, 0), min(col_off + extent_array.shape[1], summed_array.shape[1]))
+        if rows.start < rows.stop and cols.start < cols.stop:
+            summed_array[rows, cols] += extent_array[
+                rows.start - row_off : rows.stop - row_off, cols.start - col_off : cols.stop - col_off
+            ]
+        return
+
+    # Reproject non-aligned grids so I can sum them with the grid of the output
+    branch_array = np.zeros(summed_array.shape, dtype=np.int8)
+    reproject(
+        extent_array,
+        destination=branch_array,
+        src_transform=extent_transform,
+        src_crs=extent_crs,
+        src_nodata=0,
+        dst_transform=window_transform,
+        dst_crs=grid_crs,
+        dst_nodata=0,
+        resampling=Resampling.nearest,
+    )
+    summed_array += branch_array
+
+
+def __save_lid_extent_tif(branch_extents, huc, output_tif, mask_geometries=None):
+    """
+    Sums the (branch_rem, extent_array) branch extents of a lid on the grid of the first branch, masks out
+    the lakes (and everything outside of mask_geometries if given) and saves the result as output_tif.
+    The tif covers the union of the branch extents (the site footprint) snapped to the grid, which may reach
+    beyond the raster of the first branch, and is saved as a COG, so reading and polygonizing it later
+    scales with the site.
+    """
+
+    # The first inundated branch sets the output grid
+    grid_rem = branch_extents[0][0]
+    profile = grid_rem['profile'].copy()
+    profile.update(dtype=rasterio.uint8)
+    profile.update(nodata=0)
+    grid_transform = profile['transform']
+
+    # Output window holding all of the branch extents (not limited to the raster of the first branch)
+    extent_bounds = np.array(
+        [
+            array_bounds(extent_array.shape[0], extent_array.shape[1], branch_rem['transform'])
+            for branch_rem, extent_array in branch_extents
+        ]
+    )
+    bounds_window = from_bounds(
+        extent_bounds[:, 0].min(),
+        extent_bounds[:, 1].min(),
+        extent_bounds[:, 2].max(),
+        extent_bounds[:, 3].max(),
+        transform=grid_transform,
+    )
+    col_start = int(np.floor(bounds_window.col_off + 1e-6))
+    row_start = int(np.floor(bounds_window.row_off + 1e-6))
+    col_stop = int(np.ceil(bounds_window.col_off + bounds_window.width - 1e-6))
+    row_stop = int(np.ceil(bounds_window.row_off + bounds_window.height - 1e-6))
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    window_transform = rasterio.windows.transform(window, grid_transform)
+
+    summed_array = np.zeros((int(window.height), int(window.width)), dtype=np.int16)
+    for branch_rem, extent_array in branch_extents:
+        __add_branch_extent(
+            summed_array,
+            window_transform,
+            profile['crs'],
+            extent_array,
+            branch_rem['transform'],
+            branch_rem['profile']['crs'],
+        )
+
+    if mask_geometries is not None:
+        summed_array[geometry_mask(mask_geometries, summed_array.shape, window_transform)] = 0
+
+    # Mask out the lakes from the inundation array
+    with rasterio.open(grid_rem['rem_path']) as grid_src:
+        summed_masked_array = mask_out_lakes(summed_array, huc, grid_src, window=window)
+
+    del summed_array  # Clean up
+
+    # Define path to merged file, in same format as expected by post_process_cat_fim_for_viz function
+    summed_masked_array = summed_masked_array.astype('uint8')
+    profile.update(width=int(window.width), height=int(window.height), transform=window_transform)
+    _write_cog(
+        output_tif, profile, [(Window(0, 0, int(window.width), int(window.height)), summed_masked_array)]
+    )
+
+
+def calc_hand_stage(stage_val, datum_adj_ft, lid_usgs_elev, lid_altitude):
+    """
+    Returns the HAND stage (m) of a lid's stage value (ft), with the datum adjusted water surface elevation
+    in ft and m: (hand_stage, datum_adj_wse, datum_adj_wse_m).
+    """
+
+    # Determine datum-offset water surface elevation (from above).
+    datum_adj_wse = stage_val + datum_adj_ft + lid_altitude
+    datum_adj_wse_m = datum_adj_wse * 0.3048  # Convert ft to m
+
+    # Subtract HAND gage elevation from HAND WSE to get HAND stage.
+    hand_stage = datum_adj_wse_m - lid_usgs_elev
+
+    return hand_stage, datum_adj_wse, datum_adj_wse_m
+
+
+# This is called in an MP task (inundate_lid_stage_based) and uses its MP_LOG
+def produce_stage_based_lid_tifs(
+    stage_val,
+    datum_adj_ft,
+    branch_rems,
+    lid_usgs_elev,
+    lid_altitude,
+    segments,
+    lid,
+    huc,
     lid_directory,
+    category,
     category_key,
-    huc,
-    lid,
-    branch,
-    parent_log_output_file,
-    child_log_file_prefix,
+    manifest=None,
 ):
     """
-    # Open rem_path and catchment_path using rasterio.
+    Creates the extent tif of a lid for a category or interval stage from the branch REMs of the lid
+    (read once for all stages by read_lid_branch_rems).
+
+    The extent of every branch is the cells of the lid's catchments with a REM <= the HAND stage. All branch
+    extents are summed on the grid of the first branch (in branch order) that inundates, lakes are masked out,
+    and the result is saved as <lid>_<category_key>_extent.tif, a COG cropped to the window holding the
+    inundated cells.
 
-    Note: category can have different formats, depending if it is an interval or not or int or float
-    If it has a stage number it, it is an interval value
-       ie) action, action_24ft, action_24.6, or action_24.6ft
+    If a manifest (CatFIM_Manifest) is given, the outcome is recorded in it.
     """
 
+    messages = []
+
+    huc_lid_cat_id = f"{huc} : {lid} : {category_key}"
+    MP_LOG.trace(f"{huc_lid_cat_id}: Starting to create tifs")
+
+    hand_stage, datum_adj_wse, datum_adj_wse_m = calc_hand_stage(
+        stage_val, datum_adj_ft, lid_usgs_elev, lid_altitude
+    )
+
+    # If no segments, write message and exit out
+    if not segments or len(segments) == 0:
+        msg = ':missing nwm segments'
+        messages.append(lid + msg)
+        MP_LOG.warning(huc_lid_cat_id + msg)
+        return messages, hand_stage, datum_adj_wse, datum_adj_wse_m
+
+    output_tif = os.path.join(lid_directory, lid + '_' + category_key + '_extent.tif')
+    status = 'failed'
     try:
-        # This is setting up logging for this function to go up to the parent
-        MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
+        # Inundated cells of each branch (branches are in order, to force branch 0 first)
+        # No cells inundated is common. Lots of branches don't inundate as they are out of the extent area
+        branch_extents = []
+        for branch_rem in branch_rems:
+            extent_array = (branch_rem['rem'] <= hand_stage).astype('uint8')
+            if extent_array.any():
+                branch_extents.append((branch_rem, extent_array))
+
+        if len(branch_extents) == 0:
+            # MP_LOG.warning(f"{huc}: {lid}: Merging {category_key} : no valid inundated branches")
+            status = 'empty'
+        else:
+            MP_LOG.trace(
+                f"{huc_lid_cat_id}: Merging all branches into output file to be saved as {output_tif}"
+            )
+            __save_lid_extent_tif(branch_extents, huc, output_tif)
+            MP_LOG.lprint(f"{huc_lid_cat_id}: branch rollup extent file saved at {output_tif}")
+            status = 'done'
 
-        file_name = lid + '_' + category_key + '_extent_' + huc + '_' + branch
-        output_tif = os.path.join(lid_directory, file_name + '.tif')
+    except Exception:
+        msg = f':inundation failed at {category}'
+        messages.append(lid + msg)
+        MP_LOG.warning(huc_lid_cat_id + msg)
+        MP_LOG.error(traceback.format_exc())
 
-        # MP_LOG.lprint("+++++++++++++++++++++++")
-        # MP_LOG.lprint(f"... At the start of producing a tif for {file_name}")
-        # MP_LOG.trace(locals())
-        # MP_LOG.lprint(f"output_tif is {output_tif} (if it is valid)")
-        # MP_LOG.trace("+++++++++++++++++++++++")
+    if manifest is not None:
+        manifest.record_unit(huc, lid, category, category_key, stage_val, output_tif, status)
 
-        # both of these have a nodata value of 0 (well.. not by the image but by cell values)
-        rem_src = rasterio.open(rem_path)
-        catchments_src = rasterio.open(catchments_path)
-        rem_array = rem_src.read(1)
-        catchments_array = catchments_src.read(1)
+    return messages, hand_stage, datum_adj_wse, datum_adj_wse_m
 
-        # TEMP: look at a catchment and rem from the same branch.
-        # Then look at a stage based 4.4.0.0 for this huc and see if we can figure out the
-        # intended results. Are we trying for a image that makes all values below the hand stage
-        # value to be a value (kinda like a 1 and 0 ?)
 
-        # Use numpy.where operation to reclassify rem_path on the condition that the pixel values
-        #   are <= to hand_stage and the catchments value is in the hydroid_list.
+def interpolate_huc_flow_stages(huc_dir, branches, huc_flows_df):
+    """
+    Interpolates the stages of the HydroIDs of a HUC for all of the flow files (lids and magnitudes) of
+    the HUC at once: the hydrotable is read once and joined once with all of the flows.
+
+    Stages are interpolated from the rating curve of each HydroID and rounded the same way as in
+    inundation.py. Lake HydroIDs are not inundated, so they are left out.
 
-        reclass_rem_array = np.where((rem_array <= hand_stage) & (rem_array != rem_src.nodata), 1, 0).astype(
-            'uint8'
+    Returns a dataframe with one row per branch, HydroID, lid and magnitude and its stage.
+    """
+
+    feature_ids = huc_flows_df['feature_id'].unique()
+    htable_dtypes = {
+        'branch': str,
+        'feature_id': str,
+        'HydroID': int,
+        'stage': float,
+        'discharge_cms': float,
+        'LakeID': int,
+    }
+
+    # FIM versions > 4.3.5 use an aggregated hydrotable file rather than individual branch hydrotables
+    hydrotable_path = os.path.join(huc_dir, 'hydrotable.csv')
+    if os.path.isfile(hydrotable_path):
+        hydrotable_df = pd.read_csv(
+            hydrotable_path,
+            usecols=['branch_id'] + list(htable_dtypes)[1:],
+            dtype=dict(htable_dtypes, branch_id=str),
+        ).rename(columns={'branch_id': 'branch'})
+    else:
+        hydrotable_df = pd.concat(
+            [
+                pd.read_csv(
+                    os.path.join(huc_dir, 'branches', branch, f'hydroTable_{branch}.csv'),
+                    usecols=list(htable_dtypes)[1:],
+                    dtype=htable_dtypes,
+                ).assign(branch=branch)
+                for branch in branches
+            ],
+            ignore_index=True,
         )
 
-        hydroid_mask = np.isin(catchments_array, hydroid_list)
-
-        target_catchments_array = np.where(
-            ((hydroid_mask == True) & (catchments_array != catchments_src.nodata)), 1, 0
-        ).astype('uint8')
-
-        masked_reclass_rem_array = np.where(
-            ((reclass_rem_array >= 1) & (target_catchments_array >= 1)), 1, 0
-        ).astype('uint8')
-
-        # change it all to either 1 or 0 (one being inundated)
-        # masked_reclass_rem_array[np.where(masked_reclass_rem_array <= 0)] = 0
-        # masked_reclass_rem_array[np.where(masked_reclass_rem_array > 0)] = 1
-
-        # Save resulting array to new tif with appropriate name. ie) brdc1_record_extent_18060005.tif
-        # to our mapping/huc/lid site
-        # No cells were inundated which is common. Lots of branches don't inundate as they are out of the extent area
-        is_all_zero = np.all(masked_reclass_rem_array == 0)
-
-        # MP_LOG.lprint(f"{huc}: masked_reclass_rem_array, is_all_zero is {is_all_zero} for {rem_path}")
-
-        # if not is_all_zero:
-        # if is_all_zero == False: # this logic didn't let ANY files get saved
-        #    'is False' means that the object does not exist and not that it really equals the value of False
-        if is_all_zero == False:
-            # output_tif = os.path.join(
-            #     lid_directory, lid + '_' + category_key + '_extent_' + huc + '_' + branch + '.tif'
-            # )
-            # # # File may or may not exist
-            # # if os.path.exists(output_tif):
-            MP_LOG.lprint(f" +++ Branch output_tif is {output_tif}")
-            with rasterio.Env():
-                profile = rem_src.profile
-                profile.update(dtype=rasterio.uint8)
-                profile.update(nodata=0)
-
-                # Replace any existing nodata values with the new one
-                # masked_reclass_rem_array[masked_reclass_rem_array == profile["nodata"]] = 0
-
-                with rasterio.open(output_tif, 'w', **profile) as dst:
-                    # dst.nodata = 0
-                    dst.write(masked_reclass_rem_array, 1)
-        # else:
-        #     MP_LOG.trace(f"{file_name} : inundation was all zero cells")
+    hydrotable_df = hydrotable_df[
+        (hydrotable_df['LakeID'] == -999)
+        & hydrotable_df['feature_id'].isin(feature_ids)
+        & hydrotable_df['branch'].isin(branches)
+    ]
 
-    except Exception:
-        MP_LOG.error(f"{huc} : {lid} Error producing inundation maps with stage")
-        MP_LOG.error(traceback.format_exc())
+    # One join for all of the flows (each HydroID keeps its rating curve in hydrotable order)
+    rating_flows_df = hydrotable_df.merge(huc_flows_df, on='feature_id')
 
-    return
+    stages = []
+    for (branch, hydroid, lid, magnitude), rating_df in rating_flows_df.groupby(
+        ['branch', 'HydroID', 'lid', 'magnitude'], sort=False
+    ):
+        interpolated_stage = np.interp(
+            rating_df['discharge'].iloc[0], rating_df['discharge_cms'], rating_df['stage']
+        )
+        stages.append((branch, hydroid, lid, magnitude, np.float32(round(interpolated_stage, 4))))
+
+    return pd.DataFrame(stages, columns=['branch', 'HydroID', 'lid', 'magnitude', 'stage'])
+
+
+# This is called in an MP task (inundate_lid_flow_based) and uses its MP_LOG
+def produce_flow_based_lid_tifs(
+    lid_stages_df, magnitudes, branch_rems, lid, huc, lid_directory, mask_geometries, manifest=None
+):
+    """
+    Creates the extent tifs of all of the magnitudes of a lid from the branch REMs / catchments of the lid
+    (read once by read_lid_branch_rems) and the HydroID stages of interpolate_huc_flow_stages.
+
+    Each branch is processed once for all magnitudes: a cell is inundated for a magnitude when its REM is
+    >= 0 and below the stage of its HydroID (as in inundation.py). The branch extents are then merged,
+    clipped to the HUC and saved as <lid>_<magnitude>_extent.tif (see __save_lid_extent_tif).
+
+    If a manifest (CatFIM_Manifest) is given, the outcome of each magnitude is recorded in it.
+    """
+
+    messages = []
+    magnitude_extents = {magnitude: [] for magnitude in magnitudes}
+
+    for branch_rem in branch_rems:
+        # Stages of the branch HydroIDs (rows) for each magnitude (columns)
+        branch_stages_df = (
+            lid_stages_df[lid_stages_df['branch'] == branch_rem['branch']]
+            .pivot(index='HydroID', columns='magnitude', values='stage')
+            .reindex(columns=magnitudes)
+            .sort_index()
+        )
+        if branch_stages_df.empty:
+            continue
+
+        hydroids = branch_stages_df.index.to_numpy()
+        cell_index = np.searchsorted(hydroids, branch_rem['catchments']).clip(max=len(hydroids) - 1)
+        has_stage = (hydroids[cell_index] == branch_rem['catchments']) & (branch_rem['rem'] >= 0)
+
+        for magnitude, stages in zip(magnitudes, branch_stages_df.to_numpy(np.float64).T):
+            extent_array = (has_stage & (stages[cell_index] - branch_rem['rem'] > 0)).astype('uint8')
+            if extent_array.any():
+                magnitude_extents[magnitude].append((branch_rem, extent_array))
+
+    for magnitude, branch_extents in magnitude_extents.items():
+        huc_lid_mag_id = f"{huc} : {lid} : {magnitude}"
+        output_tif = os.path.join(lid_directory, lid + '_' + magnitude + '_extent.tif')
+        status = 'failed'
+        try:
+            if len(branch_extents) == 0:
+                MP_LOG.trace(f"{huc_lid_mag_id}: no inundated branches")
+                status = 'empty'
+            else:
+                __save_lid_extent_tif(branch_extents, huc, output_tif, mask_geometries)
+                MP_LOG.trace(f"{huc_lid_mag_id}: branch rollup extent file saved at {output_tif}")
+                status = 'done'
+        except Exception:
+            msg = f':inundation failed at {magnitude}'
+            messages.append(lid + msg)
+            MP_LOG.error(f"FAILURE_huc_{huc} - {lid} - {magnitude} map failed to create")
+            MP_LOG.error(traceback.format_exc())
+
+        if manifest is not None:
+            manifest.record_unit(huc, lid, magnitude, magnitude, None, output_tif, status)
+
+    return messages
 
 
 # This is not part of an MP process, but needs to have FLOG carried over so this file can see it
-# Used for Flow only?
+# Used for Flow only
 def run_catfim_inundation(
-    fim_run_dir, output_flows_dir, output_mapping_dir, job_number_huc, job_number_inundate, log_output_file
+    fim_run_dir,
+    output_flows_dir,
+    output_mapping_dir,
+    job_number_huc,
+    job_number_inundate,
+    log_output_file,
+    manifest=None,
 ):
+    """
+    Inundates all of the flow files (HUC / ahps / magnitude) with one flat scheduler (see catfim_scheduler)
+    of job_number_huc * job_number_inundate processes. For each HUC:
+        - each branch is indexed (index_huc_branch)
+        - the stages of the HydroIDs are interpolated for all of the flow files (read_huc_flow_stages)
+        - each ahps site is inundated for all of its magnitudes (inundate_lid_flow_based)
+        - the HUC is post processed (post_process_huc) as soon as all of its sites are inundated
+
+    Returns the list of HUCs post processed (which post_process_cat_fim_for_viz then skips).
+    """
+
     # Adding a pointer in this file coming from generate_categorial_fim so they can share the same log file
     FLOG.setup(log_output_file)
 
@@ -420,194 +704,359 @@ def run_catfim_inundation(
 
     FLOG.trace(f"matching_hucs now are {matching_hucs}")
 
+    output_catfim_dir = os.path.dirname(os.path.normpath(output_mapping_dir))
     child_log_file_prefix = FLOG.MP_calc_prefix_name(log_output_file, "MP_run_ind")
-    with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
-        try:
-            for huc in matching_hucs:
-
-                # Get list of AHPS site directories
-                huc_flows_dir = os.path.join(output_flows_dir, huc)
-
-                # Map path to huc directory inside the mapping directory
-                huc_mapping_dir = os.path.join(output_mapping_dir, huc)
-                if not os.path.exists(huc_mapping_dir):
-                    os.makedirs(huc_mapping_dir, exist_ok=True)
-
-                # ahps_site_dir_list = os.listdir(ahps_site_dir)
-                ahps_site_dir_list = [
-                    x for x in os.listdir(huc_flows_dir) if os.path.isdir(os.path.join(huc_flows_dir, x))
-                ]  # ahps folder names under the huc folder
-
-                FLOG.trace(f"{huc} : ahps_site_dir_list is {ahps_site_dir_list}")
-
-                # Loop through AHPS sites
-                for ahps_id in ahps_site_dir_list:
-                    # map parent directory for AHPS source data dir and list AHPS thresholds (act, min, mod, maj)
-                    ahps_site_parent = os.path.join(huc_flows_dir, ahps_id)
-
-                    # thresholds_dir_list = os.listdir(ahps_site_parent)
-                    thresholds_dir_list = [
-                        x
-                        for x in os.listdir(ahps_site_parent)
-                        if os.path.isdir(os.path.join(ahps_site_parent, x))
-                    ]
-
-                    # but we can just extract it from the csv files names which are
-                    # patterned as: 04130003/chrn6/moderate/chrn6_huc_04130003_flows_moderate.csv
-
-                    # Map parent directory for all inundation output files output files.
-                    huc_site_mapping_dir = os.path.join(huc_mapping_dir, ahps_id)
-                    if not os.path.exists(huc_site_mapping_dir):
-                        os.makedirs(huc_site_mapping_dir, exist_ok=True)
-
-                    # Loop through thresholds/magnitudes and define inundation output files paths
-
-                    FLOG.trace(f"{huc}: {ahps_id} threshold dir list is {thresholds_dir_list}")
-
-                    for magnitude in thresholds_dir_list:
-                        if "." in magnitude:
-                            continue
-
-                        magnitude_flows_csv = os.path.join(
-                            ahps_site_parent,
-                            magnitude,
-                            ahps_id + '_huc_' + huc + '_flows_' + magnitude + '.csv',
-                        )
-                        # print(f"magnitude_flows_csv is {magnitude_flows_csv}")
-                        tif_name = ahps_id + '_' + magnitude + '_extent.tif'
-                        output_extent_tif = os.path.join(huc_site_mapping_dir, tif_name)
-
-                        FLOG.trace(f"Begin inundation for {tif_name}")
-                        try:
-                            executor.submit(
-                                run_inundation,
-                                magnitude_flows_csv,
-                                huc,
-                                huc_site_mapping_dir,
-                                output_extent_tif,
-                                ahps_id,
-                                magnitude,
-                                fim_run_dir,
-                                job_number_inundate,
-                                log_output_file,
-                                child_log_file_prefix,
-                            )
-
-                        except Exception:
-                            FLOG.critical(
-                                "A critical error occured while attempting inundation"
-                                f" for {huc} - {ahps_id}-- {magnitude}"
-                            )
-                            FLOG.critical(traceback.format_exc())
-                            FLOG.merge_log_files(log_output_file, child_log_file_prefix)
-                            sys.exit(1)
+    post_process_log_file_prefix = FLOG.MP_calc_prefix_name(log_output_file, "MP_post_process")
+
+    scheduler = CatFIM_Scheduler(job_number_huc * job_number_inundate)
+    post_processed_hucs = []
+    for huc in matching_hucs:
+
+        if manifest is not None and manifest.is_huc_done(huc):
+            FLOG.lprint(f"{huc} : inundation already completed, skipped")
+            continue
+
+        huc_dir = os.path.join(fim_run_dir, huc)
+        if not os.path.isdir(os.path.join(huc_dir, 'branches')):
+            FLOG.error(f"{huc} : branch directory missing")
+            continue
+
+        # Map path to huc directory inside the mapping directory
+        huc_mapping_dir = os.path.join(output_mapping_dir, huc)
+        if not os.path.exists(huc_mapping_dir):
+            os.makedirs(huc_mapping_dir, exist_ok=True)
+
+        # All of the sites and magnitudes of the HUC are inundated together
+        FLOG.trace(f"Begin inundation for {huc}")
+        __schedule_huc_flow_inundation(
+            scheduler,
+            huc,
+            huc_dir,
+            os.path.join(output_flows_dir, huc),
+            huc_mapping_dir,
+            output_catfim_dir,
+            log_output_file,
+            child_log_file_prefix,
+            post_process_log_file_prefix,
+            manifest,
+            post_processed_hucs,
+        )
 
-        except Exception:
-            FLOG.critical("A critical error occured while attempting all hucs inundation")
-            FLOG.critical(traceback.format_exc())
-            FLOG.merge_log_files(log_output_file, child_log_file_prefix)
-            sys.exit(1)
+    try:
+        scheduler.run()
+    except Exception:
+        FLOG.critical("A critical error occured while attempting all hucs inundation")
+        FLOG.critical(traceback.format_exc())
+        FLOG.merge_log_files(log_output_file, child_log_file_prefix)
+        sys.exit(1)
 
-    # end of ProcessPoolExecutor
+    for task_key, task_error in scheduler.errors.items():
+        FLOG.error(f"{task_key} failed")
+        FLOG.error(task_error)
 
     # rolls up logs from child MP processes into this parent_log_output_file
 
     # hold on merging it up for now, to keep the overall log size down a little
     FLOG.merge_log_files(log_output_file, child_log_file_prefix, True)
+    FLOG.merge_log_files(log_output_file, post_process_log_file_prefix, True)
 
     print()
     FLOG.lprint(">>> End Inundating and Mosaicking")
 
-    return
+    return post_processed_hucs
 
 
-# This is part of an MP Pool
+# Used for Flow only
+def __schedule_huc_flow_inundation(
+    scheduler,
+    huc,
+    huc_dir,
+    huc_flows_dir,
+    huc_mapping_dir,
+    output_catfim_dir,
+    parent_log_output_file,
+    child_log_file_prefix,
+    post_process_log_file_prefix,
+    manifest,
+    post_processed_hucs,
+):
+    # Adds the tasks of a HUC to the scheduler (see run_catfim_inundation). Task keys start with the HUC.
+    branch_dir = os.path.join(huc_dir, 'branches')
+    index_keys = []
+    for branch in list_huc_branches(branch_dir):
+        index_keys.append((huc, 'index', branch))
+        scheduler.submit(
+            index_keys[-1],
+            index_huc_branch,
+            branch_dir,
+            huc,
+            branch,
+            parent_log_output_file,
+            child_log_file_prefix,
+            memory_mb=estimate_branch_index_memory_mb(branch_dir, branch),
+        )
+
+    huc_branch_index = {}
+
+    def index_done():
+        # Index the HydroIDs of every branch once for all of the ahps sites of the HUC
+        huc_branch_index['df'] = merge_huc_branch_index([scheduler.result(key) for key in index_keys])
+        branches = huc_branch_index['df']['branch'].unique()
+        scheduler.submit(
+            (huc, 'stages'),
+            read_huc_flow_stages,
+            huc,
+            huc_dir,
+            huc_flows_dir,
+            huc_mapping_dir,
+            branches,
+            parent_log_output_file,
+            child_log_file_prefix,
+            manifest,
+            memory_mb=estimate_flow_stages_memory_mb(huc_dir, branches),
+            depends_on=[(huc, 'index')],
+        )
+        scheduler.when_done((huc, 'lids'), [(huc, 'stages')], stages_done)
+
+    def stages_done():
+        huc_flow_stages = scheduler.result((huc, 'stages'))
+        if huc_flow_stages is None:
+            return
+
+        huc_flows_df, huc_stages_df = huc_flow_stages
+        lid_keys = []
+        for ahps_id, ahps_flows_df in huc_flows_df.groupby('lid'):
+            lid_index_df = get_lid_branch_index(huc_branch_index['df'], ahps_flows_df['feature_id'].unique())
+            lid_keys.append((huc, 'lid', ahps_id))
+            scheduler.submit(
+                lid_keys[-1],
+                inundate_lid_flow_based,
+                huc,
+                ahps_id,
+                huc_stages_df[huc_stages_df['lid'] == ahps_id],
+                sorted(ahps_flows_df['magnitude'].unique()),
+                lid_index_df,
+                huc_dir,
+                os.path.join(huc_mapping_dir, ahps_id),
+                parent_log_output_file,
+                child_log_file_prefix,
+                manifest,
+                memory_mb=estimate_lid_memory_mb(lid_index_df),
+                depends_on=[(huc, 'lids')],
+            )
+
+        def huc_done():
+            lid_messages = [scheduler.result(key) for key in lid_keys]
+
+            # Sites that failed unexpectedly are tried again when resuming
+            if manifest is not None and None not in lid_messages:
+                manifest.record_huc(huc)
+
+            if schedule_post_process_huc(
+                scheduler,
+                output_catfim_dir,
+                huc,
+                (huc, 'done'),
+                parent_log_output_file,
+                post_process_log_file_prefix,
+                f"{len(post_processed_hucs) + 1} HUCs inundated",
+            ):
+                post_processed_hucs.append(huc)
+
+        scheduler.when_done((huc, 'done'), lid_keys + [(huc, 'lids')], huc_done)
+
+    scheduler.when_done((huc, 'index'), index_keys, index_done)
+
+
+def estimate_flow_stages_memory_mb(huc_dir, branches):
+    """Returns the estimated memory (MB) used by read_huc_flow_stages (about twice the hydrotables size)."""
+    hydrotable_path = os.path.join(huc_dir, 'hydrotable.csv')
+    if os.path.isfile(hydrotable_path):
+        hydrotable_paths = [hydrotable_path]
+    else:
+        hydrotable_paths = [
+            os.path.join(huc_dir, 'branches', branch, f'hydroTable_{branch}.csv') for branch in branches
+        ]
+    return sum(os.path.getsize(path) for path in hydrotable_paths if os.path.isfile(path)) * 2 / 2**20
+
+
+# This is part of an MP call and needs MP_LOG
 # It is used for flow-based
-# It inundates each set based on the ahps/mangnitude list and for each segment in the
-# the branch hydrotable
-# Then each is inundated per branch and mosiaked for the ahps
-def run_inundation(
-    magnitude_flows_csv,
+def read_huc_flow_stages(
     huc,
-    output_huc_site_mapping_dir,
-    output_extent_tif,
-    ahps_site,
-    magnitude,
-    fim_run_dir,
-    job_number_inundate,
+    huc_dir,
+    huc_flows_dir,
+    output_huc_mapping_dir,
+    branches,
     parent_log_output_file,
     child_log_file_prefix,
+    manifest=None,
 ):
+    """
+    Reads all of the ahps/magnitude flow files of a HUC not completed yet and interpolates the stages of
+    every HydroID of the branches for all of them at once (see interpolate_huc_flow_stages).
+
+    Returns (huc_flows_df, huc_stages_df), with no flows if there is nothing left to inundate,
+    or None if there was an error.
+    """
+
     # Note: child_log_file_prefix is "MP_run_ind", meaning all logs created by this function start
     #  with the phrase "MP_run_ind"
     #  They will be rolled up into the parent_log_output_file
     # This is setting up logging for this function to go up to the parent\
     MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
-    # MP_LOG.trace(locals())
 
-    huc_dir = os.path.join(fim_run_dir, huc)
-    # Why all high number for job_number_inundate? Inundate_gms has to create inundation for each
-    # branch and merge them.
     try:
-        MP_LOG.lprint(f"... Running Inundate_gms and mosiacking for {huc} : {ahps_site} : {magnitude}")
-        map_file = Inundate_gms(
-            hydrofabric_dir=fim_run_dir,
-            forecast=magnitude_flows_csv,
-            num_workers=job_number_inundate,
-            hucs=huc,
-            inundation_raster=output_extent_tif,
-            inundation_polygon=None,
-            depths_raster=None,
-            verbose=False,
-            log_file=None,
-            output_fileNames=None,
-        )
+        MP_LOG.lprint(f"... Running inundation for all ahps sites and magnitudes of {huc}")
 
-        MP_LOG.trace(f"Mosaicking for {huc} : {ahps_site} : {magnitude}")
-        Mosaic_inundation(
-            map_file,
-            mosaic_attribute='inundation_rasters',
-            mosaic_output=output_extent_tif,
-            mask=os.path.join(huc_dir, 'wbd.gpkg'),
-            unit_attribute_name='huc8',
-            nodata=-9999,
-            workers=1,
-            remove_inputs=False,
-            subset=None,
-            verbose=False,
-        )
+        # Flow files are patterned as: 04130003/chrn6/moderate/chrn6_huc_04130003_flows_moderate.csv
+        flow_dfs = []
+        for ahps_id in sorted(os.listdir(huc_flows_dir)):
+            ahps_site_parent = os.path.join(huc_flows_dir, ahps_id)
+            if not os.path.isdir(ahps_site_parent):
+                continue
 
-        MP_LOG.trace(f"Mosaicking complete for {huc} : {ahps_site} : {magnitude}")
+            for magnitude in sorted(os.listdir(ahps_site_parent)):
+                magnitude_flows_csv = os.path.join(
+                    ahps_site_parent, magnitude, ahps_id + '_huc_' + huc + '_flows_' + magnitude + '.csv'
+                )
+                if "." in magnitude or not os.path.exists(magnitude_flows_csv):
+                    continue
+
+                output_extent_tif = os.path.join(
+                    output_huc_mapping_dir, ahps_id, ahps_id + '_' + magnitude + '_extent.tif'
+                )
+                if manifest is not None and manifest.is_unit_done(huc, ahps_id, magnitude, output_extent_tif):
+                    MP_LOG.trace(f"{huc} : {ahps_id} : {magnitude} already completed, skipped")
+                    continue
+
+                flows_df = pd.read_csv(
+                    magnitude_flows_csv,
+                    usecols=['feature_id', 'discharge'],
+                    dtype={'feature_id': str, 'discharge': float},
+                )
+                flow_dfs.append(flows_df.assign(lid=ahps_id, magnitude=magnitude))
+
+        if len(flow_dfs) == 0:
+            MP_LOG.warning(f"{huc} : no flow files to inundate")
+            empty_flows_df = pd.DataFrame(columns=['feature_id', 'discharge', 'lid', 'magnitude'])
+            return empty_flows_df, pd.DataFrame(columns=['branch', 'HydroID', 'lid', 'magnitude', 'stage'])
+        huc_flows_df = pd.concat(flow_dfs, ignore_index=True)
 
-        # Mask out lakes from inundated tif and re-save tif
-        # TODO: Update to only run if lake detected?
-        with rasterio.open(output_extent_tif, 'r+') as output_extent_src:
-            output_extent_array = output_extent_src.read(1)
-            output_extent_array_masked = mask_out_lakes(output_extent_array, huc, output_extent_src)
-            output_extent_src.write(output_extent_array_masked, 1)
+        huc_stages_df = interpolate_huc_flow_stages(huc_dir, branches, huc_flows_df)
+        MP_LOG.trace(f"{huc} : {len(huc_stages_df)} HydroID stages interpolated for all flow files")
 
-        MP_LOG.trace(f"Lake masking complete for {huc} : {ahps_site} : {magnitude}")
+        return huc_flows_df, huc_stages_df
 
     except Exception:
         # Log errors and their tracebacks
         MP_LOG.error(f"Exception: running inundation for {huc}")
         MP_LOG.error(traceback.format_exc())
-        return
 
-    # Inundation.py appends the huc code to the supplied output_extent_grid for stage-based.
-    # Modify output_extent_grid to match inundation.py saved filename.
-    # Search for this file, if it didn't create, send message to log file.
+    return None
+
+
+# This is part of an MP call and needs MP_LOG
+# It is used for flow-based
+def inundate_lid_flow_based(
+    huc,
+    ahps_id,
+    lid_stages_df,
+    magnitudes,
+    lid_index_df,
+    huc_dir,
+    huc_site_mapping_dir,
+    parent_log_output_file,
+    child_log_file_prefix,
+    manifest=None,
+):
+    """
+    Inundates all of the magnitudes of an ahps site: its branches (rows of the HUC index holding its
+    segments) are read once, then produce_flow_based_lid_tifs creates the extent tif of each magnitude.
+
+    Returns the messages of produce_flow_based_lid_tifs, or None if the site failed.
+    """
 
-    # base_file_path, extension = os.path.splitext(output_extent_tif)
-    # saved_extent_grid_filename = "{}_{}{}".format(base_file_path, huc, extension)
+    MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
 
-    # MP_LOG.trace(f"saved_extent_grid_filename is {saved_extent_grid_filename}")
+    try:
+        # Map parent directory for all inundation output files output files.
+        if not os.path.exists(huc_site_mapping_dir):
+            os.makedirs(huc_site_mapping_dir, exist_ok=True)
+
+        branch_rems = read_lid_branch_rems(lid_index_df, ahps_id, huc, keep_catchments=True)
+        if len(branch_rems) == 0:
+            MP_LOG.warning(f"{huc} : {ahps_id} : no branches hold the flow file segments")
+
+        # Extents are clipped to the HUC (same as the mosaic of the HUC branches)
+        wbd_gdf = gpd.read_file(os.path.join(huc_dir, 'wbd.gpkg'))
+        crs = branch_rems[0]['profile']['crs'] if len(branch_rems) > 0 else wbd_gdf.crs
+        return produce_flow_based_lid_tifs(
+            lid_stages_df,
+            magnitudes,
+            branch_rems,
+            ahps_id,
+            huc,
+            huc_site_mapping_dir,
+            list(wbd_gdf.to_crs(crs).geometry),
+            manifest,
+        )
 
-    if not os.path.exists(output_extent_tif):
-        MP_LOG.error(f"FAILURE_huc_{huc} - {ahps_site} - {magnitude} map failed to create")
-        return
+    except Exception:
+        MP_LOG.error(f"Exception: running inundation for {huc} : {ahps_id}")
+        MP_LOG.error(traceback.format_exc())
 
-    return
+    return None
+
+
+def schedule_post_process_huc(
+    scheduler,
+    output_catfim_dir,
+    huc,
+    depends_on_key,
+    parent_log_output_file,
+    child_log_file_prefix,
+    progress_stmt,
+):
+    """
+    Adds the post processing of a HUC (post_process_huc) to a CatFIM scheduler, once the task depends_on_key
+    is completed. It is called once all of the lids of the HUC are inundated, so a HUC is post processed
+    while the other HUCs are still inundating. Returns False if the HUC has no lids to post process.
+    """
+
+    huc_dir = os.path.join(output_catfim_dir, 'mapping', huc)
+    if not os.path.isdir(huc_dir):
+        return False
+    ahps_dir_list = [x for x in os.listdir(huc_dir) if os.path.isdir(os.path.join(huc_dir, x))]
+    if len(ahps_dir_list) == 0:
+        return False
+
+    gpkg_dir = os.path.join(output_catfim_dir, 'mapping', 'gpkg')
+    os.makedirs(gpkg_dir, exist_ok=True)
+
+    # The extent tifs are polygonized one at a time
+    max_tif_cells = 0
+    for ahps_lid in ahps_dir_list:
+        for tif_name in os.listdir(os.path.join(huc_dir, ahps_lid)):
+            if tif_name.endswith('_extent.tif'):
+                with rasterio.open(os.path.join(huc_dir, ahps_lid, tif_name)) as tif_src:
+                    max_tif_cells = max(max_tif_cells, tif_src.width * tif_src.height)
+
+    scheduler.submit(
+        (huc, 'post_process'),
+        post_process_huc,
+        output_catfim_dir,
+        ahps_dir_list,
+        huc_dir,
+        gpkg_dir,
+        huc,
+        parent_log_output_file,
+        child_log_file_prefix,
+        progress_stmt,
+        memory_mb=max_tif_cells * POST_PROCESS_BYTES_PER_CELL / 2**20,
+        depends_on=[depends_on_key],
+    )
+    return True
 
 
 # This is part of an MP Pool
@@ -623,6 +1072,10 @@ def post_process_huc(
     child_log_file_prefix,
     progress_stmt,
 ):
+    """
+    Polygonizes all of the extent tifs of the HUC's lids and saves them to one gpkg for the HUC
+    (gpkg_dir/{huc}_catfim_extents.gpkg), which post_process_cat_fim_for_viz later merges into the library.
+    """
 
     # Note: child_log_file_prefix is "MP_post_process_{huc}", meaning all logs created by this function start
     #  with the phrase "MP_post_process_{huc}". This one rollups up to the master catfim log
@@ -635,23 +1088,20 @@ def post_process_huc(
         # Loop through ahps sites
         attributes_dir = os.path.join(output_catfim_dir, 'attributes')
 
-        for ahps_lid in ahps_dir_list:
-            tifs_to_reformat_list = []
+        huc_extents_gdfs = []
+        for ahps_lid in sorted(ahps_dir_list):
             mapping_huc_lid_dir = os.path.join(huc_dir, ahps_lid)
             MP_LOG.trace(f"mapping_huc_lid_dir is {mapping_huc_lid_dir}")
 
             # aka. ends with "extent.tif" which means it is a rolled up version up for there branches
-            tif_list = [x for x in os.listdir(mapping_huc_lid_dir) if ('extent.tif') in x]
-
-            if len(tif_list) == 0:
-                # This is perfectly fine for there to be none
-                # MP_LOG.warning(f">> no tifs found for {huc} {ahps_lid} at {mapping_huc_lid_dir}")
-                continue
-
-            for tif in tif_list:
-                tifs_to_reformat_list.append(os.path.join(mapping_huc_lid_dir, tif))
+            tifs_to_reformat_list = [
+                os.path.join(mapping_huc_lid_dir, x)
+                for x in sorted(os.listdir(mapping_huc_lid_dir))
+                if x.endswith('_extent.tif')
+            ]
 
             if len(tifs_to_reformat_list) == 0:
+                # This is perfectly fine for there to be none
                 # MP_LOG.warning(f">> no tifs found for {huc} {ahps_lid} at {mapping_huc_lid_dir}")
                 continue
 
@@ -664,75 +1114,27 @@ def post_process_huc(
                 MP_LOG.warning(f"{ahps_lid} has no attributes file which may perfectly fine.")
                 continue
 
-            # We are going to do an MP in MP.
-            # child_log_file_prefix = MP_LOG.MP_calc_prefix_name(
-            #    parent_log_output_file, "MP_reformat_tifs", huc
-            # )
-            # Weird case, we ahve to delete any of these files that might already exist (MP in MP)
-            # Get parent log dir
-            # log_dir = os.path.dirname(parent_log_output_file)
-            # old_refomat_log_files = glob.glob(os.path.join(log_dir, 'MP_reformat_tifs_*'))
-            # for log_file in old_refomat_log_files:
-            #     os.remove(log_file)
-
-            # we only have the rolled up, no branch versions by now
-            for tif_to_process in tifs_to_reformat_list:
-                # If not os.path.exists(tif_to_process):
-                #    continue
-
-                # If stage based, the file names looks like this:
-                #      masm1_major_extent.tif  (non-interval, whole number)
-                #      masm1_major_20.6_extent.tif  (non-interval, float)
-                #      masm1_major_20.0ft_extent.tif (interval)
-                # If flow based, the file name looks like this: masm1_action_extent.tif
-                MP_LOG.trace(f".. Tif to Process = {tif_to_process}")
-                try:
-
-                    tif_file_name = os.path.basename(tif_to_process)
-                    file_name_parts = tif_file_name.split("_")
-                    magnitude = file_name_parts[1]  # part 0 is the lid
-
-                    # but if it doesn't have "fti" at the end it is not an interval
-
-                    # careful. ft can be part of the site name, so only check part 3
-                    interval_stage = None
-                    is_interval = False
-                    if len(file_name_parts) >= 3 and "fti" in file_name_parts[2]:
-                        try:
-                            stage_val = file_name_parts[2].replace("fti", "")
-                            interval_stage = float(stage_val)
-                            is_interval = True
-                        except ValueError:
-                            interval_stage = None
-                            MP_LOG.error(
-                                f"Value Error for {huc} - {ahps_lid} - magnitude {magnitude}"
-                                f" at {mapping_huc_lid_dir}"
-                            )
-                            MP_LOG.error(traceback.format_exc())
-
-                    reformat_inundation_maps(
-                        ahps_lid,
-                        tif_to_process,
-                        gpkg_dir,
-                        huc,
-                        magnitude,
-                        nws_lid_attributes_filename,
-                        interval_stage,
-                        is_interval,
-                        parent_log_output_file,
-                        child_log_file_prefix,
-                    )
-                except Exception:
-                    MP_LOG.error(
-                        f"An ind reformat map error occured for {huc} - {ahps_lid} - magnitude {magnitude}"
-                    )
-                    MP_LOG.error(traceback.format_exc())
+            try:
+                lid_extents_gdf = reformat_lid_inundation_maps(
+                    ahps_lid, tifs_to_reformat_list, huc, nws_lid_attributes_filename
+                )
+                if lid_extents_gdf is not None:
+                    huc_extents_gdfs.append(lid_extents_gdf)
+            except Exception:
+                MP_LOG.error(f"An ind reformat map error occured for {huc} - {ahps_lid}")
+                MP_LOG.error(traceback.format_exc())
 
-            # rolls up logs from child MP processes into this parent_log_output_file
-            # MP_LOG.merge_log_files(parent_log_output_file, child_log_file_prefix, True)
+        if len(huc_extents_gdfs) == 0:
+            MP_LOG.warning(f"{huc} : no extents to save")
+            return
 
-        # TODO:  Roll up the independent related ahps gpkgs into a huc level gkpg, still in the gpkg dir
-        # all of the gkpgs we want will have the huc number in front of it
+        # Save the dissolved multipolygons of all of the lids of the HUC
+        huc_extents_gdf = pd.concat(huc_extents_gdfs, ignore_index=True)
+        huc_extents_filename = os.path.join(gpkg_dir, f"{huc}_catfim_extents.gpkg")
+        huc_extents_gdf.to_file(
+            huc_extents_filename, driver=getDriver(huc_extents_filename), index=False, engine='fiona'
+        )
+        MP_LOG.trace(f"{huc} : {len(huc_extents_gdf)} extents saved as {huc_extents_filename}")
 
     except Exception:
         MP_LOG.error(f"An error has occurred in post processing for {huc}")
@@ -743,8 +1145,19 @@ def post_process_huc(
 
 # This is not part of an MP process, but does need FLOG carried into it so it can use FLOG directly
 def post_process_cat_fim_for_viz(
-    catfim_method, output_catfim_dir, job_huc_ahps, catfim_version, model_version, log_output_file
+    catfim_method,
+    output_catfim_dir,
+    job_huc_ahps,
+    catfim_version,
+    model_version,
+    log_output_file,
+    post_processed_hucs=None,
 ):
+    """
+    Polygonizes the extent tifs of every HUC (post_process_huc) and merges them into the catfim library.
+    HUCs in post_processed_hucs were already post processed while inundating (see schedule_post_process_huc)
+    and are only merged.
+    """
 
     # Adding a pointer in this file coming from generate_categorial_fim so they can share the same log file
     FLOG.setup(log_output_file)
@@ -762,11 +1175,16 @@ def post_process_cat_fim_for_viz(
     ]
 
     # if we don't have a huc_ahps_dir_list, something went catestrophically bad
-    if len(huc_ahps_dir_list) == 0:
+    if len(huc_ahps_dir_list) == 0 and not post_processed_hucs:
         raise Exception("Critical Error: Not possible to be here with no huc/ahps list")
 
+    if post_processed_hucs is None:
+        post_processed_hucs = []
+    huc_ahps_dir_list = [huc for huc in huc_ahps_dir_list if huc not in post_processed_hucs]
+
     num_hucs = len(huc_ahps_dir_list)
     huc_index = 0
+    FLOG.lprint(f"Number of hucs already post processed is {len(post_processed_hucs)}")
     FLOG.lprint(f"Number of hucs to post process is {num_hucs}")
 
     # TODO: Sep 2024: we need to remove the process pool here and put it post_process_huc (for tif inundation)
@@ -888,113 +1306,101 @@ def post_process_cat_fim_for_viz(
 
 
 # This is part of an MP pool
-def reformat_inundation_maps(
-    ahps_lid,
-    tif_to_process,
-    gpkg_dir,
-    huc,
-    magnitude,
-    nws_lid_attributes_filename,
-    interval_stage,
-    is_interval,
-    parent_log_output_file,
-    child_log_file_prefix,
-):
-    """_summary_
-    Turns inundated tifs into dissolved polys gpkg with more attributes
-
+def reformat_lid_inundation_maps(ahps_lid, tifs_to_process, huc, nws_lid_attributes_filename):
+    """
+    Turns the inundated tifs of a lid into dissolved polys (one multipolygon per tif) with more attributes.
+    The lid attributes csv is read once for all of the tifs. Returns a GeoDataFrame in VIZ_PROJECTION,
+    or None if none of the tifs has an inundated cell.
+
+    Note: magnitude and interval stage come from the file name.
+        If stage based, the file names looks like this:
+            masm1_major_extent.tif  (non-interval, whole number)
+            masm1_major_20.6_extent.tif  (non-interval, float)
+            masm1_major_20.0fti_extent.tif (interval)
+        If flow based, the file name looks like this: masm1_action_extent.tif
     """
-    # interval stage might come in as null and that is ok
 
-    # Note: child_log_file_prefix is "MP_reformat_tifs_{huc}", meaning all logs created by this
-    # function start with the phrase will rollup to the master catfim logs
+    extent_records = []
+    extent_crs = None
+    for tif_to_process in tifs_to_process:
+        MP_LOG.trace(f".. Tif to Process = {tif_to_process}")
 
-    # This is setting up logging for this function to go up to the parent
-    MP_LOG.MP_Log_setup(parent_log_output_file, child_log_file_prefix)
+        tif_file_name = os.path.basename(tif_to_process)
+        file_name_parts = tif_file_name.split("_")
+        magnitude = file_name_parts[1]  # part 0 is the lid
 
-    try:
-        MP_LOG.trace(
-            f"{huc} : {ahps_lid} : {magnitude} -- Start reformat_inundation_maps" " (tif extent to gpkg poly)"
-        )
-        MP_LOG.trace(F"tif to process is {tif_to_process}")
+        # but if it doesn't have "fti" at the end it is not an interval
+
+        # careful. ft can be part of the site name, so only check part 3
+        interval_stage = None
+        is_interval = False
+        if len(file_name_parts) >= 3 and "fti" in file_name_parts[2]:
+            try:
+                stage_val = file_name_parts[2].replace("fti", "")
+                interval_stage = float(stage_val)
+                is_interval = True
+            except ValueError:
+                interval_stage = None
+                MP_LOG.error(
+                    f"Value Error for {huc} - {ahps_lid} - magnitude {magnitude} at {tif_to_process}"
+                )
+                MP_LOG.error(traceback.format_exc())
 
-        # Convert raster to shapes
+        # Convert raster to shapes and dissolve them
         with rasterio.open(tif_to_process) as src:
             image = src.read(1)
-            mask = image > 0
+            extent_crs = src.crs
+            extent_shapes = [
+                shape(geom) for geom, _ in shapes(image, mask=image > 0, transform=src.transform)
+            ]
 
-        # Aggregate shapes
-        results = (
-            {'properties': {'extent': 1}, 'geometry': s}
-            for i, (s, v) in enumerate(shapes(image, mask=mask, transform=src.transform))
+        if len(extent_shapes) == 0:
+            MP_LOG.error(f"{huc} : {ahps_lid} : {magnitude} tif to gpkg, geodataframe is empty")
+            continue
+
+        extent_records.append(
+            {
+                'geometry': union_all(extent_shapes),
+                'ahps_lid': ahps_lid,
+                'magnitude': magnitude,
+                'huc': huc,
+                'interval_stage': interval_stage,
+                'is_interval': is_interval,
+            }
         )
 
-        # Convert list of shapes to polygon
-        # lots of polys
-        extent_poly = gpd.GeoDataFrame.from_features(list(results), crs=src.crs)
-
-        # Dissolve polygons
-        extent_poly_diss = extent_poly.dissolve(by='extent')
+    if len(extent_records) == 0:
+        return None
 
-        # Update attributes
-        extent_poly_diss = extent_poly_diss.reset_index(drop=True)
-        extent_poly_diss['ahps_lid'] = ahps_lid
-        extent_poly_diss['magnitude'] = magnitude
-        extent_poly_diss['huc'] = huc
-        extent_poly_diss['interval_stage'] = interval_stage
-        extent_poly_diss['is_interval'] = is_interval
+    extent_poly_diss = gpd.GeoDataFrame(extent_records, geometry='geometry', crs=extent_crs)
 
-        # Project to Web Mercator
-        extent_poly_diss = extent_poly_diss.to_crs(VIZ_PROJECTION)
+    # Project to Web Mercator
+    extent_poly_diss = extent_poly_diss.to_crs(VIZ_PROJECTION)
 
-        # Join attributes
-        nws_lid_attributes_table = pd.read_csv(nws_lid_attributes_filename, dtype={'huc': str})
-        nws_lid_attributes_table = nws_lid_attributes_table.loc[
-            (nws_lid_attributes_table.magnitude == magnitude) & (nws_lid_attributes_table.nws_lid == ahps_lid)
-        ]
-        extent_poly_diss = extent_poly_diss.merge(
-            nws_lid_attributes_table,
-            left_on=['ahps_lid', 'magnitude', 'huc'],
-            right_on=['nws_lid', 'magnitude', 'huc'],
-        )
-        # already has an ahps_lid column which we want and not the nws_lid column
-        extent_poly_diss = extent_poly_diss.drop(columns='nws_lid')
-
-        # Remove uncorrected stage from interval rows (to decrease potential for confusion)
-        extent_poly_diss.loc[extent_poly_diss['is_interval'] == True, 'stage_uncorrected'] = None
-
-        # Save dissolved multipolygon
-        handle = os.path.split(tif_to_process)[1].replace('.tif', '')
-        diss_extent_filename = os.path.join(gpkg_dir, f"{huc}_{handle}.gpkg")
-        extent_poly_diss["geometry"] = [
-            MultiPolygon([feature]) if type(feature) is Polygon else feature
-            for feature in extent_poly_diss["geometry"]
-        ]
+    # Join attributes
+    nws_lid_attributes_table = pd.read_csv(nws_lid_attributes_filename, dtype={'huc': str})
+    nws_lid_attributes_table = nws_lid_attributes_table.loc[nws_lid_attributes_table.nws_lid == ahps_lid]
+    extent_poly_diss = extent_poly_diss.merge(
+        nws_lid_attributes_table,
+        left_on=['ahps_lid', 'magnitude', 'huc'],
+        right_on=['nws_lid', 'magnitude', 'huc'],
+    )
+    # already has an ahps_lid column which we want and not the nws_lid column
+    extent_poly_diss = extent_poly_diss.drop(columns='nws_lid')
 
-        if not extent_poly_diss.empty:
-            extent_poly_diss.to_file(
-                diss_extent_filename, driver=getDriver(diss_extent_filename), index=False, engine='fiona'
-            )
-            # MP_LOG.trace(
-            #    f"{huc} : {ahps_lid} : {magnitude} - Reformatted inundation map saved"
-            #    f" as {diss_extent_filename}"
-            # )
-        else:
-            MP_LOG.error(f"{huc} : {ahps_lid} : {magnitude} tif to gpkg, geodataframe is empty")
+    if extent_poly_diss.empty:
+        MP_LOG.error(f"{huc} : {ahps_lid} tif to gpkg, no attributes for the magnitudes of the extents")
+        return None
 
-    except ValueError as ve:
-        msg = f"{huc} : {ahps_lid} : {magnitude} - Reformatted inundation map"
-        if "Assigning CRS to a GeoDataFrame without a geometry column is not supported" in ve:
-            MP_LOG.warning(f"{msg} - Warning: details: {ve}")
-        else:
-            MP_LOG.error(f"{msg} - Exception")
-            MP_LOG.error(traceback.format_exc())
+    # Remove uncorrected stage from interval rows (to decrease potential for confusion)
+    extent_poly_diss.loc[extent_poly_diss['is_interval'] == True, 'stage_uncorrected'] = None
 
-    except Exception:
-        MP_LOG.error(f"{huc} : {ahps_lid} : {magnitude} - Reformatted inundation map - Exception")
-        MP_LOG.error(traceback.format_exc())
+    extent_poly_diss["geometry"] = [
+        MultiPolygon([feature]) if type(feature) is Polygon else feature
+        for feature in extent_poly_diss["geometry"]
+    ]
 
-    return
+    return extent_poly_diss
 
 
 # This is not part of an MP progress and simply needs the
@@ -1014,6 +1420,7 @@ def manage_catfim_mapping(
     job_number_inundate,
     log_output_file,
     step_number=1,
+    manifest=None,
 ):
 
     # Adding a pointer in this file coming from generate_categorial_fim so they can share the same log file
@@ -1026,14 +1433,16 @@ def manage_catfim_mapping(
     if not os.path.exists(output_mapping_dir):
         os.mkdir(output_mapping_dir)
 
+    post_processed_hucs = []
     if step_number <= 1:
-        run_catfim_inundation(
+        post_processed_hucs = run_catfim_inundation(
             fim_run_dir,
             output_flows_dir,
             output_mapping_dir,
             job_number_huc,
             job_number_inundate,
             FLOG.LOG_FILE_PATH,
+            manifest,
         )
     else:
         FLOG.lprint("Skip running Inundation as Step > 1")
@@ -1046,7 +1455,13 @@ def manage_catfim_mapping(
     # for now, we will manually multiple the huc * 5 (max number of ahps types)
     ahps_jobs = job_number_huc * 5
     post_process_cat_fim_for_viz(
-        catfim_method, output_catfim_dir, ahps_jobs, catfim_version, model_version, str(FLOG.LOG_FILE_PATH)
+        catfim_method,
+        output_catfim_dir,
+        ahps_jobs,
+        catfim_version,
+        model_version,
+        str(FLOG.LOG_FILE_PATH),
+        post_processed_hucs,
     )
 
     end = time.time()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import argparse
+import functools
+import hashlib
+import io
 import os
 import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from os import listdir
 
 import geopandas as gpd
@@ -14,10 +20,14 @@ import requests
 import shapely
 from PIL import Image
 from rasterio.plot import show
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+from requests.adapters import HTTPAdapter
 from shapely import segmentize
 from shapely.geometry import LineString, Point
 from shapely.geometry.polygon import Polygon
 from shapely.ops import substring
+from urllib3.util.retry import Retry
 
 
 '''
@@ -25,8 +35,32 @@ This script contains functions that are useful for exploring Categorical FIM out
 functions are designed to be run in a Juputer notebook so that the plots and maps can be
 easily viewed.
 
+It can also be run as a script to save the QA figures (maps and elevation cross-section) of
+every CatFIM site of a run, or of some HUCs, e.g. as a nightly job (see generate_catfim_site_figures):
+    - The ESRI basemap images are fetched once (concurrently) and kept in a basemap cache.
+    - The DEM elevations of the cross-section points of all of the sites are sampled together,
+      reading each DEM block once.
+    - The figures of the sites are rendered in a pool of processes.
+
+Basemap configuration comes from the environment:
+    CATFIM_BASEMAP_CACHE_DIR   Directory of the basemap image cache. No cache if not set (defaults
+                               to <output dir>/basemap_cache when run as a script).
+    CATFIM_BASEMAP_MODE        "live" (default): use the cache, get the images not in it from ESRI.
+                               "offline": only use the cache, maps of images not in it have no basemap.
+                               "stub": never call ESRI, use a blank image (e.g. to test the rendering).
+
 '''
 
+BASEMAP_MODES = ['live', 'offline', 'stub']
+
+ESRI_EXPORT_URL = 'https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export'
+
+# Length (ft/m) of the zoomed out site maps, hard-coded for now
+ZOOMED_OUT_MAP_LENGTH = 20000
+
+# Size (pixels) of the ESRI export images (its default, as no size is requested)
+BASEMAP_IMAGE_SIZE = (400, 400)
+
 # -------------------------------------------------------------
 # Reading in and processing CatFIM library and geospatial data
 # -------------------------------------------------------------
@@ -76,6 +110,21 @@ def read_catfim_outputs(catfim_inputs_path, catfim_outputs_path, huc):
     flowline_path = os.path.join(catfim_inputs_path, huc, 'nwm_subset_streams_levelPaths_dissolved.gpkg')
     flowline_gdf = gpd.read_file(flowline_path)
 
+    catfim_library, catfim_points = read_catfim_library(catfim_outputs_path)
+
+    print('HAND-FIM and CatFIM outputs have been read in.')
+
+    return catfim_library, catfim_points, flowline_gdf
+
+
+def read_catfim_library(catfim_outputs_path):
+    '''
+    Read in the CatFIM library and sites of a CatFIM run (for all of its HUCs).
+
+    catfim_library, catfim_points = read_catfim_library(catfim_outputs_path)
+
+    '''
+
     # Read in CatFIM outputs
     catfim_outputs_mapping_path = os.path.join(catfim_outputs_path, 'mapping')
 
@@ -94,9 +143,7 @@ def read_catfim_outputs(catfim_inputs_path, catfim_outputs_path, huc):
         print(IOError)
         sys.exit()
 
-    print('HAND-FIM and CatFIM outputs have been read in.')
-
-    return catfim_library, catfim_points, flowline_gdf
+    return catfim_library, catfim_points
 
 
 def subset_catfim_geom_by_site(lid, catfim_library, catfim_points, flowline_gdf, EPSG):
@@ -191,6 +238,131 @@ def subset_apply_symbology_catfim_library(catfim_library, points_filt_gdf, lid,
     return catfim_library_filt, colordict
 
 
+# -------------------------------------------------------------
+# Basemap imagery and map bounds
+# -------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=1)
+def __get_basemap_session():
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=8, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# The rendering processes build their own session, so they never share the connections of the parent
+os.register_at_fork(after_in_child=__get_basemap_session.cache_clear)
+
+
+def get_esri_basemap(x, y, EPSG):
+    '''
+    Gets the ESRI aerial imagery of a bounding box, through the basemap cache (see module notes).
+
+    Inputs:
+    - x (xmin, xmax)
+    - y (ymin, ymax)
+    - EPSG (projection of the bounding box, 5070 suggested)
+
+    Outputs:
+    - esri_aerial (RGBA PIL image, or None if unavailable)
+
+    esri_aerial = get_esri_basemap(x, y, EPSG=5070)
+
+    '''
+    basemap_mode = os.getenv('CATFIM_BASEMAP_MODE', 'live').lower()
+    if basemap_mode not in BASEMAP_MODES:
+        sys.exit(f'CATFIM_BASEMAP_MODE must be one of {BASEMAP_MODES}, not {basemap_mode}')
+
+    if basemap_mode == 'stub':
+        return Image.new('RGBA', BASEMAP_IMAGE_SIZE, (200, 200, 200, 255))
+
+    esri_url = f"{ESRI_EXPORT_URL}?bbox={x[0]}%2C{y[0]}%2C{x[1]}%2C{y[1]}&bboxSR={EPSG}&layers=0&size=&imageSR=5070&transparent=true&dpi=200&f=image"
+
+    # Cached images are keyed by their export request
+    cache_path = None
+    if os.getenv('CATFIM_BASEMAP_CACHE_DIR'):
+        cache_key = hashlib.sha256(esri_url.encode()).hexdigest()
+        cache_path = os.path.join(os.getenv('CATFIM_BASEMAP_CACHE_DIR'), cache_key + '.png')
+        if os.path.isfile(cache_path):
+            return Image.open(cache_path).convert('RGBA')
+
+    if basemap_mode == 'offline':
+        print(f'No cached basemap for bbox {x}, {y}, the map has no basemap.')
+        return None
+
+    # Pull aerial imagery basemap from ESRI API
+    try:
+        response = __get_basemap_session().get(esri_url, timeout=60)
+        response.raise_for_status()
+        esri_aerial = Image.open(io.BytesIO(response.content)).convert('RGBA')
+    except Exception as ex:
+        print(f'Unable to get the ESRI basemap for bbox {x}, {y}: {ex}')
+        return None
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, cache_path)
+
+    return esri_aerial
+
+
+def prefetch_esri_basemaps(bounds_list, EPSG, max_workers=4):
+    '''
+    Gets the ESRI basemaps of many (x, y) bounding boxes concurrently, so the maps rendered later (in any
+    process) get them from the basemap cache.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda bounds: get_esri_basemap(*bounds, EPSG) is not None, bounds_list))
+
+
+def get_site_map_bounds(points_filt_gdf, EPSG, map_length):
+    '''
+    Returns the (x, y) bounds of a square map of map_length (in the projection units) centered on the site.
+    '''
+
+    map_centroid = points_filt_gdf
+
+    # Reproject centroid
+    map_centroid = map_centroid.to_crs(EPSG)
+
+    # Calculate bounding box
+    ycoord = int(map_centroid.get_coordinates()['y'].iloc[0])
+    xcoord = int(map_centroid.get_coordinates()['x'].iloc[0])
+
+    map_length_half = map_length / 2
+
+    xleft = xcoord - map_length_half
+    xright = xcoord + map_length_half
+    ybottom = ycoord - map_length_half
+    ytop = ycoord + map_length_half
+
+    x = (xleft, xright)
+    y = (ybottom, ytop)
+
+    return x, y
+
+
+def get_cross_section_map_bounds(xsection_catfim_filt_gdf, modifier):
+    '''
+    Returns the (x, y) bounds of the CatFIM cross-section points, widened by modifier.
+    '''
+
+    # Get bounding rectangle of filtered CatFIM library
+    xmin_bounds, ymin_bounds, xmax_bounds, ymax_bounds = xsection_catfim_filt_gdf.total_bounds
+
+    # Organize new bounding box coordinates
+    x = (xmin_bounds - modifier, xmax_bounds + modifier)
+    y = (ymin_bounds - modifier, ymax_bounds + modifier)
+
+    return x, y
+
+
 # -------------------------------------------------------------
 # Plotting CatFIM (for visualizing, not saving)
 # -------------------------------------------------------------
@@ -239,27 +411,10 @@ def map_catfim_at_site(
     # Create the bounding box
     if site_view == True:
 
-        map_centroid = points_filt_gdf
-
-        # Reproject centroid
-        map_centroid = map_centroid.to_crs(EPSG)
-
         # Input information to calculate bounding box
         map_length = 1000  # 100 ft/m buffer around point, hard-coded for now
 
-        # Calculate bounding box
-        ycoord = int(map_centroid.get_coordinates()['y'].iloc[0])
-        xcoord = int(map_centroid.get_coordinates()['x'].iloc[0])
-
-        map_length_half = map_length / 2
-
-        xleft = xcoord - map_length_half
-        xright = xcoord + map_length_half
-        ybottom = ycoord - map_length_half
-        ytop = ycoord + map_length_half
-
-        x = (xleft, xright)
-        y = (ybottom, ytop)
+        x, y = get_site_map_bounds(points_filt_gdf, EPSG, map_length)
 
     elif site_view == False:
 
@@ -291,10 +446,10 @@ def map_catfim_at_site(
     f, ax = plt.subplots(figsize=(10, 10))
 
     if basemap == True:
-        # Pull aerial imagery basemap from ESRI API
-        esri_url = f"https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export?bbox={x[0]}%2C{y[0]}%2C{x[1]}%2C{y[1]}&bboxSR={EPSG}&layers=0&size=&imageSR=5070&transparent=true&dpi=200&f=image"
-        esri_aerial = Image.open(requests.get(esri_url, stream=True).raw).convert('RGBA')
-        ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
+        # Pull aerial imagery basemap from ESRI API (or the basemap cache)
+        esri_aerial = get_esri_basemap(x, y, EPSG)
+        if esri_aerial is not None:
+            ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
 
     if legend == True:
         # Create legend from the color dictionary
@@ -439,6 +594,7 @@ def map_and_save_catfim_full_extent(
     # plt.show()
 
     plt.savefig(plot_filename)
+    plt.close(f)
 
 
 def map_catfim_at_site_zoomed_out(
@@ -478,37 +634,16 @@ def map_catfim_at_site_zoomed_out(
 
     '''
     # Create the bounding box
-
-    map_centroid = points_filt_gdf
-
-    # Reproject centroid
-    map_centroid = map_centroid.to_crs(EPSG)
-
-    # Input information to calculate bounding box
-    map_length = 20000  # ft/m buffer around point, hard-coded for now
-
-    # Calculate bounding box
-    ycoord = int(map_centroid.get_coordinates()['y'].iloc[0])
-    xcoord = int(map_centroid.get_coordinates()['x'].iloc[0])
-
-    map_length_half = map_length / 2
-
-    xleft = xcoord - map_length_half
-    xright = xcoord + map_length_half
-    ybottom = ycoord - map_length_half
-    ytop = ycoord + map_length_half
-
-    x = (xleft, xright)
-    y = (ybottom, ytop)
+    x, y = get_site_map_bounds(points_filt_gdf, EPSG, ZOOMED_OUT_MAP_LENGTH)
 
     # Assmeble baseplot
     f, ax = plt.subplots(figsize=(10, 10))
 
     if basemap == True:
-        # Pull aerial imagery basemap from ESRI API
-        esri_url = f"https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export?bbox={x[0]}%2C{y[0]}%2C{x[1]}%2C{y[1]}&bboxSR={EPSG}&layers=0&size=&imageSR=5070&transparent=true&dpi=200&f=image"
-        esri_aerial = Image.open(requests.get(esri_url, stream=True).raw).convert('RGBA')
-        ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
+        # Pull aerial imagery basemap from ESRI API (or the basemap cache)
+        esri_aerial = get_esri_basemap(x, y, EPSG)
+        if esri_aerial is not None:
+            ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
 
     if legend == True:
         # Create legend from the color dictionary
@@ -533,6 +668,7 @@ def map_catfim_at_site_zoomed_out(
     ax.set_title(plot_title)
 
     plt.savefig(plot_filename)
+    plt.close(f)
 
 
 # -------------------------------------------------------------
@@ -694,7 +830,7 @@ def create_cross_section_points(xsection_gdf, dist_between_points):
     xsection_line = xsection_gdf.geometry.iloc[0]
 
     # Initialize cross-section points geometry
-    xsection_points = shapely.geometry.MultiPoint()
+    xsection_points = []
 
     # Initialize the dist_along_line list
     half_dist_between_points = [dist_between_points / 2]
@@ -703,19 +839,15 @@ def create_cross_section_points(xsection_gdf, dist_between_points):
     # Iterate through cross-section line length and create points along the line
     for i in np.arange(0, xsection_line.length, dist_between_points):
 
-        # Get midpoint geometry
+        # Get midpoint geometry (one point per segment, so there is one point per dist_along_line value)
         s = substring(xsection_line, i, i + dist_between_points)
-
-        # Add value to cross-section points geometry
-        xsection_points = xsection_points.union(s.boundary)
+        xsection_points.append(s.interpolate(0.5, normalized=True))
 
         # dist_along_line.append(i+dist_between_points) # TODO: should this be dist_between_points/2? to get the middle?
         dist_along_line.append(i + half_dist_between_points)  # changed so it's the halfway value
 
-    # Turn the multipoint object into a geodataframe
-    xsection_points_gdf = gpd.GeoDataFrame(
-        {'geometry': [xsection_points], 'elev': -9999}, crs=xsection_gdf.crs
-    ).explode(index_parts=True)
+    # Turn the points into a geodataframe
+    xsection_points_gdf = gpd.GeoDataFrame({'geometry': xsection_points, 'elev': -9999}, crs=xsection_gdf.crs)
 
     # Add line distance column
     xsection_points_gdf['dist_along_line'] = dist_along_line
@@ -771,31 +903,74 @@ def get_elevation_for_cross_section_points(dem_path, xsection_points_gdf, EPSG):
 
     '''
 
-    # Read the raster file
-    with rasterio.open(dem_path) as src:
+    xsection_points_elev_gdf = get_elevation_for_sites_cross_section_points(
+        dem_path, [xsection_points_gdf], EPSG
+    )[0]
 
-        # Get raster projection
-        rast_proj = src.crs
+    print('Got elevation for each cross-section point.')
+    return xsection_points_elev_gdf
 
-        # Temporarily project cross-section points to match raster (it's easier this way)
-        xsection_points_temp_proj_gdf = xsection_points_gdf.to_crs(rast_proj)
 
-        # Extract raster values at point locations
-        values = []
-        for point in xsection_points_temp_proj_gdf.geometry:
-            x, y = point.x, point.y
-            row, col = src.index(x, y)
-            value = src.read(1, window=((row, row + 1), (col, col + 1)))[0, 0]
-            values.append(value)
+def get_elevation_for_sites_cross_section_points(dem_path, xsection_points_gdfs, EPSG):
+    '''
+    Gets the elevation of the cross-section points of many sites (on the same DEM) at once. The points are
+    projected together and every DEM block holding points is read once. Points outside of the DEM get
+    a NaN elevation.
 
-        # Add values to the point dataframe
-        xsection_points_temp_proj_gdf['elev'] = values
+    Inputs:
+    - dem_path (string)
+    - xsection_points_gdfs (list of xsection_points_gdf)
+    - EPSG (numerical, i.e. 5070)
 
-    # Overwrite the old crosssection points gdf with the new elevation one
-    xsection_points_elev_gdf = xsection_points_temp_proj_gdf.to_crs(EPSG)
+    Outputs:
+    - xsection_points_elev_gdfs (list, in the order of xsection_points_gdfs)
 
-    print('Got elevation for each cross-section point.')
-    return xsection_points_elev_gdf
+    xsection_points_gdfs = get_elevation_for_sites_cross_section_points(dem_path, xsection_points_gdfs, EPSG)
+
+    '''
+
+    # Read the raster file
+    with rasterio.open(dem_path) as src:
+
+        # Temporarily project cross-section points to match raster (it's easier this way)
+        xsection_points_temp_proj_gdfs = [gdf.to_crs(src.crs) for gdf in xsection_points_gdfs]
+        xs = np.concatenate([gdf.geometry.x.to_numpy() for gdf in xsection_points_temp_proj_gdfs])
+        ys = np.concatenate([gdf.geometry.y.to_numpy() for gdf in xsection_points_temp_proj_gdfs])
+
+        # Raster cell of every point
+        rows, cols = (np.asarray(index, dtype=np.int64) for index in rowcol(src.transform, xs, ys))
+        values = np.full(len(xs), np.nan)
+        in_dem = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+
+        # Extract raster values at point locations, one DEM block at a time
+        block_height, block_width = src.block_shapes[0]
+        points_df = pd.DataFrame({'block_row': rows // block_height, 'block_col': cols // block_width})[
+            in_dem
+        ]
+        for (block_row, block_col), block_points_df in points_df.groupby(['block_row', 'block_col']):
+            window = Window(
+                block_col * block_width,
+                block_row * block_height,
+                min(block_width, src.width - block_col * block_width),
+                min(block_height, src.height - block_row * block_height),
+            )
+            block = src.read(1, window=window)
+            point_ids = block_points_df.index.to_numpy()
+            values[point_ids] = block[rows[point_ids] - window.row_off, cols[point_ids] - window.col_off]
+
+    # Add values to the point dataframes and put them back in their projection
+    xsection_points_elev_gdfs = []
+    point_offset = 0
+    for xsection_points_temp_proj_gdf in xsection_points_temp_proj_gdfs:
+        xsection_points_temp_proj_gdf['elev'] = values[
+            point_offset : point_offset + len(xsection_points_temp_proj_gdf)
+        ]
+        point_offset += len(xsection_points_temp_proj_gdf)
+
+        # Overwrite the old crosssection points gdf with the new elevation one
+        xsection_points_elev_gdfs.append(xsection_points_temp_proj_gdf.to_crs(EPSG))
+
+    return xsection_points_elev_gdfs
 
 
 def apply_catfim_library_to_points(xsection_points_gdf, catfim_library_filt):
@@ -849,6 +1024,7 @@ def plot_catfim_cross_section(
     save_plot,
     plot_title,
     file_label,
+    output_dir='',
 ):
     '''
     Plots the CatFIM cross section points with the inundation category.
@@ -864,6 +1040,7 @@ def plot_catfim_cross_section(
     - save_plot (Whether to save the plot (True/False)
     - plot_label (Additional label for plot title, if needed)
     - file_label (Additional label for plot file, if needed)
+    - output_dir (Folder to save the plot in, defaults to the current folder)
 
     plot_catfim_cross_section(xsection_points_gdf, xsection_catfim_filt_gdf, xsection_midpoint, colordict, elev_upper_buffer_ft=10,
                             num_points_buffer=5, save_plot=False, plot_title = f'CatFIM library elevation cross-section at site {lid}',
@@ -919,8 +1096,9 @@ def plot_catfim_cross_section(
     # Save and display plot
     if save_plot == True:
         # Create plot filename
-        plot_name = 'catfim_crosssection_' + file_label + '.png'
+        plot_name = os.path.join(output_dir, 'catfim_crosssection_' + file_label + '.png')
         plt.savefig(plot_name)
+        plt.close(f)
         print(f'Saved plot as {plot_name}')
 
     else:
@@ -937,6 +1115,7 @@ def map_catfim_cross_section_points(
     plot_title,
     basemap,
     legend,
+    plot_filename=None,
 ):
     '''
     Plot data layers on top of a ESRI basemap... bounding box determined by the CatFIM cross section extent.
@@ -950,6 +1129,7 @@ def map_catfim_cross_section_points(
     - plot_title
     - basemap (True or False, depending on if you want the ESRI basemap)
     - legend (True or False, depending on if you want a legend)
+    - plot_filename (optional, saves the plot to this filename instead of displaying it)
 
     map_catfim_cross_section_points(catfim_library_filt, flowline_filt_gdf, xsection_catfim_filt_gdf, colordict,
                                 modifier=100, EPSG=5070, plot_title=f'CatFIM library elevation cross-section at site {lid}',
@@ -957,22 +1137,17 @@ def map_catfim_cross_section_points(
 
     '''
 
-    # Get bounding rectangle of filtered CatFIM library
-    xmin_bounds, ymin_bounds, xmax_bounds, ymax_bounds = xsection_catfim_filt_gdf.total_bounds
-
-    # Organize new bounding box coordinates
-    x = (xmin_bounds - modifier, xmax_bounds + modifier)
-    y = (ymin_bounds - modifier, ymax_bounds + modifier)
+    # Get bounding rectangle of the CatFIM cross-section points
+    x, y = get_cross_section_map_bounds(xsection_catfim_filt_gdf, modifier)
 
     # Assmeble baseplot
     f, ax = plt.subplots(figsize=(10, 10))
 
     if basemap == True:
-        # Pull aerial imagery basemap from ESRI API
-        esri_url = f"https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export?bbox={x[0]}%2C{y[0]}%2C{x[1]}%2C{y[1]}&bboxSR={EPSG}&layers=0&size=&imageSR=5070&transparent=true&dpi=200&f=image"
-        esri_aerial = Image.open(requests.get(esri_url, stream=True).raw).convert('RGBA')
-
-        ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
+        # Pull aerial imagery basemap from ESRI API (or the basemap cache)
+        esri_aerial = get_esri_basemap(x, y, EPSG)
+        if esri_aerial is not None:
+            ax.imshow(esri_aerial, extent=(x[0], x[1], y[0], y[1]))
 
     if legend == True:
         # Create legend from the color dictionary
@@ -1000,4 +1175,314 @@ def map_catfim_cross_section_points(
     ax.set_yticks([])
     ax.set_title(plot_title)
 
-    plt.show()
+    if plot_filename is not None:
+        plt.savefig(plot_filename)
+        plt.close(f)
+    else:
+        plt.show()
+
+
+# -------------------------------------------------------------
+# Saving the QA figures of many CatFIM sites (batch mode)
+# -------------------------------------------------------------
+
+'''
+# Example Usage (or run this script, see the sample at the bottom):
+
+generate_catfim_site_figures(catfim_inputs_path, catfim_outputs_path, output_dir='/data/catfim/<run>/qa_figures',
+                             lst_hucs=['06010105'], job_number=8)
+
+'''
+
+
+def __prepare_site_figures(
+    lid, huc, catfim_library, catfim_points, flowline_gdf, EPSG, xsection_length, dist_between_points
+):
+    # Subset the CatFIM geometries by site and create its cross-section points (elevations are added later)
+    if len(catfim_points[catfim_points['ahps_lid'] == lid]) != 1:
+        raise ValueError(f'{len(catfim_points[catfim_points["ahps_lid"] == lid])} points found for lid {lid}')
+
+    catfim_library_filt, points_filt_gdf, flowline_filt_gdf = subset_catfim_geom_by_site(
+        lid, catfim_library, catfim_points, flowline_gdf, EPSG
+    )
+    catfim_library_filt, colordict = subset_apply_symbology_catfim_library(
+        catfim_library, points_filt_gdf, lid, include_record=True
+    )
+    xsection_gdf = create_perpendicular_cross_section(
+        flowline_filt_gdf, points_filt_gdf, xsection_length, EPSG
+    )
+    xsection_points_gdf, xsection_midpoint = create_cross_section_points(xsection_gdf, dist_between_points)
+
+    return {
+        'lid': lid,
+        'huc': huc,
+        'catfim_library_filt': catfim_library_filt,
+        'colordict': colordict,
+        'points_filt_gdf': points_filt_gdf,
+        'flowline_filt_gdf': flowline_filt_gdf,
+        'xsection_points_gdf': xsection_points_gdf,
+        'xsection_midpoint': xsection_midpoint,
+        'xsection_catfim_filt_gdf': None,
+    }
+
+
+def __render_site_figures(site, output_dir, EPSG, dist_between_points, basemap):
+    # Saves the maps and cross-section of a site (run in a process of the rendering pool)
+    plt.switch_backend('Agg')
+
+    lid, huc = site['lid'], site['huc']
+    plot_title = f'Site: {lid}, HUC: {huc}'
+
+    map_catfim_at_site_zoomed_out(
+        site['catfim_library_filt'],
+        site['flowline_filt_gdf'],
+        site['points_filt_gdf'],
+        site['colordict'],
+        plot_title=plot_title,
+        plot_filename=os.path.join(output_dir, f'{lid}_{huc}_site_map.png'),
+        EPSG=EPSG,
+        basemap=basemap,
+        site_view=True,
+        legend=True,
+    )
+    map_and_save_catfim_full_extent(
+        site['catfim_library_filt'],
+        site['flowline_filt_gdf'],
+        site['points_filt_gdf'],
+        site['colordict'],
+        plot_title=plot_title,
+        plot_filename=os.path.join(output_dir, f'{lid}_{huc}_full_extent.png'),
+        legend=False,
+    )
+
+    xsection_catfim_filt_gdf = site['xsection_catfim_filt_gdf']
+    if xsection_catfim_filt_gdf is None or len(xsection_catfim_filt_gdf) == 0:
+        print(f'{lid} : the CatFIM library does not cross the cross-section, no cross-section plots.')
+        return
+
+    plot_catfim_cross_section(
+        site['xsection_points_gdf'],
+        xsection_catfim_filt_gdf,
+        site['xsection_midpoint'],
+        site['colordict'],
+        elev_upper_buffer_ft=10,
+        num_points_buffer=5,
+        dist_between_points=dist_between_points,
+        save_plot=True,
+        plot_title=f'CatFIM library elevation cross-section at site {lid}',
+        file_label=f'{lid}_{huc}',
+        output_dir=output_dir,
+    )
+    map_catfim_cross_section_points(
+        site['catfim_library_filt'],
+        site['flowline_filt_gdf'],
+        xsection_catfim_filt_gdf,
+        site['colordict'],
+        modifier=100,
+        EPSG=EPSG,
+        plot_title=f'CatFIM library elevation cross-section at site {lid}',
+        basemap=basemap,
+        legend=True,
+        plot_filename=os.path.join(output_dir, f'{lid}_{huc}_crosssection_map.png'),
+    )
+
+
+def generate_catfim_site_figures(
+    catfim_inputs_path,
+    catfim_outputs_path,
+    output_dir,
+    lst_hucs=None,
+    root_dem_path='/data/inputs/3dep_dems/',
+    EPSG=5070,
+    xsection_length=1000,
+    dist_between_points=10,
+    basemap=True,
+    job_number=1,
+):
+    '''
+    Saves the QA figures of every CatFIM site (of lst_hucs, or of all of the HUCs of the CatFIM library) to
+    output_dir/<huc>: the zoomed out site map, the full extent map, the elevation cross-section plot and
+    the cross-section map.
+
+    The library is read once, the cross-section elevations of all of the sites are sampled together
+    (per DEM), the basemaps are fetched concurrently into the basemap cache and the figures are rendered
+    by job_number processes. Sites that can not be prepared (e.g. no flowline near the site) are skipped.
+
+    Inputs:
+    - catfim_inputs_path (HAND outputs)
+    - catfim_outputs_path (CatFIM outputs)
+    - output_dir
+    - lst_hucs (list of HUCs, optional)
+    - root_dem_path (probably /data/inputs/3dep_dems/)
+    - EPSG (5070 suggested)
+    - xsection_length (1000 suggested)
+    - dist_between_points (10 suggested)
+    - basemap (True or False)
+    - job_number (number of rendering processes)
+
+    '''
+
+    catfim_library, catfim_points = read_catfim_library(catfim_outputs_path)
+    catfim_library['huc'] = catfim_library['huc'].astype(str).str.zfill(8)
+
+    site_hucs_df = catfim_library[['ahps_lid', 'huc']].drop_duplicates().sort_values(['huc', 'ahps_lid'])
+    if lst_hucs is not None:
+        site_hucs_df = site_hucs_df[site_hucs_df['huc'].isin(lst_hucs)]
+    print(f'Preparing the QA figures of {len(site_hucs_df)} CatFIM sites.')
+
+    # Subset the CatFIM geometries and create the cross-sections of every site
+    sites = []
+    for huc, huc_sites_df in site_hucs_df.groupby('huc'):
+        try:
+            flowline_path = os.path.join(
+                catfim_inputs_path, huc, 'nwm_subset_streams_levelPaths_dissolved.gpkg'
+            )
+            flowline_gdf = gpd.read_file(flowline_path)
+        except Exception:
+            print(f'{huc} : unable to read the HAND flowlines, its sites are skipped.')
+            continue
+
+        os.makedirs(os.path.join(output_dir, huc), exist_ok=True)
+        for lid in huc_sites_df['ahps_lid']:
+            try:
+                site = __prepare_site_figures(
+                    lid,
+                    huc,
+                    catfim_library,
+                    catfim_points,
+                    flowline_gdf,
+                    EPSG,
+                    xsection_length,
+                    dist_between_points,
+                )
+                site['dem_path'] = generate_dem_path(huc, root_dem_path)
+                sites.append(site)
+            except Exception as ex:
+                print(f'{huc} : {lid} : skipped, unable to prepare its figures: {ex}')
+
+    # Sample the elevations of the cross-section points of all of the sites, one DEM at a time
+    for dem_path in sorted(set(site['dem_path'] for site in sites)):
+        dem_sites = [site for site in sites if site['dem_path'] == dem_path]
+        try:
+            xsection_points_gdfs = get_elevation_for_sites_cross_section_points(
+                dem_path, [site['xsection_points_gdf'] for site in dem_sites], EPSG
+            )
+        except Exception as ex:
+            print(f'Unable to sample {dem_path}, no cross-section plots for its {len(dem_sites)} sites: {ex}')
+            continue
+        for site, xsection_points_gdf in zip(dem_sites, xsection_points_gdfs):
+            site['xsection_points_gdf'] = xsection_points_gdf
+            try:
+                site['xsection_catfim_filt_gdf'] = apply_catfim_library_to_points(
+                    xsection_points_gdf, site['catfim_library_filt']
+                )
+            except Exception as ex:
+                print(f"{site['huc']} : {site['lid']} : unable to overlay the cross-section points: {ex}")
+    print('Got elevation for the cross-section points of all sites.')
+
+    # Get the basemaps of all of the maps before rendering. They are kept in the basemap cache (in the
+    # output folder unless CATFIM_BASEMAP_CACHE_DIR is set) so the rendering processes share them.
+    if not os.getenv('CATFIM_BASEMAP_CACHE_DIR'):
+        os.environ['CATFIM_BASEMAP_CACHE_DIR'] = os.path.join(output_dir, 'basemap_cache')
+    if basemap == True and os.getenv('CATFIM_BASEMAP_MODE', 'live').lower() == 'live':
+        bounds_list = [
+            get_site_map_bounds(site['points_filt_gdf'], EPSG, ZOOMED_OUT_MAP_LENGTH) for site in sites
+        ]
+        bounds_list += [
+            get_cross_section_map_bounds(site['xsection_catfim_filt_gdf'], modifier=100)
+            for site in sites
+            if site['xsection_catfim_filt_gdf'] is not None and len(site['xsection_catfim_filt_gdf']) > 0
+        ]
+        prefetch_esri_basemaps(bounds_list, EPSG)
+        print(f'Got {len(bounds_list)} basemaps, cached at {os.getenv("CATFIM_BASEMAP_CACHE_DIR")}.')
+
+    # Render the figures of the sites in parallel
+    num_rendered = 0
+    with ProcessPoolExecutor(max_workers=job_number) as executor:
+        futures = {
+            executor.submit(
+                __render_site_figures,
+                site,
+                os.path.join(output_dir, site['huc']),
+                EPSG,
+                dist_between_points,
+                basemap,
+            ): site
+            for site in sites
+        }
+        for future in as_completed(futures):
+            site = futures[future]
+            try:
+                future.result()
+                num_rendered += 1
+            except Exception:
+                print(f"{site['huc']} : {site['lid']} : unable to render its figures")
+                print(traceback.format_exc())
+
+    print(f'Saved the QA figures of {num_rendered} of {len(site_hucs_df)} CatFIM sites to {output_dir}.')
+
+
+if __name__ == '__main__':
+
+    '''
+    Sample
+    python /foss_fim/tools/catfim/vis_categorical_fim.py -i /data/previous_fim/fim_4_5_2_11
+    -c /data/catfim/hand_4_5_11_1_catfim_datavis_stage_based -o /data/catfim/qa_figures -lh '06010105 17110004' -j 8
+    '''
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description='Save the QA figures (maps and cross-section) of CatFIM sites'
+    )
+    parser.add_argument(
+        '-i',
+        '--catfim_inputs_path',
+        help='REQUIRED: Path to directory containing HAND outputs, e.g. /data/previous_fim/fim_4_5_2_11',
+        required=True,
+    )
+    parser.add_argument(
+        '-c', '--catfim_outputs_path', help='REQUIRED: Path to the CatFIM output folder.', required=True
+    )
+    parser.add_argument('-o', '--output_dir', help='REQUIRED: Folder to save the figures in.', required=True)
+    parser.add_argument(
+        '-lh',
+        '--lst_hucs',
+        help='OPTIONAL: Space-delimited list of HUCs to save the figures of. Defaults to all HUCs of the'
+        ' CatFIM library.',
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        '-d',
+        '--root_dem_path',
+        help='OPTIONAL: Root folder of the DEMs. Defaults to /data/inputs/3dep_dems/',
+        required=False,
+        default='/data/inputs/3dep_dems/',
+    )
+    parser.add_argument(
+        '-nb',
+        '--no_basemap',
+        help='OPTIONAL: Maps without the ESRI basemap.',
+        required=False,
+        action='store_true',
+    )
+    parser.add_argument(
+        '-j',
+        '--job_number',
+        help='OPTIONAL: Number of processes rendering the figures. Defaults to 1.',
+        required=False,
+        default=1,
+        type=int,
+    )
+
+    args = vars(parser.parse_args())
+
+    generate_catfim_site_figures(
+        args['catfim_inputs_path'],
+        args['catfim_outputs_path'],
+        args['output_dir'],
+        lst_hucs=args['lst_hucs'].split() if args['lst_hucs'] else None,
+        root_dem_path=args['root_dem_path'],
+        basemap=not args['no_basemap'],
+        job_number=args['job_number'],
+    )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import functools
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timezone
+from threading import Lock
+
+import requests
+import urllib3
+from pyproj import Transformer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+'''
+Shared datum conversion used by CatFIM and the AHPS / rating curve tools.
+
+Horizontal conversions use one pyproj Transformer per (source, target) CRS pair, built once per process.
+
+NGVD29 to NAVD88 offsets come from the NOAA VDatum API. They are keyed by the NAD27 lat/lon rounded to
+DATUM_DECIMALS decimals (4 decimals is about 10 m, far below the spatial variation of the offset) and the
+VDatum region, so nearby sites share one API call. Offsets are kept in memory and, when a cache directory
+is set, in a SQLite file (datum_offsets.db) that can be shared by processes and reused by later runs.
+
+Configuration comes from the environment (e.g. the CatFIM .env file):
+    DATUM_CACHE_DIR      Directory of the datum_offsets.db cache. No disk cache if not set.
+    DATUM_MODE           "live" (default): use the cache, call VDatum for the offsets not in it.
+                         "offline": only use the cache, VDatum is never called. Offsets that are not
+                         in the cache are unavailable (None).
+    DATUM_MAX_WORKERS    Number of concurrent VDatum requests made by prefetch. Defaults to 4.
+'''
+
+DATUM_MODES = ['live', 'offline']
+
+DATUM_CACHE_FILE_NAME = 'datum_offsets.db'
+
+VDATUM_URL = 'https://vdatum.noaa.gov/vdatumweb/api/convert'
+
+# Decimals the NAD27 lat/lon are rounded to before looking up (or requesting) an offset
+DATUM_DECIMALS = 4
+
+
+@functools.lru_cache(maxsize=32)
+def get_transformer(src_crs, dest_crs):
+    '''
+    Returns the (cached) pyproj Transformer from src_crs to dest_crs. Coordinates are in x, y (lon, lat)
+    order, as with geopandas.
+    '''
+    return Transformer.from_crs(src_crs, dest_crs, always_xy=True)
+
+
+class Datum_Client:
+    def __init__(self, cache_dir=None, mode='live', max_workers=4):
+        if mode not in DATUM_MODES:
+            raise ValueError(f'DATUM_MODE must be one of {DATUM_MODES}, not {mode}')
+        if mode == 'offline' and not cache_dir:
+            raise ValueError('DATUM_MODE offline requires DATUM_CACHE_DIR to be set')
+
+        self.cache_path = os.path.join(cache_dir, DATUM_CACHE_FILE_NAME) if cache_dir else None
+        self.mode = mode
+        self.max_workers = max_workers
+
+        self.memory_cache = {}
+        self.memory_lock = Lock()
+
+        if self.cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.__execute(
+                'CREATE TABLE IF NOT EXISTS ngvd_to_navd ('
+                'lat REAL, lon REAL, region TEXT, adjustment_m REAL, updated TEXT,'
+                ' PRIMARY KEY (lat, lon, region))'
+            )
+
+        # Suppress Insecure Request Warning
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        # Retries (with backoff) on connection errors and busy responses
+        self.session = requests.Session()
+        retry = Retry(
+            total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __execute(self, sql, params=()):
+        # Each call uses its own connection, so the cache can be used by many processes at the same time
+        with closing(sqlite3.connect(self.cache_path, timeout=300, isolation_level=None)) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def __read_cache(self, key):
+        with self.memory_lock:
+            if key in self.memory_cache:
+                return self.memory_cache[key]
+
+        if self.cache_path is None:
+            return None
+        rows = self.__execute(
+            'SELECT adjustment_m FROM ngvd_to_navd WHERE lat = ? AND lon = ? AND region = ?', key
+        )
+        if len(rows) == 0:
+            return None
+
+        with self.memory_lock:
+            self.memory_cache[key] = rows[0][0]
+        return rows[0][0]
+
+    def __write_cache(self, key, adjustment_m):
+        with self.memory_lock:
+            self.memory_cache[key] = adjustment_m
+        if self.cache_path:
+            self.__execute(
+                'INSERT OR REPLACE INTO ngvd_to_navd VALUES (?, ?, ?, ?, ?)',
+                (*key, adjustment_m, datetime.now(timezone.utc).isoformat()),
+            )
+
+    def __fetch(self, lat, lon, region):
+        # Hard code most parameters to convert NGVD to NAVD.
+        params = {}
+        params['lat'] = lat
+        params['lon'] = lon
+        params['region'] = region
+        params['s_h_frame'] = 'NAD27'  # Source CRS
+        params['s_v_frame'] = 'NGVD29'  # Source vertical coord datum
+        params['s_vertical_unit'] = 'm'  # Source vertical units
+        params['src_height'] = 0.0  # Source vertical height
+        params['t_v_frame'] = 'NAVD88'  # Target vertical datum
+        params['tar_vertical_unit'] = 'm'  # Target vertical height
+
+        response = self.session.get(VDATUM_URL, params=params, verify=False)
+        if response.status_code != 200:
+            return None
+        # Adjustment in meters (NGVD29 to NAVD88)
+        return float(response.json()['t_z'])
+
+    def get_ngvd_to_navd_m(self, lat, lon, region='contiguous'):
+        '''
+        Returns the NGVD29 to NAVD88 adjustment (meters) at a NAD27 lat/lon, from the cache when possible
+        (see module notes). None if VDatum did not answer (after retries), or if it is not cached in offline
+        mode. Connection errors (after retries) are raised.
+        '''
+        key = (round(float(lat), DATUM_DECIMALS), round(float(lon), DATUM_DECIMALS), region)
+
+        adjustment_m = self.__read_cache(key)
+        if adjustment_m is not None or self.mode == 'offline':
+            return adjustment_m
+
+        adjustment_m = self.__fetch(*key)
+        if adjustment_m is not None:
+            self.__write_cache(key, adjustment_m)
+        return adjustment_m
+
+    def prefetch(self, lats, lons, region='contiguous'):
+        '''
+        Gets the adjustments of many NAD27 lat/lons concurrently (DATUM_MAX_WORKERS at a time) so the later
+        calls for them are answered from the cache. Points that fail are left out (and retried when used).
+        '''
+
+        def get_or_none(point):
+            try:
+                return self.get_ngvd_to_navd_m(*point, region)
+            except Exception:
+                return None
+
+        points = set(
+            (round(float(lat), DATUM_DECIMALS), round(float(lon), DATUM_DECIMALS))
+            for lat, lon in zip(lats, lons)
+        )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(get_or_none, points))
+
+
+@functools.lru_cache(maxsize=4)
+def __get_client(cache_dir, mode, max_workers):
+    return Datum_Client(cache_dir, mode, max_workers)
+
+
+# Forked processes (e.g. CatFIM workers) build their own client, so they never share the pooled
+# connections of the parent (offsets already fetched are read from the cache)
+os.register_at_fork(after_in_child=__get_client.cache_clear)
+
+
+def get_datum_client():
+    '''
+    Returns the datum client of this process, configured from the DATUM_* environment variables
+    (see module notes).
+    '''
+    return __get_client(
+        os.getenv('DATUM_CACHE_DIR') or None,
+        os.getenv('DATUM_MODE', 'live').lower(),
+        int(os.getenv('DATUM_MAX_WORKERS', 4)),
+    )
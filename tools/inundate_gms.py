@@ -5,7 +5,7 @@ import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
-from inundation import NoForecastFound, hydroTableHasOnlyLakes, inundate
+from inundation import NoForecastFound, hydroTableHasOnlyLakes, inundate, inundate_forecasts
 from tqdm import tqdm
 
 from utils.shared_functions import FIM_Helpers as fh
@@ -179,29 +179,7 @@ def __inundate_gms_generator(
         # FIM versions > 4.3.5 use an aggregated hydrotable file rather than individual branch hydrotables
         hydroTable_huc = os.path.join(huc_dir, "hydrotable.csv")
         if os.path.isfile(hydroTable_huc):
-            htable_req_cols = [
-                "HUC",
-                "branch_id",
-                "feature_id",
-                "HydroID",
-                "stage",
-                "discharge_cms",
-                "LakeID",
-            ]
-            hydroTable_all = pd.read_csv(
-                hydroTable_huc,
-                dtype={
-                    "HUC": str,
-                    "branch_id": int,
-                    "feature_id": str,
-                    "HydroID": str,
-                    "stage": float,
-                    "discharge_cms": float,
-                    "LakeID": int,
-                },
-                usecols=htable_req_cols,
-            )
-            hydroTable_all.set_index(["HUC", "feature_id", "HydroID"], inplace=True)
+            hydroTable_all = __read_huc_hydrotable(hydroTable_huc)
             hydroTable_branch = hydroTable_all.loc[hydroTable_all["branch_id"] == int(branch_id)]
         else:
             # Earlier FIM4 versions only have branch level hydrotables
@@ -211,21 +189,9 @@ def __inundate_gms_generator(
         catchment_poly = os.path.join(branch_dir, xwalked_file_name)
 
         # branch output
-        # Some other functions that call in here already added a huc, so only add it if not yet there
-        if (inundation_raster is not None) and (huc not in inundation_raster):
-            inundation_branch_raster = fh.append_id_to_file_name(inundation_raster, [huc, branch_id])
-        else:
-            inundation_branch_raster = fh.append_id_to_file_name(inundation_raster, branch_id)
-
-        if (inundation_polygon is not None) and (huc not in inundation_polygon):
-            inundation_branch_polygon = fh.append_id_to_file_name(inundation_polygon, [huc, branch_id])
-        else:
-            inundation_branch_polygon = fh.append_id_to_file_name(inundation_polygon, branch_id)
-
-        if (depths_raster is not None) and (huc not in depths_raster):
-            depths_branch_raster = fh.append_id_to_file_name(depths_raster, [huc, branch_id])
-        else:
-            depths_branch_raster = fh.append_id_to_file_name(depths_raster, branch_id)
+        inundation_branch_raster = __branch_output_file_name(inundation_raster, huc, branch_id)
+        inundation_branch_polygon = __branch_output_file_name(inundation_polygon, huc, branch_id)
+        depths_branch_raster = __branch_output_file_name(depths_raster, huc, branch_id)
 
         # identifiers
         identifiers = (huc, branch_id)
@@ -256,6 +222,172 @@ def __inundate_gms_generator(
         yield (inundate_input, identifiers)
 
 
+def Inundate_gms_forecasts(
+    hydrofabric_dir, forecasts, inundation_rasters, num_workers=1, hucs=None, verbose=False, log_file=None
+):
+    """
+    Inundates several forecasts (e.g. all the benchmark flow files of a HUC) in one pass over the branches.
+
+    Each branch REM and catchments raster is read once for all forecasts (see inundation.inundate_forecasts)
+    and the HUC hydrotable is read once per HUC instead of once per branch and forecast.
+
+    Parameters
+    ----------
+    hydrofabric_dir : str
+        Directory path to FIM hydrofabric by processing unit.
+    forecasts : list of str
+        Forecast discharges in CMS as CSV files.
+    inundation_rasters : list of str
+        Inundation raster output for each forecast (branch ids are appended to each file name).
+    num_workers : int
+        Number of branches inundated in parallel.
+    hucs : list of str
+        HUCs to inundate (all HUCs in fim_inputs.csv by default).
+
+    Returns
+    -------
+    list of pandas DataFrames
+        One map file dataframe per forecast, in the same format as returned by Inundate_gms.
+    """
+
+    if isinstance(hucs, str):
+        hucs = [hucs]
+
+    if log_file is not None:
+        if os.path.exists(log_file):
+            os.remove(log_file)
+
+        if verbose:
+            print("HUC8,BranchID,Exception", file=open(log_file, "w"))
+
+    # load fim inputs
+    hucs_branches = pd.read_csv(
+        os.path.join(hydrofabric_dir, "fim_inputs.csv"), header=None, dtype={0: str, 1: str}
+    )
+
+    if hucs is not None:
+        hucs_branches = hucs_branches.loc[hucs_branches.loc[:, 0].isin(set(hucs)), :]
+
+    inundate_input_generator = __inundate_gms_forecasts_generator(
+        hucs_branches, hydrofabric_dir, forecasts, inundation_rasters, verbose=False
+    )
+
+    map_file_records = [[] for _ in forecasts]
+
+    with ProcessPoolExecutor(max_workers=int(num_workers)) as executor:
+        executor_generator = {
+            executor.submit(inundate_forecasts, **inp): ids for inp, ids in inundate_input_generator
+        }
+        for future in tqdm(
+            as_completed(executor_generator),
+            total=len(executor_generator),
+            desc=f"Inundating branches for {len(forecasts)} forecasts with {num_workers} workers",
+            disable=(not verbose),
+        ):
+            hucCode, branch_id = executor_generator[future]
+
+            try:
+                branch_inundation_rasters, branch_depths_rasters = future.result()
+
+            except (NoForecastFound, hydroTableHasOnlyLakes) as exc:
+                if log_file is not None:
+                    print(f"{hucCode},{branch_id},{exc.__class__.__name__}, {exc}", file=open(log_file, "a"))
+                elif verbose:
+                    print(f"{hucCode},{branch_id},{exc.__class__.__name__}, {exc}")
+
+            except Exception as exc:
+                if log_file is not None:
+                    print(f"{hucCode},{branch_id},{exc.__class__.__name__}, {exc}", file=open(log_file, "a"))
+                else:
+                    print(f"{hucCode},{branch_id},{exc.__class__.__name__}, {exc}")
+
+            else:
+                for records, inundation_raster, depths_raster in zip(
+                    map_file_records, branch_inundation_rasters, branch_depths_rasters
+                ):
+                    # no branch output when none of the forecast feature_ids are in the branch hydrotable
+                    if inundation_raster is None and depths_raster is None:
+                        continue
+                    records.append(
+                        {
+                            "huc8": hucCode,
+                            "branchID": branch_id,
+                            "inundation_rasters": inundation_raster,
+                            "depths_rasters": depths_raster,
+                            "inundation_polygons": None,
+                        }
+                    )
+
+    map_file_columns = ["huc8", "branchID", "inundation_rasters", "depths_rasters", "inundation_polygons"]
+    return [pd.DataFrame(records, columns=map_file_columns) for records in map_file_records]
+
+
+def __read_huc_hydrotable(hydroTable_huc):
+    htable_req_cols = ["HUC", "branch_id", "feature_id", "HydroID", "stage", "discharge_cms", "LakeID"]
+    hydroTable_all = pd.read_csv(
+        hydroTable_huc,
+        dtype={
+            "HUC": str,
+            "branch_id": int,
+            "feature_id": str,
+            "HydroID": str,
+            "stage": float,
+            "discharge_cms": float,
+            "LakeID": int,
+        },
+        usecols=htable_req_cols,
+    )
+    hydroTable_all.set_index(["HUC", "feature_id", "HydroID"], inplace=True)
+    return hydroTable_all
+
+
+def __branch_output_file_name(file_name, huc, branch_id):
+    # Some other functions that call in here already added a huc, so only add it if not yet there
+    if (file_name is not None) and (huc not in file_name):
+        return fh.append_id_to_file_name(file_name, [huc, branch_id])
+    return fh.append_id_to_file_name(file_name, branch_id)
+
+
+def __inundate_gms_forecasts_generator(
+    hucs_branches, hydrofabric_dir, forecasts, inundation_rasters, verbose=False
+):
+    # Iterate over hucs, reading each huc level hydrotable only once
+    for huc, huc_branches in hucs_branches.groupby(0, sort=False):
+        huc = str(huc)
+        huc_dir = os.path.join(hydrofabric_dir, huc)
+
+        # FIM versions > 4.3.5 use an aggregated hydrotable file rather than individual branch hydrotables
+        hydroTable_huc = os.path.join(huc_dir, "hydrotable.csv")
+        hydroTable_all = __read_huc_hydrotable(hydroTable_huc) if os.path.isfile(hydroTable_huc) else None
+
+        for branch_id in huc_branches.loc[:, 1]:
+            branch_id = str(branch_id)
+            branch_dir = os.path.join(huc_dir, "branches", branch_id)
+
+            if hydroTable_all is not None:
+                hydroTable_branch = hydroTable_all.loc[hydroTable_all["branch_id"] == int(branch_id)]
+            else:
+                # Earlier FIM4 versions only have branch level hydrotables
+                hydroTable_branch = os.path.join(branch_dir, f"hydroTable_{branch_id}.csv")
+
+            inundate_input = {
+                "rem": os.path.join(branch_dir, f"rem_zeroed_masked_{branch_id}.tif"),
+                "catchments": os.path.join(
+                    branch_dir, f"gw_catchments_reaches_filtered_addedAttributes_{branch_id}.tif"
+                ),
+                "hydro_table": hydroTable_branch,
+                "forecasts": forecasts,
+                "inundation_rasters": [
+                    __branch_output_file_name(inundation_raster, huc, branch_id)
+                    for inundation_raster in inundation_rasters
+                ],
+                "depths_rasters": None,
+                "quiet": not verbose,
+            }
+
+            yield (inundate_input, (huc, branch_id))
+
+
 if __name__ == "__main__":
     # parse arguments
     parser = argparse.ArgumentParser(description="Inundate FIM")
@@ -3,7 +3,7 @@ import errno
 import os
 from timeit import default_timer as timer
 
-from inundate_gms import Inundate_gms
+from inundate_gms import Inundate_gms, Inundate_gms_forecasts
 from mosaic_inundation import Mosaic_inundation
 
 from utils.shared_functions import FIM_Helpers as fh
@@ -24,6 +24,7 @@ def produce_mosaicked_inundation(
     remove_intermediate=True,
     verbose=False,
     is_mosaic_for_branches=False,
+    in_memory=False,
 ):
     """
     This function calls Inundate_gms and Mosaic_inundation to produce inundation maps.
@@ -45,6 +46,10 @@ def produce_mosaicked_inundation(
         num_workers (int):        Number of parallel jobs to run.
         keep_intermediate (bool): Option to keep intermediate files.
         verbose (bool):           Print verbose messages to screen. Not tested.
+        in_memory (bool):         Write the mosaicked rasters to GDAL's in-memory file system (the returned
+                                    path is prefixed with /vsimem/) instead of disk. The branch rasters are
+                                    still written to disk. The caller must delete the returned raster with
+                                    rasterio.shutil.delete() when done.
     """
 
     # Check that inundation_raster or depths_raster is supplied
@@ -123,6 +128,9 @@ def produce_mosaicked_inundation(
                 mosaic_output = depths_raster
 
         if mosaic_output is not None:
+            if in_memory:
+                mosaic_output = '/vsimem/' + mosaic_output.lstrip('/')
+
             # Call Mosaic_inundation
             mosaic_file_path = Mosaic_inundation(
                 map_file.copy(),
@@ -142,6 +150,82 @@ def produce_mosaicked_inundation(
     return mosaic_file_path
 
 
+def produce_mosaicked_inundation_batch(
+    hydrofabric_dir,
+    huc,
+    flow_files,
+    inundation_rasters,
+    mask=None,
+    num_workers=1,
+    remove_intermediate=True,
+    verbose=False,
+    in_memory=False,
+):
+    """
+    Batched version of produce_mosaicked_inundation for several flow files of the same HUC (e.g. all the
+    magnitudes/sites of a test case). The branches are inundated once for all flow files (see
+    Inundate_gms_forecasts) and the branch extents of each flow file are then mosaicked to its own
+    inundation raster.
+
+    Args:
+        hydrofabric_dir (str):          Path to hydrofabric directory where FIM outputs were written by
+                                          fim_pipeline.
+        huc (str):                      The HUC for which to produce mosaicked inundation files.
+        flow_files (list):              Paths to the flow files to be used for inundation.
+        inundation_rasters (list):      Full path to the output inundation raster of each flow file.
+        mask (str):                     Path to the mask applied to the mosaics (e.g. the HUC wbd.gpkg).
+        num_workers (int):              Number of branches inundated in parallel.
+        remove_intermediate (bool):     Remove the branch inundation rasters once mosaicked.
+        verbose (bool):                 Print verbose messages to screen.
+        in_memory (bool):               Write the mosaicked rasters to GDAL's in-memory file system (see
+                                          produce_mosaicked_inundation).
+
+    Yields:
+        str: Path of the mosaicked inundation raster of each flow file, in order (empty string when none of
+             the branches could be inundated). Each mosaic is only produced when requested so that a caller
+             can process and delete an in-memory mosaic before the next one is produced.
+    """
+
+    if len(flow_files) != len(inundation_rasters):
+        raise ValueError("Must supply one inundation_raster per flow file.")
+
+    if not os.path.exists(os.path.join(hydrofabric_dir, huc)):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(hydrofabric_dir, huc))
+
+    for flow_file in flow_files:
+        if not os.path.exists(flow_file):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), flow_file)
+
+    for inundation_raster in inundation_rasters:
+        os.makedirs(os.path.dirname(inundation_raster), exist_ok=True)
+
+    map_files = Inundate_gms_forecasts(
+        hydrofabric_dir=hydrofabric_dir,
+        forecasts=flow_files,
+        inundation_rasters=inundation_rasters,
+        num_workers=num_workers,
+        hucs=[huc],
+        verbose=verbose,
+    )
+
+    fh.vprint("Mosaicking extents...", verbose)
+
+    for map_file, inundation_raster in zip(map_files, inundation_rasters):
+        mosaic_output = '/vsimem/' + inundation_raster.lstrip('/') if in_memory else inundation_raster
+        yield Mosaic_inundation(
+            map_file,
+            mosaic_attribute="inundation_rasters",
+            mosaic_output=mosaic_output,
+            mask=mask,
+            unit_attribute_name="huc8",
+            nodata=elev_raster_ndv,
+            remove_inputs=remove_intermediate,
+            verbose=verbose,
+        )
+
+    fh.vprint("Mosaicking complete.", verbose)
+
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(
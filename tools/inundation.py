@@ -254,6 +254,111 @@ def inundate(
     return (inundation_rasters, depth_rasters, inundation_polys)
 
 
+def inundate_forecasts(
+    rem, catchments, hydro_table, forecasts, inundation_rasters=None, depths_rasters=None, quiet=False
+):
+    """
+    Inundate a set of forecasts over the same REM and catchments rasters (e.g. every magnitude of a test case)
+
+    The REM and catchments rasters are read and the hydro-table is loaded only once, then each forecast is
+    mapped over the full extent of the rasters (same as inundate() with mask_type="filter" and no HUCs file).
+
+    Parameters
+    ----------
+    rem : str
+        File path to Relative Elevation Model raster.
+    catchments : str
+        File path to Catchments raster. Must have the same shape and extents as the REM raster.
+    hydro_table : str or pandas.DataFrame
+        File path to hydro-table csv or Pandas DataFrame object with correct indices and columns.
+    forecasts : list of str or pandas.DataFrame
+        Forecasts to inundate (file paths to forecast csv or Pandas DataFrames with correct column names).
+    inundation_rasters : list of str, optional
+        Inundation raster output for each forecast.
+    depths_rasters : list of str, optional
+        Depths raster output for each forecast.
+    quiet : bool, optional
+        Quiet output.
+
+    Returns
+    -------
+    inundation_rasters, depth_rasters : tuple of lists
+        Output file names for each forecast (None for forecasts without a matching feature_id in the
+        hydro-table or when the output was not requested).
+    """
+
+    if inundation_rasters is None:
+        inundation_rasters = [None] * len(forecasts)
+    if depths_rasters is None:
+        depths_rasters = [None] * len(forecasts)
+
+    assert (
+        len(forecasts) == len(inundation_rasters) == len(depths_rasters)
+    ), "Pass one inundation and depths raster output per forecast"
+
+    # load hydro-table only once
+    if isinstance(hydro_table, str):
+        hydro_table = pd.read_csv(
+            hydro_table,
+            dtype={
+                'HUC': str,
+                'feature_id': str,
+                'HydroID': str,
+                'stage': float,
+                'discharge_cms': float,
+                'LakeID': int,
+            },
+            low_memory=False,
+            usecols=['HUC', 'feature_id', 'HydroID', 'stage', 'discharge_cms', 'LakeID'],
+        )
+        hydro_table = hydro_table.set_index(['HUC', 'feature_id', 'HydroID'])
+
+    # read rasters only once
+    with rasterio.open(rem) as rem_src, rasterio.open(catchments) as catchments_src:
+        assert (rem_src.width == catchments_src.width) & (
+            rem_src.height == catchments_src.height
+        ), "REM and catchments rasters required same shape"
+
+        rem_array = rem_src.read(1)
+        catchments_array = catchments_src.read(1)
+        crs = rem_src.crs.wkt
+        transform = rem_src.transform
+        rem_profile = rem_src.profile
+        catchments_profile = catchments_src.profile
+
+    out_inundation_rasters, out_depth_rasters = [], []
+    for forecast, inundation_raster, depths in zip(forecasts, inundation_rasters, depths_rasters):
+        try:
+            catchmentStagesDict, _ = __subset_hydroTable_to_forecast(hydro_table, forecast)
+        except NoForecastFound as exc:
+            __vprint("{} for {}".format(exc, forecast), not quiet)
+            out_inundation_rasters += [None]
+            out_depth_rasters += [None]
+            continue
+
+        # profiles are updated in place by __inundate_in_huc
+        ir_name, d_name, _ = __inundate_in_huc(
+            rem_array,
+            catchments_array,
+            crs,
+            transform,
+            rem_profile.copy(),
+            catchments_profile.copy(),
+            None,
+            catchmentStagesDict,
+            depths,
+            inundation_raster,
+            None,
+            None,
+            None,
+            quiet,
+        )
+        out_inundation_rasters += [ir_name]
+        out_depth_rasters += [d_name]
+
+    return (out_inundation_rasters, out_depth_rasters)
+
+
 def __inundate_in_huc(
     rem_array,
     catchments_array,
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import os
+
+import pandas as pd
+from tools_shared_variables import AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT, TEST_CASES_DIR
+
+
+'''
+Catalog of the alpha test metrics used to build the master metrics CSV (synthesize_test_cases.py), which is
+the input to eval_plots.py.
+
+Each evaluated test case version (test_id / iteration / version) has one parquet "part" in the catalog
+directory holding one row per magnitude / site (nws_lid) / stats mode. Parts are written by Test_Case when
+an alpha test or composite completes. Test case versions evaluated before the catalog existed (or changed
+since their part was written) are indexed from their stats JSON files the next time the master metrics CSV
+is created, so that later runs only read the catalog.
+'''
+
+METRICS_CATALOG_DIR = os.path.join(TEST_CASES_DIR, 'metrics_catalog')
+
+METRICS_TO_WRITE = [
+    'true_negatives_count',
+    'false_negatives_count',
+    'true_positives_count',
+    'false_positives_count',
+    'contingency_tot_count',
+    'cell_area_m2',
+    'TP_area_km2',
+    'FP_area_km2',
+    'TN_area_km2',
+    'FN_area_km2',
+    'contingency_tot_area_km2',
+    'predPositive_area_km2',
+    'predNegative_area_km2',
+    'obsPositive_area_km2',
+    'obsNegative_area_km2',
+    'positiveDiff_area_km2',
+    'CSI',
+    'FAR',
+    'TPR',
+    'TNR',
+    'PND',
+    'PPV',
+    'NPV',
+    'ACC',
+    'Bal_ACC',
+    'MCC',
+    'EQUITABLE_THREAT_SCORE',
+    'PREVALENCE',
+    'BIAS',
+    'F1_SCORE',
+    'TP_perc',
+    'FP_perc',
+    'TN_perc',
+    'FN_perc',
+    'predPositive_perc',
+    'predNegative_perc',
+    'obsPositive_perc',
+    'obsNegative_perc',
+    'positiveDiff_perc',
+    'masked_count',
+    'masked_perc',
+    'masked_area_km2',
+]
+
+# Columns of the master metrics CSV
+MASTER_METRICS_COLUMNS = (
+    ['version', 'nws_lid', 'magnitude', 'huc']
+    + METRICS_TO_WRITE
+    + ['full_json_path', 'flow', 'benchmark_source', 'extent_config', 'calibrated']
+)
+
+CATALOG_KEY_COLUMNS = ['test_id', 'iteration', 'version', 'magnitude', 'nws_lid', 'stats_mode']
+
+CATALOG_COLUMNS = CATALOG_KEY_COLUMNS + [c for c in MASTER_METRICS_COLUMNS if c not in CATALOG_KEY_COLUMNS]
+
+
+def get_version_info(version):
+    '''Returns the extent configuration (MS, FR or COMP) and calibration flag (yes/no) of a FIM version name.'''
+    if '_ms' in version:
+        extent_config = 'MS'
+    elif ('_fr' in version) or (version == 'fim_2_3_3'):
+        extent_config = 'FR'
+    else:
+        extent_config = 'COMP'
+
+    if "_c" in version and version.split('_c')[1] == "":
+        calibrated = "yes"
+    else:
+        calibrated = "no"
+
+    return extent_config, calibrated
+
+
+def get_ahps_flow(flow_file):
+    '''Returns the flow used to map an AHPS site (last discharge of its benchmark flow file).'''
+    flow = ''
+    if os.path.exists(flow_file):
+        with open(flow_file, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader)
+            for row in reader:
+                flow = row[1]
+    return flow
+
+
+def get_catalog_part_path(test_id, iteration, version):
+    '''Returns the path of the catalog part of a test case version ("official" or "testing" iteration).'''
+    return os.path.join(METRICS_CATALOG_DIR, f'{test_id}__{iteration}__{version}.parquet')
+
+
+def site_stats_records(
+    stats_dictionary, test_id, iteration, version, magnitude, magnitude_dir, nws_lid='NA', flow='NA'
+):
+    '''
+    Returns the catalog records (one per stats mode) of the stats of a magnitude / site, as returned by
+    compute_contingency_stats_from_rasters().
+    '''
+    huc, benchmark_source = test_id.split('_')
+    extent_config, calibrated = get_version_info(version)
+
+    records = []
+    for stats_mode, mode_stats in stats_dictionary.items():
+        record = {
+            'test_id': test_id,
+            'iteration': iteration,
+            'version': version,
+            'magnitude': magnitude,
+            'nws_lid': nws_lid,
+            'stats_mode': stats_mode,
+            'huc': huc,
+        }
+        record.update({metric: mode_stats[metric] for metric in METRICS_TO_WRITE})
+        record.update(
+            {
+                'full_json_path': os.path.join(magnitude_dir, stats_mode + '_stats.json'),
+                'flow': flow,
+                'benchmark_source': benchmark_source,
+                'extent_config': extent_config,
+                'calibrated': calibrated,
+            }
+        )
+        records.append(record)
+
+    return records
+
+
+def write_catalog_part(records, part_path):
+    '''Writes (or replaces) a catalog part from a list of records.'''
+    part_df = pd.DataFrame(records, columns=CATALOG_COLUMNS)
+    # Metrics are stored as numbers ("NA" values of the stats JSON files become null until read_master_metrics)
+    # Metrics are stored as numbers ("NA" values of the stats JSON files become null)
+    for metric in METRICS_TO_WRITE:
+        part_df[metric] = pd.to_numeric(part_df[metric], errors='coerce')
+
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    tmp_path = f'{part_path}.{os.getpid()}.tmp'
+    part_df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, part_path)
+
+
+def index_test_case_version(version_dir, test_id, iteration, version):
+    '''
+    Returns the catalog records of a test case version directory from its stats JSON files (used for test
+    case versions that have no up to date catalog part).
+    '''
+    huc, benchmark_source = test_id.split('_')
+    is_ahps = benchmark_source in AHPS_BENCHMARK_CATEGORIES
+
+    records = []
+    for magnitude in MAGNITUDE_DICT[benchmark_source]:
+        magnitude_dir = os.path.join(version_dir, magnitude)
+        if not os.path.exists(magnitude_dir):
+            continue
+
+        for f in os.listdir(magnitude_dir):
+            if '.json' not in f or (is_ahps and 'total_area' in f):
+                continue
+
+            with open(os.path.join(magnitude_dir, f)) as stats_file:
+                stats_dictionary = {f.replace('_stats.json', ''): json.load(stats_file)}
+
+            if is_ahps:
+                nws_lid = f[:5]
+                flow = get_ahps_flow(
+                    os.path.join(
+                        TEST_CASES_DIR,
+                        f'{benchmark_source}_test_cases',
+                        f'validation_data_{benchmark_source}',
+                        huc,
+                        nws_lid,
+                        magnitude,
+                        f'ahps_{nws_lid}_huc_{huc}_flows_{magnitude}.csv',
+                    )
+                )
+            else:
+                nws_lid, flow = 'NA', 'NA'
+
+            records += site_stats_records(
+                stats_dictionary, test_id, iteration, version, magnitude, magnitude_dir, nws_lid, flow
+            )
+
+    return records
+
+
+def refresh_catalog_part(version_dir, test_id, iteration, version):
+    '''
+    Returns the catalog part path of a test case version, (re)indexing it from its stats JSON files if the
+    part does not exist or is older than the test case evaluation.
+    '''
+    part_path = get_catalog_part_path(test_id, iteration, version)
+
+    eval_metadata = os.path.join(version_dir, 'eval_metadata.json')
+    evaluated_time = os.path.getmtime(eval_metadata if os.path.exists(eval_metadata) else version_dir)
+
+    if not os.path.exists(part_path) or os.path.getmtime(part_path) < evaluated_time:
+        write_catalog_part(index_test_case_version(version_dir, test_id, iteration, version), part_path)
+
+    return part_path
+
+
+def read_master_metrics(part_paths):
+    '''
+    Returns the master metrics table (MASTER_METRICS_COLUMNS) of a list of catalog parts. As in the stats
+    JSON files, AHPS sites leave out their total_area stats and keep their domain stats (<lid>_b0m), and
+    metrics that could not be computed are written as "NA".
+    '''
+    if not part_paths:
+        return pd.DataFrame(columns=MASTER_METRICS_COLUMNS)
+
+    catalog_df = pd.concat([pd.read_parquet(part_path) for part_path in part_paths], ignore_index=True)
+
+    is_ahps = catalog_df['benchmark_source'].isin(AHPS_BENCHMARK_CATEGORIES)
+    catalog_df = catalog_df.loc[~is_ahps | (catalog_df['stats_mode'] != 'total_area')].copy()
+
+    metrics_df = catalog_df[METRICS_TO_WRITE].astype(object)
+    catalog_df[METRICS_TO_WRITE] = metrics_df.where(metrics_df.notna(), 'NA')
+
+    return catalog_df[MASTER_METRICS_COLUMNS]
@@ -26,7 +26,8 @@ def Mosaic_inundation(
     is_mosaic_for_branches=False,
     inundation_polygon=None,
 ):
-    if not os.path.isdir(os.path.dirname(mosaic_output)):
+    # (in-memory /vsimem/ outputs do not need a directory)
+    if not mosaic_output.startswith('/vsimem/') and not os.path.isdir(os.path.dirname(mosaic_output)):
         os.makedirs(os.path.dirname(mosaic_output))
 
     # check input
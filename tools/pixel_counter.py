@@ -4,6 +4,7 @@ import argparse
 import copy
 import os
 import tempfile
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -30,8 +31,9 @@ Brad Bates (NOAA, Lynker, and the National Water Center, bradford.bates@noaa.gov
 Derived from a Python version of a zonal statistics function written by Matthew Perry (@perrygeo).
 
 Description: This script isolates the number of pixels per class of a raster within the outlines of
-    one or more polygons and displays them in a table. It accomplishes this by rasterizing the vector file,
-    masking out the desired areas of both rasters, and then summarizing them in a dataframe. It makes use
+    one or more polygons and displays them in a table. It accomplishes this by streaming the raster in
+    tiles, rasterizing the polygons of each tile into a label grid aligned to the raster, taking a bincount
+    of the (polygon, class) pixel counts, and then summarizing them in a dataframe. It makes use
     of the gdal, numpy, and pandas function libraries.
 Inputs: one raster file with at least one set of attributes; one vector file containing one or more polygon
     boundaries
@@ -120,30 +122,186 @@ def bbox_to_pixel_offsets(gt, bbox):
     return (x1, y1, xsize, ysize)
 
 
-# Main function that determines zonal statistics of raster classes in a polygon area
-def zonal_stats(vector_path, raster_path_dict, nodata_value=None, global_src_extent=False):
-    stats = []
+# Size (columns and rows) of the raster tiles streamed through the zone counts
+TILE_SIZE = 2048
+
+# Counter function of each raster layer
+COUNTER_FUNCTIONS = {
+    'nlcd': get_nlcd_counts,
+    'agreement_raster': get_mask_value_counts,
+    'levees': get_levee_counts,
+    'bridges': get_bridge_counts,
+    'flood_extent': get_nlcd_counts_inside_flood,
+}
+
+
+# Function that writes all features of a vector layer into a temporary zone layer (zone_id n: nth feature),
+# which the tiles rasterize into their label grid. Returns the features, a list of whether each feature is
+# within the raster extent and the (x1, y1, x2, y2) pixel window of the vector layer extent in the raster.
+def write_zone_layer(vlyr, rds, zones_path):
+    rgt = rds.GetGeoTransform()
+
+    # Window of the vector layer extent, clipped to the raster
+    x1, y1, xsize, ysize = bbox_to_pixel_offsets(rgt, vlyr.GetExtent())
+    x1, x2 = max(x1, 0), min(x1 + xsize, rds.RasterXSize)
+    y1, y2 = max(y1, 0), min(y1 + ysize, rds.RasterYSize)
+
+    # Zone layer (with a spatial index) holding the label of each feature
+    zones_ds = ogr.GetDriverByName('GPKG').CreateDataSource(zones_path)
+    zones_layer = zones_ds.CreateLayer('zones', vlyr.GetSpatialRef(), ogr.wkbUnknown)
+    zones_layer.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+    zones_layer.StartTransaction()
+
+    features, in_raster = [], []
+    vlyr.ResetReading()
+    feat = vlyr.GetNextFeature()
+    while feat is not None:
+        features.append(feat)
+        fx1, fy1, fxsize, fysize = bbox_to_pixel_offsets(rgt, feat.geometry().GetEnvelope())
+        in_raster.append(fx1 < x2 and fx1 + fxsize > x1 and fy1 < y2 and fy1 + fysize > y1)
+
+        zone_feat = ogr.Feature(zones_layer.GetLayerDefn())
+        zone_feat.SetGeometry(feat.geometry())
+        zone_feat.SetField('zone_id', len(features))
+        zones_layer.CreateFeature(zone_feat)
+        feat = vlyr.GetNextFeature()
+
+    zones_layer.CommitTransaction()
+    zones_ds = None
+    return features, in_raster, (x1, y1, x2, y2)
+
+
+# Function that rasterizes the zone layer into the label grid of one raster tile (label 0: no feature,
+# label n: nth feature), so only one tile of labels is in memory at a time.
+def rasterize_tile_zones(zones_path, rgt, xoff, yoff, xsize, ysize):
+    tile_gt = (rgt[0] + (xoff * rgt[1]), rgt[1], 0.0, rgt[3] + (yoff * rgt[5]), 0.0, rgt[5])
+
+    zones_ds = ogr.Open(zones_path)
+    zones_layer = zones_ds.GetLayer(0)
+    xmin, ymax = tile_gt[0], tile_gt[3]
+    xmax, ymin = xmin + (xsize * rgt[1]), ymax + (ysize * rgt[5])
+    zones_layer.SetSpatialFilterRect(min(xmin, xmax), min(ymin, ymax), max(xmin, xmax), max(ymin, ymax))
+    if zones_layer.GetFeatureCount() == 0:
+        return None
+
+    # Rasterize the features of the tile at once (burning their label)
+    rvds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Int32)
+    rvds.SetGeoTransform(tile_gt)
+    gdal.RasterizeLayer(rvds, [1], zones_layer, options=['ATTRIBUTE=zone_id'])
+    labels = rvds.ReadAsArray()
+
+    rvds = None
+    zones_ds = None
+    return labels
+
+
+# Function that counts the pixels of each raster value in each zone of a tile with np.bincount over
+# (zone, value) codes. Returns the zones, values and pixel counts of the (zone, value) pairs present.
+def count_zone_values(labels, src_array, num_zones, nodata_value=None):
+    is_counted = labels > 0
+    if nodata_value is not None:
+        is_counted &= src_array != nodata_value
+    zones = labels[is_counted].astype(np.int64)
+    values = src_array[is_counted]
+
+    # Small non-negative integer classes (e.g. NLCD, agreement) are used as value codes directly
+    if np.issubdtype(values.dtype, np.integer) and values.size and values.min() >= 0 and values.max() < 256:
+        value_ids = np.arange(values.max() + 1)
+        value_codes = values.astype(np.int64)
+    else:
+        value_ids, value_codes = np.unique(values, return_inverse=True)
+    num_values = max(len(value_ids), 1)
+
+    pair_codes = zones * num_values + value_codes
+    if (num_zones + 1) * num_values <= max(4 * pair_codes.size, 1 << 20):
+        pair_counts = np.bincount(pair_codes, minlength=(num_zones + 1) * num_values)
+        pair_codes = np.flatnonzero(pair_counts)
+        pair_counts = pair_counts[pair_codes]
+    else:
+        # Too many distinct (zone, value) codes for a dense count (e.g. continuous rasters)
+        pair_codes, pair_counts = np.unique(pair_codes, return_counts=True)
+
+    return pair_codes // num_values, value_ids[pair_codes % num_values], pair_counts
 
-    # Loop through different raster paths in the raster_path_dict and
-    # perform zonal statistics on the files.
+
+# Function that counts the pixels of one tile of each raster of a group (run by zonal_stats, possibly
+# in a process pool). Returns the tile zone counts (see count_zone_values) of each raster, or None if no
+# feature is in the tile.
+def count_tile(args):
+    raster_paths, zones_path, rgt, xoff, yoff, xsize, ysize, num_zones, nodata_value = args
+
+    labels = rasterize_tile_zones(zones_path, rgt, xoff, yoff, xsize, ysize)
+    if labels is None or not labels.any():
+        return None
+
+    tile_counts = []
+    for raster_path in raster_paths:
+        rds = gdal.Open(raster_path)
+        src_array = rds.GetRasterBand(1).ReadAsArray(xoff, yoff, labels.shape[1], labels.shape[0])
+        tile_counts.append(count_zone_values(labels, src_array, num_zones, nodata_value))
+        rds = None
+
+    return tile_counts
+
+
+# Function that merges the tile zone counts of a raster into {zone: {raster value: pixel count}}
+def merge_zone_counts(tile_counts):
+    if not tile_counts:
+        return {}
+
+    counts_df = (
+        pd.DataFrame(
+            {
+                'zone': np.concatenate([zones for zones, _, _ in tile_counts]),
+                'value': np.concatenate([values for _, values, _ in tile_counts]),
+                'count': np.concatenate([counts for _, _, counts in tile_counts]),
+            }
+        )
+        .groupby(['zone', 'value'], sort=True)['count']
+        .sum()
+        .reset_index()
+    )
+
+    zones = counts_df['zone'].to_numpy()
+    zone_starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+    return {
+        int(zone): dict(zip(values.tolist(), counts.tolist()))
+        for zone, values, counts in zip(
+            zones[zone_starts],
+            np.split(counts_df['value'].to_numpy(), zone_starts[1:]),
+            np.split(counts_df['count'].to_numpy(), zone_starts[1:]),
+        )
+    }
+
+
+# Main function that determines zonal statistics of raster classes in a polygon area.
+# The rasters of each raster grid and vector file are streamed in tiles (TILE_SIZE) in one pass, spread
+# over num_workers processes. Each tile rasterizes the features it holds into its own label grid, so memory
+# is bounded by the tile size rather than the vector extent. A pixel is counted in the feature that its
+# center falls in (features are assumed not to overlap), and features that are partly outside of a raster
+# are counted over their overlapping part.
+# global_src_extent is ignored (the raster is always read in tiles). It is only kept so existing callers
+# passing it do not break.
+def zonal_stats(vector_path, raster_path_dict, nodata_value=None, global_src_extent=False, num_workers=1):
+    # Group the raster layers by vector file and raster grid so that each group is rasterized once
+    layer_groups = {}
     for layer in raster_path_dict:
         raster_path = raster_path_dict[layer]
         if raster_path == "":  # Only process if a raster path is provided
             continue
         if layer == 'flood_extent' and raster_path_dict["nlcd"] != "":
-            vector_path = make_flood_extent_polygon(flood_extent)
+            vector_path = make_flood_extent_polygon(raster_path)
             raster_path = raster_path_dict["nlcd"]
 
         # Opens raster file and sets path
         rds = gdal.Open(raster_path)
 
         assert rds
-        rb = rds.GetRasterBand(1)
-        rgt = rds.GetGeoTransform()
+        grid_key = (vector_path, rds.GetGeoTransform(), rds.RasterXSize, rds.RasterYSize)
+        rds = None
 
         if nodata_value:
             nodata_value = float(nodata_value)
-            rb.SetNoDataValue(nodata_value)
         if vector_path == "":
             print('No vector path provided. Continuing to next layer.')
             continue
@@ -151,8 +309,11 @@ def zonal_stats(vector_path, raster_path_dict, nodata_value=None, global_src_ext
             print(f'{vector_path} does not exist. Continuing to next layer.')
             continue
 
-        # Opens vector file and sets path
+        layer_groups.setdefault(grid_key, []).append((layer, raster_path))
 
+    stats_by_layer = {}
+    for (vector_path, _, _, _), group_layers in layer_groups.items():
+        # Opens vector file and sets path
         try:
             vds = ogr.Open(vector_path)
             vlyr = vds.GetLayer(0)
@@ -160,94 +321,57 @@ def zonal_stats(vector_path, raster_path_dict, nodata_value=None, global_src_ext
             print(repr(e))
             continue
 
-        # Creates an in-memory numpy array of the source raster data covering
-        #   the whole extent of the vector layer
-        if global_src_extent:
-            # use global source extent
-            # useful only when disk IO or raster scanning inefficiencies are your limiting factor
-            # advantage: reads raster data in one pass
-            # disadvantage: large vector extents may have big memory requirements
-            src_offset = bbox_to_pixel_offsets(rgt, vlyr.GetExtent())
-            src_array = rb.ReadAsArray(*src_offset)
-
-            # calculate new geotransform of the layer subset
-            new_gt = (
-                (rgt[0] + (src_offset[0] * rgt[1])),
-                rgt[1],
-                0.0,
-                (rgt[3] + (src_offset[1] * rgt[5])),
-                0.0,
-                rgt[5],
-            )
-
-        mem_drv = ogr.GetDriverByName('Memory')
-        driver = gdal.GetDriverByName('MEM')
-
-        # Loop through vectors, as many as exist in file
-        # Creates new list to contain their stats
+        raster_paths = [raster_path for _, raster_path in group_layers]
+        rds = gdal.Open(raster_paths[0])
+        rgt = rds.GetGeoTransform()
 
-        feat = vlyr.GetNextFeature()
-        while feat is not None:
-            if not global_src_extent:
-                # use local source extent
-                # fastest option when you have fast disks and well indexed raster (ie tiled Geotiff)
-                # advantage: each feature uses the smallest raster chunk
-                # disadvantage: lots of reads on the source raster
-                src_offset = bbox_to_pixel_offsets(rgt, feat.geometry().GetEnvelope())
-                src_array = rb.ReadAsArray(*src_offset)
-
-                # calculate new geotransform of the feature subset
-                new_gt = (
-                    (rgt[0] + (src_offset[0] * rgt[1])),
-                    rgt[1],
-                    0.0,
-                    (rgt[3] + (src_offset[1] * rgt[5])),
-                    0.0,
-                    rgt[5],
+        with tempfile.TemporaryDirectory() as zones_dir:
+            zones_path = os.path.join(zones_dir, 'zones.gpkg')
+            features, in_raster, (x1, y1, x2, y2) = write_zone_layer(vlyr, rds, zones_path)
+            rds = None
+
+            # Stream the tiles of the vector extent through the zone counts of each raster
+            tile_args = [
+                (
+                    raster_paths,
+                    zones_path,
+                    rgt,
+                    col,
+                    row,
+                    min(TILE_SIZE, x2 - col),
+                    min(TILE_SIZE, y2 - row),
+                    len(features),
+                    nodata_value,
                 )
+                for row in range(y1, y2, TILE_SIZE)
+                for col in range(x1, x2, TILE_SIZE)
+            ]
+
+            if num_workers > 1 and len(tile_args) > 1:
+                with Pool(processes=num_workers) as pool:
+                    tiles_counts = pool.map(count_tile, tile_args)
+            else:
+                tiles_counts = [count_tile(args) for args in tile_args]
+        tiles_counts = [tile_counts for tile_counts in tiles_counts if tile_counts is not None]
+
+        for i, (layer, _) in enumerate(group_layers):
+            zone_counts = merge_zone_counts([tile_counts[i] for tile_counts in tiles_counts])
+            layer_stats = []
+            for zone, feat in enumerate(features, start=1):
+                if not in_raster[zone - 1]:
+                    continue
+                feature_stats = COUNTER_FUNCTIONS[layer](feat, zone_counts.get(zone, {}))
+                if feature_stats is not None:
+                    layer_stats.append(feature_stats)
+            stats_by_layer[layer] = layer_stats
+
+        vds = None
+
+    # Stats are listed by layer (in raster_path_dict order), then by feature
+    stats = []
+    for layer in raster_path_dict:
+        stats += stats_by_layer.get(layer, [])
 
-            # Create a temporary vector layer in memory
-            mem_ds = mem_drv.CreateDataSource('out')
-            mem_layer = mem_ds.CreateLayer('poly', None, ogr.wkbPolygon)
-            mem_layer.CreateFeature(feat.Clone())
-
-            # Rasterize temporary vector layer
-            rvds = driver.Create('', src_offset[2], src_offset[3], 1, gdal.GDT_Byte)
-            rvds.SetGeoTransform(new_gt)
-            gdal.RasterizeLayer(rvds, [1], mem_layer, burn_values=[1])
-            rv_array = rvds.ReadAsArray()
-
-            # Mask the source data array with our current feature and get statistics (pixel count)
-            #   of masked areas
-            # we take the logical_not to flip 0<->1 to get the correct mask effect
-            # we also mask out nodata values explictly
-            if src_array is None:
-                feat = vlyr.GetNextFeature()
-                continue
-            masked = np.ma.MaskedArray(
-                src_array, mask=np.logical_or(src_array == nodata_value, np.logical_not(rv_array))
-            )
-
-            # Call different counter functions depending on the raster's source.
-            if layer == "nlcd":
-                feature_stats = get_nlcd_counts(feat, masked)
-            if layer == "agreement_raster":
-                feature_stats = get_mask_value_counts(feat, masked)
-            if layer == "levees":
-                feature_stats = get_levee_counts(feat, masked)
-            if layer == "bridges":
-                feature_stats = get_bridge_counts(feat, masked)
-            if layer == "flood_extent":
-                feature_stats = get_nlcd_counts_inside_flood(feat, masked)
-
-            stats.append(feature_stats)
-
-            rvds = None
-            mem_ds = None
-            feat = vlyr.GetNextFeature()
-
-    vds = None
-    rds = None
     if stats != []:
         return stats
     else:
@@ -270,6 +394,14 @@ if __name__ == "__main__":
     parser.add_argument('-b', '--bridges', help='Path to bridges file.', required=False, default="")
     parser.add_argument('-f', '--flood_extent', help='Path to flood extent file.', required=False, default="")
     parser.add_argument('-c', '--csv', help='Path to export csv file.', required=True)
+    parser.add_argument(
+        '-j',
+        '--job-number',
+        help='Number of processes used to count the raster tiles.',
+        required=False,
+        default=1,
+        type=int,
+    )
     # Assign variables from arguments.
     args = vars(parser.parse_args())
     vector = args['vector']
@@ -281,7 +413,7 @@ if __name__ == "__main__":
     csv = args['csv']
 
     raster_path_dict = {'nlcd': nlcd, 'levees': levees, 'bridges': bridges, 'flood_extent': flood_extent}
-    stats = zonal_stats(vector, raster_path_dict)
+    stats = zonal_stats(vector, raster_path_dict, num_workers=args['job_number'])
 
     # Export CSV
     df = pd.DataFrame(stats)
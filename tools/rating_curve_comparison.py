@@ -25,6 +25,12 @@ from rasterio import features as riofeatures
 from rasterio import plot as rioplot
 from shapely.geometry import Polygon
 
+from utils.rating_lookup_store import (
+    get_lookup_store_dir,
+    read_nwm_recurr_intervals_cfs,
+    read_usgs_rating_curves,
+)
+
 
 gpd.options.io_engine = "pyogrio"
 
@@ -50,6 +56,9 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
         string of columns to group eval metrics.
 """
 
+# hydroTable columns used for the FIM rating curves
+HYDROTABLE_COLUMNS = ['HydroID', 'feature_id', 'stage', 'discharge_cms', 'default_discharge_cms']
+
 
 def check_file_age(file):
     '''
@@ -84,14 +93,16 @@ def generate_rating_curve_metrics(args):
     elev_table_filename = args[0]
     branches_folder = args[1]
     usgs_gages_filename = args[2]
-    usgs_recurr_stats_filename = args[3]
     nwm_recurr_data_filename = args[4]
-    rc_comparison_plot_filename = args[5]
     nwm_flow_dir = args[6]
     catfim_flows_filename = args[7]
     huc = args[8]
-    alt_plot = args[9]
-    single_plot = args[10]
+    lookup_store_dir = args[11]
+    rating_curves_filename = args[12]
+
+    # Rating curves left by an earlier (interrupted) run must never be plotted as this run's
+    if isfile(rating_curves_filename):
+        os.remove(rating_curves_filename)
 
     logging.info("Generating rating curve metrics for huc: " + str(huc))
     elev_table = pd.read_csv(
@@ -103,42 +114,30 @@ def generate_rating_curve_metrics(args):
     elev_table = elev_table.dropna(subset=['location_id'])
     elev_table = elev_table[elev_table['location_id'].apply(lambda x: str(x).isdigit())]
 
-    # Read in the USGS gages rating curve database csv
-    usgs_gages = pd.read_csv(usgs_gages_filename, dtype={'location_id': object, 'feature_id': object})
+    # Read in the USGS gages rating curves for this HUC's gages from the lookup store
+    usgs_gages = read_usgs_rating_curves(
+        lookup_store_dir, usgs_gages_filename, location_ids=elev_table['location_id'].unique()
+    )
 
     # Aggregate FIM4 hydroTables
     if not elev_table.empty:
-        hydrotable = pd.DataFrame()
-        for branch in elev_table.levpa_id.unique():
-            branch_elev_table = elev_table.loc[elev_table.levpa_id == branch].copy()
-            # branch_elev_table = elev_table.loc[(elev_table.levpa_id == branch) & (elev_table.location_id.notnull())].copy()
+        branch_hydrotables = []
+        for branch, branch_elev_table in elev_table.groupby('levpa_id', sort=False):
+            # Only read the hydroTable columns used for the rating curves
             branch_hydrotable = pd.read_csv(
                 join(branches_folder, str(branch), f'hydroTable_{branch}.csv'),
-                dtype={
-                    'HydroID': object,
-                    'feature_id': object,
-                    'obs_source': object,
-                    'last_updated': object,
-                    'submitter': object,
-                },
+                dtype={'HydroID': object, 'feature_id': object},
+                usecols=lambda col: col in HYDROTABLE_COLUMNS,
             )
             # Only pull SRC for hydroids that are in this branch
             branch_hydrotable = branch_hydrotable.loc[
                 branch_hydrotable.HydroID.isin(branch_elev_table.HydroID)
             ]
-            branch_hydrotable = branch_hydrotable.drop(columns=['order_'])
             # Join SRC with elevation data
             branch_elev_table = branch_elev_table.rename(columns={'feature_id': 'fim_feature_id'})
-            branch_hydrotable = branch_hydrotable.merge(branch_elev_table, on="HydroID")
-            # Append to full rating curve dataframe
-            if hydrotable.empty:
-                hydrotable = branch_hydrotable
-            else:
-                hydrotable = pd.concat([hydrotable, branch_hydrotable])
+            branch_hydrotables.append(branch_hydrotable.merge(branch_elev_table, on="HydroID"))
+        hydrotable = pd.concat(branch_hydrotables)
 
-        # Join rating curves with elevation data
-        # elev_table = elev_table.rename(columns={'feature_id':'fim_feature_id'})
-        # hydrotable = hydrotable.merge(elev_table, on="HydroID")
         if 'location_id' in hydrotable.columns:
             relevant_gages = list(hydrotable.location_id.unique())
         else:
@@ -189,8 +188,7 @@ def generate_rating_curve_metrics(args):
                 )
                 limited_hydrotable_default['discharge_cfs'] = limited_hydrotable_default.default_discharge_cfs
                 limited_hydrotable_default['source'] = "FIM_default"
-                rating_curves = pd.concat([limited_hydrotable, select_usgs_gages])
-                rating_curves = pd.concat([rating_curves, limited_hydrotable_default])
+                rating_curves = pd.concat([limited_hydrotable, select_usgs_gages, limited_hydrotable_default])
             else:
                 rating_curves = pd.concat([limited_hydrotable, select_usgs_gages])
 
@@ -200,197 +198,77 @@ def generate_rating_curve_metrics(args):
             rating_curves['order_'].fillna(0, inplace=True)
             rating_curves['order_'] = rating_curves['order_'].astype('int')
 
-            # NWM recurr intervals
-            recurr_intervals = ("2", "5", "10", "25", "50")
-            recurr_dfs = []
-            for interval in recurr_intervals:
-                recurr_file = join(nwm_flow_dir, 'nwm3_17C_recurr_{}_0_cms.csv'.format(interval))
-                df = pd.read_csv(recurr_file, dtype={'feature_id': str})
-                # Update column names
-                df = df.rename(columns={"discharge": interval})
-                recurr_dfs.append(df)
-
-            # Merge NWM recurr intervals into a single layer
-            nwm_recurr_intervals_all = reduce(
-                lambda x, y: pd.merge(x, y, on='feature_id', how='outer'), recurr_dfs
-            )
-            nwm_recurr_intervals_all = pd.melt(
-                nwm_recurr_intervals_all,
-                id_vars=['feature_id'],
-                value_vars=recurr_intervals,
-                var_name='recurr_interval',
-                value_name='discharge_cms',
-            )
-
-            # Append catfim data (already set up in format similar to nwm_recurr_intervals_all)
-            cat_fim = pd.read_csv(catfim_flows_filename, dtype={'feature_id': str})
-            nwm_recurr_intervals_all = pd.concat([nwm_recurr_intervals_all, cat_fim])
-
-            # Convert discharge to cfs and filter
-            nwm_recurr_intervals_all['discharge_cfs'] = nwm_recurr_intervals_all.discharge_cms * 35.3147
-            nwm_recurr_intervals_all = nwm_recurr_intervals_all.filter(
-                items=['discharge_cfs', 'recurr_interval', 'feature_id']
-            ).drop_duplicates()
-
             # Identify unique gages
             usgs_crosswalk = hydrotable.filter(items=['location_id', 'feature_id']).drop_duplicates()
             usgs_crosswalk = usgs_crosswalk.dropna(subset=['location_id'])
 
-            nwm_recurr_data_table = pd.DataFrame()
-            # usgs_recurr_data = pd.DataFrame()
-
-            # Interpolate USGS/FIM elevation at each gage
-            for index, gage in usgs_crosswalk.iterrows():
-                # Interpolate USGS elevation at NWM recurrence intervals
-                usgs_rc = rating_curves.loc[
-                    (rating_curves.location_id == gage.location_id) & (rating_curves.source == "USGS")
-                ]
-
-                if len(usgs_rc) < 1:
-                    logging.info(
-                        f"missing USGS rating curve data for usgs station {gage.location_id} in huc {huc}"
-                    )
-                    continue
-
-                str_order = np.unique(usgs_rc.order_).item()
-                feature_id = str(gage.feature_id)
-
-                usgs_pred_elev, feature_index = get_recurr_intervals(
-                    usgs_rc, usgs_crosswalk, nwm_recurr_intervals_all
-                )
-
-                # Handle sites missing data
-                if len(usgs_pred_elev) < 1:
-                    logging.info(
-                        f"WARNING: missing USGS elevation data for usgs station {gage.location_id} in huc {huc}"
-                    )
-                    continue
-
-                # Clean up data
-                usgs_pred_elev['location_id'] = gage.location_id
-                usgs_pred_elev = usgs_pred_elev.filter(
-                    items=['location_id', 'recurr_interval', 'discharge_cfs', 'pred_elev']
-                )
-                usgs_pred_elev = usgs_pred_elev.rename(columns={"pred_elev": "USGS"})
-
-                # Interpolate FIM elevation at NWM recurrence intervals
-                fim_rc = rating_curves.loc[
-                    (rating_curves.location_id == gage.location_id) & (rating_curves.source == "FIM")
-                ]
+            # NWM recurr intervals and catfim flows for the crosswalked feature_ids
+            nwm_recurr_intervals_all = read_nwm_recurr_intervals_cfs(
+                lookup_store_dir,
+                nwm_flow_dir,
+                catfim_flows_filename,
+                feature_ids=usgs_crosswalk['feature_id'].dropna().unique(),
+            )
 
-                if len(fim_rc) < 1:
-                    logging.info(
-                        f"missing FIM rating curve data for usgs station {gage.location_id} in huc {huc}"
-                    )
-                    continue
-
-                if feature_index is not None:
-                    fim_pred_elev, feature_index = get_recurr_intervals(
-                        fim_rc, usgs_crosswalk, nwm_recurr_intervals_all, feature_index
-                    )
-
-                # Handle sites missing data
-                if len(fim_pred_elev) < 1:
-                    logging.info(
-                        f"WARNING: missing FIM elevation data for usgs station {gage.location_id} in huc {huc}"
-                    )
-                    continue
-
-                # Clean up data
-                fim_pred_elev = fim_pred_elev.rename(columns={"pred_elev": "FIM"})
-                fim_pred_elev = fim_pred_elev.filter(items=['recurr_interval', 'discharge_cfs', 'FIM'])
-                usgs_pred_elev = usgs_pred_elev.merge(fim_pred_elev, on=['recurr_interval', 'discharge_cfs'])
-
-                # Add attributes
-                usgs_pred_elev['HUC'] = huc
-                usgs_pred_elev['HUC4'] = huc[0:4]
-                usgs_pred_elev['str_order'] = str_order
-                usgs_pred_elev['feature_id'] = feature_id
-
-                # Melt dataframe
-                usgs_pred_elev = pd.melt(
-                    usgs_pred_elev,
-                    id_vars=[
-                        'location_id',
-                        'feature_id',
-                        'recurr_interval',
-                        'discharge_cfs',
-                        'HUC',
-                        'HUC4',
-                        'str_order',
-                    ],
-                    value_vars=['USGS', 'FIM'],
-                    var_name="source",
-                    value_name='elevation_ft',
-                )
-                nwm_recurr_data_table = pd.concat([nwm_recurr_data_table, usgs_pred_elev])
-
-                # Interpolate FIM elevation at USGS observations
-                # fim_rc = fim_rc.merge(usgs_crosswalk, on="location_id")
-                # usgs_rc = usgs_rc.rename(columns={"elevation_ft": "USGS"})
-                #
-                # # Sort stage in ascending order
-                # usgs_rc = usgs_rc.sort_values('USGS',ascending=True)
-                #
-                # # Interpolate FIM elevation at USGS observations
-                # usgs_rc['FIM'] = np.interp(
-                #     usgs_rc.discharge_cfs.values,
-                #     fim_rc['discharge_cfs'],
-                #     fim_rc['elevation_ft'],
-                #     left=np.nan,
-                #     right=np.nan,
-                # )
-                # usgs_rc = usgs_rc[usgs_rc['FIM'].notna()]
-                # usgs_rc = usgs_rc.drop(columns=["source"])
-                #
-                # # Melt dataframe
-                # usgs_rc = pd.melt(
-                #     usgs_rc,
-                #     id_vars=['location_id', 'discharge_cfs', 'str_order'],
-                #     value_vars=['USGS', 'FIM'],
-                #     var_name="source",
-                #     value_name='elevation_ft',
-                # )
-                #
-                # if not usgs_rc.empty:
-                #     usgs_recurr_data = pd.concat([usgs_recurr_data, usgs_rc])
-
-            # Generate stats for all sites in huc
-            # if not usgs_recurr_data.empty:
-            #     usgs_recurr_stats_table = calculate_rc_stats_elev(usgs_recurr_data)
-            #     usgs_recurr_stats_table.to_csv(usgs_recurr_stats_filename,index=False)
-
-            # # Generate plots (not currently being used)
-            # fim_elev_at_USGS_rc_plot_filename = join(
-            #     dirname(rc_comparison_plot_filename), 'FIM_elevations_at_USGS_rc_' + str(huc) + '.png'
-            # )
-            # generate_facet_plot(usgs_recurr_data, fim_elev_at_USGS_rc_plot_filename)
+            # Interpolate USGS/FIM elevation at the NWM recurrence intervals of all gages at once
+            nwm_recurr_data_table = get_recurr_elevations(
+                rating_curves, usgs_crosswalk, nwm_recurr_intervals_all, huc
+            )
 
             if not nwm_recurr_data_table.empty:
                 nwm_recurr_data_table.discharge_cfs = np.round(nwm_recurr_data_table.discharge_cfs, 2)
                 nwm_recurr_data_table.elevation_ft = np.round(nwm_recurr_data_table.elevation_ft, 2)
                 nwm_recurr_data_table.to_csv(nwm_recurr_data_filename, index=False)
-            if 'location_id' not in nwm_recurr_data_table.columns:
+            else:
                 logging.info(
                     f"WARNING: nwm_recurr_data_table is missing location_id column for gage {relevant_gages} "
                     f"in huc {huc}"
                 )
 
-            # plot rating curves
-            if alt_plot:
-                generate_rc_and_rem_plots(
-                    rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table, branches_folder
-                )
-            elif single_plot:
-                generate_single_plot(rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table)
-            else:
-                generate_facet_plot(rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table)
+            # Save the rating curves for the plotting stage (generate_rating_curve_plots)
+            rating_curves.to_parquet(rating_curves_filename, index=False)
         else:
             logging.info(f"no USGS data for gage(s): {relevant_gages} in huc {huc}")
     else:
         logging.info(f"no valid USGS gages found in huc {huc} (note: may be ahps sites without UGSG gages)")
 
 
+def generate_rating_curve_plots(args):
+    '''
+    Plots the rating curves of a HUC from the tables saved by generate_rating_curve_metrics() (run as a
+    separate stage after all of the HUC metrics are done).
+    '''
+    branches_folder = args[1]
+    nwm_recurr_data_filename = args[4]
+    rc_comparison_plot_filename = args[5]
+    huc = args[8]
+    alt_plot = args[9]
+    single_plot = args[10]
+    rating_curves_filename = args[12]
+
+    if not isfile(rating_curves_filename):
+        return
+
+    logging.info("Generating rating curve plots for huc: " + str(huc))
+    rating_curves = pd.read_parquet(rating_curves_filename)
+    if isfile(nwm_recurr_data_filename):
+        nwm_recurr_data_table = pd.read_csv(
+            nwm_recurr_data_filename, dtype={'location_id': str, 'feature_id': str, 'recurr_interval': str}
+        )
+    else:
+        nwm_recurr_data_table = pd.DataFrame()
+
+    # plot rating curves
+    if alt_plot:
+        generate_rc_and_rem_plots(
+            rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table, branches_folder
+        )
+    elif single_plot:
+        generate_single_plot(rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table)
+    else:
+        generate_facet_plot(rating_curves, rc_comparison_plot_filename, nwm_recurr_data_table)
+
+
 def aggregate_metrics(output_dir, procs_list, stat_groups):
     # Default stat group to location_id
     if stat_groups is None:
@@ -436,222 +314,81 @@ def aggregate_metrics(output_dir, procs_list, stat_groups):
     return agg_recurr_stats_table
 
 
-def generate_single_plot(rc, plot_filename, recurr_data_table):
-    tmp_rc = rc.copy()
-
-    # Filter FIM elevation based on USGS data
-    for gage in rc.location_id.unique():
-        rc = rc[rc.location_id == gage]
-
-        plot_filename_splitext = os.path.splitext(plot_filename)
-        gage_plot_filename = plot_filename_splitext[0] + '_' + gage + plot_filename_splitext[1]
-
-        # print(recurr_data_table.head)
-        try:
-            min_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.min()
-            max_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.max()
-            min_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.min()
-            max_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.max()
-            ri100 = recurr_data_table[
-                (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-            ].discharge_cfs.max()
-
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage)
-                    & (rc.source == 'FIM')
-                    & (
-                        ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                        & (rc.discharge_cfs > max_q)
-                    )
-                ].index
-            )
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage)
-                    & (rc.source == 'FIM')
-                    & (rc.elevation_ft < min_elev - 2)
-                    & (rc.discharge_cfs < min_q)
-                ].index
+def filter_fim_rating_curves(rc, recurr_data_table):
+    '''
+    Drops the parts of the FIM rating curves that extend well beyond the USGS rating curve of their gage
+    (outside of the USGS discharge range and more than 2 ft outside of the USGS elevation range or above the
+    highest recurrence flow) so that the plots are scaled to the USGS data.
+    '''
+    try:
+        usgs_range = (
+            rc[rc.source == 'USGS']
+            .groupby('location_id')
+            .agg(
+                min_elev=('elevation_ft', 'min'),
+                max_elev=('elevation_ft', 'max'),
+                min_q=('discharge_cfs', 'min'),
+                max_q=('discharge_cfs', 'max'),
             )
-
-            if 'default_discharge_cfs' in rc.columns:  # Plot both "FIM" and "FIM_default" rating curves
-                rc = rc.drop(
-                    rc[
-                        (rc.location_id == gage)
-                        & (rc.source == 'FIM_default')
-                        & (
-                            ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                            & (rc.discharge_cfs > max_q)
-                        )
-                    ].index
-                )
-                rc = rc.drop(
-                    rc[
-                        (rc.location_id == gage)
-                        & (rc.source == 'FIM_default')
-                        & (rc.elevation_ft < min_elev - 2)
-                    ].index
-                )
-        except Exception as ex:
-            summary = traceback.StackSummary.extract(traceback.walk_stack(None))
-            logging.info("WARNING: rating curve dataframe not processed correctly...")
-            logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
-
-        rc = rc.rename(columns={"location_id": "USGS Gage"})
-
-        # split out branch 0 FIM data
-        rc['source_branch'] = np.where(
-            (rc.source == 'FIM') & (rc.levpa_id == '0'),
-            'FIM_b0',
-            np.where((rc.source == 'FIM_default') & (rc.levpa_id == '0'), 'FIM_default_b0', rc.source),
         )
-        # rc['source_branch'] = np.where(
-        #     (rc.source == 'FIM_default') & (rc.levpa_id == '0'), 'FIM_default_b0', rc.source
-        # )
-
-        ## Generate rating curve plots
-        num_plots = len(rc["USGS Gage"].unique())
-        if num_plots > 3:
-            columns = num_plots // 3
-        else:
-            columns = 1
+        ri100 = (
+            recurr_data_table[recurr_data_table.source == 'FIM'].groupby('location_id').discharge_cfs.max()
+        )
+    except Exception as ex:
+        summary = traceback.StackSummary.extract(traceback.walk_stack(None))
+        logging.info("WARNING: rating curve dataframe not processed correctly...")
+        logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
+        return rc
+
+    # USGS ranges of the gage of each rating curve point
+    gage_range = usgs_range.reindex(rc.location_id.values)
+    gage_ri100 = ri100.reindex(rc.location_id.values).values
+    elevation_ft = rc.elevation_ft.values
+    discharge_cfs = rc.discharge_cfs.values
+
+    above_usgs = ((elevation_ft > gage_range.max_elev.values + 2) | (discharge_cfs > gage_ri100)) & (
+        discharge_cfs > gage_range.max_q.values
+    )
+    below_usgs = elevation_ft < gage_range.min_elev.values - 2
 
-        sns.set(style="ticks")
+    drop = (rc.source.values == 'FIM') & (
+        above_usgs | (below_usgs & (discharge_cfs < gage_range.min_q.values))
+    )
+    if 'default_discharge_cfs' in rc.columns:  # Plot both "FIM" and "FIM_default" rating curves
+        drop |= (rc.source.values == 'FIM_default') & (above_usgs | below_usgs)
 
-        # Plot both "FIM" and "FIM_default" rating curves
-        if '0' in rc.levpa_id.values:  # checks to see if branch zero data exists in the rating curve df
-            hue_order = (
-                ['USGS', 'FIM', 'FIM_default', 'FIM_b0', 'FIM_default_b0']
-                if 'default_discharge_cfs' in rc.columns
-                else ['USGS', 'FIM', 'FIM_b0']
-            )
-            kw = (
-                {
-                    'color': ['blue', 'green', 'orange', 'green', 'orange'],
-                    'linestyle': ["-", "-", "-", "--", "--"],
-                }
-                if 'default_discharge_cfs' in rc.columns
-                else {'color': ['blue', 'green', 'green'], 'linestyle': ["-", "-", "--"]}
-            )
-        else:
-            hue_order = (
-                ['USGS', 'FIM', 'FIM_default'] if 'default_discharge_cfs' in rc.columns else ['USGS', 'FIM']
-            )
-            kw = (
-                {'color': ['blue', 'green', 'orange'], 'linestyle': ["-", "-", "-"]}
-                if 'default_discharge_cfs' in rc.columns
-                else {'color': ['blue', 'green'], 'linestyle': ["-", "_"]}
-            )
-        # Facet Grid
-        g = sns.FacetGrid(
-            rc,
-            col="USGS Gage",
-            hue="source_branch",
-            hue_order=hue_order,
-            sharex=False,
-            sharey=False,
-            col_wrap=columns,
-            height=3.5,
-            aspect=1.65,
-            hue_kws=kw,
+    return rc[~drop]
+
+
+def plot_recurr_intervals(ax, recurr_data, text_offset):
+    '''
+    Plots the NWM 17C recurrence flows (catfim flows are skipped) of a gage as vertical lines.
+    '''
+    recurr_data = recurr_data[recurr_data.recurr_interval.astype(str).str.isnumeric()]
+    for recurr_interval, discharge_cfs in zip(recurr_data.recurr_interval, recurr_data.discharge_cfs):
+        label = 'NWM 17C\nRecurrence' if recurr_interval == '2' else None  # only label 2 yr
+        ax.axvline(x=discharge_cfs, c='purple', linewidth=0.5, label=label)  # plot recurrence intervals
+        y_bottom, y_top = ax.get_ylim()
+        ax.text(
+            discharge_cfs, y_top - (y_top - y_bottom) * text_offset, recurr_interval, size='small', c='purple'
         )
-        g.map(plt.plot, "discharge_cfs", "elevation_ft", linewidth=2, alpha=0.8)
-        g.set_axis_labels(x_var="Discharge (cfs)", y_var="Elevation (ft)")
-
-        ## Plot recurrence intervals
-        axes = g.axes_dict
-        for gage in axes:
-            ax = axes[gage]
-            plt.sca(ax)
-            try:
-                recurr_data = recurr_data_table[
-                    (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-                ].filter(items=['recurr_interval', 'discharge_cfs'])
-                for i, r in recurr_data.iterrows():
-                    if not r.recurr_interval.isnumeric():
-                        continue  # skip catfim flows
-                    label = 'NWM 17C\nRecurrence' if r.recurr_interval == '2' else None  # only label 2 yr
-                    plt.axvline(
-                        x=r.discharge_cfs, c='purple', linewidth=0.5, label=label
-                    )  # plot recurrence intervals
-                    plt.text(
-                        r.discharge_cfs,
-                        ax.get_ylim()[1] - (ax.get_ylim()[1] - ax.get_ylim()[0]) * 0.03,
-                        r.recurr_interval,
-                        size='small',
-                        c='purple',
-                    )
-            except Exception as ex:
-                summary = traceback.StackSummary.extract(traceback.walk_stack(None))
-                logging.info("WARNING: Could not plot recurrence intervals...")
-                logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
-
-        # Adjust the arrangement of the plots
-        g.fig.tight_layout(w_pad=1)
-        g.add_legend()
-
-        plt.savefig(gage_plot_filename)
-        plt.close()
-
-        rc = tmp_rc
 
 
-def generate_facet_plot(rc, plot_filename, recurr_data_table):
-    # Filter FIM elevation based on USGS data
-    for gage in rc.location_id.unique():
-        # print(recurr_data_table.head)
-        try:
-            min_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.min()
-            max_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.max()
-            min_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.min()
-            max_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.max()
-            ri100 = recurr_data_table[
-                (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-            ].discharge_cfs.max()
-
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage)
-                    & (rc.source == 'FIM')
-                    & (
-                        ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                        & (rc.discharge_cfs > max_q)
-                    )
-                ].index
-            )
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage)
-                    & (rc.source == 'FIM')
-                    & (rc.elevation_ft < min_elev - 2)
-                    & (rc.discharge_cfs < min_q)
-                ].index
-            )
+def get_gage_recurr_data(recurr_data_table):
+    '''
+    Returns the FIM recurrence flows (recurr_interval, discharge_cfs) of each gage as a dictionary.
+    '''
+    recurr_data = recurr_data_table[recurr_data_table.source == 'FIM']
+    return {
+        gage: gage_recurr_data.filter(items=['recurr_interval', 'discharge_cfs'])
+        for gage, gage_recurr_data in recurr_data.groupby('location_id', sort=False)
+    }
 
-            if 'default_discharge_cfs' in rc.columns:  # Plot both "FIM" and "FIM_default" rating curves
-                rc = rc.drop(
-                    rc[
-                        (rc.location_id == gage)
-                        & (rc.source == 'FIM_default')
-                        & (
-                            ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                            & (rc.discharge_cfs > max_q)
-                        )
-                    ].index
-                )
-                rc = rc.drop(
-                    rc[
-                        (rc.location_id == gage)
-                        & (rc.source == 'FIM_default')
-                        & (rc.elevation_ft < min_elev - 2)
-                    ].index
-                )
-        except Exception as ex:
-            summary = traceback.StackSummary.extract(traceback.walk_stack(None))
-            logging.info("WARNING: rating curve dataframe not processed correctly...")
-            logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
 
+def plot_rating_curve_facets(rc, plot_filename, recurr_data_table):
+    '''
+    Plots the (filtered) rating curves of one or more gages on a seaborn facet grid with one facet per gage.
+    '''
     rc = rc.rename(columns={"location_id": "USGS Gage"})
 
     # split out branch 0 FIM data
@@ -714,33 +451,15 @@ def generate_facet_plot(rc, plot_filename, recurr_data_table):
     g.set_axis_labels(x_var="Discharge (cfs)", y_var="Elevation (ft)")
 
     ## Plot recurrence intervals
-    axes = g.axes_dict
-    for gage in axes:
-        ax = axes[gage]
-        plt.sca(ax)
-        try:
-            recurr_data = recurr_data_table[
-                (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-            ].filter(items=['recurr_interval', 'discharge_cfs'])
-            recurr_q_max = recurr_data['discharge_cfs'].max()
-            for i, r in recurr_data.iterrows():
-                if not r.recurr_interval.isnumeric():
-                    continue  # skip catfim flows
-                label = 'NWM 17C\nRecurrence' if r.recurr_interval == '2' else None  # only label 2 yr
-                plt.axvline(
-                    x=r.discharge_cfs, c='purple', linewidth=0.5, label=label
-                )  # plot recurrence intervals
-                plt.text(
-                    r.discharge_cfs,
-                    ax.get_ylim()[1] - (ax.get_ylim()[1] - ax.get_ylim()[0]) * 0.03,
-                    r.recurr_interval,
-                    size='small',
-                    c='purple',
-                )
-        except Exception as ex:
-            summary = traceback.StackSummary.extract(traceback.walk_stack(None))
-            logging.info("WARNING: Could not plot recurrence intervals...")
-            logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
+    try:
+        gage_recurr_data = get_gage_recurr_data(recurr_data_table)
+        for gage, ax in g.axes_dict.items():
+            if gage in gage_recurr_data:
+                plot_recurr_intervals(ax, gage_recurr_data[gage], 0.03)
+    except Exception as ex:
+        summary = traceback.StackSummary.extract(traceback.walk_stack(None))
+        logging.info("WARNING: Could not plot recurrence intervals...")
+        logging.info(f'Summary: {summary} \n Exception: \n {repr(ex)}')
 
     # Adjust the arrangement of the plots
     g.fig.tight_layout(w_pad=1)
@@ -750,6 +469,50 @@ def generate_facet_plot(rc, plot_filename, recurr_data_table):
     plt.close()
 
 
+def generate_single_plot(rc, plot_filename, recurr_data_table):
+    # Filter FIM elevation based on USGS data
+    rc = filter_fim_rating_curves(rc, recurr_data_table)
+
+    plot_filename_splitext = os.path.splitext(plot_filename)
+    for gage, gage_rc in rc.groupby('location_id', sort=False):
+        gage_plot_filename = plot_filename_splitext[0] + '_' + gage + plot_filename_splitext[1]
+        plot_rating_curve_facets(gage_rc, gage_plot_filename, recurr_data_table)
+
+
+def generate_facet_plot(rc, plot_filename, recurr_data_table):
+    # Filter FIM elevation based on USGS data
+    rc = filter_fim_rating_curves(rc, recurr_data_table)
+
+    plot_rating_curve_facets(rc, plot_filename, recurr_data_table)
+
+
+def read_branch_rem_data(branches_folder, branch):
+    '''
+    Reads the reaches, catchment raster and REM (limited to the SRC calculation height) of a branch for the
+    rating curve / REM plots.
+    '''
+    reaches_filename = os.path.join(
+        branches_folder,
+        branch,
+        f'demDerived_reaches_split_filtered_addedAttributes_crosswalked_{branch}.gpkg',
+    )
+    reaches = gpd.read_file(reaches_filename) if os.path.isfile(reaches_filename) else None
+
+    with rasterio.open(
+        os.path.join(branches_folder, branch, f'gw_catchments_reaches_filtered_addedAttributes_{branch}.tif')
+    ) as catch_rast:
+        catchments = catch_rast.read()
+    with rasterio.open(os.path.join(branches_folder, branch, f'rem_zeroed_masked_{branch}.tif')) as rem:
+        rem_transform = rem.transform
+        rem_extent = rioplot.plotting_extent(rem)
+        rem_sub25 = rem.read()
+        # Set all pixels above the SRC calculation height to nan
+        rem_sub25[np.where(rem_sub25 > 25.3)] = -9999.0
+        rem_sub25[np.where(rem_sub25 == -9999.0)] = np.nan
+
+    return reaches, catchments, rem_sub25, rem_transform, rem_extent
+
+
 def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_folder):
     ## Set up figure
     num_plots = len(rc["location_id"].unique())
@@ -763,91 +526,28 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
     # Create a dictionary with location_id as keys and branch id as values
     gage_branch_dict = rc.groupby('location_id')['levpa_id'].first().to_dict()
 
-    for i, gage in enumerate(gage_branch_dict):
-        #####################################################################################################
-        # Filter FIM elevation based on USGS data
-
-        min_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.min()
-        max_elev = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].elevation_ft.max()
-        min_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.min()
-        max_q = rc.loc[(rc.location_id == gage) & (rc.source == 'USGS')].discharge_cfs.max()
-        ri100 = recurr_data_table[
-            (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-        ].discharge_cfs.max()
-
-        rc = rc.drop(
-            rc[
-                (rc.location_id == gage)
-                & (rc.source == 'FIM')
-                & (
-                    ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                    & (rc.discharge_cfs > max_q)
-                )
-            ].index
-        )
-        rc = rc.drop(
-            rc[
-                (rc.location_id == gage)
-                & (rc.source == 'FIM')
-                & (rc.elevation_ft < min_elev - 2)
-                & (rc.discharge_cfs < min_q)
-            ].index
-        )
-
-        if 'default_discharge_cfs' in rc.columns:  # Plot both "FIM" and "FIM_default" rating curves
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage)
-                    & (rc.source == 'FIM_default')
-                    & (
-                        ((rc.elevation_ft > (max_elev + 2)) | (rc.discharge_cfs > ri100))
-                        & (rc.discharge_cfs > max_q)
-                    )
-                ].index
-            )
-            rc = rc.drop(
-                rc[
-                    (rc.location_id == gage) & (rc.source == 'FIM_default') & (rc.elevation_ft < min_elev - 2)
-                ].index
-            )
+    # Filter FIM elevation based on USGS data
+    rc = filter_fim_rating_curves(rc, recurr_data_table)
+    gage_recurr_data = get_gage_recurr_data(recurr_data_table)
 
+    # The branch data is only read again when the branch changes from one gage to the next
+    branch_data_key, branch_data = None, None
+    for i, gage in enumerate(gage_branch_dict):
         ######################################################################################################
         ## Read in reaches, catchment raster, and rem raster
         branch = gage_branch_dict[gage]
-        if os.path.isfile(
-            os.path.join(
-                branches_folder,
-                branch,
-                f'demDerived_reaches_split_filtered_addedAttributes_crosswalked_{branch}.gpkg',
-            )
-        ):
-            reaches = gpd.read_file(
-                os.path.join(
-                    branches_folder,
-                    branch,
-                    f'demDerived_reaches_split_filtered_addedAttributes_crosswalked_{branch}.gpkg',
-                )
-            )
-            reach = reaches[reaches.HydroID == hydroid]
-        with rasterio.open(
-            os.path.join(
-                branches_folder, branch, f'gw_catchments_reaches_filtered_addedAttributes_{branch}.tif'
-            )
-        ) as catch_rast:
-            catchments = catch_rast.read()
-        with rasterio.open(os.path.join(branches_folder, branch, f'rem_zeroed_masked_{branch}.tif')) as rem:
-            rem_transform = rem.transform
-            rem_extent = rioplot.plotting_extent(rem)
-            rem_sub25 = rem.read()
-            # Set all pixels above the SRC calculation height to nan
-            rem_sub25[np.where(rem_sub25 > 25.3)] = -9999.0
-            rem_sub25[np.where(rem_sub25 == -9999.0)] = np.nan
+        if branch != branch_data_key:
+            branch_data = None  # release the previous branch rasters before reading the next ones
+            branch_data = read_branch_rem_data(branches_folder, branch)
+            branch_data_key = branch
+        reaches, catchments, rem_sub25, rem_transform, rem_extent = branch_data
+        gage_rc = rc[rc.location_id == gage]
 
         # Plot the rating curve
         ax[i, 1].plot(
             "discharge_cfs",
             "elevation_ft",
-            data=rc[(rc.source == 'USGS') & (rc.location_id == gage)],
+            data=gage_rc[gage_rc.source == 'USGS'],
             linewidth=2,
             alpha=0.8,
             label='USGS',
@@ -855,7 +555,7 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
         ax[i, 1].plot(
             "discharge_cfs",
             "elevation_ft",
-            data=rc[(rc.source == 'FIM') & (rc.location_id == gage)],
+            data=gage_rc[gage_rc.source == 'FIM'],
             linewidth=2,
             alpha=0.8,
             label='FIM',
@@ -864,33 +564,18 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
             ax[i, 1].plot(
                 "default_discharge_cfs",
                 "elevation_ft",
-                data=rc[(rc.source == 'FIM_default') & (rc.location_id == gage)],
+                data=gage_rc[gage_rc.source == 'FIM_default'],
                 linewidth=2,
                 alpha=0.8,
                 label='FIM_default',
             )
 
         # Plot the recurrence intervals
-        recurr_data = recurr_data_table[
-            (recurr_data_table.location_id == gage) & (recurr_data_table.source == 'FIM')
-        ].filter(items=['recurr_interval', 'discharge_cfs'])
-        for _, r in recurr_data.iterrows():
-            if not r.recurr_interval.isnumeric():
-                continue  # skip catfim flows
-            label = 'NWM 17C\nRecurrence' if r.recurr_interval == '2' else None  # only label 2 yr
-            ax[i, 1].axvline(
-                x=r.discharge_cfs, c='purple', linewidth=0.5, label=label
-            )  # plot recurrence intervals
-            ax[i, 1].text(
-                r.discharge_cfs,
-                ax[i, 1].get_ylim()[1] - (ax[i, 1].get_ylim()[1] - ax[i, 1].get_ylim()[0]) * 0.06,
-                r.recurr_interval,
-                size='small',
-                c='purple',
-            )
+        if gage in gage_recurr_data:
+            plot_recurr_intervals(ax[i, 1], gage_recurr_data[gage], 0.06)
 
         # Get the hydroid
-        hydroid = rc[rc.location_id == gage].HydroID.unique()[0]
+        hydroid = gage_rc.HydroID.unique()[0]
         if not hydroid:
             logging.info(f'Gage {gage} in HUC {branch} has no HydroID')
             continue
@@ -900,9 +585,9 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
         catchment_rem[np.where(catchments != int(hydroid))] = np.nan
 
         # Convert raster to WSE feet and limit to upper bound of rating curve
-        dem_adj_elevation = rc[rc.location_id == gage].dem_adj_elevation.unique()[0]
+        dem_adj_elevation = gage_rc.dem_adj_elevation.unique()[0]
         catchment_rem = (catchment_rem + dem_adj_elevation) * 3.28084
-        max_elev = rc[(rc.source == 'FIM') & (rc.location_id == gage)].elevation_ft.max()
+        max_elev = gage_rc[gage_rc.source == 'FIM'].elevation_ft.max()
         catchment_rem[np.where(catchment_rem > max_elev)] = (
             np.nan
         )  # <-- Comment out this line to get the full raster that is
@@ -927,8 +612,8 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
         bounds = ((bounds[0] - 20, bounds[2] + 20), (bounds[1] - 20, bounds[3] + 20))
 
         # REM plot
-        if 'reach' in locals():
-            reach.plot(ax=ax[i, 0], color='#999999', linewidth=0.9)
+        if reaches is not None:
+            reaches[reaches.HydroID == hydroid].plot(ax=ax[i, 0], color='#999999', linewidth=0.9)
         im = ax[i, 0].imshow(
             rasterio.plot.reshape_as_image(catchment_rem),
             cmap='gnuplot',
@@ -942,54 +627,233 @@ def generate_rc_and_rem_plots(rc, plot_filename, recurr_data_table, branches_fol
         ax[i, 0].set_yticks([])
         ax[i, 0].set_title(gage)
 
-    del catchments, rem_sub25, catchment_rem
+    del branch_data
     ax[0, 1].legend()
     plt.savefig(plot_filename, dpi=200)
     plt.close()
 
 
-def get_recurr_intervals(site_rc, usgs_crosswalk, nwm_recurr_intervals, feature_index=None):
-    usgs_site = site_rc.merge(usgs_crosswalk, on="location_id")
-    nwm_ids = len(usgs_site.feature_id.drop_duplicates())
+def interpolate_curves(curve_ids, curve_x, curve_y, query_ids, query_x, query_sets=None):
+    '''
+    Linearly interpolates many curves at once. Each curve is a group of points (in order) of curve_x/curve_y
+    sharing the same curve id, and each query is interpolated on the curve of its query id. The results
+    are the same as calling np.interp(x, xp, fp, left=np.nan, right=np.nan) for each curve.
 
-    if nwm_ids > 0:
-        try:
-            if feature_index is None:
-                min_discharge = site_rc.loc[(site_rc.source == 'USGS')].discharge_cfs.min()
-                max_discharge = site_rc.loc[(site_rc.source == 'USGS')].discharge_cfs.max()
-                discharge_range = max_discharge - min_discharge
-                filtered = nwm_recurr_intervals.copy().loc[
-                    nwm_recurr_intervals.feature_id == usgs_site.feature_id.drop_duplicates().iloc[0]
-                ]
-                min_q_recurr = filtered.discharge_cfs.min()
-                max_q_recurr = filtered.discharge_cfs.max()
-                spread_q = max_q_recurr - min_q_recurr
-                ratio = spread_q / discharge_range
-                # If there is only one feature_id for each location_id or the ratio is large enough
-                if nwm_ids == 1 or ratio > 0.1:
-                    feature_index = 0
-                # If there is more one feature_id for each location_id and the ratio is not large enough
-                else:
-                    feature_index = 1
-            nwm_recurr_intervals = nwm_recurr_intervals.copy().loc[
-                nwm_recurr_intervals.feature_id == usgs_site.feature_id.drop_duplicates().iloc[feature_index]
-            ]
-            nwm_recurr_intervals['pred_elev'] = np.interp(
-                nwm_recurr_intervals.discharge_cfs.values,
-                usgs_site['discharge_cfs'],
-                usgs_site['elevation_ft'],
-                left=np.nan,
-                right=np.nan,
+    Curves with ascending x values are interpolated in a single batched search; any other curve (unsorted or
+    with missing x values) falls back to np.interp, with one call per query set (the np.interp results on an
+    unsorted curve depend on the sequence of values interpolated together).
+
+    Parameters
+    ----------
+    curve_ids, query_ids : array of int
+        Curve ids (0 to number of curves - 1) of the curve points / queries.
+    curve_x, curve_y : array of float
+        Curve points.
+    query_x : array of float
+        Values to interpolate.
+    query_sets : array of int (optional)
+        Set of each query (e.g. the gage the values are interpolated for). All queries are in one set by
+        default.
+
+    Returns
+    -------
+    numpy array of the interpolated values (nan outside of the curve or for a curve without points).
+    '''
+    curve_ids = np.asarray(curve_ids, dtype=np.int64)
+    query_ids = np.asarray(query_ids, dtype=np.int64)
+    curve_x = np.asarray(curve_x, dtype=np.float64)
+    curve_y = np.asarray(curve_y, dtype=np.float64)
+    query_x = np.asarray(query_x, dtype=np.float64)
+    if query_sets is not None:
+        query_sets = np.asarray(query_sets)
+
+    query_y = np.full(len(query_x), np.nan)
+    if len(curve_x) == 0 or len(query_x) == 0:
+        return query_y
+
+    # Group the points of each curve together (keeping the point order of each curve)
+    point_order = np.argsort(curve_ids, kind='stable')
+    curve_ids, curve_x, curve_y = curve_ids[point_order], curve_x[point_order], curve_y[point_order]
+    num_curves = max(curve_ids[-1], query_ids.max()) + 1
+
+    unsorted_curves = np.zeros(num_curves, dtype=bool)
+    descending = (curve_ids[1:] == curve_ids[:-1]) & ~(curve_x[1:] >= curve_x[:-1])
+    unsorted_curves[curve_ids[1:][descending]] = True
+    unsorted_curves[curve_ids[np.isnan(curve_x)]] = True
+    has_points = np.bincount(curve_ids, minlength=num_curves) > 0
+
+    # Batched search: the x values are replaced by their rank so that (curve id, rank) can be searched as
+    # one sorted integer key
+    sorted_points = ~unsorted_curves[curve_ids]
+    batch_queries = np.flatnonzero(has_points[query_ids] & ~unsorted_curves[query_ids] & ~np.isnan(query_x))
+    if len(batch_queries) > 0 and sorted_points.any():
+        point_ids = curve_ids[sorted_points]
+        xp = curve_x[sorted_points]
+        fp = curve_y[sorted_points]
+        q_ids = query_ids[batch_queries]
+        x = query_x[batch_queries]
+
+        x_values, x_ranks = np.unique(np.concatenate([xp, x]), return_inverse=True)
+        key_size = len(x_values) + 1
+        point_keys = point_ids * key_size + x_ranks[: len(xp)]
+        query_keys = q_ids * key_size + x_ranks[len(xp) :]
+
+        first = np.searchsorted(point_keys, q_ids * key_size, side='left')
+        last = np.searchsorted(point_keys, (q_ids + 1) * key_size, side='left') - 1
+        j = np.searchsorted(point_keys, query_keys, side='right') - 1
+
+        inside = (j >= first) & (j < last)
+        at_last = (j == last) & (x == xp[last])
+
+        j_in, x_in = j[inside], x[inside]
+        slope = (fp[j_in + 1] - fp[j_in]) / (xp[j_in + 1] - xp[j_in])
+        y_in = slope * (x_in - xp[j_in]) + fp[j_in]
+        # Same handling of infinite slopes as np.interp
+        y_nan = np.isnan(y_in)
+        y_in[y_nan] = slope[y_nan] * (x_in[y_nan] - xp[j_in + 1][y_nan]) + fp[j_in + 1][y_nan]
+        same_y = np.isnan(y_in) & (fp[j_in] == fp[j_in + 1])
+        y_in[same_y] = fp[j_in][same_y]
+
+        batch_y = np.full(len(batch_queries), np.nan)
+        batch_y[inside] = y_in
+        batch_y[at_last] = fp[last[at_last]]
+        query_y[batch_queries] = batch_y
+
+    if query_sets is None:
+        query_sets = np.zeros(len(query_x), dtype=np.int64)
+    for curve_id in np.flatnonzero(unsorted_curves):
+        curve_points = curve_ids == curve_id
+        curve_queries = query_ids == curve_id
+        for query_set in np.unique(query_sets[curve_queries]):
+            set_queries = curve_queries & (query_sets == query_set)
+            query_y[set_queries] = np.interp(
+                query_x[set_queries], curve_x[curve_points], curve_y[curve_points], left=np.nan, right=np.nan
             )
 
-            return nwm_recurr_intervals, feature_index
-        except Exception as ex:
-            summary = traceback.StackSummary.extract(traceback.walk_stack(None))
-            print(summary, repr(ex))
-            return [], None
+    return query_y
 
-    else:
-        return [], None
+
+def get_recurr_elevations(rating_curves, usgs_crosswalk, nwm_recurr_intervals, huc):
+    '''
+    Interpolates the USGS and FIM rating curve elevations at the NWM recurrence flows (and catfim flows) of
+    every crosswalked gage (location_id / feature_id) of a HUC.
+
+    When a gage is crosswalked to more than one feature_id, the flows of the first feature_id are used if
+    their spread is at least 10% of the USGS rating curve discharge range, otherwise the flows of the second
+    feature_id are used.
+
+    Returns
+    -------
+    pandas DataFrame of the elevations (melted by source) at the recurrence flows of each gage
+    '''
+    usgs_rc = rating_curves[rating_curves.source == 'USGS']
+    fim_rc = rating_curves[rating_curves.source == 'FIM']
+
+    # Crosswalked feature_ids of each gage (in crosswalk order)
+    gage_feature_ids = usgs_crosswalk.groupby('location_id', sort=False, dropna=False).feature_id.agg(list)
+
+    # Select the feature_id used for the recurrence flows of each gage
+    usgs_q = usgs_rc.groupby('location_id').discharge_cfs.agg(['min', 'max'])
+    recurr_q = nwm_recurr_intervals.groupby('feature_id').discharge_cfs.agg(['min', 'max'])
+    gages = pd.DataFrame(
+        {
+            'num_feature_ids': gage_feature_ids.str.len(),
+            'first_feature_id': gage_feature_ids.str[0],
+            'second_feature_id': gage_feature_ids.str[1],
+        }
+    )
+    discharge_range = usgs_q['max'] - usgs_q['min']
+    spread_q = (recurr_q['max'] - recurr_q['min']).reindex(gages.first_feature_id).values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = spread_q / discharge_range.reindex(gages.index).values
+    gages['recurr_feature_id'] = np.where(
+        (gages.num_feature_ids == 1) | (ratio > 0.1), gages.first_feature_id, gages.second_feature_id
+    )
+
+    # Stream order of each gage
+    str_orders = usgs_rc.groupby('location_id').order_.agg(['nunique', 'first'])
+    gages['num_str_orders'] = str_orders['nunique'].reindex(gages.index)
+    gages['str_order'] = str_orders['first'].reindex(gages.index)
+
+    # One block of recurrence flows per crosswalked gage
+    blocks = usgs_crosswalk.filter(items=['location_id', 'feature_id']).reset_index(drop=True)
+    blocks = blocks.join(gages, on='location_id')
+    blocks['block'] = np.arange(len(blocks))
+    has_usgs_rc = blocks.location_id.isin(usgs_rc.location_id).values
+    # Gages whose USGS rating curve has no discharge range are left out: with the pinned pandas (Python float
+    # scalars), the per-gage feature_id selection raised ZeroDivisionError on them and dropped the gage
+    has_recurr_flows = (
+        blocks.recurr_feature_id.isin(nwm_recurr_intervals.feature_id)
+        & (blocks.location_id.map(discharge_range) != 0)
+    ).values
+    has_fim_rc = blocks.location_id.isin(fim_rc.location_id).values
+    for location_id in blocks.location_id[~has_usgs_rc]:
+        logging.info(f"missing USGS rating curve data for usgs station {location_id} in huc {huc}")
+    for location_id in blocks.location_id[has_usgs_rc & ~has_recurr_flows]:
+        logging.info(f"WARNING: missing USGS elevation data for usgs station {location_id} in huc {huc}")
+    for location_id in blocks.location_id[has_usgs_rc & has_recurr_flows & ~has_fim_rc]:
+        logging.info(f"missing FIM rating curve data for usgs station {location_id} in huc {huc}")
+    blocks = blocks[has_usgs_rc & has_recurr_flows & has_fim_rc]
+
+    # A gage with more than one stream order has ambiguous rating curves
+    single_order = blocks.num_str_orders == 1
+    for location_id in blocks.location_id[~single_order]:
+        logging.info(f"WARNING: more than one stream order for usgs station {location_id} in huc {huc}")
+    blocks = blocks[single_order]
+    if blocks.empty:
+        return pd.DataFrame()
+    blocks['str_order'] = blocks.str_order.astype(int)
+
+    recurr_data = blocks.filter(
+        items=['block', 'location_id', 'feature_id', 'str_order', 'recurr_feature_id']
+    )
+    recurr_data = recurr_data.merge(
+        nwm_recurr_intervals.rename(columns={'feature_id': 'recurr_feature_id'}), on='recurr_feature_id'
+    )
+
+    # Interpolate the USGS/FIM elevations of all gages at their recurrence flows
+    # (site rating curve points are repeated once per crosswalked feature_id, as the gage/crosswalk join does)
+    site_rc = pd.concat([usgs_rc, fim_rc]).filter(
+        items=['location_id', 'source', 'discharge_cfs', 'elevation_ft']
+    )
+    site_rc = site_rc.merge(usgs_crosswalk.filter(items=['location_id']), on='location_id')
+    curve_keys = site_rc.location_id + '|' + site_rc.source
+    curve_ids, curve_index = pd.factorize(curve_keys)
+    for source in ['USGS', 'FIM']:
+        recurr_data[source] = interpolate_curves(
+            curve_ids,
+            site_rc.discharge_cfs.values,
+            site_rc.elevation_ft.values,
+            curve_index.get_indexer(recurr_data.location_id + '|' + source),
+            recurr_data.discharge_cfs.values,
+            recurr_data.block.values,
+        )
+
+    # Add attributes
+    recurr_data['HUC'] = huc
+    recurr_data['HUC4'] = huc[0:4]
+    recurr_data['feature_id'] = recurr_data.feature_id.astype(str)
+
+    # Melt dataframe (keeping the rows of each gage together)
+    recurr_data = pd.melt(
+        recurr_data,
+        id_vars=[
+            'block',
+            'location_id',
+            'feature_id',
+            'recurr_interval',
+            'discharge_cfs',
+            'HUC',
+            'HUC4',
+            'str_order',
+        ],
+        value_vars=['USGS', 'FIM'],
+        var_name="source",
+        value_name='elevation_ft',
+    )
+    recurr_data = recurr_data.sort_values('block', kind='stable').drop(columns=['block'])
+
+    return recurr_data.reset_index(drop=True)
 
 
 def calculate_rc_stats_elev(rc, stat_groups=None):
@@ -1012,78 +876,41 @@ def calculate_rc_stats_elev(rc, stat_groups=None):
     # Calculate variables for NRMSE
     rc_unmelt["yhat_minus_y"] = rc_unmelt[src_elev] - rc_unmelt[usgs_elev]
     rc_unmelt["yhat_minus_y_squared"] = rc_unmelt["yhat_minus_y"] ** 2
+    rc_unmelt["abs_yhat_minus_y"] = rc_unmelt["yhat_minus_y"].abs()
 
     # Calculate metrics by group
-    station_rc = rc_unmelt.groupby(stat_groups)
-
-    # Calculate variables for NRMSE
-    sum_y_diff = (
-        station_rc.apply(lambda x: x["yhat_minus_y_squared"].sum())
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "sum_y_diff"}, axis=1)
-    )
-
-    # Determine number of events that are modeled
-    n = (
-        station_rc.apply(lambda x: x[usgs_elev].count())
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "n"}, axis=1)
-    )
-
-    # Determine the maximum/minimum USGS elevation
-    y_max = (
-        station_rc.apply(lambda x: x[usgs_elev].max())
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "y_max"}, axis=1)
-    )
-    y_min = (
-        station_rc.apply(lambda x: x[usgs_elev].min())
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "y_min"}, axis=1)
-    )
-
-    # Collect variables for NRMSE
-    nrmse_table = reduce(
-        lambda x, y: pd.merge(x, y, on=stat_groups, how='outer'), [sum_y_diff, n, y_max, y_min]
-    )
-    nrmse_table_group = nrmse_table.groupby(stat_groups)
-
-    # Calculate nrmse
-    def NRMSE(x):
-        if x['n'].values == 1:  # when n==1, NRME equation will return an `inf`
-            return x['sum_y_diff'] ** 0.5
-        else:
-            return ((x['sum_y_diff'] / x['n']) ** 0.5) / (x['y_max'] - x['y_min'])
-
-    nrmse = nrmse_table_group.apply(NRMSE).reset_index(stat_groups, drop=False).rename({0: "nrmse"}, axis=1)
-
-    # Calculate Mean Absolute Depth Difference
-    mean_abs_y_diff = (
-        station_rc.apply(lambda x: (abs(x["yhat_minus_y"]).mean()))
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "mean_abs_y_diff_ft"}, axis=1)
-    )
-
-    # Calculate Mean Depth Difference (non-absolute value)
-    mean_y_diff = (
-        station_rc.apply(lambda x: (x["yhat_minus_y"].mean()))
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "mean_y_diff_ft"}, axis=1)
+    rc_stat_table = (
+        rc_unmelt.groupby(stat_groups)
+        .agg(
+            # Number of events that are modeled
+            n=(usgs_elev, 'count'),
+            sum_y_diff=('yhat_minus_y_squared', 'sum'),
+            # Maximum/minimum USGS elevation
+            y_max=(usgs_elev, 'max'),
+            y_min=(usgs_elev, 'min'),
+            # Mean Absolute Depth Difference
+            mean_abs_y_diff_ft=('abs_yhat_minus_y', 'mean'),
+            # Mean Depth Difference (non-absolute value)
+            mean_y_diff_ft=('yhat_minus_y', 'mean'),
+            sum_yhat_minus_y=('yhat_minus_y', 'sum'),
+            sum_y=(usgs_elev, 'sum'),
+        )
+        .reset_index()
     )
 
-    # Calculate Percent Bias
-    percent_bias = (
-        station_rc.apply(lambda x: 100 * (x["yhat_minus_y"].sum() / x[usgs_elev].sum()))
-        .reset_index(stat_groups, drop=False)
-        .rename({0: "percent_bias"}, axis=1)
-    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Calculate nrmse (when n==1, NRME equation will return an `inf`)
+        rc_stat_table['nrmse'] = np.where(
+            rc_stat_table['n'] == 1,
+            rc_stat_table['sum_y_diff'] ** 0.5,
+            ((rc_stat_table['sum_y_diff'] / rc_stat_table['n']) ** 0.5)
+            / (rc_stat_table['y_max'] - rc_stat_table['y_min']),
+        )
 
-    rc_stat_table = reduce(
-        lambda x, y: pd.merge(x, y, on=stat_groups, how='outer'),
-        [n, nrmse, mean_abs_y_diff, mean_y_diff, percent_bias],
-    )
+        # Calculate Percent Bias
+        rc_stat_table['percent_bias'] = 100 * (rc_stat_table['sum_yhat_minus_y'] / rc_stat_table['sum_y'])
 
-    return rc_stat_table
+    return rc_stat_table[stat_groups + ['n', 'nrmse', 'mean_abs_y_diff_ft', 'mean_y_diff_ft', 'percent_bias']]
 
 
 def create_static_gpkg(output_dir, output_gpkg, agg_recurr_stats_table, gages_gpkg_filepath):
@@ -1287,6 +1114,14 @@ if __name__ == '__main__':
         action='append',
     )
     parser.add_argument('-s', '--single-plot', help='Create single plots', action='store_true')
+    parser.add_argument(
+        '-np',
+        '--no-plots',
+        help='Skip the rating curve plots (only compute the metrics)',
+        required=False,
+        default=False,
+        action='store_true',
+    )
     args = vars(parser.parse_args())
 
     fim_dir = args['fim_dir']
@@ -1299,6 +1134,7 @@ if __name__ == '__main__':
     alt_plot = args['alt_plot']
     eval = args['evaluate_results']
     single_plot = args['single_plot']
+    no_plots = args['no_plots']
     if args['stat_gages']:
         gages_gpkg_filepath = args['stat_gages'][0]
         stat_gages = args['stat_gages'][1]
@@ -1346,6 +1182,12 @@ if __name__ == '__main__':
         # Check age of gages csv and recommend updating if older than 30 days.
         print(check_file_age(usgs_gages_filename))
 
+        # Build (or reuse) the USGS rating curve and NWM recurrence flow lookup tables once before the HUC
+        # workers start. The workers then only read the rows for their own gages.
+        lookup_store_dir = get_lookup_store_dir(join(output_dir, 'lookup_store'))
+        read_usgs_rating_curves(lookup_store_dir, usgs_gages_filename, ['location_id'], location_ids=[])
+        read_nwm_recurr_intervals_cfs(lookup_store_dir, nwm_flow_dir, catfim_flows_filename, feature_ids=[])
+
         merged_elev_table = []
         huc_list = [huc for huc in os.listdir(fim_dir) if re.search(r"^\d{6,8}$", huc)]
         for huc in huc_list:
@@ -1354,6 +1196,7 @@ if __name__ == '__main__':
             usgs_recurr_stats_filename = join(tables_dir, f"usgs_interpolated_elevation_stats_{huc}.csv")
             nwm_recurr_data_filename = join(tables_dir, f"nwm_recurrence_flow_elevations_{huc}.csv")
             rc_comparison_plot_filename = join(plots_dir, f"FIM-USGS_rating_curve_comparison_{huc}.png")
+            rating_curves_filename = join(tables_dir, f"rating_curves_{huc}.parquet")
 
             if isfile(elev_table_filename):
                 procs_list.append(
@@ -1369,6 +1212,8 @@ if __name__ == '__main__':
                         huc,
                         alt_plot,
                         single_plot,
+                        lookup_store_dir,
+                        rating_curves_filename,
                     ]
                 )
                 # Aggregate all of the individual huc elev_tables into one aggregate
@@ -1396,6 +1241,14 @@ if __name__ == '__main__':
         with Pool(processes=number_of_jobs) as pool:
             pool.map(generate_rating_curve_metrics, procs_list)
 
+        # Plot the rating curves as a separate stage so that the metrics are not held up by the plotting
+        if not no_plots:
+            logging.info(
+                f"Generating rating curve plots for {len(procs_list)} hucs using {number_of_jobs} jobs"
+            )
+            with Pool(processes=number_of_jobs) as pool:
+                pool.map(generate_rating_curve_plots, procs_list)
+
         # Create point layer of usgs gages with joined stats attributes
         if stat_gages:
             logging.info("Creating usgs gages GPKG with joined rating curve summary stats")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import glob
 import json
 import os
 import re
@@ -8,12 +9,22 @@ import sys
 import traceback
 
 import pandas as pd
-from inundate_mosaic_wrapper import produce_mosaicked_inundation
+import rasterio.shutil
+from hash_compare import hashfile
+from inundate_mosaic_wrapper import produce_mosaicked_inundation, produce_mosaicked_inundation_batch
 from inundation import inundate
+from metrics_catalog import (
+    get_ahps_flow,
+    get_catalog_part_path,
+    index_test_case_version,
+    site_stats_records,
+    write_catalog_part,
+)
 from mosaic_inundation import Mosaic_inundation
 from tools_shared_functions import compute_contingency_stats_from_rasters
 from tools_shared_variables import (
     AHPS_BENCHMARK_CATEGORIES,
+    BENCHMARK_CACHE_DIR,
     INPUTS_DIR,
     MAGNITUDE_DICT,
     OUTPUTS_DIR,
@@ -25,6 +36,11 @@ from tools_shared_variables import (
 from utils.shared_functions import FIM_Helpers as fh
 
 
+# Increment when the evaluation changes in a way that invalidates existing test case results, so that
+# alpha tests run with skip_unchanged are re-evaluated
+EVALUATION_FINGERPRINT_VERSION = 1
+
+
 class Benchmark(object):
     AHPS_BENCHMARK_CATEGORIES = AHPS_BENCHMARK_CATEGORIES
     MAGNITUDE_DICT = MAGNITUDE_DICT
@@ -110,6 +126,10 @@ class Test_Case(Benchmark):
         super().__init__(self.benchmark_cat)
         self.version = version
         self.archive = archive
+        # Keep the predicted (mosaicked) inundation raster on disk (see alpha_test)
+        self.keep_predicted_raster = True
+        # Metrics catalog records of the evaluated magnitudes/sites (see write_metadata)
+        self.metrics_records = []
         # FIM run directory path - uses HUC 6 for FIM 1 & 2
         self.fim_dir = os.path.join(
             PREVIOUS_FIM_DIR if archive else OUTPUTS_DIR,
@@ -192,6 +212,8 @@ class Test_Case(Benchmark):
         overwrite=True,
         verbose=False,
         gms_workers=1,
+        keep_predicted_raster=None,
+        skip_unchanged=False,
     ):
         '''Compares a FIM directory with benchmark data from a variety of sources.
 
@@ -213,15 +235,41 @@ class Test_Case(Benchmark):
             If True, prints out all pertinent data.
         gms_workers : int
             Number of worker processes assigned to GMS processing.
+        keep_predicted_raster : bool
+            If True, the mosaicked GMS inundation raster of each magnitude/site is written to the test case
+            directory. If False, it is only held in memory for the agreement analysis. Defaults to True for
+            archived (official) versions and False otherwise.
+        skip_unchanged : bool
+            If True, the test case is only re-evaluated if its inputs (hydrofabric, benchmark, flow and mask
+            files) or settings changed since the last evaluation run with skip_unchanged. Otherwise the
+            existing results are kept.
+
+        Returns
+        -------
+        dict
+            Evaluation summary of the test case (test_id, version, status and changed_inputs), where status is
+            one of 'recomputed', 'reused' or 'skipped'.
         '''
 
+        eval_summary = {
+            'test_id': self.test_id,
+            'version': self.version,
+            'status': 'recomputed',
+            'changed_inputs': '',
+        }
+
         try:
             if not overwrite and os.path.isdir(self.dir):
                 print(f"Metrics for {self.dir} already exist. Use overwrite flag (-o) to overwrite metrics.")
-                return
+                eval_summary['status'] = 'skipped'
+                return eval_summary
 
             fh.vprint(f"Starting alpha test for {self.dir}", verbose)
 
+            self.keep_predicted_raster = (
+                self.archive if keep_predicted_raster is None else keep_predicted_raster
+            )
+
             self.stats_modes_list = ['total_area']
 
             # Create paths to fim_run outputs for use in inundate()
@@ -264,21 +312,45 @@ class Test_Case(Benchmark):
                     inclusion_area_buffer = 0
                 self.stats_modes_list.append(inclusion_area_name + '_b' + str(inclusion_area_buffer) + 'm')
 
+            if skip_unchanged:
+                settings = {
+                    'model': model,
+                    'mask_type': mask_type,
+                    'inclusion_area': inclusion_area,
+                    'inclusion_area_buffer': inclusion_area_buffer,
+                    'calibrated': calibrated,
+                }
+                previous_fingerprint = self.read_fingerprint()
+                fingerprint = self.get_input_fingerprint(settings, previous_fingerprint)
+                changed_inputs = self.get_changed_inputs(fingerprint, previous_fingerprint)
+
+                if not changed_inputs:
+                    fh.vprint(f"Inputs of {self.dir} are unchanged, keeping the existing metrics.", verbose)
+                    eval_summary['status'] = 'reused'
+                    return eval_summary
+                eval_summary['changed_inputs'] = ';'.join(changed_inputs)
+
             # Delete the directory if it exists
             if os.path.exists(self.dir):
                 shutil.rmtree(self.dir)
             os.mkdir(self.dir)
+            self.metrics_records = []
 
             # Get the magnitudes and lids for the current huc and loop through them
             validation_data = self.data(self.huc)
+            if model == 'GMS':
+                # Every magnitude/site shares the same branches, so they are all inundated in one pass
+                self._batch_inundate_and_compute(validation_data, verbose=verbose, gms_workers=gms_workers)
+
             for magnitude in validation_data:
-                for instance in validation_data[
-                    magnitude
-                ]:  # instance will be the lid for AHPS sites and '' for other sites
-                    # For each site, inundate the REM and compute aggreement raster with stats
-                    self._inundate_and_compute(
-                        magnitude, instance, model=model, verbose=verbose, gms_workers=gms_workers
-                    )
+                if model != 'GMS':
+                    for instance in validation_data[
+                        magnitude
+                    ]:  # instance will be the lid for AHPS sites and '' for other sites
+                        # For each site, inundate the REM and compute aggreement raster with stats
+                        self._inundate_and_compute(
+                            magnitude, instance, model=model, verbose=verbose, gms_workers=gms_workers
+                        )
 
                 # Clean up 'total_area' outputs from AHPS sites
                 if self.is_ahps:
@@ -286,6 +358,10 @@ class Test_Case(Benchmark):
 
             # Write out evaluation meta-data
             self.write_metadata(calibrated, model)
+            if skip_unchanged:
+                self.write_fingerprint(fingerprint)
+
+            return eval_summary
 
         except KeyboardInterrupt:
             print("Program aborted via keyboard interrupt")
@@ -296,47 +372,150 @@ class Test_Case(Benchmark):
             print(f"trace for {self.test_id} -------------\n", traceback.format_exc())
             sys.exit(1)
 
-    def _inundate_and_compute(
-        self, magnitude, lid, compute_only=False, model='', verbose=False, gms_workers=1
-    ):
-        '''Method for inundating and computing contingency rasters as part of the alpha_test.
-        Used by both the alpha_test() and composite() methods.
+    def _get_benchmark_files(self, magnitude, lid):
+        '''Returns the benchmark raster, benchmark flow file and domain shapefile (AHPS sites only, None
+        otherwise) of a magnitude/site of the test case.
+        '''
+        benchmark_rast = (
+            f'ahps_{lid}' if lid else self.benchmark_cat
+        ) + f'_huc_{self.huc}_extent_{magnitude}.tif'
+        benchmark_rast = os.path.join(self.benchmark_dir, lid, magnitude, benchmark_rast)
+        benchmark_flows = benchmark_rast.replace(f'_extent_{magnitude}.tif', f'_flows_{magnitude}.csv')
+        domain = os.path.join(self.benchmark_dir, lid, f'{lid}_domain.shp') if self.is_ahps else None
+        return benchmark_rast, benchmark_flows, domain
 
-         Parameters
-         ----------
-         magnitude : str
-             Magnitude of the current benchmark site.
-         lid : str
-             lid of the current benchmark site. For non-AHPS sites, this should be an empty string ('').
-         compute_only : bool
-             If true, skips inundation and only computes contingency stats.
+    def _get_fingerprint_files(self, model):
+        '''Returns the input files of the alpha test as {path: content_hash}. HUC level inputs (hydrofabric,
+        benchmark and flow files) are compared by content, the shared national inputs (masks and WBD) by
+        size and modification time only. Must be called after the alpha test inputs are set up.
         '''
-        # Output files
-        fh.vprint("Creating output files", verbose)
+        files = {}
+        if model == 'GMS':
+            for file_name in ['hydrotable.csv', 'wbd.gpkg']:
+                files[os.path.join(self.fim_dir, file_name)] = True
+            for pattern in [
+                'rem_zeroed_masked_*.tif',
+                'gw_catchments_reaches_filtered_addedAttributes_*.tif',
+            ]:
+                for branch_file in glob.glob(os.path.join(self.fim_dir, 'branches', '*', pattern)):
+                    files[branch_file] = True
+        else:
+            for fim_file in [self.rem, self.catchments, self.hydro_table, self.catchment_poly]:
+                if fim_file:
+                    files[fim_file] = True
+            files[self.hucs] = False
+
+        for magnitude, lids in self.data(self.huc).items():
+            for lid in lids:
+                benchmark_rast, benchmark_flows, domain = self._get_benchmark_files(magnitude, lid)
+                files[benchmark_rast] = True
+                files[benchmark_flows] = True
+                if domain is not None:
+                    # shapefile and its sidecar files
+                    for domain_file in glob.glob(os.path.splitext(domain)[0] + '.*'):
+                        files[domain_file] = True
+
+        for mask in self.mask_dict.values():
+            if mask['path']:
+                files[mask['path']] = False
+
+        return files
+
+    def get_input_fingerprint(self, settings, previous_fingerprint=None):
+        '''Returns the fingerprint of the alpha test inputs: the settings and the size, modification time
+        and (for HUC level inputs) content hash of each input file. Content hashes of files with the same
+        size and modification time as in the previous fingerprint are reused instead of recomputed.
+        '''
+        previous_files = previous_fingerprint['files'] if previous_fingerprint else {}
+
+        fingerprint_files = {}
+        for file_path, content_hash in sorted(self._get_fingerprint_files(settings['model']).items()):
+            if not os.path.isfile(file_path):
+                continue
+            file_stat = os.stat(file_path)
+            file_sig = [file_stat.st_size, file_stat.st_mtime_ns]
+
+            previous_entry = previous_files.get(file_path)
+            if previous_entry is not None and previous_entry['sig'] == file_sig:
+                fingerprint_files[file_path] = previous_entry
+            else:
+                fingerprint_files[file_path] = {
+                    'sig': file_sig,
+                    'sha256': hashfile(file_path) if content_hash else None,
+                }
 
+        return {'version': EVALUATION_FINGERPRINT_VERSION, 'settings': settings, 'files': fingerprint_files}
+
+    def get_changed_inputs(self, fingerprint, previous_fingerprint):
+        '''Returns the list of inputs (file paths, 'settings' or a reason) that changed between two
+        fingerprints. An empty list means the existing results of the test case can be reused.
+        '''
+        if previous_fingerprint is None:
+            return ['no previous evaluation']
+        if not os.path.isfile(os.path.join(self.dir, 'eval_metadata.json')):
+            return ['incomplete previous evaluation']
+        if previous_fingerprint['version'] != fingerprint['version']:
+            return ['evaluation version']
+
+        changed_inputs = []
+        if previous_fingerprint['settings'] != fingerprint['settings']:
+            changed_inputs.append('settings')
+
+        files, previous_files = fingerprint['files'], previous_fingerprint['files']
+        for file_path in sorted(set(files) | set(previous_files)):
+            entry, previous_entry = files.get(file_path), previous_files.get(file_path)
+            if entry is None or previous_entry is None:
+                changed_inputs.append(file_path)
+            elif entry['sig'] != previous_entry['sig'] and (
+                entry['sha256'] is None or entry['sha256'] != previous_entry['sha256']
+            ):
+                changed_inputs.append(file_path)
+
+        return changed_inputs
+
+    def read_fingerprint(self):
+        '''Returns the input fingerprint of the last evaluation run with skip_unchanged (None if missing).'''
+        fingerprint_json = os.path.join(self.dir, 'eval_fingerprint.json')
+        if not os.path.isfile(fingerprint_json):
+            return None
+        try:
+            with open(fingerprint_json) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def write_fingerprint(self, fingerprint):
+        '''Writes the input fingerprint of the test case evaluation.'''
+        with open(os.path.join(self.dir, 'eval_fingerprint.json'), 'w') as f:
+            json.dump(fingerprint, f, indent=2)
+
+    def _get_site_files(self, magnitude, lid):
+        '''Returns the output and benchmark file paths of a magnitude/site of the test case (and creates the
+        magnitude output directory). Returns None if any of the benchmark files does not exist.
+        '''
         test_case_out_dir = os.path.join(self.dir, magnitude)
         inundation_prefix = lid + '_' if lid else ''
         inundation_path = os.path.join(test_case_out_dir, f'{inundation_prefix}inundation_extent.tif')
-        predicted_raster_path = inundation_path.replace('.tif', f'_{self.huc}.tif')
-        agreement_raster = os.path.join(
-            test_case_out_dir, (f'ahps_{lid}' if lid else '') + 'total_area_agreement.tif'
-        )
-        stats_json = os.path.join(test_case_out_dir, 'stats.json')
-        stats_csv = os.path.join(test_case_out_dir, 'stats.csv')
+        site_files = {
+            'magnitude': magnitude,
+            'lid': lid,
+            'inundation_path': inundation_path,
+            'predicted_raster_path': inundation_path.replace('.tif', f'_{self.huc}.tif'),
+            'agreement_raster': os.path.join(
+                test_case_out_dir, (f'ahps_{lid}' if lid else '') + 'total_area_agreement.tif'
+            ),
+            'stats_json': os.path.join(test_case_out_dir, 'stats.json'),
+            'stats_csv': os.path.join(test_case_out_dir, 'stats.csv'),
+        }
 
         # Create directory
         if not os.path.isdir(test_case_out_dir):
             os.mkdir(test_case_out_dir)
 
         # Benchmark raster and flow files
-        benchmark_rast = (
-            f'ahps_{lid}' if lid else self.benchmark_cat
-        ) + f'_huc_{self.huc}_extent_{magnitude}.tif'
-        benchmark_rast = os.path.join(self.benchmark_dir, lid, magnitude, benchmark_rast)
-        benchmark_flows = benchmark_rast.replace(f'_extent_{magnitude}.tif', f'_flows_{magnitude}.csv')
+        benchmark_rast, benchmark_flows, domain = self._get_benchmark_files(magnitude, lid)
         mask_dict_indiv = self.mask_dict.copy()
         if self.is_ahps:  # add domain shapefile to mask for AHPS sites
-            domain = os.path.join(self.benchmark_dir, lid, f'{lid}_domain.shp')
             mask_dict_indiv.update({lid: {'path': domain, 'buffer': None, 'operation': 'include'}})
         # Check to make sure all relevant files exist
         if (
@@ -344,18 +523,96 @@ class Test_Case(Benchmark):
             or not os.path.isfile(benchmark_flows)
             or (self.is_ahps and not os.path.isfile(domain))
         ):
+            return None
+
+        site_files.update(
+            {
+                'benchmark_rast': benchmark_rast,
+                'benchmark_flows': benchmark_flows,
+                'mask_dict': mask_dict_indiv,
+            }
+        )
+        return site_files
+
+    def _compute_site_stats(self, predicted_raster_path, site_files):
+        '''Creates the agreement raster and contingency stats of a magnitude/site from its predicted raster
+        and adds them to the metrics catalog records. In-memory (/vsimem/) predicted rasters are deleted once
+        the stats are computed.
+        '''
+        stats_dictionary = None
+        if predicted_raster_path.startswith('/vsimem/'):
+            try:
+                stats_dictionary = compute_contingency_stats_from_rasters(
+                    predicted_raster_path,
+                    site_files['benchmark_rast'],
+                    site_files['agreement_raster'],
+                    stats_csv=site_files['stats_csv'],
+                    stats_json=site_files['stats_json'],
+                    mask_dict=site_files['mask_dict'],
+                    benchmark_cache_dir=BENCHMARK_CACHE_DIR,
+                )
+            finally:
+                rasterio.shutil.delete(predicted_raster_path)
+        elif os.path.isfile(predicted_raster_path):
+            stats_dictionary = compute_contingency_stats_from_rasters(
+                predicted_raster_path,
+                site_files['benchmark_rast'],
+                site_files['agreement_raster'],
+                stats_csv=site_files['stats_csv'],
+                stats_json=site_files['stats_json'],
+                mask_dict=site_files['mask_dict'],
+                benchmark_cache_dir=BENCHMARK_CACHE_DIR,
+            )
+
+        if stats_dictionary is not None:
+            lid = site_files['lid']
+            self.metrics_records += site_stats_records(
+                stats_dictionary,
+                self.test_id,
+                'official' if self.archive else 'testing',
+                self.version,
+                site_files['magnitude'],
+                os.path.dirname(site_files['stats_json']),
+                nws_lid=lid if lid else 'NA',
+                flow=get_ahps_flow(site_files['benchmark_flows']) if self.is_ahps else 'NA',
+            )
+
+    def _inundate_and_compute(
+        self, magnitude, lid, compute_only=False, model='', verbose=False, gms_workers=1
+    ):
+        '''Method for inundating and computing contingency rasters as part of the alpha_test.
+        Used by both the alpha_test() and composite() methods.
+
+         Parameters
+         ----------
+         magnitude : str
+             Magnitude of the current benchmark site.
+         lid : str
+             lid of the current benchmark site. For non-AHPS sites, this should be an empty string ('').
+         compute_only : bool
+             If true, skips inundation and only computes contingency stats.
+        '''
+        # Output files
+        fh.vprint("Creating output files", verbose)
+
+        site_files = self._get_site_files(magnitude, lid)
+        if site_files is None:
             return -1
+        predicted_raster_path = site_files['predicted_raster_path']
+        benchmark_flows = site_files['benchmark_flows']
 
         # Inundate REM
         if not compute_only:  # composite alpha tests don't need to be inundated
             if model == "GMS":
-                produce_mosaicked_inundation(
+                # The branch extents are mosaicked in memory unless the predicted raster is to be kept
+                predicted_raster_path = produce_mosaicked_inundation(
                     os.path.dirname(self.fim_dir),
                     self.huc,
                     benchmark_flows,
                     inundation_raster=predicted_raster_path,
                     mask=os.path.join(self.fim_dir, "wbd.gpkg"),
                     verbose=verbose,
+                    in_memory=not self.keep_predicted_raster,
                 )
 
             # FIM v3 and before
@@ -373,7 +630,7 @@ class Test_Case(Benchmark):
                     subset_hucs=self.huc,
                     num_workers=1,
                     aggregate=False,
-                    inundation_raster=inundation_path,
+                    inundation_raster=site_files['inundation_path'],
                     inundation_polygon=None,
                     depths=None,
                     out_raster_profile=None,
@@ -385,17 +642,49 @@ class Test_Case(Benchmark):
 
         # Create contingency rasters and stats
         fh.vprint("Begin creating contingency rasters and stats", verbose)
-        if os.path.isfile(predicted_raster_path):
-            compute_contingency_stats_from_rasters(
-                predicted_raster_path,
-                benchmark_rast,
-                agreement_raster,
-                stats_csv=stats_csv,
-                stats_json=stats_json,
-                mask_dict=mask_dict_indiv,
-            )
+        self._compute_site_stats(predicted_raster_path, site_files)
         return
 
+    def _batch_inundate_and_compute(self, validation_data, verbose=False, gms_workers=1):
+        '''Inundates every magnitude/site of a GMS test case in one pass over the branches and computes
+        the contingency rasters and stats of each of them.
+
+         Parameters
+         ----------
+         validation_data : dict
+             Magnitudes and sites of the test case (see Benchmark.data).
+        '''
+        fh.vprint("Creating output files", verbose)
+
+        sites_files = []
+        for magnitude in validation_data:
+            for instance in validation_data[magnitude]:
+                site_files = self._get_site_files(magnitude, instance)
+                if site_files is not None:
+                    sites_files.append(site_files)
+
+        if not sites_files:
+            return
+
+        # The branch extents are mosaicked in memory unless the predicted rasters are to be kept. Each mosaic
+        # is produced as it is needed, so only one in-memory predicted raster exists at a time.
+        fh.vprint(f"Inundating {len(sites_files)} benchmark flow files", verbose)
+        predicted_raster_paths = produce_mosaicked_inundation_batch(
+            os.path.dirname(self.fim_dir),
+            self.huc,
+            [site_files['benchmark_flows'] for site_files in sites_files],
+            [site_files['predicted_raster_path'] for site_files in sites_files],
+            mask=os.path.join(self.fim_dir, "wbd.gpkg"),
+            num_workers=gms_workers,
+            verbose=verbose,
+            in_memory=not self.keep_predicted_raster,
+        )
+
+        # Create contingency rasters and stats
+        fh.vprint("Begin creating contingency rasters and stats", verbose)
+        for predicted_raster_path, site_files in zip(predicted_raster_paths, sites_files):
+            self._compute_site_stats(predicted_raster_path, site_files)
+
     @classmethod
     def run_alpha_test(
         cls,
@@ -412,11 +701,13 @@ class Test_Case(Benchmark):
         overwrite=True,
         verbose=False,
         gms_workers=1,
+        keep_predicted_raster=None,
+        skip_unchanged=False,
     ):
         '''Class method for instantiating the test_case class and running alpha_test directly'''
 
         alpha_class = cls(test_id, version, archive_results)
-        alpha_class.alpha_test(
+        return alpha_class.alpha_test(
             calibrated,
             model,
             mask_type,
@@ -425,6 +716,8 @@ class Test_Case(Benchmark):
             overwrite,
             verbose,
             gms_workers,
+            keep_predicted_raster,
+            skip_unchanged,
         )
 
     def composite(self, version_2, calibrated=False, overwrite=True, verbose=False):
@@ -521,11 +814,18 @@ class Test_Case(Benchmark):
         composite_test_case.write_metadata(calibrated, 'COMP')
 
     def write_metadata(self, calibrated, model):
-        '''Writes metadata files for a test_case directory.'''
+        '''Writes metadata files for a test_case directory and its metrics catalog part.'''
         with open(os.path.join(self.dir, 'eval_metadata.json'), 'w') as meta:
             eval_meta = {'calibrated': calibrated, 'model': model}
             meta.write(json.dumps(eval_meta, indent=2))
 
+        # Test cases that were copied rather than evaluated (see composite) are indexed from their stats files
+        iteration = 'official' if self.archive else 'testing'
+        records = self.metrics_records
+        if not records:
+            records = index_test_case_version(self.dir, self.test_id, iteration, self.version)
+        write_catalog_part(records, get_catalog_part_path(self.test_id, iteration, self.version))
+
     def clean_ahps_outputs(self, magnitude_directory):
         '''Cleans up `total_area` files from an input AHPS magnitude directory.'''
         output_file_list = [os.path.join(magnitude_directory, of) for of in os.listdir(magnitude_directory)]
@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import json
 import os
 import re
 import sys
@@ -12,8 +10,9 @@ from datetime import datetime
 from multiprocessing import Pool
 
 import pandas as pd
+from metrics_catalog import read_master_metrics, refresh_catalog_part
 from run_test_case import Test_Case
-from tools_shared_variables import AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT, PREVIOUS_FIM_DIR, TEST_CASES_DIR
+from tools_shared_variables import PREVIOUS_FIM_DIR, TEST_CASES_DIR
 from tqdm import tqdm
 
 from utils.shared_functions import FIM_Helpers as fh
@@ -28,10 +27,11 @@ def create_master_metrics_csv(
     prev_metrics_csv,
 ):
     """
-    This function searches for and collates metrics into a single CSV file that can queried database-style.
+    This function collates metrics into a single CSV file that can queried database-style.
         The CSV is an input to eval_plots.py.
-        This function automatically looks for metrics produced for official versions and loads them into
-            memory to be written to the output CSV.
+        The metrics are read from the metrics catalog (see metrics_catalog.py), which is written by each
+            alpha test. Test case versions that are not in the catalog yet (or changed since they were
+            cataloged) are indexed from their stats files first.
 
     Args:
         master_metrics_csv_output (str)    : Full path to CSV output.
@@ -43,247 +43,53 @@ def create_master_metrics_csv(
                                                 the CSV output.
     """
 
-    # Construct header
-    metrics_to_write = [
-        'true_negatives_count',
-        'false_negatives_count',
-        'true_positives_count',
-        'false_positives_count',
-        'contingency_tot_count',
-        'cell_area_m2',
-        'TP_area_km2',
-        'FP_area_km2',
-        'TN_area_km2',
-        'FN_area_km2',
-        'contingency_tot_area_km2',
-        'predPositive_area_km2',
-        'predNegative_area_km2',
-        'obsPositive_area_km2',
-        'obsNegative_area_km2',
-        'positiveDiff_area_km2',
-        'CSI',
-        'FAR',
-        'TPR',
-        'TNR',
-        'PND',
-        'PPV',
-        'NPV',
-        'ACC',
-        'Bal_ACC',
-        'MCC',
-        'EQUITABLE_THREAT_SCORE',
-        'PREVALENCE',
-        'BIAS',
-        'F1_SCORE',
-        'TP_perc',
-        'FP_perc',
-        'TN_perc',
-        'FN_perc',
-        'predPositive_perc',
-        'predNegative_perc',
-        'obsPositive_perc',
-        'obsNegative_perc',
-        'positiveDiff_perc',
-        'masked_count',
-        'masked_perc',
-        'masked_area_km2',
-    ]
-
-    # Create table header
-    additional_header_info_prefix = ['version', 'nws_lid', 'magnitude', 'huc']
-    list_to_write = [
-        additional_header_info_prefix
-        + metrics_to_write
-        + ['full_json_path']
-        + ['flow']
-        + ['benchmark_source']
-        + ['extent_config']
-        + ["calibrated"]
-    ]
-
     # add in composite of versions (used for previous FIM3 versions)
     if "official" in iteration_list:
         composite_versions = [v.replace('_ms', '_comp') for v in prev_versions_to_include_list if '_ms' in v]
         prev_versions_to_include_list += composite_versions
 
-    # Iterate through 5 benchmark sources
+    # Find (and refresh if needed) the catalog parts of the test case versions to include
+    catalog_parts = []
     for benchmark_source in ['ble', 'nws', 'usgs', 'ifc', 'ras2fim']:
         benchmark_test_case_dir = os.path.join(TEST_CASES_DIR, benchmark_source + '_test_cases')
         if not os.path.exists(benchmark_test_case_dir):
             continue
 
-        test_cases_list = [d for d in os.listdir(benchmark_test_case_dir) if re.match(r'\d{8}_\w{3,7}', d)]
-
-        if benchmark_source in ['ble', 'ifc', 'ras2fim']:
-            magnitude_list = MAGNITUDE_DICT[benchmark_source]
-
-            # Iterate through available test cases
-            for each_test_case in test_cases_list:
-                try:
-                    # Get HUC id
-                    int(each_test_case.split('_')[0])
-                    huc = each_test_case.split('_')[0]
-
-                    # Update filepaths based on whether the official or dev versions should be included
-                    for iteration in iteration_list:
-                        if (
-                            iteration == "official"
-                        ):  # and str(pfiles) == "True": # "official" refers to previous finalized model versions
-                            versions_to_crawl = os.path.join(
-                                benchmark_test_case_dir, each_test_case, 'official_versions'
-                            )
-                            versions_to_aggregate = prev_versions_to_include_list
-
-                        if (
-                            iteration == "testing"
-                        ):  # "testing" refers to the development model version(s) being evaluated
-                            versions_to_crawl = os.path.join(
-                                benchmark_test_case_dir, each_test_case, 'testing_versions'
-                            )
-                            versions_to_aggregate = dev_versions_to_include_list
-
-                        # Pull version info from filepath
-                        for magnitude in magnitude_list:
-                            for version in versions_to_aggregate:
-                                if '_ms' in version:
-                                    extent_config = 'MS'
-                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
-                                    extent_config = 'FR'
-                                else:
-                                    extent_config = 'COMP'
-                                if "_c" in version and version.split('_c')[1] == "":
-                                    calibrated = "yes"
-                                else:
-                                    calibrated = "no"
-                                version_dir = os.path.join(versions_to_crawl, version)
-                                magnitude_dir = os.path.join(version_dir, magnitude)
-
-                                # Add metrics from file to metrics table ('list_to_write')
-                                if os.path.exists(magnitude_dir):
-                                    magnitude_dir_list = os.listdir(magnitude_dir)
-                                    for f in magnitude_dir_list:
-                                        if '.json' in f:
-                                            flow = 'NA'
-                                            nws_lid = "NA"
-                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
-                                            full_json_path = os.path.join(magnitude_dir, f)
-                                            if os.path.exists(full_json_path):
-                                                stats_dict = json.load(open(full_json_path))
-                                                for metric in metrics_to_write:
-                                                    sub_list_to_append.append(stats_dict[metric])
-                                                sub_list_to_append.append(full_json_path)
-                                                sub_list_to_append.append(flow)
-                                                sub_list_to_append.append(benchmark_source)
-                                                sub_list_to_append.append(extent_config)
-                                                sub_list_to_append.append(calibrated)
-
-                                                list_to_write.append(sub_list_to_append)
-                except ValueError:
-                    pass
-
-        # Iterate through AHPS benchmark data
-        if benchmark_source in AHPS_BENCHMARK_CATEGORIES:
-            test_cases_list = os.listdir(benchmark_test_case_dir)
-
-            for each_test_case in test_cases_list:
-                try:
-                    # Get HUC id
-                    int(each_test_case.split('_')[0])
-                    huc = each_test_case.split('_')[0]
-
-                    # Update filepaths based on whether the official or dev versions should be included
-                    for iteration in iteration_list:
-                        if iteration == "official":  # "official" refers to previous finalized model versions
-                            versions_to_crawl = os.path.join(
-                                benchmark_test_case_dir, each_test_case, 'official_versions'
-                            )
-                            versions_to_aggregate = prev_versions_to_include_list
-
-                        if (
-                            iteration == "testing"
-                        ):  # "testing" refers to the development model version(s) being evaluated
-                            versions_to_crawl = os.path.join(
-                                benchmark_test_case_dir, each_test_case, 'testing_versions'
-                            )
-                            versions_to_aggregate = dev_versions_to_include_list
-
-                        # Pull model info from filepath
-                        for magnitude in ['action', 'minor', 'moderate', 'major']:
-                            for version in versions_to_aggregate:
-                                if '_ms' in version:
-                                    extent_config = 'MS'
-                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
-                                    extent_config = 'FR'
-                                else:
-                                    extent_config = 'COMP'
-                                if "_c" in version and version.split('_c')[1] == "":
-                                    calibrated = "yes"
-                                else:
-                                    calibrated = "no"
-
-                                version_dir = os.path.join(versions_to_crawl, version)
-                                magnitude_dir = os.path.join(version_dir, magnitude)
-
-                                if os.path.exists(magnitude_dir):
-                                    magnitude_dir_list = os.listdir(magnitude_dir)
-                                    for f in magnitude_dir_list:
-                                        if '.json' in f and 'total_area' not in f:
-                                            nws_lid = f[:5]
-                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
-                                            full_json_path = os.path.join(magnitude_dir, f)
-                                            flow = ''
-                                            if os.path.exists(full_json_path):
-                                                # Get flow used to map
-                                                flow_file = os.path.join(
-                                                    benchmark_test_case_dir,
-                                                    'validation_data_' + benchmark_source,
-                                                    huc,
-                                                    nws_lid,
-                                                    magnitude,
-                                                    'ahps_'
-                                                    + nws_lid
-                                                    + '_huc_'
-                                                    + huc
-                                                    + '_flows_'
-                                                    + magnitude
-                                                    + '.csv',
-                                                )
-                                                if os.path.exists(flow_file):
-                                                    with open(flow_file, newline='') as csv_file:
-                                                        reader = csv.reader(csv_file)
-                                                        next(reader)
-                                                        for row in reader:
-                                                            flow = row[1]
-
-                                                # Add metrics from file to metrics table ('list_to_write')
-                                                stats_dict = json.load(open(full_json_path))
-                                                for metric in metrics_to_write:
-                                                    sub_list_to_append.append(stats_dict[metric])
-                                                sub_list_to_append.append(full_json_path)
-                                                sub_list_to_append.append(flow)
-                                                sub_list_to_append.append(benchmark_source)
-                                                sub_list_to_append.append(extent_config)
-                                                sub_list_to_append.append(calibrated)
-                                                list_to_write.append(sub_list_to_append)
-                except ValueError:
-                    pass
+        test_cases_list = [
+            d for d in os.listdir(benchmark_test_case_dir) if re.match(rf'\d{{8}}_{benchmark_source}$', d)
+        ]
+
+        for each_test_case in test_cases_list:
+            for iteration in iteration_list:
+                if iteration == "official":  # "official" refers to previous finalized model versions
+                    versions_to_crawl = os.path.join(
+                        benchmark_test_case_dir, each_test_case, 'official_versions'
+                    )
+                    versions_to_aggregate = prev_versions_to_include_list
+
+                if (
+                    iteration == "testing"
+                ):  # "testing" refers to the development model version(s) being evaluated
+                    versions_to_crawl = os.path.join(
+                        benchmark_test_case_dir, each_test_case, 'testing_versions'
+                    )
+                    versions_to_aggregate = dev_versions_to_include_list
+
+                for version in versions_to_aggregate:
+                    version_dir = os.path.join(versions_to_crawl, version)
+                    if os.path.isdir(version_dir):
+                        catalog_parts.append(
+                            refresh_catalog_part(version_dir, each_test_case, iteration, version)
+                        )
+
+    df_to_write = read_master_metrics(catalog_parts)
 
     # If previous metrics are provided: read in previously compiled metrics and join to calcaulated metrics
     if prev_metrics_csv is not None:
         prev_metrics_df = pd.read_csv(prev_metrics_csv)
 
-        # Put calculated metrics into a dataframe and set the headers
-        df_to_write_calc = pd.DataFrame(list_to_write)
-        df_to_write_calc.columns = df_to_write_calc.iloc[0]
-        df_to_write_calc = df_to_write_calc[1:]
-
         # Join the calculated metrics and the previous metrics dataframe
-        df_to_write = pd.concat([df_to_write_calc, prev_metrics_df], axis=0)
-
-    else:
-        df_to_write = pd.DataFrame(list_to_write)
-        df_to_write.columns = df_to_write.iloc[0]
-        df_to_write = df_to_write[1:]
+        df_to_write = pd.concat([df_to_write, prev_metrics_df], axis=0)
 
     # Save aggregated compiled metrics ('df_to_write') as a CSV
     # create the path if it does not already exist
@@ -293,15 +99,78 @@ def create_master_metrics_csv(
     df_to_write.to_csv(master_metrics_csv_output, index=False)
 
 
+def run_huc_alpha_tests(huc_test_cases, alpha_test_args):
+    """
+    Runs the alpha tests of all test cases (benchmark categories) of a HUC one after the other in the same
+    worker process, so that the state the worker keeps for the HUC (mask layer reads and the benchmark rasters
+    aligned to the HUC grid) is reused by all of its magnitudes, sites and benchmark categories.
+
+    Returns the list of evaluation summaries of the test cases. A failing test case is reported and does not
+    stop the other test cases of the HUC, but a keyboard interrupt stops the HUC.
+    """
+    eval_summaries = []
+    for test_case_class in huc_test_cases:
+        try:
+            eval_summaries.append(test_case_class.alpha_test(**alpha_test_args))
+        except SystemExit as ex:
+            # alpha_test exits on errors, and on keyboard interrupts which must still stop the run
+            if isinstance(ex.__context__, KeyboardInterrupt):
+                raise
+            print(f"{test_case_class.test_id}, {ex.__class__.__name__}, {ex}")
+        except Exception as ex:
+            print(f"{test_case_class.test_id}, {ex.__class__.__name__}, {ex}")
+
+    return eval_summaries
+
+
+def group_test_cases_by_huc(test_cases):
+    """Returns the test cases (with an existing FIM directory) grouped by HUC: {huc: [test cases]}."""
+    huc_test_cases = {}
+    for test_case_class in test_cases:
+        if os.path.exists(test_case_class.fim_dir):
+            huc_test_cases.setdefault(test_case_class.huc, []).append(test_case_class)
+    return huc_test_cases
+
+
 def progress_bar_handler(executor_dict, verbose, desc):
+    results = []
     for future in tqdm(
         as_completed(executor_dict), total=len(executor_dict), disable=(not verbose), desc=desc
     ):
         try:
-            future.result()
+            results.append(future.result())
         except Exception as exc:
             print('{}, {}, {}'.format(executor_dict[future], exc.__class__.__name__, exc))
 
+    return results
+
+
+def write_evaluation_summary(eval_summaries, evaluation_summary_csv):
+    """
+    Writes the evaluation summary of the alpha tests (which test cases were recomputed, reused or skipped
+    and, when re-evaluated with --skip-unchanged, which inputs changed) and prints the status counts.
+    """
+    summary_df = pd.DataFrame(
+        [summary for summary in eval_summaries if summary is not None],
+        columns=['test_id', 'version', 'status', 'changed_inputs'],
+    )
+    if summary_df.empty:
+        return
+
+    summary_df = summary_df.sort_values(['version', 'test_id'])
+    os.makedirs(os.path.dirname(evaluation_summary_csv), exist_ok=True)
+    summary_df.to_csv(evaluation_summary_csv, index=False)
+
+    status_counts = summary_df['status'].value_counts()
+    print(
+        "Test cases recomputed: {}, reused (unchanged inputs): {}, skipped: {}".format(
+            status_counts.get('recomputed', 0),
+            status_counts.get('reused', 0),
+            status_counts.get('skipped', 0),
+        )
+    )
+    print(f"Evaluation summary saved at {evaluation_summary_csv}")
+
 
 if __name__ == '__main__':
     # Sample usage:
@@ -358,7 +227,13 @@ if __name__ == '__main__':
     '''
 
     # Parse arguments.
-    parser = argparse.ArgumentParser(description='Caches metrics from previous versions of HAND.')
+    parser = argparse.ArgumentParser(
+        description='Caches metrics from previous versions of HAND.',
+        epilog='Benchmark rasters and masks aligned to the HUC grids are cached in the benchmark_cache_dir '
+        'environment variable folder (default /data/test_cases/benchmark_cache), which is kept under '
+        'benchmark_cache_max_gb (default 50) GB by removing its least recently used files. The folder can be '
+        'deleted at any time to purge the cache; it is rebuilt by later evaluations.',
+    )
     parser.add_argument(
         '-c',
         '--config',
@@ -484,6 +359,27 @@ if __name__ == '__main__':
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        '-kp',
+        '--keep-predicted-rasters',
+        help='Optional: Write the mosaicked predicted inundation raster of every magnitude/site to the test '
+        'case directories (useful for debugging). By default these are only kept for PREV (archived) runs, '
+        'DEV runs evaluate them in memory.',
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        '-su',
+        '--skip-unchanged',
+        help='Optional: Only re-evaluate test cases whose inputs (hydrofabric, benchmark, flow and mask files) '
+        'or settings changed since their last evaluation run with this flag. Test cases with unchanged inputs '
+        'keep their existing metrics. A summary of the recomputed test cases is written next to the master '
+        'metrics CSV.',
+        required=False,
+        default=False,
+        action="store_true",
+    )
 
     # Assign variables from arguments.
     args = vars(parser.parse_args())
@@ -504,6 +400,8 @@ if __name__ == '__main__':
     prev_metrics_csv = args['previous_metrics_csv']
     pfiles = bool(args['cycle_previous_files'])
     master_metrics_only = bool(args['master_metrics_only'])
+    keep_predicted_rasters = True if args['keep_predicted_rasters'] else None
+    skip_unchanged = bool(args['skip_unchanged'])
 
     print("================================")
     print("Start synthesize test cases")
@@ -599,38 +497,43 @@ if __name__ == '__main__':
 
     # =================================
     # Set up multiprocessor
+    eval_summaries = []
     if not master_metrics_only:
+        alpha_test_args = {
+            'calibrated': calibrated,
+            'model': model,
+            'mask_type': 'huc',
+            'overwrite': overwrite,
+            'verbose': gms_verbose if model == 'GMS' else verbose,
+            'gms_workers': job_number_branch,
+            'keep_predicted_raster': keep_predicted_rasters,
+            'skip_unchanged': skip_unchanged,
+        }
+
+        # The test cases are sharded by HUC so that each worker evaluates all of the test cases of a HUC
+        huc_test_cases = group_test_cases_by_huc(all_test_cases)
         with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
-            # Loop through all test cases, build the alpha test arguments, and submit them to the process pool
+            # Loop through all HUCs and submit their test cases to the process pool
             executor_dict = {}
 
-            for test_case_class in all_test_cases:
-                if not os.path.exists(test_case_class.fim_dir):
-                    continue
-
-                fh.vprint(f"test_case_class.test_id is {test_case_class.test_id}", verbose)
-
-                alpha_test_args = {
-                    'calibrated': calibrated,
-                    'model': model,
-                    'mask_type': 'huc',
-                    'overwrite': overwrite,
-                    'verbose': gms_verbose if model == 'GMS' else verbose,
-                    'gms_workers': job_number_branch,
-                }
+            for huc, test_cases in huc_test_cases.items():
+                fh.vprint(f"test cases of {huc} are {[tc.test_id for tc in test_cases]}", verbose)
 
                 try:
-                    future = executor.submit(test_case_class.alpha_test, **alpha_test_args)
-                    executor_dict[future] = test_case_class.test_id
+                    future = executor.submit(run_huc_alpha_tests, test_cases, alpha_test_args)
+                    executor_dict[future] = huc
                 except Exception as ex:
                     print(f"*** {ex}")
                     traceback.print_exc()
                     sys.exit(1)
 
             # Send the executor to the progress bar and wait for all MS tasks to finish
-            progress_bar_handler(
-                executor_dict, True, f"Running {model} alpha test cases with {job_number_huc} workers"
-            )
+            for huc_summaries in progress_bar_handler(
+                executor_dict,
+                True,
+                f"Running {model} alpha test cases of {len(huc_test_cases)} HUCs with {job_number_huc} workers",
+            ):
+                eval_summaries += huc_summaries
             # wait(executor_dict.keys())
 
     # Composite alpha test run is initiated by a MS `model` and providing a `fr_run_dir`
@@ -644,30 +547,32 @@ if __name__ == '__main__':
                 benchmark_categories=[] if benchmark_category == "all" else [benchmark_category],
             )
 
+            alpha_test_args = {
+                'calibrated': calibrated,
+                'model': model,
+                'mask_type': 'huc',
+                'verbose': verbose,
+                'overwrite': overwrite,
+                'skip_unchanged': skip_unchanged,
+            }
+
+            huc_test_cases = group_test_cases_by_huc(all_test_cases)
             with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
                 executor_dict = {}
-                for test_case_class in all_test_cases:
-                    if not os.path.exists(test_case_class.fim_dir):
-                        continue
-                    alpha_test_args = {
-                        'calibrated': calibrated,
-                        'model': model,
-                        'mask_type': 'huc',
-                        'verbose': verbose,
-                        'overwrite': overwrite,
-                    }
+                for huc, test_cases in huc_test_cases.items():
                     try:
-                        future = executor.submit(test_case_class.alpha_test, **alpha_test_args)
-                        executor_dict[future] = test_case_class.test_id
+                        future = executor.submit(run_huc_alpha_tests, test_cases, alpha_test_args)
+                        executor_dict[future] = huc
                     except Exception as ex:
                         print(f"*** {ex}")
                         traceback.print_exc()
                         sys.exit(1)
 
                 # Send the executor to the progress bar and wait for all FR tasks to finish
-                progress_bar_handler(
+                for huc_summaries in progress_bar_handler(
                     executor_dict, True, f"Running FR test cases with {job_number_huc} workers"
-                )
+                ):
+                    eval_summaries += huc_summaries
                 # wait(executor_dict.keys())
 
             # Loop through FR test cases, build composite arguments, and
@@ -696,6 +601,11 @@ if __name__ == '__main__':
                     executor_dict, verbose, f"Compositing test cases with {job_number_huc} workers"
                 )
 
+    if eval_summaries:
+        write_evaluation_summary(
+            eval_summaries, os.path.splitext(master_metrics_csv)[0] + '_evaluation_summary.csv'
+        )
+
     ## if using DEV version, include the testing versions the user included with the "-dc" flag
     if dev_versions_to_compare is not None:
         dev_versions_to_include_list += dev_versions_to_compare
@@ -6,13 +6,18 @@ import shutil
 import sys
 import traceback
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime, timezone
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from pixel_counter import zonal_stats
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
 from run_test_case import Test_Case
-from shapely.validation import make_valid
+from shapely.geometry import box
 from tools_shared_functions import compute_stats_from_contingency_table
 from tqdm import tqdm
 
@@ -25,26 +30,98 @@ gpd.options.io_engine = "pyogrio"
 
 # global RLOG
 FLOG = fl.FIM_logger()  # the non mp version
+MP_LOG = fl.FIM_logger()  # the mp version
 
 """
 This module uses zonal stats to subdivide alpha metrics by each HAND catchment.
-The output is a vector geopackage and is also known as the "FIM Performance" layer
-when loaded into HydroVIS. At the time of this commit, it takes approximately
-20 to 32 hours to complete.
+The output is a vector geopackage (also written as GeoParquet and CSV) and is also known as the
+"FIM Performance" layer when loaded into HydroVIS. Test cases are processed in parallel (one huc /
+benchmark per process) and the pixel counts of all catchments are computed in one pass over each
+agreement raster.
 
 """
 
 
 #####################################################
-# Perform zonal stats is a funtion stored in pixel_counter.py.
-# The input huc_gpkg is a single huc8 geopackage, the second input argument must be input as a dict.
+# Computes the agreement pixel counts of each catchment (HydroID) of a huc8.
+# The agreement raster is read in strips of rows, and the HydroID zones of each strip are read from the
+#   branch 0 catchment raster (whose values are the HydroIDs) when it is on the agreement raster grid, or
+#   rasterized from the crosswalked catchments otherwise. The counts of all catchments are then accumulated
+#   with a single np.bincount over (HydroID, agreement) codes.
 # For the purposes of assembling the alpha metrics by hydroid, always use agreement_raster total
 #   area agreement tiff.
-# This function is called automatically. Returns stats dict of pixel counts.
+# Returns a list of pixel count dicts (HydroID, tn, fn, fp, tp, mp), one per catchment.
 #####################################################
-def perform_zonal_stats(huc_gpkg, agree_rast):
-    stats = zonal_stats(huc_gpkg, {"agreement_raster": agree_rast}, nodata_value=10)
-    return stats
+def perform_zonal_stats(catchment_geom, agree_rast, catchment_raster=None, block_rows=2048):
+    hydro_ids = np.sort(pd.unique(catchment_geom['HydroID'])).astype(np.int64)
+    # Agreement values 0: TN, 1: FN, 2: FP, 3: TP, 4: masked (10: nodata is not counted)
+    counts = np.zeros(len(hydro_ids) * 5, dtype=np.int64)
+
+    with rasterio.open(agree_rast) as agree_src, ExitStack() as stack:
+        catchment_offsets = None
+        if catchment_raster is not None and os.path.exists(catchment_raster):
+            catchment_src = stack.enter_context(rasterio.open(catchment_raster))
+            catchment_offsets = __get_aligned_offsets(catchment_src, agree_src)
+        if catchment_offsets is None:
+            catchment_geom = catchment_geom.to_crs(agree_src.crs)
+
+        for row_off in range(0, agree_src.height, block_rows):
+            window = Window(0, row_off, agree_src.width, min(block_rows, agree_src.height - row_off))
+
+            if catchment_offsets is not None:
+                zones = catchment_src.read(
+                    1,
+                    window=Window(
+                        catchment_offsets[0], catchment_offsets[1] + row_off, window.width, window.height
+                    ),
+                    boundless=True,
+                    fill_value=0,
+                )
+            else:
+                window_bounds = rasterio.windows.bounds(window, agree_src.transform)
+                block_geom = catchment_geom.iloc[catchment_geom.sindex.query(box(*window_bounds))]
+                if block_geom.empty:
+                    continue
+                zones = rasterize(
+                    zip(block_geom.geometry, block_geom['HydroID']),
+                    out_shape=(window.height, window.width),
+                    transform=agree_src.window_transform(window),
+                    fill=0,
+                    dtype='int32',
+                )
+
+            agreement = agree_src.read(1, window=window)
+            is_counted = (zones != 0) & (agreement >= 0) & (agreement <= 4)
+            zones, agreement = zones[is_counted].astype(np.int64), agreement[is_counted].astype(np.int64)
+
+            # Zones that are not crosswalked catchments are dropped
+            zone_idx = np.minimum(np.searchsorted(hydro_ids, zones), len(hydro_ids) - 1)
+            is_catchment = hydro_ids[zone_idx] == zones
+            counts += np.bincount(
+                zone_idx[is_catchment] * 5 + agreement[is_catchment], minlength=len(hydro_ids) * 5
+            )
+
+    counts = counts.reshape(-1, 5)
+    return [
+        {'HydroID': int(hydro_id), 'tn': int(tn), 'fn': int(fn), 'fp': int(fp), 'tp': int(tp), 'mp': int(mp)}
+        for hydro_id, (tn, fn, fp, tp, mp) in zip(hydro_ids, counts)
+    ]
+
+
+#####################################################
+# Returns the (column, row) offsets of the agreement raster grid in the catchment raster grid,
+#   or None if the two rasters are not on the same pixel grid.
+#####################################################
+def __get_aligned_offsets(catchment_src, agree_src):
+    if catchment_src.crs != agree_src.crs or not np.allclose(catchment_src.res, agree_src.res):
+        return None
+
+    col_off = (agree_src.transform.c - catchment_src.transform.c) / catchment_src.res[0]
+    row_off = (catchment_src.transform.f - agree_src.transform.f) / catchment_src.res[1]
+    if abs(col_off - round(col_off)) > 1e-6 or abs(row_off - round(row_off)) > 1e-6:
+        return None
+
+    return int(round(col_off)), int(round(row_off))
 
 
 #####################################################
@@ -78,8 +155,9 @@ def assemble_hydro_alpha_for_single_huc(stats, huc8, mag, bench):
         ]
     )
 
-    FLOG.trace(f"Assemble hydro for huc is {huc8} for {mag} and  {bench}")
+    MP_LOG.trace(f"Assemble hydro for huc is {huc8} for {mag} and  {bench}")
 
+    hydro_dfs = []
     for dicts in stats:
         tot_pop = dicts['tn'] + dicts['fn'] + dicts['fp'] + dicts['tp']
         if tot_pop == 0:
@@ -194,13 +272,80 @@ def assemble_hydro_alpha_for_single_huc(stats, huc8, mag, bench):
             ],
         )
 
-        concat_list = [in_mem_df, dict_to_df]
-        in_mem_df = pd.concat(concat_list, sort=False)
+        hydro_dfs.append(dict_to_df)
+
+    if hydro_dfs:
+        in_mem_df = pd.concat([in_mem_df] + hydro_dfs, sort=False)
 
     return in_mem_df
 
 
-def catchment_zonal_stats(benchmark_category, version, output_file_name):
+#####################################################
+# Computes the alpha stats by hydroid of all agreement rasters of a single test case.
+# This function is run in a process pool by catchment_zonal_stats (one test case per process).
+# Returns the test case geometry output (in VIZ_PROJECTION), or None if the FIM version
+#   does not have the huc.
+#####################################################
+def test_case_zonal_stats(test_case_class, version, parent_log_file, child_log_file_prefix):
+    MP_LOG.MP_Log_setup(parent_log_file, child_log_file_prefix)
+
+    if not os.path.exists(test_case_class.fim_dir):
+        MP_LOG.warning(f'{test_case_class.fim_dir} does not exist')
+        return None
+
+    MP_LOG.lprint(f"Processing {test_case_class.test_id}")
+    test_case_processing_start = datetime.now(timezone.utc)
+
+    agreement_dict = test_case_class.get_current_agreements()
+
+    # We are only using branch 0 catchments to define boundaries for zonal stats
+    branch_zero_dir = os.path.join(test_case_class.fim_dir, 'branches', '0')
+    catchment_gpkg = os.path.join(
+        branch_zero_dir, "gw_catchments_reaches_filtered_addedAttributes_crosswalked_0.gpkg"
+    )
+    # The catchment raster holds the HydroIDs of the same catchments (used as zones when it is on the
+    #   agreement raster grid)
+    catchment_raster = os.path.join(branch_zero_dir, "gw_catchments_reaches_filtered_addedAttributes_0.tif")
+
+    catchment_geom = gpd.read_file(catchment_gpkg)
+    catchment_geom['geometry'] = catchment_geom.make_valid()
+    hydro_geom_df = catchment_geom[["HydroID", "geometry"]]
+
+    test_case_output = None
+    for agree_rast in agreement_dict:
+
+        define_mag = agree_rast.split(version)
+        define_mag_1 = define_mag[1].split('/')
+        mag = define_mag_1[1]
+
+        MP_LOG.trace(f"Processing {test_case_class.test_id}: {mag}")
+        MP_LOG.trace(define_mag[1])
+        MP_LOG.trace(f"catchment_gpkg : {catchment_gpkg} - agree_rast is {agree_rast}")
+        stats = perform_zonal_stats(hydro_geom_df, agree_rast, catchment_raster)
+        if stats == []:
+            MP_LOG.lprint(f"{test_case_class.test_id}: No zonal stats for {mag}")
+            continue
+
+        in_mem_df = assemble_hydro_alpha_for_single_huc(
+            stats, test_case_class.huc, mag, test_case_class.benchmark_cat
+        )
+
+        MP_LOG.trace(f"merging geom output: {test_case_class.test_id}: magnitude = {mag}")
+
+        geom_output = hydro_geom_df.merge(in_mem_df, on='HydroID', how='inner').to_crs(VIZ_PROJECTION)
+
+        test_case_output = pd.concat([geom_output, test_case_output], sort=False)
+
+    MP_LOG.lprint(f"Processing complete for {test_case_class.test_id}")
+    # calculate duration per test case
+    test_case_processing_end = datetime.now(timezone.utc)
+    time_duration = test_case_processing_end - test_case_processing_start
+    MP_LOG.lprint(f".. Duration: {str(time_duration).split('.')[0]}")
+
+    return test_case_output
+
+
+def catchment_zonal_stats(benchmark_category, version, output_file_name, job_number=1):
     # Execution code
     csv_output = gpd.GeoDataFrame(
         columns=[
@@ -236,72 +381,42 @@ def catchment_zonal_stats(benchmark_category, version, output_file_name):
 
     num_test_cases = len(all_test_cases)
     FLOG.lprint("")
-    FLOG.lprint(f'Processing {num_test_cases} test cases...')
+    FLOG.lprint(f'Processing {num_test_cases} test cases with {job_number} jobs...')
 
     missing_hucs = []
+    test_case_outputs = [None] * num_test_cases
+
+    # Each test case (huc / benchmark) is processed in its own process
+    child_log_file_prefix = FLOG.MP_calc_prefix_name(FLOG.LOG_FILE_PATH, "MP_test_case")
+    with ProcessPoolExecutor(max_workers=job_number) as executor:
+        executor_dict = {
+            executor.submit(
+                test_case_zonal_stats, test_case_class, version, FLOG.LOG_FILE_PATH, child_log_file_prefix
+            ): i
+            for i, test_case_class in enumerate(all_test_cases)
+        }
 
-    # easier to filter by one huc for debugging purposes
-    # debug_test_hucs = ["12090301", "07100007", "19020302"]
-    # tqdm will likely not work with all of the printd
-    for test_case_class in tqdm(all_test_cases, desc=f'Running {len(all_test_cases)} test cases'):
-        if not os.path.exists(test_case_class.fim_dir):
-            FLOG.warning(f'{test_case_class.fim_dir} does not exist')
-            missing_hucs.append(test_case_class.huc)
-            continue
-
-        # DEBUGGING CODE
-        # huc = test_case_class.huc
-        # if huc not in  debug_test_hucs:
-        #     print(f"skipped {huc}")
-        #     continue
-
-        FLOG.lprint(f"Processing {test_case_class.test_id}")
-        test_case_processing_start = datetime.now(timezone.utc)
-
-        agreement_dict = test_case_class.get_current_agreements()
-
-        # We are only using branch 0 catchments to define boundaries for zonal stats
-        catchment_gpkg = os.path.join(
-            test_case_class.fim_dir,
-            'branches',
-            '0',
-            "gw_catchments_reaches_filtered_addedAttributes_crosswalked_0.gpkg",
-        )
-
-        catchment_geom = gpd.read_file(catchment_gpkg)
-        catchment_geom['geometry'] = catchment_geom.apply(lambda row: make_valid(row.geometry), axis=1)
-
-        for agree_rast in agreement_dict:
-
-            define_mag = agree_rast.split(version)
-            define_mag_1 = define_mag[1].split('/')
-            mag = define_mag_1[1]
-
-            FLOG.trace(f"Processing {test_case_class.test_id}: {mag}")
-            FLOG.trace(define_mag[1])
-            FLOG.trace(f"catchment_gpkg : {catchment_gpkg} - agree_rast is {agree_rast}")
-            stats = perform_zonal_stats(catchment_gpkg, agree_rast)
-            if stats == []:
-                FLOG.lprint(f"{test_case_class.test_id}: No zonal stats for {mag}")
+        for future in tqdm(
+            as_completed(executor_dict), total=num_test_cases, desc=f'Running {num_test_cases} test cases'
+        ):
+            i = executor_dict[future]
+            test_case_class = all_test_cases[i]
+            try:
+                test_case_outputs[i] = future.result()
+            except Exception:
+                FLOG.error(f"Processing failed for {test_case_class.test_id}")
+                FLOG.error(traceback.format_exc())
                 continue
 
-            hydro_geom_df = catchment_geom[["HydroID", "geometry"]]
-
-            in_mem_df = assemble_hydro_alpha_for_single_huc(
-                stats, test_case_class.huc, mag, test_case_class.benchmark_cat
-            )
-
-            FLOG.trace(f"merging geom output: {test_case_class.test_id}: magnitude = {mag}")
+            if not os.path.exists(test_case_class.fim_dir):
+                missing_hucs.append(test_case_class.huc)
 
-            geom_output = hydro_geom_df.merge(in_mem_df, on='HydroID', how='inner').to_crs(VIZ_PROJECTION)
+    FLOG.merge_log_files(FLOG.LOG_FILE_PATH, child_log_file_prefix)
 
-            csv_output = pd.concat([geom_output, csv_output], sort=False)
-
-        FLOG.lprint(f"Processing complete for {test_case_class.test_id}")
-        # calculate duration per test case
-        test_case_processing_end = datetime.now(timezone.utc)
-        time_duration = test_case_processing_end - test_case_processing_start
-        FLOG.lprint(f".. Duration: {str(time_duration).split('.')[0]}")
+    # Test cases are stacked in reverse order (latest first)
+    csv_output = pd.concat(
+        [output for output in reversed(test_case_outputs) if output is not None] + [csv_output], sort=False
+    )
 
     if missing_hucs:
         FLOG.warning(f"There were {len(missing_hucs)} HUCs missing from the input FIM version")
@@ -323,6 +438,10 @@ def catchment_zonal_stats(benchmark_category, version, output_file_name):
     FLOG.lprint(f'Writing geopackage {output_file_name}')
     csv_output.to_file(output_file_name, index=False, driver="GPKG", engine='fiona')
 
+    parquet_path = output_file_name.replace(".gpkg", ".parquet")
+    FLOG.lprint(f'Writing GeoParquet {parquet_path}')
+    csv_output.to_parquet(parquet_path, index=False)
+
     FLOG.lprint('Writing to CSV')
     csv_path = output_file_name.replace(".gpkg", ".csv")
     csv_output.to_csv(csv_path, index=False)  # Save to CSV
@@ -335,7 +454,8 @@ if __name__ == "__main__":
     python /foss_fim/tools/test_case_by_hydro_id.py \
         -b all \
         -v fim_4_5_11_1 \
-        -g /outputs/fim_performance/hand_4_5_11_1/fim_performance_catchments.gpkg
+        -g /outputs/fim_performance/hand_4_5_11_1/fim_performance_catchments.gpkg \
+        -j 8
     """
 
     parser = argparse.ArgumentParser(description='Produces alpha metrics by hydro id.')
@@ -357,15 +477,24 @@ if __name__ == "__main__":
         '--gpkg',
         help='Filepath and filename to hold exported gpkg file.'
         ' eg. /data/fim_performance/hand_4_5_11_1/fim_performance_catchments.gpkg.'
-        ' A CSV with the same name will also be written.',
+        ' A CSV and a GeoParquet file with the same name will also be written.',
         required=True,
     )
+    parser.add_argument(
+        '-j',
+        '--job_number',
+        help='OPTIONAL: Number of test cases (huc / benchmark) to process in parallel. Default is 1.',
+        required=False,
+        default=1,
+        type=int,
+    )
 
     # Assign variables from arguments.
     args = vars(parser.parse_args())
     benchmark_category = args['benchmark_category']
     version = args['version']
     gpkg_file = args['gpkg']
+    job_number = args['job_number']
 
     # TODO: Oct 2024: This logic below should be moved into a function
     # leaving nothing here but just loading args and passing them to the function
@@ -416,7 +545,7 @@ if __name__ == "__main__":
     print(f"log file being created as {FLOG.LOG_FILE_PATH}")
 
     try:
-        catchment_zonal_stats(benchmark_category, version, output_file_name)
+        catchment_zonal_stats(benchmark_category, version, output_file_name, job_number)
     except Exception:
         # FLOG.critical generally means stop the program
         # FLOG.error means major problem but execution continues (sometimes in MP)
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
 import datetime as dt
+import functools
+import hashlib
 import json
 import logging
 import os
 import pathlib
 import traceback
+from collections import OrderedDict
+from contextlib import ExitStack
 from pathlib import Path
 
 import geopandas as gpd
@@ -14,20 +18,19 @@ import pandas as pd
 import rasterio
 import rasterio.crs
 import rasterio.shutil
-import requests
+import rasterio.windows
 import rioxarray as rxr
-import urllib3
 import xarray as xr
+from datum_client import get_datum_client, get_transformer
 from dotenv import load_dotenv
 from geocube.api.core import make_geocube
 from gval import CatStats
 from rasterio import features
 from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import Resampling, calculate_default_transform, reproject
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from shapely.geometry import MultiPolygon, Polygon, shape
-from urllib3.util.retry import Retry
+from shapely.geometry import MultiPolygon, Polygon, box, shape
+from wrds_client import get_wrds_client
 
 
 gpd.options.io_engine = "pyogrio"
@@ -82,7 +85,14 @@ def filter_nwm_segments_by_stream_order(unfiltered_segments, desired_order, nwm_
     return filtered_segments
 
 
-def mask_out_lakes(input_array, huc, raster_src):
+@functools.lru_cache(maxsize=4)
+def _read_preclip_lakes(huc):
+    # Read in waterbodies geopackage (kept per process, CatFIM masks the lakes of a HUC for every stage/flow)
+    preclip_lakes_path = f'/data/inputs/pre_clip_huc8/20241002/{huc}/nwm_lakes_proj_subset.gpkg'  # TODO: Update to get path from variables
+    return gpd.read_file(preclip_lakes_path)
+
+
+def mask_out_lakes(input_array, huc, raster_src, window=None):
     '''
     This function is used in CatFIM to mask out lakes from inundated tifs.
 
@@ -91,23 +101,26 @@ def mask_out_lakes(input_array, huc, raster_src):
     input_array: inundation TIF that needs lakes removed (called summed_array for stage-based)
     huc: HUC8 id (string), needed to get the correct lakes file
     raster_src: src from a raster that should be uses for getting the correct raster dimensions
+    window: (optional) rasterio Window of raster_src covered by input_array (defaults to the full raster)
 
     Outputs:
 
-    masked_array: same array as before, but with lakes masked out and the dimensions of raster_src
+    masked_array: same array as before, but with lakes masked out and the dimensions of raster_src (or window)
 
     '''
 
-    # Read in waterbodies geopackage
-    preclip_lakes_path = f'/data/inputs/pre_clip_huc8/20241002/{huc}/nwm_lakes_proj_subset.gpkg'  # TODO: Update to get path from variables
-    preclip_lakes_gdf = gpd.read_file(preclip_lakes_path)
+    preclip_lakes_gdf = _read_preclip_lakes(huc)
+
+    if window is None:
+        transform = raster_src.transform
+        out_shape = (raster_src.height, raster_src.width)
+    else:
+        transform = rasterio.windows.transform(window, raster_src.transform)
+        out_shape = (int(window.height), int(window.width))
 
     # Create a binary raster using the shapefile geometry
     lake_mask = geometry_mask(
-        preclip_lakes_gdf.geometry,
-        transform=raster_src.transform,
-        invert=False,
-        out_shape=(raster_src.height, raster_src.width),
+        preclip_lakes_gdf.geometry, transform=transform, invert=False, out_shape=out_shape
     )
 
     # Set values within the lake geometry to zero, masking them out of the FIM
@@ -140,6 +153,7 @@ def compute_contingency_stats_from_rasters(
     stats_csv: str = None,
     stats_json: str = None,
     mask_dict: dict = {},
+    benchmark_cache_dir: str = None,
 ):
     """
     This function contains FIM-specific logic to prepare raster datasets for use in the generic
@@ -162,6 +176,8 @@ def compute_contingency_stats_from_rasters(
         in other processes.
     mask_dict: dict
         Dictionary with inclusionary and/or exclusionary masks asn options.
+    benchmark_cache_dir: str, optional
+        Directory of the aligned benchmark and mask label cache (see get_stats_table_from_binary_rasters()).
 
     Returns
     -------
@@ -175,7 +191,11 @@ def compute_contingency_stats_from_rasters(
 
     # Get statistics table from two rasters.
     stats_dictionary = get_stats_table_from_binary_rasters(
-        benchmark_raster_path, predicted_raster_path, agreement_raster, mask_dict=mask_dict
+        benchmark_raster_path,
+        predicted_raster_path,
+        agreement_raster,
+        mask_dict=mask_dict,
+        benchmark_cache_dir=benchmark_cache_dir,
     )
 
     for stats_mode in stats_dictionary:
@@ -393,8 +413,270 @@ def cross_walk_gval_fim(metric_df: pd.DataFrame, cell_area: int, masked_count: i
     return {x: y for x, y in zip(metric_df.columns, metric_df.values[0])}
 
 
+# Number of mask layer reads kept in memory by each process (see _read_mask_geometries)
+MASK_CACHE_SIZE = 16
+_mask_geometries_cache = OrderedDict()
+
+
+def _read_mask_geometries(poly_path: str, buffer_val: float, bounds: tuple, crs) -> list:
+    """
+    Reads the polygons of a mask layer within bounds, projects them to crs and buffers them (if buffer_val != 0).
+    Returns an empty list if no features are present within bounds.
+
+    The reads are cached by each process (keyed by the mask file signature, bounds, crs and buffer) so that a
+    worker evaluating the magnitudes, sites and benchmark categories of the same HUC reads each mask layer once.
+    """
+
+    file_stat = os.stat(poly_path)
+    cache_key = (
+        os.path.abspath(poly_path),
+        file_stat.st_size,
+        file_stat.st_mtime_ns,
+        buffer_val,
+        tuple(bounds),
+        crs.to_wkt(),
+    )
+    if cache_key in _mask_geometries_cache:
+        _mask_geometries_cache.move_to_end(cache_key)
+        return list(_mask_geometries_cache[cache_key])
+
+    poly_all = gpd.read_file(poly_path, bbox=tuple(bounds))
+    if poly_all.empty:
+        mask_geoms = []
+    else:
+        poly_all_proj = poly_all.to_crs(crs)
+        poly_all_proj = poly_all_proj.buffer(buffer_val) if buffer_val != 0 else poly_all_proj.geometry
+        mask_geoms = list(poly_all_proj)
+
+    _mask_geometries_cache[cache_key] = mask_geoms
+    if len(_mask_geometries_cache) > MASK_CACHE_SIZE:
+        _mask_geometries_cache.popitem(last=False)
+
+    return list(mask_geoms)
+
+
+def _mask_data_window(keep_mask: np.ndarray, row_off: int = 0, col_off: int = 0):
+    """
+    Returns the (row_start, row_stop, col_start, col_stop) bounding box of the True cells of keep_mask
+    (offset by row_off/col_off) or None if there are no True cells. This is the window that rio.clip() crops to.
+    """
+
+    rows = np.flatnonzero(keep_mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(keep_mask.any(axis=0))
+    return (row_off + rows[0], row_off + rows[-1] + 1, col_off + cols[0], col_off + cols[-1] + 1)
+
+
+# Increment when the preparation of the cached benchmark/mask rasters changes so that they are prepared again
+BENCHMARK_CACHE_VERSION = 1
+
+# Size cap of the benchmark cache (least recently used files are removed once it is exceeded)
+BENCHMARK_CACHE_MAX_GB = float(os.getenv('benchmark_cache_max_gb', 50))
+
+
+def _rasterize_mask_labels(candidate_src, mask_dict: dict):
+    """
+    Rasterizes the mask layers once into a bit label raster on the candidate grid (bit 0: exclusion masks,
+    bit n: nth inclusion mask).
+
+    Returns the label array and the stats modes as [stats key, include label bit,
+    (row_start, row_stop, col_start, col_stop)], starting with total_area.
+    """
+
+    height, width = candidate_src.height, candidate_src.width
+    transform = candidate_src.transform
+
+    include_layers = [
+        poly_layer for poly_layer in mask_dict if mask_dict[poly_layer]['operation'] == 'include'
+    ]
+    label_dtype = np.uint8 if len(include_layers) < 8 else np.uint32
+    labels = np.zeros((height, width), dtype=label_dtype)
+
+    exclusion_geoms = []
+    for poly_layer in mask_dict:
+        if mask_dict[poly_layer]['operation'] == 'exclude':
+            buffer_val = 0 if mask_dict[poly_layer]['buffer'] is None else mask_dict[poly_layer]['buffer']
+            exclusion_geoms += _read_mask_geometries(
+                mask_dict[poly_layer]['path'], buffer_val, candidate_src.bounds, candidate_src.crs
+            )
+    if exclusion_geoms:
+        labels[
+            geometry_mask(exclusion_geoms, out_shape=(height, width), transform=transform, invert=True)
+        ] = 1
+
+    total_area_window = _mask_data_window((labels & 1) == 0) if exclusion_geoms else (0, height, 0, width)
+    if total_area_window is None:
+        raise ValueError(f'All of {candidate_src.name} is masked by the exclusion masks')
+    stats_modes = [['total_area', 0, total_area_window]]
+
+    # The inclusion masks are clipped from the exclusion masked (and cropped) agreement map
+    row_start, row_stop, col_start, col_stop = total_area_window
+    for layer_bit, poly_layer in enumerate(include_layers, start=1):
+        buffer_val = 0 if mask_dict[poly_layer]['buffer'] is None else mask_dict[poly_layer]['buffer']
+        include_geoms = _read_mask_geometries(
+            mask_dict[poly_layer]['path'],
+            buffer_val,
+            rasterio.windows.bounds(
+                rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start),
+                transform,
+            ),
+            candidate_src.crs,
+        )
+        if not include_geoms:
+            continue
+
+        include_mask = geometry_mask(
+            include_geoms, out_shape=(height, width), transform=transform, invert=True
+        )
+        labels[include_mask] |= label_dtype(1 << layer_bit)
+        include_window = _mask_data_window(
+            include_mask[row_start:row_stop, col_start:col_stop], row_start, col_start
+        )
+        del include_mask
+        if include_window is None:
+            continue
+
+        stats_modes.append([poly_layer + '_b' + str(buffer_val) + 'm', 1 << layer_bit, include_window])
+
+    return labels, stats_modes
+
+
+def _encode_benchmark(benchmark: np.ndarray, benchmark_nodata) -> np.ndarray:
+    """
+    Encodes a benchmark block as uint8: 0 and 1 are kept, nodata --> 10 and any other value --> 255.
+    """
+
+    encoded = np.full(benchmark.shape, 255, dtype=np.uint8)
+    encoded[benchmark == 0] = 0
+    encoded[benchmark == 1] = 1
+    if benchmark_nodata is not None:
+        encoded[benchmark == benchmark_nodata] = 10
+    return encoded
+
+
+def _write_cog(out_path: str, profile: dict, blocks, tags: dict = {}):
+    """
+    Writes (window, array) blocks (and tags) to a temporary tiled GeoTIFF and converts it to a COG at out_path.
+    The COG is moved in place at the end so that concurrent readers never see a partial file.
+    """
+
+    tmp_path = f'{out_path}.{os.getpid()}.tmp.tif'
+    profile = dict(profile, driver='GTiff', tiled=True, blockxsize=512, blockysize=512, compress='lzw')
+    profile['BIGTIFF'] = 'IF_SAFER'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        for window, array in blocks:
+            dst.write(array, 1, window=window)
+        dst.update_tags(**tags)
+    rasterio.shutil.copy(tmp_path, tmp_path + '.cog', driver='COG')
+    os.replace(tmp_path + '.cog', out_path)
+    os.remove(tmp_path)
+
+
+def _iter_block_windows(height: int, width: int, block_size: int):
+    for block_row in range(0, height, block_size):
+        for block_col in range(0, width, block_size):
+            yield rasterio.windows.Window(
+                block_col, block_row, min(block_size, width - block_col), min(block_size, height - block_row)
+            )
+
+
+def _get_benchmark_cache_paths(
+    benchmark_cache_dir: str, benchmark_raster_path: str, mask_dict: dict, candidate_src
+):
+    """
+    Returns the paths of the cached aligned benchmark raster and of the cached mask labels (raster and stats
+    modes json) for a benchmark raster and mask layers on the grid of candidate_src.
+
+    The cache is keyed by the candidate grid (crs, transform and shape) and by the path, size and
+    modification time of the benchmark and mask files, so that a changed input is prepared again.
+    """
+
+    def file_signature(file_path):
+        if file_path is None or not os.path.exists(file_path):
+            return file_path
+        file_stat = os.stat(file_path)
+        return [os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns]
+
+    def cache_key(*items):
+        return hashlib.sha256(
+            json.dumps([BENCHMARK_CACHE_VERSION, *items], default=str).encode()
+        ).hexdigest()[:16]
+
+    grid_key = cache_key(
+        candidate_src.crs.to_wkt(),
+        list(candidate_src.transform)[:6],
+        candidate_src.height,
+        candidate_src.width,
+    )
+    benchmark_key = cache_key(file_signature(benchmark_raster_path))
+    mask_key = cache_key(
+        [
+            [poly_layer, mask['operation'], mask['buffer'], file_signature(mask['path'])]
+            for poly_layer, mask in mask_dict.items()
+        ]
+    )
+
+    grid_dir = os.path.join(benchmark_cache_dir, grid_key)
+    os.makedirs(grid_dir, exist_ok=True)
+    return (
+        os.path.join(grid_dir, f'benchmark_{benchmark_key}.tif'),
+        os.path.join(grid_dir, f'masks_{mask_key}.tif'),
+        os.path.join(grid_dir, f'masks_{mask_key}.json'),
+    )
+
+
+def _use_benchmark_cache_file(cache_path: str) -> bool:
+    """
+    Returns whether a benchmark cache file exists, marking it as recently used (its modification time is the
+    last use that _trim_benchmark_cache goes by).
+    """
+
+    try:
+        os.utime(cache_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _trim_benchmark_cache(benchmark_cache_dir: str, keep_paths: list):
+    """
+    Removes the least recently used files of the benchmark cache until it is under BENCHMARK_CACHE_MAX_GB
+    (the files of the current evaluation, keep_paths, and files being written are never removed).
+    """
+
+    cache_files = []
+    for root, _, file_names in os.walk(benchmark_cache_dir):
+        for file_name in file_names:
+            cache_path = os.path.join(root, file_name)
+            if '.tmp' in file_name or cache_path in keep_paths:
+                continue
+            try:
+                file_stat = os.stat(cache_path)
+            except FileNotFoundError:
+                continue
+            cache_files.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+
+    cache_size = sum(size for _, size, _ in cache_files)
+    cache_size += sum(os.path.getsize(path) for path in keep_paths if os.path.exists(path))
+    max_size = BENCHMARK_CACHE_MAX_GB * 1024**3
+    for _, size, cache_path in sorted(cache_files):
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
 def get_stats_table_from_binary_rasters(
-    benchmark_raster_path: str, candidate_raster_path: str, agreement_raster: str = None, mask_dict: dict = {}
+    benchmark_raster_path: str,
+    candidate_raster_path: str,
+    agreement_raster: str = None,
+    mask_dict: dict = {},
+    block_size: int = 4096,
+    benchmark_cache_dir: str = None,
 ):
     """
     Produces categorical statistics table from 2 rasters and returns it. Also exports an agreement raster classified as:
@@ -405,6 +687,19 @@ def get_stats_table_from_binary_rasters(
         4: Masked
         10: Nodata
 
+    The rasters are evaluated block by block on the candidate grid (the benchmark is read through a nearest
+    neighbor warped view when it is not on the candidate grid), and the mask layers are rasterized once into a
+    compact bit label raster (bit 0: exclusion masks, bit n: nth inclusion mask). The contingency counts of
+    every stats mode are accumulated in the same pass, so memory use is bounded by the label raster and one
+    block.
+
+    If a benchmark cache directory is given, the benchmark snapped to the candidate grid (uint8 COG with the
+    nodata = 10 convention applied) and the mask label raster are saved there the first time and reused by
+    later evaluations on the same grid (e.g. other FIM versions of the same HUC), which then skip the
+    reprojection and the mask rasterization. The cache is kept under BENCHMARK_CACHE_MAX_GB (the
+    benchmark_cache_max_gb environment variable, 50 by default) by removing its least recently used files
+    after new files are written.
+
     Parameters
     ----------
     benchmark_raster_path: str
@@ -415,6 +710,10 @@ def get_stats_table_from_binary_rasters(
         Path to save agreement raster/s
     mask_dict : dict, default = {}
         Dictionary with inclusionary and/or exclusionary masks asn options.
+    block_size: int, default = 4096
+        Size (rows and columns) of the blocks that are evaluated at a time.
+    benchmark_cache_dir: str, default = None
+        Directory of the aligned benchmark and mask label cache. No cache is used if None.
 
     Returns
     -------
@@ -424,102 +723,222 @@ def get_stats_table_from_binary_rasters(
 
     """
 
-    # Load benchmark and candidate data
-    benchmark_raster = rxr.open_rasterio(benchmark_raster_path)
-    cell_area = np.abs(np.prod(benchmark_raster.rio.resolution()))
-    candidate_raster = rxr.open_rasterio(candidate_raster_path)
-    candidate_raster.data = xr.where(
-        (candidate_raster != candidate_raster.rio.nodata) & (candidate_raster >= 0), 1, candidate_raster
-    )
-    candidate_raster.data = xr.where(
-        (candidate_raster != candidate_raster.rio.nodata) & (candidate_raster < 0), 0, candidate_raster
-    )
-    candidate_raster.data = xr.where(candidate_raster == candidate_raster.rio.nodata, 10, candidate_raster)
-    candidate_raster = candidate_raster.rio.write_nodata(10)
-    benchmark_raster.data = xr.where(benchmark_raster == benchmark_raster.rio.nodata, 10, benchmark_raster)
-    benchmark_raster = benchmark_raster.rio.write_nodata(10)
-
-    pairing_dictionary = {
-        (0, 0): 0,
-        (0, 1): 1,
-        (0, 10): 10,
-        (1, 0): 2,
-        (1, 1): 3,
-        (1, 10): 10,
-        (4, 0): 4,
-        (4, 1): 4,
-        (4, 10): 10,
-        (10, 0): 10,
-        (10, 1): 10,
-        (10, 10): 10,
-    }
-
-    # Loop through exclusion masks and mask the agreement_array.
-    all_masks_df = None
-    if mask_dict != {}:
-        for poly_layer in mask_dict:
-            operation = mask_dict[poly_layer]['operation']
-
-            if operation == 'exclude':
-                poly_path = mask_dict[poly_layer]['path']
-                buffer_val = 0 if mask_dict[poly_layer]['buffer'] is None else mask_dict[poly_layer]['buffer']
+    with rasterio.open(candidate_raster_path) as candidate_src, ExitStack() as benchmark_stack:
+        height, width = candidate_src.height, candidate_src.width
+        transform = candidate_src.transform
+        candidate_nodata = candidate_src.nodata
 
-                # Read mask bounds with candidate boundary box
-                poly_all = gpd.read_file(poly_path, bbox=candidate_raster.rio.bounds())
-
-                # Make sure features are present in bounding box area before projecting.
-                # Continue to next layer if features are absent.
-                if poly_all.empty:
-                    del poly_all
-                    continue
-
-                # Project layer to reference crs.
-                poly_all_proj = poly_all.to_crs(candidate_raster.rio.crs)
-
-                # Buffer if buffer val exists
-                poly_all_proj = poly_all_proj.buffer(buffer_val) if buffer_val != 0 else poly_all_proj
+        cached_benchmark = cached_labels = cached_modes = None
+        cache_written = False
+        if benchmark_cache_dir is not None:
+            cached_benchmark, cached_labels, cached_modes = _get_benchmark_cache_paths(
+                benchmark_cache_dir, benchmark_raster_path, mask_dict, candidate_src
+            )
 
-                if all_masks_df is not None:
-                    all_masks_df = pd.concat([all_masks_df, poly_all_proj])
-                else:
-                    all_masks_df = poly_all_proj
+        if cached_benchmark is not None and _use_benchmark_cache_file(cached_benchmark):
+            benchmark_reader = benchmark_stack.enter_context(rasterio.open(cached_benchmark))
+            cell_area = float(benchmark_reader.tags()['cell_area'])
+        else:
+            benchmark_src = benchmark_stack.enter_context(rasterio.open(benchmark_raster_path))
+            cell_area = np.abs(np.prod(benchmark_src.res))
 
-                del poly_all, poly_all_proj
+            benchmark_bounds = rasterio.warp.transform_bounds(
+                benchmark_src.crs, candidate_src.crs, *benchmark_src.bounds
+            )
+            if not box(*candidate_src.bounds).intersects(box(*benchmark_bounds)):
+                raise ValueError(
+                    f'Benchmark raster {benchmark_raster_path} does not intersect {candidate_raster_path}'
+                )
 
-    stats_table_dictionary = {}  # Initialize empty dictionary.
+            # Read the benchmark through a nearest neighbor warped view of the candidate grid if not aligned
+            if (
+                benchmark_src.crs == candidate_src.crs
+                and benchmark_src.transform == transform
+                and benchmark_src.shape == candidate_src.shape
+            ):
+                benchmark_reader = benchmark_src
+            else:
+                benchmark_reader = benchmark_stack.enter_context(
+                    WarpedVRT(
+                        benchmark_src,
+                        crs=candidate_src.crs,
+                        transform=transform,
+                        width=width,
+                        height=height,
+                        resampling=Resampling.nearest,
+                        nodata=10 if benchmark_src.nodata is None else benchmark_src.nodata,
+                    )
+                )
 
-    c_aligned, b_aligned = candidate_raster.gval.homogenize(benchmark_raster, target_map="candidate")
-    del candidate_raster, benchmark_raster
+            if cached_benchmark is not None:
+                _write_cog(
+                    cached_benchmark,
+                    {
+                        'width': width,
+                        'height': height,
+                        'count': 1,
+                        'dtype': 'uint8',
+                        'crs': candidate_src.crs,
+                        'transform': transform,
+                        'nodata': 10,
+                    },
+                    (
+                        (
+                            window,
+                            _encode_benchmark(
+                                benchmark_reader.read(1, window=window), benchmark_reader.nodata
+                            ),
+                        )
+                        for window in _iter_block_windows(height, width, block_size)
+                    ),
+                    tags={'cell_area': repr(float(cell_area))},
+                )
+                cache_written = True
+                benchmark_reader = benchmark_stack.enter_context(rasterio.open(cached_benchmark))
+                cell_area = float(benchmark_reader.tags()['cell_area'])
+
+        benchmark_nodata = benchmark_reader.nodata
+
+        # Mask label raster and stats modes (from the cache if available)
+        if (
+            cached_labels is not None
+            and _use_benchmark_cache_file(cached_labels)
+            and _use_benchmark_cache_file(cached_modes)
+        ):
+            with rasterio.open(cached_labels) as labels_src:
+                labels = labels_src.read(1)
+            with open(cached_modes) as f:
+                stats_modes = [[key, bit, tuple(window)] for key, bit, window in json.load(f)]
+        else:
+            labels, stats_modes = _rasterize_mask_labels(candidate_src, mask_dict)
+            if cached_labels is not None:
+                _write_cog(
+                    cached_labels,
+                    {
+                        'width': width,
+                        'height': height,
+                        'count': 1,
+                        'dtype': labels.dtype.name,
+                        'crs': candidate_src.crs,
+                        'transform': transform,
+                    },
+                    [(rasterio.windows.Window(0, 0, width, height), labels)],
+                )
+                tmp_modes = f'{cached_modes}.{os.getpid()}.tmp'
+                with open(tmp_modes, 'w') as f:
+                    json.dump([[key, bit, [int(i) for i in window]] for key, bit, window in stats_modes], f)
+                os.replace(tmp_modes, cached_modes)
+                cache_written = True
+
+        if cache_written:
+            _trim_benchmark_cache(benchmark_cache_dir, [cached_benchmark, cached_labels, cached_modes])
+
+        # Stats modes: [stats key, include label bit, (row_start, row_stop, col_start, col_stop), output path]
+        stats_modes[0].append(agreement_raster)
+        for stats_mode in stats_modes[1:]:
+            layer_agreement_raster = None
+            if agreement_raster:
+                layer_agreement_raster = os.path.join(
+                    os.path.split(agreement_raster)[0], stats_mode[0] + '_agreement.tif'
+                )
+            stats_mode.append(layer_agreement_raster)
+
+        # Temporary tiled GeoTIFFs for the agreement rasters (converted to COG at the end)
+        agreement_writers = {}
+        for stats_key, _, (r0, r1, c0, c1), out_path in stats_modes:
+            if out_path:
+                profile = {
+                    'driver': 'GTiff',
+                    'width': c1 - c0,
+                    'height': r1 - r0,
+                    'count': 1,
+                    'dtype': 'int32',
+                    'crs': candidate_src.crs,
+                    'transform': rasterio.windows.transform(
+                        rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0), transform
+                    ),
+                    'nodata': 10,
+                    'tiled': True,
+                    'blockxsize': 512,
+                    'blockysize': 512,
+                    'compress': 'lzw',
+                    'BIGTIFF': 'IF_SAFER',
+                }
+                agreement_writers[stats_key] = rasterio.open(out_path + '.tmp.tif', 'w', **profile)
+
+        category_counts = {stats_key: np.zeros(256, dtype=np.int64) for stats_key, _, _, _ in stats_modes}
+
+        for block_window in _iter_block_windows(height, width, block_size):
+            block_row, block_col = block_window.row_off, block_window.col_off
+            candidate = candidate_src.read(1, window=block_window)
+            benchmark = benchmark_reader.read(1, window=block_window)
+
+            # Candidate: >= 0 --> 1 (wet), < 0 --> 0 (dry), nodata --> 10
+            candidate_class = np.where(candidate >= 0, 1, 0).astype(np.uint8)
+            if candidate_nodata is not None:
+                candidate_is_nodata = (
+                    np.isnan(candidate) if np.isnan(candidate_nodata) else candidate == candidate_nodata
+                )
+                candidate_class[candidate_is_nodata] = 10
+
+            # Agreement: 0 TN, 1 FN, 2 FP, 3 TP, 10 nodata (255 for benchmark values that are not 0/1)
+            agreement = np.full(candidate.shape, 255, dtype=np.uint8)
+            for benchmark_value in (0, 1):
+                is_value = benchmark == benchmark_value
+                agreement[is_value] = candidate_class[is_value] * 2 + benchmark_value
+            agreement[candidate_class == 10] = 10
+            if benchmark_nodata is not None:
+                agreement[benchmark == benchmark_nodata] = 10
+            del candidate, benchmark, candidate_class
+
+            block_labels = labels[
+                block_row : block_row + block_window.height, block_col : block_col + block_window.width
+            ]
+            is_excluded = (block_labels & 1) != 0
+            is_nodata = agreement == 10
+
+            for stats_key, include_bit, (r0, r1, c0, c1), _ in stats_modes:
+                # Intersection of the block with the stats mode window
+                br0, br1 = (
+                    max(r0, block_row) - block_row,
+                    min(r1, block_row + block_window.height) - block_row,
+                )
+                bc0, bc1 = (
+                    max(c0, block_col) - block_col,
+                    min(c1, block_col + block_window.width) - block_col,
+                )
+                if br0 >= br1 or bc0 >= bc1:
+                    continue
 
-    agreement_map = c_aligned.gval.compute_agreement_map(
-        b_aligned, comparison_function='pairing_dict', pairing_dict=pairing_dictionary
-    )
-    del c_aligned, b_aligned
-
-    agreement_map_og = agreement_map.copy()
-    agreement_map.rio.write_nodata(4, inplace=True)
-
-    # Mask if mask_dict is provided
-    if all_masks_df is not None:
-        agreement_map = agreement_map.rio.clip(all_masks_df['geometry'], invert=True)
-        agreement_map.data = xr.where(
-            agreement_map_og.sel({'x': agreement_map.coords['x'], 'y': agreement_map.coords['y']}) == 10,
-            10,
-            agreement_map,
-        )
+                is_masked = is_excluded[br0:br1, bc0:bc1]
+                if include_bit:
+                    is_masked = is_masked | ((block_labels[br0:br1, bc0:bc1] & include_bit) == 0)
+                mode_agreement = agreement[br0:br1, bc0:bc1].copy()
+                mode_agreement[is_masked & ~is_nodata[br0:br1, bc0:bc1]] = 4
+
+                category_counts[stats_key] += np.bincount(mode_agreement.ravel(), minlength=256)
+
+                if stats_key in agreement_writers:
+                    mode_agreement[mode_agreement == 255] = 10
+                    agreement_writers[stats_key].write(
+                        mode_agreement.astype(np.int32),
+                        1,
+                        window=rasterio.windows.Window(
+                            block_col + bc0 - c0, block_row + br0 - r0, bc1 - bc0, br1 - br0
+                        ),
+                    )
+                del mode_agreement
 
-    crosstab_table = agreement_map.gval.compute_crosstab()
+        del labels
 
-    metrics_table = crosstab_table.gval.compute_categorical_metrics(
-        positive_categories=[1], negative_categories=[0], metrics="all"
-    )
+    for stats_key, writer in agreement_writers.items():
+        writer.close()
+        out_path = [mode[3] for mode in stats_modes if mode[0] == stats_key][0]
+        rasterio.shutil.copy(out_path + '.tmp.tif', out_path, driver='COG')
+        os.remove(out_path + '.tmp.tif')
 
-    # Only write the agreement raster if user-specified.
+    # Only write the legend if the agreement raster is user-specified.
     if agreement_raster != None:
-        agreement_map_write = agreement_map.rio.write_nodata(10, encoded=True)
-        agreement_map_write.rio.to_raster(agreement_raster, dtype=np.int32, driver="COG")
-        del agreement_map_write
-
         # Write legend text file
         legend_txt = os.path.join(os.path.split(agreement_raster)[0], 'read_me.txt')
 
@@ -537,83 +956,25 @@ def get_stats_table_from_binary_rasters(
             )
             f.write("%s\n" % 'Results produced at: {current_time}'.format(current_time=current_time))
 
-    # Store summed pixel counts in dictionary.
-    stats_table_dictionary.update(
-        {
-            'total_area': cross_walk_gval_fim(
-                metric_df=metrics_table, cell_area=cell_area, masked_count=np.sum(agreement_map.data == 4)
-            )
-        }
-    )
-
-    del crosstab_table, metrics_table
-
-    # After agreement_array is masked with default mask layers, check for inclusion masks in mask_dict.
-    if mask_dict != {}:
-        for poly_layer in mask_dict:
-            operation = mask_dict[poly_layer]['operation']
-
-            if operation == 'include':
-                poly_path = mask_dict[poly_layer]['path']
-                buffer_val = 0 if mask_dict[poly_layer]['buffer'] is None else mask_dict[poly_layer]['buffer']
-
-                # Read mask bounds with candidate boundary box
-                poly_all = gpd.read_file(poly_path, bbox=agreement_map.rio.bounds())
-
-                # Make sure features are present in bounding box area before projecting.
-                # Continue to next layer if features are absent.
-                if poly_all.empty:
-                    del poly_all
-                    continue
-
-                poly_all_proj = poly_all.to_crs(agreement_map.rio.crs)
-
-                # Buffer if buffer val exists
-                poly_all_proj = poly_all_proj.buffer(buffer_val) if buffer_val != 0 else poly_all_proj
-
-                poly_handle = poly_layer + '_b' + str(buffer_val) + 'm'
-
-                # Do analysis on inclusion masked area
-                agreement_map_include = agreement_map.rio.clip(poly_all_proj['geometry'])
-                agreement_map_include.data = xr.where(
-                    agreement_map_og.sel(
-                        {'x': agreement_map_include.coords['x'], 'y': agreement_map_include.coords['y']}
-                    )
-                    == 10,
-                    10,
-                    agreement_map_include,
-                )
-
-                crosstab_table = agreement_map_include.gval.compute_crosstab()
-
-                metrics_table = crosstab_table.gval.compute_categorical_metrics(
-                    positive_categories=[1], negative_categories=[0], metrics="all"
-                )
-
-                if agreement_raster:
-                    # Write the layer_agreement_raster.
-                    layer_agreement_raster = os.path.join(
-                        os.path.split(agreement_raster)[0], poly_handle + '_agreement.tif'
-                    )
-                    agreement_map_write = agreement_map_include.rio.write_nodata(10, encoded=True)
-                    agreement_map_write.rio.to_raster(layer_agreement_raster, dtype=np.int32, driver="COG")
-                    del agreement_map_write
-
-                # Update stats table dictionary
-                stats_table_dictionary.update(
-                    {
-                        poly_handle: cross_walk_gval_fim(
-                            metric_df=metrics_table,
-                            cell_area=cell_area,
-                            masked_count=np.sum(agreement_map_include.data == 4),
-                        )
-                    }
-                )
-                del agreement_map_include
-
-                del poly_all, poly_all_proj, metrics_table, crosstab_table
-
-    del agreement_map
+    # Store summed pixel counts in dictionary (count keys in the same order as the gval crosstab).
+    count_keys = [
+        'false_negatives_count',
+        'false_positives_count',
+        'true_negatives_count',
+        'true_positives_count',
+    ]
+    stats_table_dictionary = {}
+    for stats_key, _, _, _ in stats_modes:
+        counts = category_counts[stats_key]
+        mode_stats = compute_stats_from_contingency_table(
+            int(counts[0]),
+            int(counts[1]),
+            int(counts[2]),
+            int(counts[3]),
+            cell_area=cell_area,
+            masked_count=int(counts[4]),
+        )
+        stats_table_dictionary[stats_key] = {**{key: mode_stats[key] for key in count_keys}, **mode_stats}
 
     return stats_table_dictionary
 
@@ -666,11 +1027,9 @@ def get_metadata(
     params['must_include'] = must_include
     params['upstream_trace_distance'] = upstream_trace_distance
     params['downstream_trace_distance'] = downstream_trace_distance
-    # Suppress Insecure Request Warning
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-    # Request data from url
-    response = requests.get(url, params=params, verify=False)
+    # Request data from url (through the shared WRDS client and its cache)
+    response = get_wrds_client().get(url, params=params)
     #    print(response)
     #    print(url)
     if response.ok:
@@ -987,18 +1346,8 @@ def get_thresholds(threshold_url, select_by, selector, threshold='all'):
     params['threshold'] = threshold
     url = f'{threshold_url}/{select_by}/{selector}'
 
-    # response = requests.get(url, params=params, verify=False)
-
-    # Call the API
-    session = requests.Session()
-
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-
-    response = session.get(url, params=params, verify=False)
+    # Call the API (through the shared WRDS client and its cache)
+    response = get_wrds_client().get(url, params=params)
 
     if response.status_code == 200:
         thresholds_json = response.json()
@@ -1042,10 +1391,29 @@ def get_thresholds(threshold_url, select_by, selector, threshold='all'):
                 flows['units'] = threshold_data.get('metadata').get('calc_flow_units')
         return stages, flows
     else:
-        print("WRDS response error: ")
+        print(f"WRDS response error: {response.status_code} {response.reason} ({response.url})")
+        return None, None
 
 
-#        print(response)
+def prefetch_thresholds(threshold_url, select_by, selectors, threshold='all'):
+    '''
+    Fetches the thresholds of many sites concurrently through the shared WRDS client, so the following
+    get_thresholds calls for those sites are answered from its cache.
+
+    Parameters
+    ----------
+    threshold_url : STR
+        WRDS threshold API.
+    select_by : STR
+        Type of site (nws_lid, usgs_site_code etc).
+    selectors : LIST
+        Sites to fetch thresholds for.
+    threshold : STR, optional
+        Threshold option. The default is 'all'.
+    '''
+    get_wrds_client().prefetch(
+        [(f'{threshold_url}/{select_by}/{selector}', {'threshold': threshold}) for selector in selectors]
+    )
 
 
 ########################################################################
@@ -1144,7 +1512,7 @@ def get_datum(metadata):
 def convert_latlon_datum(lat, lon, src_crs, dest_crs):
     '''
     Converts latitude and longitude datum from a source CRS to a dest CRS
-    using geopandas and returns the projected latitude and longitude coordinates.
+    using a cached pyproj Transformer and returns the projected latitude and longitude coordinates.
 
     Parameters
     ----------
@@ -1153,9 +1521,9 @@ def convert_latlon_datum(lat, lon, src_crs, dest_crs):
     lon : FLOAT
         Input Longitude.
     src_crs : STR
-        CRS associated with input lat/lon. Geopandas must recognize code.
+        CRS associated with input lat/lon. pyproj must recognize code.
     dest_crs : STR
-        Target CRS that lat/lon will be projected to. Geopandas must recognize code.
+        Target CRS that lat/lon will be projected to. pyproj must recognize code.
 
     Returns
     -------
@@ -1165,16 +1533,32 @@ def convert_latlon_datum(lat, lon, src_crs, dest_crs):
         Reprojected longitude coordinate in dest_crs.
 
     '''
+    new_lats, new_lons = convert_latlon_datums([lat], [lon], src_crs, dest_crs)
+    return new_lats[0], new_lons[0]
 
-    # Create a temporary DataFrame containing the input lat/lon.
-    temp_df = pd.DataFrame({'lat': [lat], 'lon': [lon]})
-    # Convert dataframe to a GeoDataFrame using the lat/lon coords. Input CRS is assigned.
-    temp_gdf = gpd.GeoDataFrame(temp_df, geometry=gpd.points_from_xy(temp_df.lon, temp_df.lat), crs=src_crs)
-    # Reproject GeoDataFrame to destination CRS.
-    reproject = temp_gdf.to_crs(dest_crs)
-    # Get new Lat/Lon coordinates from the geometry data.
-    new_lat, new_lon = [reproject.geometry.y.item(), reproject.geometry.x.item()]
-    return new_lat, new_lon
+
+def convert_latlon_datums(lats, lons, src_crs, dest_crs):
+    '''
+    Batch version of convert_latlon_datum: converts arrays of latitudes and longitudes from a source CRS
+    to a dest CRS in one call.
+
+    Returns
+    -------
+    new_lats, new_lons : NUMPY ARRAYS
+        Reprojected latitude and longitude coordinates in dest_crs.
+    '''
+    new_lons, new_lats = get_transformer(src_crs, dest_crs).transform(
+        np.asarray(lons, dtype=float), np.asarray(lats, dtype=float), errcheck=True
+    )
+    return np.atleast_1d(new_lats), np.atleast_1d(new_lons)
+
+
+def __latlons_to_nad27(lats, lons, crs):
+    # If crs is not NAD 27, convert crs to NAD27 and get adjusted lat lon
+    if crs != 'NAD27':
+        return convert_latlon_datums(lats, lons, crs, 'NAD27')
+    # Otherwise assume lat/lon is in NAD27.
+    return np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
 
 
 #######################################################################
@@ -1183,68 +1567,63 @@ def convert_latlon_datum(lat, lon, src_crs, dest_crs):
 def ngvd_to_navd_ft(datum_info, region='contiguous'):
     '''
     Given the lat/lon, retrieve the adjustment from NGVD29 to NAVD88 in feet.
-    Uses NOAA tidal API to get conversion factor. Requires that lat/lon is
-    in NAD27 crs. If input lat/lon are not NAD27 then these coords are
-    reprojected to NAD27 and the reproject coords are used to get adjustment.
+    Uses NOAA VDatum API (through the cache of the shared datum client) to get
+    conversion factor. Requires that lat/lon is in NAD27 crs. If input lat/lon
+    are not NAD27 then these coords are reprojected to NAD27 and the reproject
+    coords are used to get adjustment.
     There appears to be an issue when region is not in contiguous US.
 
     Parameters
     ----------
-    lat : FLOAT
-        Latitude.
-    lon : FLOAT
-        Longitude.
+    datum_info : DICT
+        Site datum information (lat, lon and crs), e.g. from get_datum.
+    region : STR, optional
+        VDatum region. The default is 'contiguous'.
 
     Returns
     -------
     datum_adj_ft : FLOAT
         Vertical adjustment in feet, from NGVD29 to NAVD88, and rounded to nearest hundredth.
+        None if unavailable.
 
     '''
-    # If crs is not NAD 27, convert crs to NAD27 and get adjusted lat lon
-    if datum_info['crs'] != 'NAD27':
-        lat, lon = convert_latlon_datum(datum_info['lat'], datum_info['lon'], datum_info['crs'], 'NAD27')
-    else:
-        # Otherwise assume lat/lon is in NAD27.
-        lat = datum_info['lat']
-        lon = datum_info['lon']
+    lats, lons = __latlons_to_nad27([datum_info['lat']], [datum_info['lon']], datum_info['crs'])
 
-    # Define url for datum API
-    datum_url = 'https://vdatum.noaa.gov/vdatumweb/api/convert'
+    adjustment = get_datum_client().get_ngvd_to_navd_m(lats[0], lons[0], region)
+    if adjustment is None:
+        return None
+    # convert meters to feet
+    return round(adjustment * 3.28084, 2)
 
-    # Define parameters. Hard code most parameters to convert NGVD to NAVD.
-    params = {}
-    params['lat'] = lat
-    params['lon'] = lon
-    params['region'] = region
-    params['s_h_frame'] = 'NAD27'  # Source CRS
-    params['s_v_frame'] = 'NGVD29'  # Source vertical coord datum
-    params['s_vertical_unit'] = 'm'  # Source vertical units
-    params['src_height'] = 0.0  # Source vertical height
-    params['t_v_frame'] = 'NAVD88'  # Target vertical datum
-    params['tar_vertical_unit'] = 'm'  # Target vertical height
-
-    # Suppress Insecure Request Warning
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-
-    # Call the API
-    session = requests.Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-
-    response = session.get(datum_url, params=params, verify=False)
-
-    # If successful get the navd adjustment
-    if response.status_code == 200:
-        results = response.json()
-        # Get adjustment in meters (NGVD29 to NAVD88)
-        adjustment = results['t_z']
-        # convert meters to feet
-        adjustment_ft = round(float(adjustment) * 3.28084, 2)
-    else:
-        adjustment_ft = None
-    return adjustment_ft
+
+def prefetch_ngvd_to_navd(datum_infos, region='contiguous'):
+    '''
+    Gets the NGVD29 to NAVD88 adjustments of many sites at once: their lat/lons are converted to NAD27 in
+    batches and the adjustments requested concurrently through the shared datum client, so the following
+    ngvd_to_navd_ft calls for those sites are answered from its cache.
+
+    Parameters
+    ----------
+    datum_infos : LIST
+        Site datum information (lat, lon and crs) dictionaries, e.g. from get_datum.
+    region : STR, optional
+        VDatum region. The default is 'contiguous'.
+    '''
+    # One batch conversion per source crs
+    sites_df = pd.DataFrame(
+        [(info['lat'], info['lon'], info['crs']) for info in datum_infos], columns=['lat', 'lon', 'crs']
+    )
+    nad27_lats, nad27_lons = [], []
+    for crs, crs_sites_df in sites_df.groupby('crs'):
+        try:
+            lats, lons = __latlons_to_nad27(crs_sites_df['lat'], crs_sites_df['lon'], crs)
+        except Exception:
+            # Sites with an invalid crs are left out, they get their error when used
+            continue
+        nad27_lats.extend(lats)
+        nad27_lons.extend(lons)
+
+    get_datum_client().prefetch(nad27_lats, nad27_lons, region)
 
 
 #######################################################################
@@ -1276,8 +1655,8 @@ def get_rating_curve(rating_curve_url, location_ids):
     joined_location_ids = '%2C'.join(location_ids)
     url = f'{rating_curve_url}/{joined_location_ids}'
 
-    # Call the API
-    response = requests.get(url, verify=False)
+    # Call the API (through the shared WRDS client and its cache)
+    response = get_wrds_client().get(url)
 
     # If successful
     if response.ok:
@@ -4,6 +4,8 @@ import os
 # Environmental variables and constants.
 TEST_CASES_DIR = r"/data/test_cases/"
 PREVIOUS_FIM_DIR = r"/data/previous_fim"
+# Benchmark rasters and mask layers snapped to the FIM grid of each HUC (reused by later evaluations)
+BENCHMARK_CACHE_DIR = os.getenv("benchmark_cache_dir", os.path.join(TEST_CASES_DIR, "benchmark_cache"))
 OUTPUTS_DIR = os.environ["outputsDir"]
 INPUTS_DIR = os.environ["inputsDir"]
 AHPS_BENCHMARK_CATEGORIES = ["usgs", "nws"]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+'''
+Shared client for the WRDS API (metadata, thresholds and rating curves) used by CatFIM and the AHPS tools.
+
+All requests of a process go through one pooled requests.Session (with retries), which forked processes
+build again. Responses are kept in memory and, when a cache directory is set, on disk as one JSON file per
+request (url + params). Cached responses are reused until they are older than the TTL, then revalidated
+with their ETag (if WRDS sent one) or fetched again.
+
+Configuration comes from the environment (e.g. the CatFIM .env file):
+    WRDS_CACHE_DIR       Directory of the on-disk response cache. No disk cache if not set.
+    WRDS_CACHE_TTL_HOURS Age (in hours) after which cached responses are revalidated. Defaults to 24.
+    WRDS_MODE            "live" (default): use the cache and the API as described above.
+                         "record": always call the API and save every response to the cache.
+                         "replay": only use the cache, the API is never called. Requests that are not
+                         in the cache return a 404 response. Used to rerun (or test) CatFIM offline
+                         from a cache recorded earlier.
+    WRDS_MAX_WORKERS     Number of concurrent requests made by prefetch. Defaults to 4.
+'''
+
+WRDS_MODES = ['live', 'record', 'replay']
+
+# Number of responses kept in memory per process
+MEMORY_CACHE_SIZE = 4096
+
+
+class WRDS_Response:
+    '''Minimal stand in for requests.Response, shared by live and cached responses.'''
+
+    def __init__(self, url, status_code, reason, headers, body):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.body
+
+
+class WRDS_Client:
+    def __init__(self, cache_dir=None, ttl_hours=24, mode='live', max_workers=4):
+        if mode not in WRDS_MODES:
+            raise ValueError(f'WRDS_MODE must be one of {WRDS_MODES}, not {mode}')
+        if mode != 'live' and not cache_dir:
+            raise ValueError(f'WRDS_MODE {mode} requires WRDS_CACHE_DIR to be set')
+
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_hours * 3600
+        self.mode = mode
+        self.max_workers = max_workers
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.memory_cache = OrderedDict()
+        self.memory_lock = Lock()
+
+        # Suppress Insecure Request Warning
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        self.session = requests.Session()
+        retry = Retry(connect=3, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __request_key(self, url, params):
+        params = {k: v for k, v in sorted((params or {}).items()) if v is not None}
+        return hashlib.sha256(json.dumps([url, params], default=str).encode()).hexdigest()
+
+    def __read_cache_file(self, key):
+        cache_path = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.isfile(cache_path):
+            return None
+        try:
+            with open(cache_path) as f:
+                return json.load(f)
+        except ValueError:
+            # A partially written entry is fetched again
+            return None
+
+    def __write_cache_file(self, key, entry):
+        cache_path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, cache_path)
+
+    def __remember(self, key, entry):
+        with self.memory_lock:
+            self.memory_cache[key] = entry
+            self.memory_cache.move_to_end(key)
+            while len(self.memory_cache) > MEMORY_CACHE_SIZE:
+                self.memory_cache.popitem(last=False)
+
+    def __fetch(self, url, params, cached_entry=None):
+        headers = {}
+        if cached_entry is not None and cached_entry['headers'].get('ETag'):
+            headers['If-None-Match'] = cached_entry['headers']['ETag']
+
+        response = self.session.get(url, params=params, headers=headers, verify=False)
+
+        if response.status_code == 304 and cached_entry is not None:
+            # Not modified, the cached response is good for another TTL
+            return dict(cached_entry, fetched=time.time())
+
+        try:
+            body = response.json() if response.ok else None
+        except ValueError:
+            body = None
+
+        return {
+            'url': response.url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': {k: response.headers[k] for k in ['Date', 'ETag'] if k in response.headers},
+            'body': body,
+            'fetched': time.time(),
+        }
+
+    def get(self, url, params=None):
+        '''
+        Returns the response (WRDS_Response) of a GET request, from the cache when possible (see module
+        notes). Only successful responses are cached.
+        '''
+        key = self.__request_key(url, params)
+
+        cached_entry = None
+        if self.mode != 'record':
+            with self.memory_lock:
+                cached_entry = self.memory_cache.get(key)
+            if cached_entry is None and self.cache_dir:
+                cached_entry = self.__read_cache_file(key)
+
+        if self.mode == 'replay':
+            if cached_entry is None:
+                return WRDS_Response(url, 404, 'Not in the WRDS replay store', {}, None)
+            entry = cached_entry
+        elif cached_entry is not None and time.time() - cached_entry['fetched'] < self.ttl_seconds:
+            entry = cached_entry
+        else:
+            entry = self.__fetch(url, params, cached_entry)
+            if entry['status_code'] == 200 and self.cache_dir:
+                self.__write_cache_file(key, entry)
+
+        if entry['status_code'] == 200:
+            self.__remember(key, entry)
+
+        return WRDS_Response(
+            entry['url'], entry['status_code'], entry['reason'], entry['headers'], entry['body']
+        )
+
+    def prefetch(self, requests_list):
+        '''
+        Fetches a list of (url, params) requests concurrently (WRDS_MAX_WORKERS at a time) so the later
+        calls for them (e.g. get_thresholds for each site of a HUC) are answered from the cache.
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            responses = executor.map(lambda request: self.get(*request), requests_list)
+            return list(responses)
+
+
+@functools.lru_cache(maxsize=4)
+def __get_client(cache_dir, ttl_hours, mode, max_workers):
+    return WRDS_Client(cache_dir, ttl_hours, mode, max_workers)
+
+
+# Forked processes (e.g. CatFIM workers) build their own client, so they never share the pooled
+# connections of the parent (a response could otherwise be read by another process)
+os.register_at_fork(after_in_child=__get_client.cache_clear)
+
+
+def get_wrds_client():
+    '''
+    Returns the WRDS client of this process, configured from the WRDS_* environment variables
+    (see module notes).
+    '''
+    return __get_client(
+        os.getenv('WRDS_CACHE_DIR') or None,
+        float(os.getenv('WRDS_CACHE_TTL_HOURS', 24)),
+        os.getenv('WRDS_MODE', 'live').lower(),
+        int(os.getenv('WRDS_MAX_WORKERS', 4)),
+    )